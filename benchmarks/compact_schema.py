@@ -0,0 +1,270 @@
+"""
+Compares probe insert throughput and space per probe of the text-keyed schema
+(version 4) with the compact encoding of integer references and enum codes
+(version 5).
+
+For each layout a database is filled with monitors and a task per probe, then
+probes are inserted in batches with the statement the storage records them
+with, and the space taken by the probes table and its indexes is measured.
+The text-keyed database is then migrated, and measured again.
+
+Usage:
+
+    python benchmarks/compact_schema.py [--probes 100000] [--monitors 100]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.core.task import TaskStatus
+from monico.storage.common import TASK_STATUS_CODES
+from monico.storage.sqlite import SqliteStorage
+
+TEXT_KEYS_VERSION = 4
+BATCH_SIZE = 1000
+
+
+def generate(storage, monitors: int, probes: int) -> [Probe]:
+    """Creates monitors, returns probes of tasks spread over them"""
+    ids = [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        ).id
+        for i in range(monitors)
+    ]
+    now = int(time.time())
+    result = []
+    for i in range(probes):
+        probe = Probe.create(ids[i % monitors], str(uuid.uuid4()), 0.1, 200, None, None)
+        probe.timestamp = now - probes + i
+        result.append(probe)
+    return result
+
+
+def batches(probes: [Probe]) -> [[Probe]]:
+    return [probes[i : i + BATCH_SIZE] for i in range(0, len(probes), BATCH_SIZE)]
+
+
+def report(backend: str, layout: str, probes: int, size: int, elapsed=None):
+    results = [f"{size / probes:6.1f} bytes/probe"]
+    if elapsed is not None:
+        results.insert(0, f"{probes / elapsed:9.1f} rows/s")
+    print(f"{backend}, {layout}: {', '.join(results)}")
+
+
+def sqlite_probes_size(storage: SqliteStorage) -> int:
+    """Bytes of pages of the probes table and its indexes"""
+    cur = storage.conn.execute(
+        """
+        SELECT SUM(pgsize) FROM dbstat WHERE name IN (
+            SELECT name FROM sqlite_master WHERE tbl_name = :probes
+        )
+        """,
+        {"probes": storage.tables.probes},
+    )
+    return cur.fetchone()[0]
+
+
+def sqlite_insert(storage: SqliteStorage, probes: [Probe], compact: bool) -> float:
+    """Inserts tasks and probes, returns seconds spent inserting probes"""
+    tasks = storage.tables.tasks
+    if compact:
+        task_sql = f"""
+            INSERT INTO {tasks} (id, timestamp, fk_monitor, status) VALUES
+                (?, ?, (SELECT seq FROM {storage.tables.monitors} WHERE id = ?), ?)
+        """
+        status = TASK_STATUS_CODES[TaskStatus.COMPLETED]
+        probe_sql = storage._insert_probe_sql
+        values = storage._probe_values
+    else:
+        task_sql = f"""
+            INSERT INTO {tasks} (id, timestamp, fk_monitor, status)
+            VALUES (?, ?, ?, ?)
+        """
+        status = TaskStatus.COMPLETED.value
+        probe_sql = f"""
+            INSERT INTO {storage.tables.probes} (
+                id, timestamp, fk_monitor, fk_task, response_time,
+                response_code, response_error, content_match
+            )
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """
+
+        def values(probe: Probe) -> tuple:
+            return (
+                probe.id,
+                probe.timestamp,
+                probe.monitor_id,
+                probe.task_id,
+                probe.response_time,
+                probe.response_code,
+                None,
+                probe.content_match,
+            )
+
+    storage.conn.executemany(
+        task_sql, [(p.task_id, p.timestamp, p.monitor_id, status) for p in probes]
+    )
+    storage.conn.commit()
+    started_at = time.perf_counter()
+    for batch in batches(probes):
+        storage.conn.executemany(probe_sql, [values(probe) for probe in batch])
+        storage.conn.commit()
+    return time.perf_counter() - started_at
+
+
+def benchmark_sqlite(monitors: int, count: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for compact in (False, True):
+            storage = SqliteStorage(
+                os.path.join(tmpdir, f"bench-{compact}.db"), prefix="bench"
+            )
+            storage.connect()
+            migrations = storage.migrations()
+            storage._apply_migrations(
+                migrations if compact else migrations[:TEXT_KEYS_VERSION]
+            )
+            probes = generate(storage, monitors, count)
+            elapsed = sqlite_insert(storage, probes, compact)
+            layout = "compact" if compact else "text keys"
+            version = storage.schema_version()
+            report(
+                "SQLite",
+                f"{layout:>9} (schema {version})",
+                count,
+                sqlite_probes_size(storage),
+                elapsed,
+            )
+            if not compact:
+                started_at = time.perf_counter()
+                storage.migrate()
+                elapsed = time.perf_counter() - started_at
+                report(
+                    "SQLite",
+                    f"migrated to schema {storage.schema_version()} in {elapsed:.2f}s",
+                    count,
+                    sqlite_probes_size(storage),
+                )
+            storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, monitors: int, count: int):
+    import psycopg2.extras
+    from monico.storage.pg import PgStorage
+
+    storage = PgStorage(uri, prefix="bench")
+    storage.connect()
+
+    def probes_size(cur) -> int:
+        cur.execute("SELECT pg_total_relation_size(%s)", (storage.tables.probes,))
+        return cur.fetchone()[0]
+
+    try:
+        for compact in (False, True):
+            storage.teardown()
+            migrations = storage.migrations()
+            storage._apply_migrations(
+                migrations if compact else migrations[:TEXT_KEYS_VERSION]
+            )
+            probes = generate(storage, monitors, count)
+            monitor_ref = "%s"
+            task_ref = "%s"
+            status = TaskStatus.COMPLETED.value
+            if compact:
+                monitor_ref = (
+                    f"(SELECT seq FROM {storage.tables.monitors} WHERE id = %s)"
+                )
+                task_ref = f"(SELECT seq FROM {storage.tables.tasks} WHERE id = %s)"
+                status = TASK_STATUS_CODES[TaskStatus.COMPLETED]
+            with storage.connection() as conn:
+                cur = conn.cursor()
+                psycopg2.extras.execute_values(
+                    cur,
+                    f"""
+                    INSERT INTO {storage.tables.tasks}
+                        (id, timestamp, fk_monitor, status)
+                    VALUES %s
+                    """,
+                    [(p.task_id, p.timestamp, p.monitor_id, status) for p in probes],
+                    template=f"(%s, %s, {monitor_ref}, %s)",
+                    page_size=BATCH_SIZE,
+                )
+                conn.commit()
+                started_at = time.perf_counter()
+                for batch in batches(probes):
+                    psycopg2.extras.execute_values(
+                        cur,
+                        f"""
+                        INSERT INTO {storage.tables.probes} (
+                            id, timestamp, fk_monitor, fk_task, response_time,
+                            response_code, response_error, content_match
+                        )
+                        VALUES %s
+                        """,
+                        [
+                            (
+                                p.id,
+                                p.timestamp,
+                                p.monitor_id,
+                                p.task_id,
+                                p.response_time,
+                                p.response_code,
+                                None,
+                                p.content_match,
+                            )
+                            for p in batch
+                        ],
+                        template=f"(%s, %s, {monitor_ref}, {task_ref}, %s, %s, %s, %s)",
+                        page_size=BATCH_SIZE,
+                    )
+                    conn.commit()
+                elapsed = time.perf_counter() - started_at
+                layout = "compact" if compact else "text keys"
+                report(
+                    "PostgreSQL",
+                    f"{layout:>9} (schema {storage.schema_version()})",
+                    count,
+                    probes_size(cur),
+                    elapsed,
+                )
+                conn.commit()
+                if not compact:
+                    started_at = time.perf_counter()
+                    storage.migrate()
+                    elapsed = time.perf_counter() - started_at
+                    report(
+                        "PostgreSQL",
+                        f"migrated to schema {storage.schema_version()} "
+                        f"in {elapsed:.2f}s",
+                        count,
+                        probes_size(cur),
+                    )
+                    conn.commit()
+                cur.close()
+    finally:
+        storage.teardown()
+        storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--probes", type=int, default=100000)
+    parser.add_argument("--monitors", type=int, default=100)
+    args = parser.parse_args()
+    benchmark_sqlite(args.monitors, args.probes)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.monitors, args.probes)
+
+
+if __name__ == "__main__":
+    main()
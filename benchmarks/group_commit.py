@@ -0,0 +1,97 @@
+"""
+Compares probe ingest on a single SQLite file with writes committed by each
+caller (direct) and by a single writer thread with group commit (grouped).
+
+Several threads record probes one at a time, like workers that flush after
+every probe. Direct writers compete for the write lock and commit on their
+own; grouped writes are queued for the writer thread, which commits the
+probes of all threads together. Failed writes, e.g. "database is locked"
+once the busy timeout runs out, are counted.
+
+Usage:
+
+    python benchmarks/group_commit.py [--probes 2000] [--threads 8]
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+MONITORS = 100
+
+
+def ingest(storage, ids: [str], probes: int, threads: int) -> (float, int):
+    """Records probes from the threads, returns elapsed seconds and errors"""
+    errors = 0
+    errors_lock = threading.Lock()
+
+    def record(offset: int):
+        nonlocal errors
+        futures = []
+        for i in range(offset, probes, threads):
+            probe = Probe.create(ids[i % len(ids)], None, 0.1, 200, None, None)
+            try:
+                futures.append(storage.record_probe(probe))
+            except Exception:
+                with errors_lock:
+                    errors += 1
+        for future in futures:
+            if future.exception() is not None:
+                with errors_lock:
+                    errors += 1
+
+    started_at = time.perf_counter()
+    workers = [threading.Thread(target=record, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    storage.flush()
+    return time.perf_counter() - started_at, errors
+
+
+def benchmark(probes: int, threads: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for profile in SqliteProfile:
+            for grouped in (False, True):
+                storage = SqliteStorage(
+                    os.path.join(tmpdir, f"bench-{profile.value}-{grouped}.db"),
+                    prefix="bench",
+                    profile=profile,
+                    group_commit=grouped,
+                )
+                storage.connect()
+                storage.setup()
+                ids = [
+                    storage.create_monitor(
+                        Monitor(None, f"monitor-{i}", f"https://example-{i}.com")
+                    ).id
+                    for i in range(MONITORS)
+                ]
+                elapsed, errors = ingest(storage, ids, probes, threads)
+                writes = "grouped" if grouped else "direct"
+                print(
+                    f"SQLite {profile.value:>7}, {writes:>7}: "
+                    f"{probes / elapsed:8.1f} probes/s, {errors} failed writes"
+                )
+                storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--probes", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    benchmark(args.probes, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Measures the task life cycle with storage kept in memory, as the reference
+for how fast scheduling can go without a database, next to SQLite.
+
+Every round the manager lists the monitors and issues a task for each, then
+the worker locks the tasks in batches and records their probes, which
+completes the tasks.
+
+Usage:
+
+    python benchmarks/memory_storage.py [--monitors 1000] [--rounds 10]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+from monico.core.manager import Manager
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.memory import InMemoryStorage
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+BATCH_SIZE = 10
+
+
+def run_rounds(storage, monitors: int, rounds: int) -> float:
+    """Runs the tasks of every monitor through their life cycle, returns tasks/s"""
+    for i in range(monitors):
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        )
+    manager = Manager(storage, logging.getLogger("bench"))
+    tasks = 0
+    started_at = time.perf_counter()
+    for _ in range(rounds):
+        for monitor in storage.list_monitors():
+            manager.issue_task(monitor)
+        while locked := storage.lock_tasks("bench", BATCH_SIZE):
+            storage.record_probes(
+                [Probe.create(t.monitor_id, t.id, 0.1, 200, None, None) for t in locked]
+            )
+            tasks += len(locked)
+    storage.flush()
+    return tasks / (time.perf_counter() - started_at)
+
+
+def report(backend: str, rate: float):
+    print(f"{backend:>10}: {rate:9.1f} tasks/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--monitors", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+
+    report("memory", run_rounds(InMemoryStorage(), args.monitors, args.rounds))
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        storage = SqliteStorage(
+            os.path.join(tmpdir, "bench.db"),
+            prefix="bench",
+            profile=SqliteProfile.TUNED,
+        )
+        storage.connect()
+        storage.setup()
+        report("SQLite", run_rounds(storage, args.monitors, args.rounds))
+        storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        from monico.storage.pg import PgStorage
+
+        storage = PgStorage(pg_uri, prefix="bench")
+        storage.connect()
+        storage.setup(force=True)
+        try:
+            report("PostgreSQL", run_rounds(storage, args.monitors, args.rounds))
+        finally:
+            storage.teardown()
+            storage.disconnect()
+
+
+if __name__ == "__main__":
+    main()
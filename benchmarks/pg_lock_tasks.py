@@ -0,0 +1,98 @@
+"""
+Measures task claiming throughput of PostgreSQL storage by worker count.
+
+A backlog of pending tasks is claimed by N worker threads, each with its own
+connection, calling lock_tasks until the backlog is empty. With SKIP LOCKED
+claiming the throughput should grow with the number of workers instead of
+flattening out on contention for the oldest rows.
+
+Usage:
+
+    MONICO_TEST_POSTGRES_URI=postgres://... \\
+        python benchmarks/pg_lock_tasks.py [--tasks 20000] [--batch-size 10]
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+from monico.core.monitor import Monitor
+from monico.core.task import TaskStatus
+from monico.storage.common import TASK_STATUS_CODES
+from monico.storage.pg import PgStorage
+
+WORKER_COUNTS = [1, 2, 4, 8]
+
+
+def build_storage(uri: str) -> PgStorage:
+    storage = PgStorage(uri, prefix="bench")
+    storage.connect()
+    return storage
+
+
+def fill(storage: PgStorage, tasks: int):
+    storage.setup(force=True)
+    monitor = storage.create_monitor(Monitor(None, "bench", "https://example.com"))
+    with storage.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            INSERT INTO {storage.tables.tasks} (id, timestamp, fk_monitor, status)
+            SELECT gen_random_uuid()::text, EXTRACT(EPOCH FROM NOW())::int + n, m.seq, %s
+            FROM generate_series(1, %s) n, {storage.tables.monitors} m
+            WHERE m.id = %s
+            """,
+            (TASK_STATUS_CODES[TaskStatus.PENDING], tasks, monitor.id),
+        )
+        conn.commit()
+        cur.close()
+
+
+def run(uri: str, workers: int, tasks: int, batch_size: int) -> (float, int):
+    claimed = [0] * workers
+    start = threading.Barrier(workers + 1)
+
+    def work(i: int):
+        storage = build_storage(uri)
+        start.wait()
+        while batch := storage.lock_tasks(f"worker-{i}", batch_size):
+            claimed[i] += len(batch)
+        storage.disconnect()
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.join()
+    return time.monotonic() - started_at, sum(claimed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tasks", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=10)
+    args = parser.parse_args()
+
+    uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if not uri:
+        sys.exit("Set MONICO_TEST_POSTGRES_URI to run this benchmark")
+
+    storage = build_storage(uri)
+    try:
+        for workers in WORKER_COUNTS:
+            fill(storage, args.tasks)
+            elapsed, claimed = run(uri, workers, args.tasks, args.batch_size)
+            assert claimed == args.tasks, f"claimed {claimed} of {args.tasks}"
+            print(
+                f"{workers} worker(s): {claimed} tasks in {elapsed:6.2f}s "
+                f"({claimed / elapsed:8.1f} tasks/s)"
+            )
+    finally:
+        storage.teardown()
+        storage.disconnect()
+
+
+if __name__ == "__main__":
+    main()
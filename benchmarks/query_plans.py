@@ -0,0 +1,185 @@
+"""
+Shows query plans and timings of the hot-path queries (lock_tasks and
+list_probes) without and with the indexes of the hot-path migration.
+
+A database is filled with completed tasks, a backlog of pending tasks and
+probes of many monitors. The hot-path indexes are replaced with the ones of
+the baseline schema, and the queries issued by the storage backend are
+captured, explained, and timed; then the indexes are restored and the same
+is done again.
+
+Usage:
+
+    python benchmarks/query_plans.py [--monitors 200] [--probes 500]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.core.task import TaskStatus
+from monico.storage.common import TASK_STATUS_CODES
+from monico.storage.sqlite import SqliteStorage
+
+PENDING_TASKS = 100
+ROUNDS = 20
+
+
+def fill(storage, monitors: int, probes_per_monitor: int) -> [str]:
+    """Fills the storage with test data, returns monitor IDs"""
+    ids = []
+    now = int(time.time())
+    for i in range(monitors):
+        monitor = storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        )
+        ids.append(monitor.id)
+        for j in range(probes_per_monitor):
+            task = monitor.create_task()
+            task.timestamp = now - (probes_per_monitor - j) * 60
+            task.status = TaskStatus.COMPLETED
+            storage.create_task(task)
+            probe = Probe.create(monitor.id, task.id, 0.1, 200, None, None)
+            probe.timestamp = task.timestamp
+            storage.record_probe(probe)
+    for i in range(PENDING_TASKS):
+        storage.create_task(
+            Monitor(ids[i % len(ids)], "m", "https://e.com").create_task()
+        )
+    return ids
+
+
+def hot_path_indexes(storage, enabled: bool) -> [str]:
+    """Statements adding the hot-path indexes, or reverting to the baseline ones"""
+    tasks, probes = storage.tables.tasks, storage.tables.probes
+    if not enabled:
+        return [
+            f"DROP INDEX {tasks}_pending_timestamp_idx",
+            f"DROP INDEX {probes}_fk_monitor_timestamp_idx",
+            f"CREATE INDEX {probes}_fk_monitor_idx ON {probes} (fk_monitor)",
+        ]
+    return [
+        f"CREATE INDEX {tasks}_pending_timestamp_idx ON {tasks} (timestamp) "
+        f"WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}",
+        f"CREATE INDEX {probes}_fk_monitor_timestamp_idx "
+        f"ON {probes} (fk_monitor, timestamp DESC)",
+        f"DROP INDEX {probes}_fk_monitor_idx",
+    ]
+
+
+def measure(storage, monitor_ids: [str], explain) -> None:
+    statements = []
+    storage.conn.set_trace_callback(statements.append)
+    started_at = time.perf_counter()
+    for i in range(ROUNDS):
+        storage.lock_tasks("bench", 1)
+        storage.list_probes(monitor_ids[i % len(monitor_ids)], limit=10)
+    elapsed = time.perf_counter() - started_at
+    storage.conn.set_trace_callback(None)
+
+    # first lock_tasks and first list_probes query
+    queries = [s for s in statements if s.lstrip().startswith(("UPDATE", "SELECT"))]
+    for statement in queries[:2]:
+        query = " ".join(statement.split())
+        print(f"  {query[:100]}...")
+        for line in explain(storage, statement):
+            print(f"    {line}")
+    print(f"  {ROUNDS} x (lock_tasks + list_probes): {elapsed * 1000:.1f}ms")
+
+
+def explain_sqlite(storage, statement: str) -> [str]:
+    cur = storage.conn.execute(f"EXPLAIN QUERY PLAN {statement}")
+    return [row[3] for row in cur.fetchall()]
+
+
+def benchmark_sqlite(monitors: int, probes: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        storage = SqliteStorage(os.path.join(tmpdir, "bench.db"), prefix="bench")
+        storage.connect()
+        storage.setup()
+        monitor_ids = fill(storage, monitors, probes)
+        for enabled in (False, True):
+            for statement in hot_path_indexes(storage, enabled):
+                storage.conn.execute(statement)
+            storage.conn.execute("ANALYZE")
+            print(f"SQLite, {'with' if enabled else 'without'} hot-path indexes:")
+            measure(storage, monitor_ids, explain_sqlite)
+        storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, monitors: int, probes: int):
+    import psycopg2.extensions
+    from monico.storage.pg import PgStorage
+
+    class TracingConnection(psycopg2.extensions.connection):
+        """Mimics sqlite3 trace callback for capturing executed statements"""
+
+        trace = None
+
+        def set_trace_callback(self, trace):
+            self.trace = trace
+
+        def cursor(self, *args, **kwargs):
+            conn = self
+
+            class TracingCursor(psycopg2.extensions.cursor):
+                def execute(self, query, vars=None):
+                    if conn.trace is not None:
+                        conn.trace(self.mogrify(query, vars).decode())
+                    return super().execute(query, vars)
+
+            return super().cursor(*args, cursor_factory=TracingCursor, **kwargs)
+
+    def explain_pg(storage, statement: str) -> [str]:
+        cur = storage.conn.cursor()
+        cur.execute(f"EXPLAIN {statement}")
+        plan = [row[0] for row in cur.fetchall()]
+        storage.conn.rollback()
+        return plan
+
+    storage = PgStorage(uri, prefix="bench", pool_max_size=1)
+    storage.pool.connect = lambda: psycopg2.connect(
+        uri, connection_factory=TracingConnection
+    )
+    storage.connect()
+    # storage methods reuse the connection checked out for the whole run
+    with storage.connection() as conn:
+        storage.conn = conn
+        try:
+            storage.setup(force=True)
+            monitor_ids = fill(storage, monitors, probes)
+            for enabled in (False, True):
+                cur = conn.cursor()
+                for statement in hot_path_indexes(storage, enabled):
+                    cur.execute(statement)
+                cur.execute("ANALYZE")
+                conn.commit()
+                print(
+                    f"PostgreSQL, {'with' if enabled else 'without'} hot-path indexes:"
+                )
+                measure(storage, monitor_ids, explain_pg)
+        finally:
+            storage.teardown()
+    storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--monitors", type=int, default=200)
+    parser.add_argument("--probes", type=int, default=500)
+    args = parser.parse_args()
+    benchmark_sqlite(args.monitors, args.probes)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.monitors, args.probes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares probe ingest into a single SQLite file with ingest into SQLite
+storage sharded across several files.
+
+Several threads record probes of random monitors one at a time, each in a
+transaction of its own. With a single file every commit waits for the one
+write lock; with shards, writes of monitors in different shards are committed
+in parallel. Writes failing with "database is locked" are counted.
+
+Usage:
+
+    python benchmarks/sharded_sqlite.py [--probes 4000] [--threads 8] [--shards 4]
+"""
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from monico.storage.sharded import ShardedSqliteStorage
+
+MONITORS = 100
+
+
+def ingest(storage, ids: [str], probes: int, threads: int) -> (float, int):
+    """Records probes from the threads, returns elapsed seconds and errors"""
+    errors = 0
+    errors_lock = threading.Lock()
+
+    def record(count: int):
+        nonlocal errors
+        for _ in range(count):
+            probe = Probe.create(random.choice(ids), None, 0.1, 200, None, None)
+            try:
+                storage.record_probe(probe)
+            except Exception:
+                with errors_lock:
+                    errors += 1
+
+    started_at = time.perf_counter()
+    workers = [
+        threading.Thread(target=record, args=(probes // threads,))
+        for _ in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    storage.flush()
+    return time.perf_counter() - started_at, errors
+
+
+def benchmark(probes: int, threads: int, shards: int):
+    for profile in SqliteProfile:
+        for shard_count in (1, shards):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                uri = f"{tmpdir}/bench.db"
+                if shard_count == 1:
+                    storage = SqliteStorage(uri, prefix="bench", profile=profile)
+                else:
+                    storage = ShardedSqliteStorage(
+                        uri, shard_count, prefix="bench", profile=profile
+                    )
+                storage.connect()
+                storage.setup()
+                ids = [
+                    storage.create_monitor(
+                        Monitor(None, f"monitor-{i}", f"https://example-{i}.com")
+                    ).id
+                    for i in range(MONITORS)
+                ]
+                elapsed, errors = ingest(storage, ids, probes, threads)
+                print(
+                    f"SQLite {profile.value:>7}, {shard_count} shard(s): "
+                    f"{probes / elapsed:8.1f} probes/s, {errors} failed writes"
+                )
+                storage.disconnect()
+            finally:
+                shutil.rmtree(tmpdir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--probes", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--shards", type=int, default=4)
+    args = parser.parse_args()
+    benchmark(args.probes, args.threads, args.shards)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Compares SQLite storage profiles under multi-process load.
+
+One process plays the manager (issues tasks), the others play workers
+(lock tasks and record probes), all sharing the same database file, which
+is how `monico run-manager` and `monico run-worker` are deployed. The same
+number of tasks is pushed through each profile and the elapsed time is
+measured.
+
+Usage:
+
+    python benchmarks/sqlite_profiles.py [--workers 4] [--tasks 2000]
+"""
+import os
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import multiprocessing
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+MONITORS = 100
+BATCH_SIZE = 10
+
+
+def build_storage(path: str, profile: SqliteProfile) -> SqliteStorage:
+    storage = SqliteStorage(path, prefix="bench", profile=profile)
+    storage.connect()
+    return storage
+
+
+def manager(path, profile, tasks, results):
+    storage = build_storage(path, profile)
+    monitors = storage.list_monitors()
+    issued = errors = 0
+    while issued < tasks:
+        try:
+            storage.create_task(monitors[issued % len(monitors)].create_task())
+            issued += 1
+        except sqlite3.OperationalError:
+            errors += 1
+    storage.disconnect()
+    results.put(errors)
+
+
+def worker(path, profile, tasks, recorded, worker_id, results):
+    storage = build_storage(path, profile)
+    errors = 0
+    while recorded.value < tasks:
+        try:
+            batch = storage.lock_tasks(worker_id, BATCH_SIZE)
+        except sqlite3.OperationalError:
+            errors += 1
+            continue
+        for task in batch:
+            probe = Probe.create(
+                monitor_id=task.monitor_id,
+                task_id=task.id,
+                response_time=0.1,
+                response_code=200,
+                response_error=None,
+                content_match=None,
+            )
+            try:
+                storage.record_probe(probe)
+                with recorded.get_lock():
+                    recorded.value += 1
+            except sqlite3.OperationalError:
+                errors += 1
+    storage.disconnect()
+    results.put(errors)
+
+
+def run(profile: SqliteProfile, workers: int, tasks: int):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, "bench.db")
+    try:
+        storage = build_storage(path, profile)
+        storage.setup()
+        for i in range(MONITORS):
+            storage.create_monitor(
+                Monitor(
+                    mid=None,
+                    name=f"monitor-{i}",
+                    endpoint=f"https://example-{i}.com",
+                    interval=5,
+                )
+            )
+        storage.disconnect()
+
+        results = multiprocessing.Queue()
+        recorded = multiprocessing.Value("i", 0)
+        processes = [
+            multiprocessing.Process(
+                target=manager, args=(path, profile, tasks, results)
+            )
+        ] + [
+            multiprocessing.Process(
+                target=worker,
+                args=(path, profile, tasks, recorded, f"worker-{i}", results),
+            )
+            for i in range(workers)
+        ]
+        started_at = time.monotonic()
+        for process in processes:
+            process.start()
+        errors = sum(results.get() for _ in processes)
+        for process in processes:
+            process.join()
+        elapsed = time.monotonic() - started_at
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print(
+        f"{profile.value:>8}: {tasks} tasks in {elapsed:6.2f}s "
+        f"({tasks / elapsed:8.1f} tasks/s), "
+        f"'database is locked' errors: {errors}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--tasks", type=int, default=2000)
+    args = parser.parse_args()
+    for profile in SqliteProfile:
+        run(profile, args.workers, args.tasks)
+
+
+if __name__ == "__main__":
+    main()
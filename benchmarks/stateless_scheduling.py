@@ -0,0 +1,163 @@
+"""
+Compares task-based and stateless scheduling: throughput of scheduling rounds
+and bytes written per probe.
+
+Every round all monitors become due. With tasks, the manager issues a task per
+monitor, workers lock the tasks, read their monitors and record probes, which
+complete the tasks. With stateless scheduling, workers claim due monitors and
+record probes. On SQLite the bytes the process writes to database, WAL and
+journal files are counted; on PostgreSQL the WAL generated by the server.
+Making monitors due between rounds is not counted.
+
+Usage:
+
+    python benchmarks/stateless_scheduling.py [--monitors 500] [--rounds 10]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+BATCH_SIZE = 10
+SCHEDULINGS = ["tasks", "stateless"]
+
+
+def create_monitors(storage, monitors: int):
+    for i in range(monitors):
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        )
+
+
+def age_monitors_sql(storage) -> str:
+    """Statement making all monitors due"""
+    return f"""
+        UPDATE {storage.tables.monitors}
+        SET last_task_at = last_task_at - interval
+        WHERE last_task_at IS NOT NULL
+    """
+
+
+def probe(task_id: str, monitor: Monitor) -> Probe:
+    return Probe.create(monitor.id, task_id, 0.1, 200, None, None)
+
+
+def run_round(storage, scheduling: str) -> int:
+    """Probes all due monitors once, returns the number of probes"""
+    probes = 0
+    if scheduling == "tasks":
+        now = int(time.time())
+        for monitor in storage.list_monitors():
+            if monitor.last_task_at is None or now - monitor.last_task_at >= 60:
+                storage.create_task(monitor.create_task())
+        while tasks := storage.lock_tasks("bench", BATCH_SIZE):
+            storage.record_probes(
+                [probe(t.id, storage.read_monitor(t.monitor_id)) for t in tasks]
+            )
+            probes += len(tasks)
+    else:
+        while monitors := storage.claim_monitors("bench", BATCH_SIZE):
+            storage.record_probes([probe(m.create_task().id, m) for m in monitors])
+            probes += len(monitors)
+    return probes
+
+
+def written_bytes() -> int:
+    """Bytes the process passed to write calls"""
+    with open("/proc/self/io") as f:
+        counters = dict(line.split(": ") for line in f.read().splitlines())
+    return int(counters["wchar"])
+
+
+def report(backend: str, scheduling: str, probes: int, elapsed: float, written: int):
+    print(
+        f"{backend}, {scheduling:>9}: {probes / elapsed:8.1f} probes/s, "
+        f"{written / probes:8.1f} bytes written/probe"
+    )
+
+
+def benchmark_sqlite(monitors: int, rounds: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for scheduling in SCHEDULINGS:
+            storage = SqliteStorage(
+                os.path.join(tmpdir, f"bench-{scheduling}.db"),
+                prefix="bench",
+                profile=SqliteProfile.TUNED,
+            )
+            storage.connect()
+            storage.setup()
+            create_monitors(storage, monitors)
+            probes, elapsed, written = 0, 0.0, 0
+            for _ in range(rounds):
+                storage.conn.execute(age_monitors_sql(storage))
+                storage.conn.commit()
+                storage.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                written_before = written_bytes()
+                started_at = time.perf_counter()
+                probes += run_round(storage, scheduling)
+                elapsed += time.perf_counter() - started_at
+                # written back to the database file eventually
+                storage.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                written += written_bytes() - written_before
+            report("SQLite", scheduling, probes, elapsed, written)
+            storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, monitors: int, rounds: int):
+    from monico.storage.pg import PgStorage
+
+    storage = PgStorage(uri, prefix="bench")
+    storage.connect()
+
+    def execute(sql: str, params: tuple = ()):
+        with storage.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            row = cur.fetchone() if cur.description else None
+            cur.close()
+            conn.commit()
+        return row
+
+    try:
+        for scheduling in SCHEDULINGS:
+            storage.setup(force=True)
+            create_monitors(storage, monitors)
+            probes, elapsed, written = 0, 0.0, 0
+            for _ in range(rounds):
+                execute(age_monitors_sql(storage))
+                [since] = execute("SELECT pg_current_wal_lsn()")
+                started_at = time.perf_counter()
+                probes += run_round(storage, scheduling)
+                elapsed += time.perf_counter() - started_at
+                [wal] = execute(
+                    "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (since,)
+                )
+                written += int(wal)
+            report("PostgreSQL", scheduling, probes, elapsed, written)
+    finally:
+        storage.teardown()
+        storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--monitors", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=10)
+    args = parser.parse_args()
+    benchmark_sqlite(args.monitors, args.rounds)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.monitors, args.rounds)
+
+
+if __name__ == "__main__":
+    main()
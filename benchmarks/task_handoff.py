@@ -0,0 +1,137 @@
+"""
+Compares tasks locked by a polling worker with tasks handed over to a worker
+in the same process: throughput of the task life cycle and bytes written per
+task.
+
+A polled task is created pending by the manager, locked by the worker and
+completed by recording its probe. A handed-over task is created already
+locked by the worker, then put on an in-memory queue, and completed by
+recording its probe. On SQLite the bytes the process writes to database, WAL
+and journal files are counted; on PostgreSQL the WAL generated by the server.
+
+Usage:
+
+    python benchmarks/task_handoff.py [--tasks 5000] [--monitors 100]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import shutil
+import asyncio
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+BATCH_SIZE = 10
+WORKER_ID = "bench"
+
+
+def run_tasks(storage, monitors: int, tasks: int, handoff: bool) -> float:
+    """Runs tasks through their life cycle, returns elapsed seconds"""
+    monitors = [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        )
+        for i in range(monitors)
+    ]
+    queue = asyncio.Queue()
+    started_at = time.perf_counter()
+    for i in range(0, tasks, BATCH_SIZE):
+        for j in range(i, min(i + BATCH_SIZE, tasks)):
+            task = monitors[j % len(monitors)].create_task()
+            if handoff:
+                task.lock(WORKER_ID)
+            storage.create_task(task)
+            if handoff:
+                queue.put_nowait(task)
+        if handoff:
+            batch = [queue.get_nowait() for _ in range(queue.qsize())]
+        else:
+            batch = storage.lock_tasks(WORKER_ID, BATCH_SIZE)
+        storage.record_probes(
+            [Probe.create(t.monitor_id, t.id, 0.1, 200, None, None) for t in batch]
+        )
+    return time.perf_counter() - started_at
+
+
+def written_bytes() -> int:
+    """Bytes the process passed to write calls"""
+    with open("/proc/self/io") as f:
+        counters = dict(line.split(": ") for line in f.read().splitlines())
+    return int(counters["wchar"])
+
+
+def report(backend: str, handoff: bool, tasks: int, elapsed: float, written: int):
+    mode = "handed over" if handoff else "polled"
+    print(
+        f"{backend}, {mode:>11}: {tasks / elapsed:8.1f} tasks/s, "
+        f"{written / tasks:8.1f} bytes written/task"
+    )
+
+
+def benchmark_sqlite(monitors: int, tasks: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for handoff in (False, True):
+            storage = SqliteStorage(
+                os.path.join(tmpdir, f"bench-{handoff}.db"),
+                prefix="bench",
+                profile=SqliteProfile.TUNED,
+            )
+            storage.connect()
+            storage.setup()
+            written_before = written_bytes()
+            elapsed = run_tasks(storage, monitors, tasks, handoff)
+            # written back to the database file eventually
+            storage.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            report("SQLite", handoff, tasks, elapsed, written_bytes() - written_before)
+            storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, monitors: int, tasks: int):
+    from monico.storage.pg import PgStorage
+
+    storage = PgStorage(uri, prefix="bench")
+    storage.connect()
+
+    def execute(sql: str, params: tuple = ()):
+        with storage.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            row = cur.fetchone()
+            cur.close()
+            conn.rollback()
+        return row[0]
+
+    try:
+        for handoff in (False, True):
+            storage.setup(force=True)
+            since = execute("SELECT pg_current_wal_lsn()")
+            elapsed = run_tasks(storage, monitors, tasks, handoff)
+            written = execute(
+                "SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (since,)
+            )
+            report("PostgreSQL", handoff, tasks, elapsed, int(written))
+    finally:
+        storage.teardown()
+        storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tasks", type=int, default=5000)
+    parser.add_argument("--monitors", type=int, default=100)
+    args = parser.parse_args()
+    benchmark_sqlite(args.monitors, args.tasks)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.monitors, args.tasks)
+
+
+if __name__ == "__main__":
+    main()
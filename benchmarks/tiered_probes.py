@@ -0,0 +1,115 @@
+"""
+Compares recording and reading recent probes on SQLite with tiered storage,
+which keeps recent probes of every monitor in memory in front of SQLite.
+
+Probes are recorded in batches, like workers do, and after every batch the
+latest probes of some monitors are listed, like circuit breakers and status
+checks do. Tiered storage serves the reads from memory and writes the probes
+to SQLite in the background; recording is timed as callers see it, plus
+the final flush.
+
+Usage:
+
+    python benchmarks/tiered_probes.py [--monitors 100] [--batches 500] [--reads 10]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from monico.storage.tiered import TieredStorage
+
+BATCH_SIZE = 10
+PROBES_LISTED = 10
+
+
+def run(storage, monitors: int, batches: int, reads: int) -> (float, float):
+    """Records batches of probes and reads probes, returns probes/s and reads/s"""
+    ids = [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        ).id
+        for i in range(monitors)
+    ]
+    write_time = read_time = 0.0
+    for _ in range(batches):
+        started_at = time.perf_counter()
+        storage.record_probes(
+            [
+                Probe.create(random.choice(ids), None, 0.1, 200, None, None)
+                for _ in range(BATCH_SIZE)
+            ]
+        )
+        write_time += time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        for _ in range(reads):
+            storage.list_probes(random.choice(ids), limit=PROBES_LISTED)
+        read_time += time.perf_counter() - started_at
+
+    started_at = time.perf_counter()
+    storage.flush()
+    write_time += time.perf_counter() - started_at
+    return batches * BATCH_SIZE / write_time, batches * reads / read_time
+
+
+def report(backend: str, storage, rates: (float, float)):
+    hit_rate = storage.metrics().get("cache_hit_rate")
+    print(
+        f"{backend:>18}: {rates[0]:9.1f} probes/s recorded, "
+        f"{rates[1]:9.1f} reads/s"
+        + (f", hit rate {hit_rate:.1%}" if hit_rate is not None else "")
+    )
+
+
+def benchmark(build, name: str, args):
+    for tiered in (False, True):
+        storage = build()
+        if tiered:
+            storage = TieredStorage(storage, probes_per_monitor=PROBES_LISTED)
+        storage.connect()
+        storage.setup(force=True)
+        try:
+            rates = run(storage, args.monitors, args.batches, args.reads)
+            report(f"{name}{' tiered' if tiered else ''}", storage, rates)
+        finally:
+            storage.teardown()
+            storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--monitors", type=int, default=100)
+    parser.add_argument("--batches", type=int, default=500)
+    parser.add_argument("--reads", type=int, default=10)
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        benchmark(
+            lambda: SqliteStorage(
+                os.path.join(tmpdir, "bench.db"),
+                prefix="bench",
+                profile=SqliteProfile.TUNED,
+            ),
+            "SQLite",
+            args,
+        )
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        from monico.storage.pg import PgStorage
+
+        benchmark(lambda: PgStorage(pg_uri, prefix="bench"), "PostgreSQL", args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+Compares random (version 4) and time-ordered (version 7) UUIDs as task and
+probe IDs: insert throughput and size of the ID indexes.
+
+For each kind of ID a fresh database is filled with a task per probe, then
+the probes are recorded in batches with record_probes. Random IDs land on
+random pages of the ID indexes, splitting them and missing the page cache;
+time-ordered IDs are appended to the last page.
+
+Usage:
+
+    python benchmarks/time_ordered_ids.py [--probes 200000] [--batch-size 1000]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+from monico.core.ids import uuid7
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.core.task import TaskStatus
+from monico.storage.common import TASK_STATUS_CODES
+from monico.storage.sqlite import SqliteStorage
+
+MONITORS = 100
+GENERATORS = [("uuid4", uuid.uuid4), ("uuid7", uuid7)]
+
+
+def generate(storage, probes: int, new_id) -> [Probe]:
+    """Creates monitors, returns probes of tasks spread over them"""
+    ids = [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        ).id
+        for i in range(MONITORS)
+    ]
+    now = int(time.time())
+    result = []
+    for i in range(probes):
+        probe = Probe.create(ids[i % MONITORS], str(new_id()), 0.1, 200, None, None)
+        probe.id = str(new_id())
+        probe.timestamp = now - probes + i
+        result.append(probe)
+    return result
+
+
+def task_values(probes: [Probe]) -> [tuple]:
+    pending = TASK_STATUS_CODES[TaskStatus.PENDING]
+    return [(p.task_id, p.timestamp, p.monitor_id, pending) for p in probes]
+
+
+def record(storage, probes: [Probe], batch_size: int) -> float:
+    """Records probes in batches, returns elapsed seconds"""
+    started_at = time.perf_counter()
+    for i in range(0, len(probes), batch_size):
+        storage.record_probes(probes[i : i + batch_size])
+    return time.perf_counter() - started_at
+
+
+def report(backend: str, name: str, count: int, timings: dict, sizes: dict):
+    rates = ", ".join(f"{k} {count / v:8.1f} rows/s" for (k, v) in timings.items())
+    indexes = ", ".join(f"{k} {v / 1024 / 1024:6.2f} MiB" for (k, v) in sizes.items())
+    print(f"{backend}, {name}: {rates}; ID indexes: {indexes}")
+
+
+def benchmark_sqlite(count: int, batch_size: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, new_id in GENERATORS:
+            storage = SqliteStorage(os.path.join(tmpdir, f"{name}.db"), prefix="bench")
+            storage.connect()
+            storage.setup()
+            tables = storage.tables
+            probes = generate(storage, count, new_id)
+
+            started_at = time.perf_counter()
+            for i in range(0, count, batch_size):
+                storage.conn.executemany(
+                    f"""
+                    INSERT INTO {tables.tasks} (id, timestamp, fk_monitor, status)
+                    VALUES (?, ?, (SELECT seq FROM {tables.monitors} WHERE id = ?), ?)
+                    """,
+                    task_values(probes[i : i + batch_size]),
+                )
+                storage.conn.commit()
+            timings = {"tasks": time.perf_counter() - started_at}
+            timings["probes"] = record(storage, probes, batch_size)
+
+            sizes = {}
+            for table in (tables.tasks, tables.probes):
+                # the UNIQUE constraint on the ID column
+                cur = storage.conn.execute(
+                    "SELECT SUM(pgsize) FROM dbstat WHERE name = :name",
+                    {"name": f"sqlite_autoindex_{table}_1"},
+                )
+                sizes[table.split("_")[-1]] = cur.fetchone()[0]
+            report("SQLite", name, count, timings, sizes)
+            storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, count: int, batch_size: int):
+    import psycopg2.extras
+    from monico.storage.pg import PgStorage
+
+    storage = PgStorage(uri, prefix="bench")
+    storage.connect()
+    tables = storage.tables
+    try:
+        for name, new_id in GENERATORS:
+            storage.setup(force=True)
+            probes = generate(storage, count, new_id)
+            with storage.connection() as conn:
+                cur = conn.cursor()
+                started_at = time.perf_counter()
+                for i in range(0, count, batch_size):
+                    psycopg2.extras.execute_values(
+                        cur,
+                        f"""
+                        INSERT INTO {tables.tasks} (id, timestamp, fk_monitor, status)
+                        VALUES %s
+                        """,
+                        task_values(probes[i : i + batch_size]),
+                        template=f"(%s, %s, (SELECT seq FROM {tables.monitors} "
+                        "WHERE id = %s), %s)",
+                        page_size=batch_size,
+                    )
+                    conn.commit()
+                timings = {"tasks": time.perf_counter() - started_at}
+                timings["probes"] = record(storage, probes, batch_size)
+
+                sizes = {}
+                for table in (tables.tasks, tables.probes):
+                    cur.execute("SELECT pg_relation_size(%s)", (f"{table}_pkey",))
+                    sizes[table.split("_")[-1]] = cur.fetchone()[0]
+                conn.commit()
+                cur.close()
+            report("PostgreSQL", name, count, timings, sizes)
+    finally:
+        storage.teardown()
+        storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--probes", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    benchmark_sqlite(args.probes, args.batch_size)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.probes, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+Compares durable and transient task queues: throughput of the task life cycle
+and bytes written per task.
+
+Every task goes through the states the manager and workers move it through:
+it is created pending, locked by a worker, and completed by recording its
+probe. On SQLite the bytes the process writes to database, WAL and journal
+files are counted; on PostgreSQL the WAL generated by the server.
+
+Usage:
+
+    python benchmarks/transient_tasks.py [--tasks 5000] [--monitors 100]
+
+PostgreSQL is benchmarked too when MONICO_TEST_POSTGRES_URI is set.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+
+LOCK_BATCH_SIZE = 10
+
+
+def run_tasks(storage, monitors: int, tasks: int) -> float:
+    """Runs tasks through their life cycle, returns elapsed seconds"""
+    ids = [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        ).id
+        for i in range(monitors)
+    ]
+    started_at = time.perf_counter()
+    for i in range(0, tasks, LOCK_BATCH_SIZE):
+        for j in range(i, min(i + LOCK_BATCH_SIZE, tasks)):
+            monitor = storage.read_monitor(ids[j % monitors])
+            storage.create_task(monitor.create_task())
+        for task in storage.lock_tasks("bench", LOCK_BATCH_SIZE):
+            probe = Probe.create(task.monitor_id, task.id, 0.1, 200, None, None)
+            storage.record_probe(probe)
+    return time.perf_counter() - started_at
+
+
+def written_bytes() -> int:
+    """Bytes the process passed to write calls"""
+    with open("/proc/self/io") as f:
+        counters = dict(line.split(": ") for line in f.read().splitlines())
+    return int(counters["wchar"])
+
+
+def report(backend: str, queue: str, tasks: int, elapsed: float, written: int):
+    print(
+        f"{backend}, {queue:>9}: {tasks / elapsed:8.1f} tasks/s, "
+        f"{written / tasks:8.1f} bytes written/task"
+    )
+
+
+def benchmark_sqlite(monitors: int, tasks: int):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for transient in (False, True):
+            storage = SqliteStorage(
+                os.path.join(tmpdir, f"bench-{transient}.db"),
+                prefix="bench",
+                profile=SqliteProfile.TUNED,
+                transient_tasks=transient,
+            )
+            storage.connect()
+            storage.setup()
+            written_before = written_bytes()
+            elapsed = run_tasks(storage, monitors, tasks)
+            # written back to the database file eventually
+            storage.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            written = written_bytes() - written_before
+            queue = "transient" if transient else "durable"
+            report("SQLite", queue, tasks, elapsed, written)
+            storage.disconnect()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def benchmark_pg(uri: str, monitors: int, tasks: int):
+    from monico.storage.pg import PgStorage
+
+    def wal_position() -> str:
+        with storage.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_current_wal_lsn()")
+            lsn = cur.fetchone()[0]
+            cur.close()
+            conn.rollback()
+        return lsn
+
+    def wal_bytes(since: str) -> int:
+        with storage.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)", (since,))
+            written = int(cur.fetchone()[0])
+            cur.close()
+            conn.rollback()
+        return written
+
+    for transient in (False, True):
+        storage = PgStorage(uri, prefix="bench", transient_tasks=transient)
+        storage.connect()
+        try:
+            storage.setup(force=True)
+            since = wal_position()
+            elapsed = run_tasks(storage, monitors, tasks)
+            queue = "transient" if transient else "durable"
+            report("PostgreSQL", queue, tasks, elapsed, wal_bytes(since))
+        finally:
+            storage.teardown()
+            storage.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--tasks", type=int, default=5000)
+    parser.add_argument("--monitors", type=int, default=100)
+    args = parser.parse_args()
+    benchmark_sqlite(args.monitors, args.tasks)
+    pg_uri = os.environ.get("MONICO_TEST_POSTGRES_URI")
+    if pg_uri:
+        benchmark_pg(pg_uri, args.monitors, args.tasks)
+
+
+if __name__ == "__main__":
+    main()
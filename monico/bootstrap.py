@@ -3,11 +3,14 @@ import logging
 from monico.core.app import App
 from monico.core.storage import StorageInterface
 from monico.config import ConfigurationError
-from monico.storage.sqlite import SqliteStorage
-from monico.config import Config, ConfigLoader
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from monico.storage.sharded import ShardedSqliteStorage
+from monico.storage.memory import InMemoryStorage
+from monico.storage.tiered import TieredStorage
+from monico.config import Config, ConfigLoader, parse_duration
 
 try:
-    from monico.storage.pg import PgStorage
+    from monico.storage.pg import PgStorage, ProbePartitioning
 
     postgres_support = True
 except ImportError:
@@ -26,8 +29,12 @@ class AppContext:
     """Context manager for monico app."""
 
     @staticmethod
-    def create():
-        return AppContext(build_default_app(postgres_support))
+    def create(check_schema: bool = True):
+        """
+        Creates the context of the app. Commands that set up or migrate the
+        storage skip the check that its schema is up to date.
+        """
+        return AppContext(build_default_app(postgres_support, check_schema))
 
     def __init__(self, app: App):
         self.app = app
@@ -39,21 +46,47 @@ class AppContext:
         self.app.shutdown()
 
 
+def build_sqlite_storage(
+    uri: str, config: Config, **kwargs
+) -> SqliteStorage | ShardedSqliteStorage:
+    """Builds SQLite storage, sharded if more than one shard is configured."""
+    kwargs.update(
+        profile=SqliteProfile(config.sqlite_profile.value),
+        transient_tasks=config.task_queue.value == "transient",
+        group_commit=config.sqlite_writes.value == "grouped",
+    )
+    shards = int(config.sqlite_shards.value)
+    if shards > 1:
+        return ShardedSqliteStorage(uri, shards, **kwargs)
+    return SqliteStorage(uri, **kwargs)
+
+
 def build_storage(
     config: Config, log: logging.Logger, postgres_support: bool
 ) -> StorageInterface:
     """Builds storage from config."""
-    if config.postgres_uri is None and config.sqlite_uri is None:
+    retention = {
+        name: parse_duration(value.value) if value is not None else None
+        for (name, value) in [
+            ("probe_retention", config.probe_retention),
+            ("task_retention", config.task_retention),
+        ]
+    }
+    transient_tasks = config.task_queue.value == "transient"
+    if config.memory_uri is not None:
+        log.debug(f"using memory storage: {config.memory_uri.value}")
+        storage = InMemoryStorage(config.memory_uri.value, **retention)
+    elif config.postgres_uri is None and config.sqlite_uri is None:
         default_db_location = os.path.expanduser("~/.monic/monico.db")
         default_sqlite_uri = f"sqlite://{default_db_location}"
         log.debug(
             "no storage backend specified, "
             f"using default sqlite: {default_sqlite_uri}"
         )
-        storage = SqliteStorage(default_sqlite_uri)
+        storage = build_sqlite_storage(default_sqlite_uri, config, **retention)
     elif config.sqlite_uri is not None:
         log.debug(f"using sqlite storage: {config.sqlite_uri.value}")
-        storage = SqliteStorage(config.sqlite_uri.value)
+        storage = build_sqlite_storage(config.sqlite_uri.value, config, **retention)
     elif config.postgres_uri is not None:
         if not postgres_support:
             raise ConfigurationError(
@@ -66,11 +99,25 @@ def build_storage(
                 # "https://monico.io/docs/installation/postgres.html"
             )
         log.debug(f"using postgres storage: {config.postgres_uri.value}")
-        storage = PgStorage(config.postgres_uri.value)
+        partitioning = config.postgres_probe_partitioning.value
+        storage = PgStorage(
+            config.postgres_uri.value,
+            pool_min_size=int(config.postgres_pool_min_size.value),
+            pool_max_size=int(config.postgres_pool_max_size.value),
+            probe_partitioning=(
+                ProbePartitioning(partitioning) if partitioning != "none" else None
+            ),
+            transient_tasks=transient_tasks,
+            **retention,
+        )
+    probe_cache = int(config.probe_cache.value)
+    if probe_cache > 0:
+        log.debug(f"keeping {probe_cache} recent probes of every monitor in memory")
+        storage = TieredStorage(storage, probes_per_monitor=probe_cache)
     return storage
 
 
-def build_default_app(postgres_support) -> App:
+def build_default_app(postgres_support, check_schema: bool = True) -> App:
     """Builds main monico app."""
     config = ConfigLoader().load()
     log = logging.getLogger("monico")
@@ -90,4 +137,6 @@ def build_default_app(postgres_support) -> App:
     log.debug(f"log level set to {config.log_level.value}")
 
     storage.connect()
-    return App(storage, log)
+    if check_schema:
+        storage.check_schema()
+    return App(storage, log, stateless=config.scheduling.value == "stateless")
@@ -1,5 +1,6 @@
 import click
 from monico.cli.setup import setup
+from monico.cli.migrate import migrate
 from monico.cli.create import create
 from monico.cli.list import list_monitors
 from monico.cli.status import status
@@ -16,6 +17,7 @@ def cli():
 
 
 cli.add_command(setup)
+cli.add_command(migrate)
 cli.add_command(create)
 cli.add_command(list_monitors)
 cli.add_command(status)
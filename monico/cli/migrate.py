@@ -0,0 +1,15 @@
+import click
+from monico.bootstrap import AppContext
+from monico.cli.utils import adapt_exceptions_for_cli
+
+
+@click.command()
+@adapt_exceptions_for_cli
+def migrate():
+    """Applies pending database schema migrations"""
+    with AppContext.create(check_schema=False) as app:
+        migrations = app.migrate()
+    for migration in migrations:
+        click.echo(f"Applied migration {migration.version}: {migration.description}")
+    if not migrations:
+        click.echo("Database schema is up to date")
@@ -1,13 +1,20 @@
 import click
 from typing import Optional
 from monico.bootstrap import AppContext
-from monico.cli.utils import adapt_exceptions_for_cli
+from monico.cli.utils import adapt_exceptions_for_cli, parse_affinity
+from monico.core.affinity import HostAffinity
 
 
 @click.command()
 @click.option("-w", "--worker-id", help="Worker ID", default=None, type=str)
+@click.option(
+    "--affinity",
+    help='Prefer tasks for hosts in this slot, e.g. "0/3" for the first of three workers',
+    default=None,
+    callback=parse_affinity,
+)
 @adapt_exceptions_for_cli
-def run(worker_id: Optional[str]):
+def run(worker_id: Optional[str], affinity: Optional[HostAffinity]):
     """Starts both manager and worker processes concurrently."""
     with AppContext.create() as app:
-        app.run(worker_id=worker_id)
+        app.run(worker_id=worker_id, affinity=affinity)
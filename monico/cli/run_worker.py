@@ -1,13 +1,20 @@
 import click
 from typing import Optional
 from monico.bootstrap import AppContext
-from monico.cli.utils import adapt_exceptions_for_cli
+from monico.cli.utils import adapt_exceptions_for_cli, parse_affinity
+from monico.core.affinity import HostAffinity
 
 
 @click.command()
 @click.option("--id", help="Worker ID", default=None, type=str)
+@click.option(
+    "--affinity",
+    help='Prefer tasks for hosts in this slot, e.g. "0/3" for the first of three workers',
+    default=None,
+    callback=parse_affinity,
+)
 @adapt_exceptions_for_cli
-def run_worker(id: Optional[str]):
+def run_worker(id: Optional[str], affinity: Optional[HostAffinity]):
     """Starts the worker process."""
     with AppContext.create() as app:
-        app.run_worker(worker_id=id)
+        app.run_worker(worker_id=id, affinity=affinity)
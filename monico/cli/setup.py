@@ -14,6 +14,6 @@ from monico.cli.utils import adapt_exceptions_for_cli
 @adapt_exceptions_for_cli
 def setup(force=False):
     """Initializes the database"""
-    with AppContext.create() as app:
+    with AppContext.create(check_schema=False) as app:
         app.setup(force=force)
     click.echo("Initialized the database")
@@ -10,6 +10,7 @@ from monico.utils import (
     timestamp_to_human_readable_string,
     seconds_to_human_readable_string,
 )
+from monico.core.breaker import CircuitBreaker, CircuitState
 from rich.live import Live
 
 
@@ -31,8 +32,28 @@ def monitor_header_table(monitor):
     return table
 
 
-def status_table(monitor, probes):
-    table = Table(show_header=True, header_style="bold magenta")
+def circuit_description(breaker: CircuitBreaker, now: int) -> str:
+    state = breaker.state_at(now)
+    if state is CircuitState.CLOSED:
+        return "closed"
+    opened = (
+        f"since {timestamp_to_human_readable_string(breaker.opened_at)} "
+        f"after {breaker.failures} consecutive failures"
+    )
+    if state is CircuitState.HALF_OPEN:
+        return f"half-open, open {opened}, trial probe is due"
+    return (
+        f"open {opened}, "
+        f"next probe at {timestamp_to_human_readable_string(breaker.retry_at)}"
+    )
+
+
+def status_table(monitor, probes, breaker):
+    table = Table(
+        show_header=True,
+        header_style="bold magenta",
+        caption=f"Circuit: {circuit_description(breaker, int(time.time()))}",
+    )
     table.add_column("Time")
     table.add_column("Response Time")
     table.add_column("Response Code", justify="right")
@@ -74,11 +95,12 @@ def status(id, live, number_of_probes):
 def status_static(app, monitor_id, number_of_probes):
     """Displays status of a monitor as a single static output"""
     monitor, probes = app.status(monitor_id, limit_probes=number_of_probes)
+    breaker = app.circuit_breaker(monitor_id)
     console = Console()
     console.print(monitor_header_table(monitor))
 
     console.print(f"\nLast {number_of_probes} probes:", style="bold")
-    console.print(status_table(monitor, probes))
+    console.print(status_table(monitor, probes, breaker))
 
 
 def status_live(app, monitor_id, number_of_probes):
@@ -87,11 +109,13 @@ def status_live(app, monitor_id, number_of_probes):
     console.print("Press Ctrl+C to exit\n")
 
     monitor, probes = app.status(monitor_id, limit_probes=number_of_probes)
+    breaker = app.circuit_breaker(monitor_id)
     console.print(monitor_header_table(monitor))
 
     console.print(f"\nLast {number_of_probes} probes:", style="bold")
-    with Live(status_table(monitor, probes)) as live:
+    with Live(status_table(monitor, probes, breaker)) as live:
         while True:
             monitor, probes = app.status(monitor_id, limit_probes=number_of_probes)
-            live.update(status_table(monitor, probes))
+            breaker = app.circuit_breaker(monitor_id)
+            live.update(status_table(monitor, probes, breaker))
             time.sleep(1)
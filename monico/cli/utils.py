@@ -6,6 +6,7 @@ from monico.core.storage import (
     MonitorNotFoundException,
     StorageConnectionException,
 )
+from monico.core.affinity import HostAffinity, AffinityError
 from monico.config import ConfigurationError
 
 
@@ -35,3 +36,13 @@ def adapt_exceptions_for_cli(func):
     wrapper.__name__ = func.__name__
     wrapper.__doc__ = func.__doc__
     return wrapper
+
+
+def parse_affinity(ctx, param, value):
+    """Click callback converting the --affinity option to HostAffinity"""
+    if value is None:
+        return None
+    try:
+        return HostAffinity.parse(value)
+    except AffinityError as e:
+        raise click.BadParameter(str(e))
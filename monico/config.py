@@ -1,5 +1,6 @@
 import os
 import toml
+from urllib.parse import urlparse
 from dataclasses import dataclass, field
 from typing import Optional, TypeVar, Generic
 
@@ -11,6 +12,23 @@ class ConfigurationError(Exception):
     pass
 
 
+# seconds per unit of durations like "30d"
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(value: str | int) -> int:
+    """
+    Parses a duration like "90s", "15m", "12h", "30d" or "2w" into seconds.
+    Plain numbers are seconds.
+    """
+    value = str(value).strip()
+    unit = DURATION_UNITS.get(value[-1:].lower())
+    number = value[:-1] if unit is not None else value
+    if not number.isdigit():
+        raise ValueError(f"Invalid duration: {value}")
+    return int(number) * (unit or 1)
+
+
 @dataclass
 class EnvironmentVariableConfigSource:
     name: str
@@ -43,7 +61,43 @@ class ConfigValue(Generic[T]):
 @dataclass
 class Config:
     sqlite_uri: Optional[ConfigValue[str]] = None
+    sqlite_profile: ConfigValue[str] = field(
+        default_factory=lambda: ConfigValue(
+            value="default", source=DefaultConfigSource()
+        )
+    )
+    sqlite_writes: ConfigValue[str] = field(
+        default_factory=lambda: ConfigValue(
+            value="direct", source=DefaultConfigSource()
+        )
+    )
+    sqlite_shards: ConfigValue[int] = field(
+        default_factory=lambda: ConfigValue(value=1, source=DefaultConfigSource())
+    )
     postgres_uri: Optional[ConfigValue[str]] = None
+    postgres_probe_partitioning: ConfigValue[str] = field(
+        default_factory=lambda: ConfigValue(value="none", source=DefaultConfigSource())
+    )
+    postgres_pool_min_size: ConfigValue[int] = field(
+        default_factory=lambda: ConfigValue(value=1, source=DefaultConfigSource())
+    )
+    postgres_pool_max_size: ConfigValue[int] = field(
+        default_factory=lambda: ConfigValue(value=10, source=DefaultConfigSource())
+    )
+    memory_uri: Optional[ConfigValue[str]] = None
+    probe_retention: Optional[ConfigValue[str]] = None
+    task_retention: Optional[ConfigValue[str]] = None
+    probe_cache: ConfigValue[int] = field(
+        default_factory=lambda: ConfigValue(value=0, source=DefaultConfigSource())
+    )
+    task_queue: ConfigValue[str] = field(
+        default_factory=lambda: ConfigValue(
+            value="durable", source=DefaultConfigSource()
+        )
+    )
+    scheduling: ConfigValue[str] = field(
+        default_factory=lambda: ConfigValue(value="tasks", source=DefaultConfigSource())
+    )
     log_level: ConfigValue[str] = field(
         default_factory=lambda: ConfigValue(
             value="WARNING", source=DefaultConfigSource()
@@ -70,6 +124,7 @@ class ConfigLoader:
     STORAGE_BACKEND_FIELD_NAMES = [
         "sqlite_uri",
         "postgres_uri",
+        "memory_uri",
     ]
 
     config: Config
@@ -82,6 +137,16 @@ class ConfigLoader:
         self.load_from_env()
         self.validate_single_storage_backend()
         self.validate_log_level()
+        self.validate_sqlite_profile()
+        self.validate_sqlite_writes()
+        self.validate_sqlite_shards()
+        self.validate_postgres_probe_partitioning()
+        self.validate_postgres_pool_size()
+        self.validate_memory_uri()
+        self.validate_retention()
+        self.validate_probe_cache()
+        self.validate_task_queue()
+        self.validate_scheduling()
         return self.config
 
     def validate_single_storage_backend(self):
@@ -110,6 +175,110 @@ class ConfigLoader:
                 f"Defined in: {self.config.log_level.source}"
             )
 
+    def validate_sqlite_profile(self):
+        valid_values = ["default", "tuned"]
+        if self.config.sqlite_profile.value not in valid_values:
+            raise ConfigurationError(
+                f"Invalid SQLite profile: {self.config.sqlite_profile.value}. "
+                f"Valid values are: {', '.join(valid_values)}.\n"
+                f"Defined in: {self.config.sqlite_profile.source}"
+            )
+
+    def validate_sqlite_writes(self):
+        valid_values = ["direct", "grouped"]
+        if self.config.sqlite_writes.value not in valid_values:
+            raise ConfigurationError(
+                f"Invalid SQLite writes: {self.config.sqlite_writes.value}. "
+                f"Valid values are: {', '.join(valid_values)}.\n"
+                f"Defined in: {self.config.sqlite_writes.source}"
+            )
+
+    def validate_sqlite_shards(self):
+        shards = self.config.sqlite_shards
+        if not str(shards.value).isdigit() or int(shards.value) < 1:
+            raise ConfigurationError(
+                f"Invalid number of SQLite shards: {shards.value}. "
+                "Expected a positive integer.\n"
+                f"Defined in: {shards.source}"
+            )
+
+    def validate_postgres_probe_partitioning(self):
+        valid_values = ["none", "day", "week"]
+        partitioning = self.config.postgres_probe_partitioning
+        if partitioning.value not in valid_values:
+            raise ConfigurationError(
+                f"Invalid PostgreSQL probe partitioning: {partitioning.value}. "
+                f"Valid values are: {', '.join(valid_values)}.\n"
+                f"Defined in: {partitioning.source}"
+            )
+
+    def validate_postgres_pool_size(self):
+        min_size = self.config.postgres_pool_min_size
+        max_size = self.config.postgres_pool_max_size
+        for size, minimum in [(min_size, 0), (max_size, 1)]:
+            if not str(size.value).isdigit() or int(size.value) < minimum:
+                raise ConfigurationError(
+                    f"Invalid PostgreSQL pool size: {size.value}. "
+                    f"Expected an integer of at least {minimum}.\n"
+                    f"Defined in: {size.source}"
+                )
+        if int(min_size.value) > int(max_size.value):
+            raise ConfigurationError(
+                f"Invalid PostgreSQL pool size: minimum {min_size.value} "
+                f"is larger than maximum {max_size.value}.\n"
+                f"Defined in: {min_size.source} and {max_size.source}"
+            )
+
+    def validate_memory_uri(self):
+        memory_uri = self.config.memory_uri
+        if memory_uri is not None and urlparse(memory_uri.value).scheme != "memory":
+            raise ConfigurationError(
+                f"Invalid memory storage URI: {memory_uri.value}. "
+                'Expected a URI like "memory://".\n'
+                f"Defined in: {memory_uri.source}"
+            )
+
+    def validate_retention(self):
+        for name in ["probe_retention", "task_retention"]:
+            retention = self.config.__getattribute__(name)
+            if retention is None:
+                continue
+            try:
+                parse_duration(retention.value)
+            except ValueError:
+                raise ConfigurationError(
+                    f"Invalid {name.replace('_', ' ')}: {retention.value}. "
+                    "Expected a duration like 30d, 12h, 15m or 90s.\n"
+                    f"Defined in: {retention.source}"
+                )
+
+    def validate_probe_cache(self):
+        probe_cache = self.config.probe_cache
+        if not str(probe_cache.value).isdigit():
+            raise ConfigurationError(
+                f"Invalid probe cache: {probe_cache.value}. "
+                "Expected a number of probes, 0 to disable the cache.\n"
+                f"Defined in: {probe_cache.source}"
+            )
+
+    def validate_task_queue(self):
+        valid_values = ["durable", "transient"]
+        if self.config.task_queue.value not in valid_values:
+            raise ConfigurationError(
+                f"Invalid task queue: {self.config.task_queue.value}. "
+                f"Valid values are: {', '.join(valid_values)}.\n"
+                f"Defined in: {self.config.task_queue.source}"
+            )
+
+    def validate_scheduling(self):
+        valid_values = ["tasks", "stateless"]
+        if self.config.scheduling.value not in valid_values:
+            raise ConfigurationError(
+                f"Invalid scheduling: {self.config.scheduling.value}. "
+                f"Valid values are: {', '.join(valid_values)}.\n"
+                f"Defined in: {self.config.scheduling.source}"
+            )
+
     def load_from_config_file(self):
         """Builds config from config file"""
         for location in self.CONFIG_FILE_LOCATIONS:
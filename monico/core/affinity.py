@@ -0,0 +1,81 @@
+"""
+Connection affinity between workers and endpoint hosts.
+
+Each endpoint host is hashed into one of `count` slots. A worker owning
+slot `index` prefers tasks for hosts in its slot, so that probes to the same
+host keep landing on the worker holding a warm keep-alive connection to it.
+"""
+import zlib
+from dataclasses import dataclass
+from monico.core.limits import endpoint_host
+
+
+class AffinityError(ValueError):
+    pass
+
+
+@dataclass(frozen=True)
+class HostAffinity:
+    index: int
+    count: int
+    # whether any task is taken when there are no tasks in the worker's slot
+    fallback: bool = True
+
+    # seconds a task can stay pending before a worker picks it up
+    # even if the task is not in its slot (e.g. the owning worker is down)
+    GRACE_PERIOD = 10
+
+    def __post_init__(self):
+        if self.count < 1:
+            raise AffinityError("Number of affinity slots must be at least 1")
+        if not 0 <= self.index < self.count:
+            raise AffinityError(
+                f"Affinity slot must be between 0 and {self.count - 1}, "
+                f"got {self.index}"
+            )
+
+    def __str__(self):
+        return f"{self.index}/{self.count}"
+
+    @classmethod
+    def parse(cls, value: str) -> "HostAffinity":
+        """Parses affinity from the "<index>/<count>" notation, e.g. "0/3" """
+        try:
+            index, count = (int(part) for part in value.split("/"))
+        except ValueError:
+            raise AffinityError(
+                f'Affinity must be in the "<index>/<count>" format, got "{value}"'
+            )
+        return cls(index, count)
+
+    @staticmethod
+    def slot(host: str, count: int) -> int:
+        """Maps the host to a slot; stable across processes and restarts"""
+        return zlib.crc32(host.encode()) % count
+
+    def matches(self, endpoint: str) -> bool:
+        return self.slot(endpoint_host(endpoint), self.count) == self.index
+
+    def scan_size(self, batch_size: int) -> int:
+        """Number of pending tasks to inspect to fill a batch with preferred tasks"""
+        return batch_size * self.count
+
+    def select(self, candidates: [(str, int, str)], batch_size: int, now: int):
+        """
+        Selects up to batch_size task IDs out of (id, timestamp, endpoint)
+        candidates ordered from oldest to newest. Only tasks in the worker's
+        slot and tasks that have waited longer than the grace period are taken,
+        unless there are no tasks in the worker's slot at all: then any pending
+        task is taken, if fallback is enabled.
+        """
+        if self.fallback and not any(
+            self.matches(endpoint) for (_, _, endpoint) in candidates
+        ):
+            return [tid for (tid, _, _) in candidates[:batch_size]]
+
+        selected = [
+            tid
+            for (tid, timestamp, endpoint) in candidates
+            if self.matches(endpoint) or now - timestamp > self.GRACE_PERIOD
+        ]
+        return selected[:batch_size]
@@ -3,14 +3,19 @@ This module contains the main application class.
 This class is responsible for managing the whole application execution,
 dependency injection, etc.
 """
+import time
+import signal
 import asyncio
 import logging
 from typing import Optional
 from monico.core.monitor import Monitor
-from monico.core.storage import StorageInterface
+from monico.core.storage import StorageInterface, StorageSetupException
 from monico.core.manager import Manager
-from monico.core.worker import Worker
+from monico.core.worker import Worker, StatelessWorker
 from monico.core.probe import Probe
+from monico.core.breaker import CircuitBreaker
+from monico.core.affinity import HostAffinity
+from monico.core.rollup import Rollup, plan_rollup_ranges
 
 
 class App:
@@ -21,15 +26,24 @@ class App:
 
     storage: StorageInterface
     log: logging.Logger
+    # whether workers claim due monitors instead of tasks issued by the manager
+    stateless: bool
 
-    def __init__(self, storage: StorageInterface, log: logging.Logger):
+    def __init__(
+        self, storage: StorageInterface, log: logging.Logger, stateless: bool = False
+    ):
         self.storage = storage
         self.log = log
+        self.stateless = stateless
 
     def setup(self, force=False):
         """Initializes the application"""
         self.storage.setup(force)
 
+    def migrate(self) -> list:
+        """Applies pending schema migrations, returns the applied ones"""
+        return self.storage.migrate()
+
     def connect(self):
         """Connects to the storage backend"""
         self.storage.connect()
@@ -40,6 +54,25 @@ class App:
         probes = self.storage.list_probes(mid, limit=limit_probes)
         return monitor, probes
 
+    def probe_stats(self, mid: str, since: int, until: Optional[int] = None) -> Rollup:
+        """
+        Aggregates probes of the monitor in the time range, e.g. for uptime
+        and latency. Reads rollups of the coarsest resolution that fits each
+        part of the range; the range is widened to whole rollup buckets.
+        """
+        now = int(time.time())
+        until = now if until is None else until
+        stats = Rollup(mid, until - since, since)
+        for resolution, start, end in plan_rollup_ranges(since, until, now):
+            for rollup in self.storage.list_rollups(mid, resolution, start, end):
+                stats.merge(rollup)
+        return stats
+
+    def circuit_breaker(self, mid: str) -> CircuitBreaker:
+        """Restores the state of the monitor's circuit breaker from its recent probes"""
+        probes = self.storage.list_probes(mid, limit=CircuitBreaker.history_size())
+        return CircuitBreaker.from_probes(probes)
+
     def create_monitor(
         self,
         mid: str,
@@ -60,22 +93,104 @@ class App:
         """Removes a monitor"""
         return self.storage.delete_monitor(mid)
 
-    def run_manager(self):
-        """Starts the manager process responsible for scheduling probes"""
+    def run_until_stopped(self, *components: Manager | Worker):
+        """
+        Runs the components until they finish. On SIGTERM or SIGINT the
+        components are asked to stop gracefully; a second signal terminates
+        the process right away.
+        """
         loop = asyncio.get_event_loop()
-        loop.run_until_complete(Manager(self.storage, self.log).run())
+        signals = (signal.SIGTERM, signal.SIGINT)
+
+        def stop(sig: signal.Signals):
+            self.log.warning(f"received {sig.name}, shutting down gracefully")
+            for s in signals:
+                loop.remove_signal_handler(s)
+            for component in components:
+                component.stop()
+
+        for sig in signals:
+            try:
+                loop.add_signal_handler(sig, stop, sig)
+            except (NotImplementedError, RuntimeError):
+                # not supported on this platform or outside of the main thread
+                pass
+        try:
+            loop.run_until_complete(
+                asyncio.gather(*[component.run() for component in components])
+            )
+        finally:
+            for sig in signals:
+                loop.remove_signal_handler(sig)
+
+    def manager(self, worker: Optional[Worker] = None) -> Manager:
+        """
+        Builds the manager. Tasks are handed to the worker running in the same
+        process through its queue, if it has one, as long as their hosts are
+        in the worker's affinity slot.
+        """
+        return Manager(
+            self.storage,
+            self.log,
+            issue_tasks=not self.stateless,
+            queue=worker.queue if worker is not None else None,
+            queue_worker_id=worker.worker_id if worker is not None else None,
+            queue_affinity=worker.affinity if worker is not None else None,
+        )
+
+    def worker(
+        self,
+        worker_id: Optional[str],
+        affinity: Optional[HostAffinity],
+        queue: Optional[asyncio.Queue] = None,
+    ) -> Worker:
+        if self.stateless:
+            return StatelessWorker(self.storage, self.log, worker_id, affinity)
+        return Worker(self.storage, self.log, worker_id, affinity, queue)
+
+    def require_shared_tasks(self):
+        """
+        Raises if the manager and workers can't run as separate processes,
+        because tasks are only kept in memory of the process issuing them.
+        """
+        if not self.stateless and self.storage.PROCESS_LOCAL_TASKS:
+            raise StorageSetupException(
+                "Tasks are kept in memory of the process, so workers of other "
+                "processes never see tasks issued by the manager. "
+                "Use `monico run` to run both in one process, or a durable "
+                'task queue (task_queue = "durable") shared by processes.'
+            )
+
+    def run_manager(self):
+        """
+        Starts the manager process responsible for scheduling probes.
+        With stateless scheduling it only maintains the storage.
+        """
+        self.require_shared_tasks()
+        self.run_until_stopped(self.manager())
 
-    def run_worker(self, worker_id: Optional[str] = None):
+    def run_worker(
+        self,
+        worker_id: Optional[str] = None,
+        affinity: Optional[HostAffinity] = None,
+    ):
         """Starts the worker process responsible for executing probes"""
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(Worker(self.storage, self.log, worker_id).run())
+        self.require_shared_tasks()
+        self.run_until_stopped(self.worker(worker_id, affinity))
 
-    def run(self, worker_id: Optional[str] = None):
-        """Starts both manager and worker processes concurrently."""
-        loop = asyncio.get_event_loop()
-        manager_task = loop.create_task(Manager(self.storage, self.log).run())
-        worker_task = loop.create_task(Worker(self.storage, self.log, worker_id).run())
-        loop.run_until_complete(asyncio.gather(manager_task, worker_task))
+    def run(
+        self,
+        worker_id: Optional[str] = None,
+        affinity: Optional[HostAffinity] = None,
+    ):
+        """
+        Starts both manager and worker processes concurrently. The manager
+        hands tasks to the worker through an in-memory queue.
+        """
+        worker = self.worker(
+            worker_id, affinity, asyncio.Queue(maxsize=Manager.QUEUE_SIZE)
+        )
+        self.run_until_stopped(self.manager(worker), worker)
 
     def shutdown(self):
         """Shuts down the application"""
@@ -0,0 +1,114 @@
+"""
+Circuit breaker for persistently failing endpoints.
+
+A monitor whose endpoint keeps failing with connection errors or timeouts
+holds worker slots for the whole request timeout on every probe. After
+FAILURE_THRESHOLD consecutive failures the circuit opens: probes are skipped
+until the retry time, then a single trial (half-open) probe is let through
+with the regular timeout. A successful trial closes the circuit, a failed one
+opens it again for twice as long (up to MAX_OPEN_DURATION).
+"""
+from enum import Enum
+from typing import Optional
+from monico.core.probe import Probe
+
+
+class CircuitState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+def is_failure(probe: Probe) -> bool:
+    """
+    Only connection errors and timeouts count as failures: an endpoint that
+    responds (with any status code) is cheap to probe.
+    """
+    return probe.response_error is not None
+
+
+class CircuitBreaker:
+    FAILURE_THRESHOLD = 5  # consecutive failures that open the circuit
+    OPEN_DURATION = 60  # seconds to wait before the first trial probe
+    MAX_OPEN_DURATION = 600  # upper bound for the wait between trial probes
+
+    state: CircuitState
+    failures: int
+    opened_at: Optional[int]
+    retry_at: Optional[int]
+    open_duration: int
+
+    def __init__(self):
+        self.close()
+
+    @classmethod
+    def history_size(cls) -> int:
+        """
+        Number of latest probes that restore the breaker state: the failures
+        that open the circuit, and the failed trials that back off up to
+        MAX_OPEN_DURATION.
+        """
+        trials, duration = 0, cls.OPEN_DURATION
+        while duration < cls.MAX_OPEN_DURATION:
+            duration *= 2
+            trials += 1
+        return cls.FAILURE_THRESHOLD + trials
+
+    @classmethod
+    def from_probes(cls, probes: [Probe]) -> "CircuitBreaker":
+        """Restores the breaker state by replaying a history of probes"""
+        breaker = cls()
+        for probe in sorted(probes, key=lambda p: p.timestamp):
+            breaker.record(probe, probe.timestamp)
+        return breaker
+
+    def close(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.retry_at = None
+        self.open_duration = self.OPEN_DURATION
+
+    def open(self, now: int, duration: int):
+        if self.opened_at is None:
+            self.opened_at = now
+        self.state = CircuitState.OPEN
+        self.open_duration = duration
+        self.retry_at = now + duration
+
+    def state_at(self, now: int) -> CircuitState:
+        """
+        State of the circuit at the time: an open circuit whose retry time
+        has passed lets a trial probe through, i.e. it is half-open.
+        """
+        if self.state is CircuitState.OPEN and now >= self.retry_at:
+            return CircuitState.HALF_OPEN
+        return self.state
+
+    def allow(self, now: int) -> bool:
+        """
+        Checks if a probe is allowed to run. When the retry time of an open
+        circuit has passed, the circuit becomes half-open and a single trial
+        probe is allowed until the next retry time.
+        """
+        if self.state is CircuitState.CLOSED:
+            return True
+        if now < self.retry_at:
+            return False
+        self.state = CircuitState.HALF_OPEN
+        # if the trial probe never reports back, allow another one later
+        self.retry_at = now + self.open_duration
+        return True
+
+    def record(self, probe: Probe, now: int):
+        """Updates the breaker state with the result of a probe"""
+        if not is_failure(probe):
+            self.close()
+            return
+
+        self.failures += 1
+        if self.state is not CircuitState.CLOSED:
+            # failed trial: back off further
+            self.open(now, min(self.open_duration * 2, self.MAX_OPEN_DURATION))
+        elif self.failures >= self.FAILURE_THRESHOLD:
+            self.open(now, self.OPEN_DURATION)
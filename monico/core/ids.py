@@ -0,0 +1,55 @@
+"""
+Time-ordered identifiers.
+
+IDs of tasks and probes are UUIDs version 7 (RFC 9562): they start with the
+creation time, so that new rows are appended at the right edge of primary key
+indexes instead of being scattered across them, like random UUIDs are.
+"""
+import time
+import uuid
+import secrets
+import threading
+
+_lock = threading.Lock()
+_last_ms = 0
+_counter = 0
+_COUNTER_MAX = 0xFFF  # 12 bits
+
+
+def uuid7() -> uuid.UUID:
+    """
+    Returns a UUID made of the Unix time in milliseconds, a 12-bit counter
+    ordering IDs generated by the process within the same millisecond, and
+    62 random bits from the OS, which, unlike the `random` module's state, are
+    not shared by forked processes.
+    """
+    global _last_ms, _counter
+    with _lock:
+        ms = time.time_ns() // 1_000_000
+        if ms > _last_ms:
+            _last_ms = ms
+            _counter = 0
+        else:
+            # same millisecond, or the clock went back: keep counting, so that
+            # IDs of the process stay ordered
+            _counter += 1
+            if _counter > _COUNTER_MAX:
+                _last_ms += 1
+                _counter = 0
+        ms, counter = _last_ms, _counter
+    value = (
+        (ms & 0xFFFFFFFFFFFF) << 80
+        | 0x7 << 76
+        | counter << 64
+        | 0b10 << 62
+        | secrets.randbits(62)
+    )
+    return uuid.UUID(int=value)
+
+
+def is_uuid7(value: str) -> bool:
+    """Whether the ID is a time-ordered UUID, e.g. generated by uuid7()"""
+    try:
+        return uuid.UUID(value).version == 7
+    except ValueError:
+        return False
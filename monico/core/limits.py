@@ -0,0 +1,122 @@
+"""
+Outbound request limits used by the worker.
+
+Probes are throttled in two ways: a per-host concurrency cap, so that many
+monitors on the same origin don't open dozens of simultaneous connections to
+it, and a global token bucket, which caps the total number of requests per
+second issued by the worker.
+"""
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import urlparse
+
+
+def endpoint_host(endpoint: str) -> str:
+    """Returns the host (including port, if any) the endpoint points to"""
+    return urlparse(endpoint).netloc
+
+
+class TokenBucket:
+    """
+    Token bucket limiting the rate of requests.
+    Waiting callers are served in FIFO order.
+    """
+
+    rate: float
+    capacity: float
+    tokens: float
+    updated_at: float
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        """Waits until a token is available and takes it"""
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+class HostLimiter:
+    """
+    Limits the number of concurrent requests per host.
+    Requests to a busy host are queued without blocking requests to other hosts.
+    """
+
+    max_concurrency: int
+
+    def __init__(self, max_concurrency: int):
+        if max_concurrency < 1:
+            raise ValueError("Concurrency limit must be at least 1")
+        self.max_concurrency = max_concurrency
+        # host -> semaphore; entries are removed once nobody uses them,
+        # so the dict only holds hosts with active or queued requests
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+        self.users: dict[str, int] = {}
+
+    @asynccontextmanager
+    async def acquire(self, host: str):
+        """Holds one of the host's concurrency slots for the duration of the block"""
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.max_concurrency)
+            self.users[host] = 0
+        semaphore = self.semaphores[host]
+        self.users[host] += 1
+        try:
+            async with semaphore:
+                yield
+        finally:
+            self.users[host] -= 1
+            if self.users[host] == 0:
+                del self.users[host]
+                del self.semaphores[host]
+
+
+class RequestLimiter:
+    """Combines per-host concurrency limit and global rate limit"""
+
+    hosts: Optional[HostLimiter]
+    bucket: Optional[TokenBucket]
+
+    def __init__(
+        self,
+        per_host_concurrency: Optional[int] = None,
+        rate_limit: Optional[float] = None,
+    ):
+        self.hosts = HostLimiter(per_host_concurrency) if per_host_concurrency else None
+        self.bucket = TokenBucket(rate_limit) if rate_limit else None
+
+    @asynccontextmanager
+    async def acquire(self, endpoint: str):
+        """
+        Waits until a request to the endpoint is allowed by both limits.
+        Host slot is taken first, so that requests queued behind a busy host
+        don't consume tokens of the global rate limit.
+        """
+        if self.hosts is None:
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            yield
+            return
+
+        async with self.hosts.acquire(endpoint_host(endpoint)):
+            if self.bucket is not None:
+                await self.bucket.acquire()
+            yield
@@ -1,28 +1,94 @@
 import time
 import asyncio
 import logging
+from typing import Optional
 from monico.core.storage import StorageInterface, MonitorSortingOrder
 from monico.core.monitor import Monitor
+from monico.core.affinity import HostAffinity
 
 
 class Manager:
     MIN_WAIT_TIME = 5  # seconds to wait between scheduling tasks
+    MAINTENANCE_INTERVAL = 600  # seconds between storage maintenance runs
+    # tasks waiting in the queue of the in-process worker at most; once it's
+    # full, tasks are stored pending, for any worker to lock
+    QUEUE_SIZE = 100
 
     storage: StorageInterface
     log: logging.Logger
+    # whether tasks are issued; with stateless scheduling workers claim due
+    # monitors themselves, and the manager only maintains the storage
+    issue_tasks: bool
+    # queue of the worker running in the same process, issued tasks are
+    # handed to it directly, stored as already locked by it
+    queue: Optional[asyncio.Queue]
+    queue_worker_id: Optional[str]
+    # affinity of that worker; tasks for hosts outside its slot are stored
+    # pending, for the worker owning the slot
+    queue_affinity: Optional[HostAffinity]
 
-    def __init__(self, storage: StorageInterface, log: logging.Logger):
+    stopping: asyncio.Event
+    maintained_at: Optional[float]
+    # storage maintenance running in the background
+    maintenance: Optional[asyncio.Future]
+
+    def __init__(
+        self,
+        storage: StorageInterface,
+        log: logging.Logger,
+        issue_tasks: bool = True,
+        queue: Optional[asyncio.Queue] = None,
+        queue_worker_id: Optional[str] = None,
+        queue_affinity: Optional[HostAffinity] = None,
+    ):
         self.storage = storage
         self.log = log
+        self.issue_tasks = issue_tasks
+        self.queue = queue
+        self.queue_worker_id = queue_worker_id
+        self.queue_affinity = queue_affinity
+        self.stopping = asyncio.Event()
+        self.maintained_at = None
+        self.maintenance = None
+
+    def stop(self):
+        """Asks the manager to stop scheduling tasks"""
+        self.log.info("manager is stopping")
+        self.stopping.set()
+
+    async def pause(self, seconds: float):
+        """Sleeps for the given number of seconds or until the manager is stopping"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def hands_over(self, monitor: Monitor) -> bool:
+        """Whether the task of the monitor goes to the in-process worker"""
+        if self.queue is None or self.queue.full():
+            return False
+        return self.queue_affinity is None or self.queue_affinity.matches(
+            monitor.endpoint
+        )
 
     def issue_task(self, monitor: Monitor):
         self.log.debug(f"issuing task for monitor {monitor.id}")
-        self.storage.create_task(monitor.create_task())
+        task = monitor.create_task()
+        if not self.hands_over(monitor):
+            self.storage.create_task(task)
+            return
+        # stored locked, so that it's only ever run by the in-process worker;
+        # that saves locking it, and the worker doesn't have to poll for it
+        task.lock(self.queue_worker_id)
+        self.storage.create_task(task)
+        self.queue.put_nowait(task)
 
     async def schedule(self):
         """
         Loops over all monitors and schedules a task if necessary.
         """
+        if not self.issue_tasks:
+            return
         now = int(time.time())
         monitors = self.storage.list_monitors(
             sort=MonitorSortingOrder.LAST_TASK_AT_DESC
@@ -52,17 +118,50 @@ class Manager:
                 f"interval of {monitor.interval} seconds: skipping."
             )
 
+    def start_maintenance(self):
+        """
+        Starts storage maintenance in the background, if MAINTENANCE_INTERVAL
+        has passed since the last run and it's not running already.
+        """
+        now = time.monotonic()
+        if self.maintenance is not None and not self.maintenance.done():
+            return
+        if (
+            self.maintained_at is not None
+            and now - self.maintained_at < self.MAINTENANCE_INTERVAL
+        ):
+            return
+        self.maintained_at = now
+        self.maintenance = asyncio.ensure_future(self.maintain())
+
+    async def maintain(self):
+        """Runs storage maintenance in a thread, so that it doesn't hold up scheduling"""
+        try:
+            stats = await asyncio.to_thread(self.storage.maintain)
+        except Exception as e:
+            self.log.error(f"manager failed to maintain storage: {e}")
+            return
+        if stats:
+            values = " ".join(f"{k}={v}" for (k, v) in stats.items())
+            self.log.info(f"storage maintenance; {values}")
+
     async def run(self):
-        self.log.info(f"manager has started")
+        self.log.info(f"manager has started; issue_tasks={self.issue_tasks}")
 
-        while True:
+        while not self.stopping.is_set():
+            pause = asyncio.ensure_future(self.pause(self.MIN_WAIT_TIME))
             try:
-                await asyncio.gather(
-                    asyncio.sleep(self.MIN_WAIT_TIME),
-                    self.schedule(),
-                )
+                await asyncio.gather(pause, self.schedule())
+                self.start_maintenance()
             except Exception as e:
+                pause.cancel()
                 self.log.error(f"manager encountered an unexpected exception: {e}")
             except asyncio.CancelledError:
                 self.log.info("manager process has been cancelled")
                 break
+
+        if self.maintenance is not None:
+            # a maintenance batch in progress can't be interrupted
+            await asyncio.wait([self.maintenance])
+        self.storage.flush()
+        self.log.info("manager has stopped")
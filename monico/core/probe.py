@@ -2,7 +2,7 @@ from dataclasses import dataclass
 from enum import Enum
 from typing import Optional
 import time
-import uuid
+from monico.core.ids import uuid7
 
 
 class ProbeResponseError(Enum):
@@ -20,6 +20,11 @@ class Probe:
     response_code: int
     response_error: str
     content_match: str
+    # time spent waiting on worker's outbound request limits;
+    # measured separately and not included in response_time
+    wait_time: Optional[float] = None
+    # time spent resolving the endpoint's hostname; included in response_time
+    dns_time: Optional[float] = None
 
     @staticmethod
     def create(
@@ -31,7 +36,7 @@ class Probe:
         content_match: Optional[str],
     ):
         return Probe(
-            id=str(uuid.uuid4()),
+            id=str(uuid7()),
             monitor_id=monitor_id,
             task_id=task_id,
             timestamp=int(time.time()),
@@ -0,0 +1,199 @@
+"""
+Worker-wide asynchronous DNS resolver.
+
+Hostnames are resolved with aiodns and cached for as long as their DNS
+records' TTL allows. Failed lookups are cached too (negative caching), so a
+broken domain doesn't cost a lookup on every probe. Hostnames of monitors
+that are about to be due can be resolved in the background ahead of time.
+"""
+import time
+import socket
+import asyncio
+import aiodns
+import aiohttp
+from dataclasses import dataclass
+from typing import Optional
+from aiohttp.abc import AbstractResolver
+
+
+@dataclass
+class CacheEntry:
+    addresses: [str]
+    family: int
+    expires_at: float
+    error: Optional[str] = None
+    from_hosts_file: bool = False
+
+
+class CachingResolver(AbstractResolver):
+    MIN_TTL = 5  # seconds; floor for records with very short TTL
+    MAX_TTL = 3600  # seconds; ceiling for records with very long TTL
+    HOSTS_TTL = 60  # seconds to cache entries resolved from the hosts file
+    NEGATIVE_TTL = 30  # seconds to cache failed lookups
+    # seconds to cache answers without records of a family, e.g. no AAAA records
+    # of IPv4-only hosts; longer than NEGATIVE_TTL so they don't double DNS traffic
+    NODATA_TTL = 600
+    # address families looked up for any address, IPv4 addresses first
+    FAMILIES = (socket.AF_INET, socket.AF_INET6)
+
+    dns: Optional[aiodns.DNSResolver]
+    cache: dict[(str, int), CacheEntry]
+
+    def __init__(self, dns: Optional[aiodns.DNSResolver] = None):
+        self.dns = dns
+        self.cache = {}
+        # lookups in progress; concurrent requests for the same host share them
+        self.lookups: dict[(str, int), asyncio.Future] = {}
+
+    def get_dns(self) -> aiodns.DNSResolver:
+        # created lazily, because aiodns binds to the running event loop
+        if self.dns is None:
+            self.dns = aiodns.DNSResolver()
+        return self.dns
+
+    async def resolve(
+        self, host: str, port: int = 0, family: int = socket.AF_INET
+    ) -> [dict]:
+        # AF_UNSPEC, which aiohttp asks for by default, means any address
+        if family == socket.AF_UNSPEC:
+            families = self.FAMILIES
+        else:
+            families = [
+                socket.AF_INET6 if family == socket.AF_INET6 else socket.AF_INET
+            ]
+        entries = await asyncio.gather(*[self.lookup(host, f) for f in families])
+        if not any(entry.addresses for entry in entries):
+            raise OSError(next(entry.error for entry in entries if entry.error))
+        return [
+            {
+                "hostname": host,
+                "host": address,
+                "port": port,
+                "family": entry.family,
+                "proto": 0,
+                "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+            }
+            for entry in entries
+            for address in entry.addresses
+        ]
+
+    async def lookup(self, host: str, family: int = socket.AF_INET) -> CacheEntry:
+        """Returns a cached entry for the host and family, resolving it if necessary"""
+        entry = self.cache.get((host, family))
+        if entry is not None and entry.expires_at > time.monotonic():
+            return entry
+        return await asyncio.shield(self.start_query(host, family))
+
+    def start_query(self, host: str, family: int) -> asyncio.Future:
+        key = (host, family)
+        if key not in self.lookups:
+            self.lookups[key] = asyncio.ensure_future(self.query(host, family))
+            self.lookups[key].add_done_callback(lambda _: self.lookups.pop(key))
+        return self.lookups[key]
+
+    async def query(self, host: str, family: int) -> CacheEntry:
+        """Queries DNS for the host and caches the result"""
+        now = time.monotonic()
+        try:
+            qtype = "AAAA" if family == socket.AF_INET6 else "A"
+            records = await self.get_dns().query(host, qtype)
+        except aiodns.error.DNSError as e:
+            no_data = bool(e.args) and e.args[0] == aiodns.error.ARES_ENODATA
+            if no_data or self.resolved_otherwise(host, family):
+                # the name is in DNS, so the hosts file won't have it either;
+                # hosts without addresses of this family are cached for longer
+                ttl = self.NODATA_TTL if no_data else self.NEGATIVE_TTL
+                entry = CacheEntry(
+                    addresses=[],
+                    family=family,
+                    expires_at=now + ttl,
+                    error=e.args[1] if len(e.args) > 1 else "DNS lookup failed",
+                )
+            else:
+                # names like "localhost" are not in DNS, but in the hosts file
+                entry = await self.query_hosts_file(host, family, now)
+        else:
+            ttl = min((record.ttl for record in records), default=0)
+            entry = CacheEntry(
+                addresses=[record.host for record in records],
+                family=family,
+                expires_at=now + max(self.MIN_TTL, min(ttl, self.MAX_TTL)),
+            )
+
+        if not entry.addresses and entry.error is None:
+            entry.error = "DNS lookup failed"
+            entry.expires_at = now + self.NEGATIVE_TTL
+        self.cache[(host, family)] = entry
+        return entry
+
+    def resolved_otherwise(self, host: str, family: int) -> bool:
+        """Whether DNS has valid addresses of the host in another family"""
+        now = time.monotonic()
+        for other in self.FAMILIES:
+            entry = self.cache.get((host, other))
+            if (
+                other != family
+                and entry is not None
+                and entry.addresses
+                and entry.expires_at > now
+                and not entry.from_hosts_file
+            ):
+                return True
+        return False
+
+    async def query_hosts_file(self, host: str, family: int, now: float):
+        try:
+            result = await self.get_dns().gethostbyname(host, family)
+            return CacheEntry(
+                addresses=result.addresses,
+                family=family,
+                expires_at=now + self.HOSTS_TTL,
+                from_hosts_file=True,
+            )
+        except aiodns.error.DNSError as e:
+            return CacheEntry(
+                addresses=[],
+                family=family,
+                expires_at=now + self.NEGATIVE_TTL,
+                error=e.args[1] if len(e.args) > 1 else "DNS lookup failed",
+            )
+
+    def prefetch(self, hosts: [str], within: float = 0):
+        """
+        Resolves IPv4 and IPv6 addresses of the hosts in the background
+        unless they are cached and their entries stay valid for at least
+        `within` seconds.
+        """
+        deadline = time.monotonic() + within
+        for host in set(hosts):
+            for family in self.FAMILIES:
+                entry = self.cache.get((host, family))
+                if entry is None or entry.expires_at <= deadline:
+                    self.start_query(host, family)
+
+    async def close(self):
+        for lookup in list(self.lookups.values()):
+            lookup.cancel()
+        if self.dns is not None:
+            self.dns.cancel()
+            self.dns = None
+
+
+def dns_timing_trace_config() -> aiohttp.TraceConfig:
+    """
+    Trace config measuring the time spent resolving hostnames of a request.
+    The time is added to the "dns_time" key of the request's trace context.
+    """
+
+    async def on_start(session, context, params):
+        context.dns_started_at = asyncio.get_event_loop().time()
+
+    async def on_end(session, context, params):
+        elapsed = asyncio.get_event_loop().time() - context.dns_started_at
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx["dns_time"] += elapsed
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_dns_resolvehost_start.append(on_start)
+    trace_config.on_dns_resolvehost_end.append(on_end)
+    return trace_config
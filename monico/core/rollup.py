@@ -0,0 +1,168 @@
+"""
+Per-monitor aggregates of probes over fixed time buckets.
+
+Rollups are kept at several resolutions and updated as probes are recorded,
+so that uptime and latency over long ranges are computed from a few rows per
+hour instead of from every probe.
+"""
+import bisect
+from dataclasses import dataclass, field
+from typing import Optional
+from monico.core.probe import Probe
+
+RESOLUTIONS = [60, 3600]  # bucket sizes in seconds, finest first
+# seconds rollups of a resolution are kept for; coarser ones are kept forever
+RETENTION = {60: 7 * 86400}
+# upper bounds in seconds of the latency histogram buckets; one more bucket
+# counts slower responses
+LATENCY_BUCKETS = [0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+def bucket_start(timestamp: int, resolution: int) -> int:
+    return timestamp - timestamp % resolution
+
+
+@dataclass
+class Rollup:
+    monitor_id: str
+    resolution: int
+    bucket: int  # start of the bucket
+    probes: int = 0
+    # probes that failed with a connection error or a timeout
+    errors: int = 0
+    status_2xx: int = 0
+    status_3xx: int = 0
+    status_4xx: int = 0
+    status_5xx: int = 0
+    # probes with a measured response time
+    latency_count: int = 0
+    latency_sum: float = 0.0
+    latency_min: Optional[float] = None
+    latency_max: Optional[float] = None
+    latency_histogram: [int] = field(
+        default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1)
+    )
+
+    def add(self, probe: Probe):
+        """Adds a probe to the aggregates"""
+        self.probes += 1
+        if probe.response_error is not None:
+            self.errors += 1
+        if probe.response_code is not None:
+            status_class = f"status_{probe.response_code // 100}xx"
+            if hasattr(self, status_class):
+                setattr(self, status_class, getattr(self, status_class) + 1)
+        if probe.response_time is not None:
+            self.add_latency(probe.response_time)
+
+    def add_latency(self, latency: float):
+        self.latency_count += 1
+        self.latency_sum += latency
+        if self.latency_min is None or latency < self.latency_min:
+            self.latency_min = latency
+        if self.latency_max is None or latency > self.latency_max:
+            self.latency_max = latency
+        self.latency_histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def merge(self, other: "Rollup"):
+        """Adds aggregates of another rollup, e.g. of an adjacent bucket"""
+        self.probes += other.probes
+        self.errors += other.errors
+        self.status_2xx += other.status_2xx
+        self.status_3xx += other.status_3xx
+        self.status_4xx += other.status_4xx
+        self.status_5xx += other.status_5xx
+        self.latency_count += other.latency_count
+        self.latency_sum += other.latency_sum
+        latencies_min = [
+            x for x in (self.latency_min, other.latency_min) if x is not None
+        ]
+        latencies_max = [
+            x for x in (self.latency_max, other.latency_max) if x is not None
+        ]
+        self.latency_min = min(latencies_min, default=None)
+        self.latency_max = max(latencies_max, default=None)
+        self.latency_histogram = [
+            a + b for (a, b) in zip(self.latency_histogram, other.latency_histogram)
+        ]
+
+    @property
+    def uptime(self) -> Optional[float]:
+        """Share of probes that got a response"""
+        if not self.probes:
+            return None
+        return 1 - self.errors / self.probes
+
+    @property
+    def latency_avg(self) -> Optional[float]:
+        if not self.latency_count:
+            return None
+        return self.latency_sum / self.latency_count
+
+    def latency_percentile(self, percentile: float) -> Optional[float]:
+        """
+        Estimates a latency percentile (0-100) as the upper bound of the
+        histogram bucket it falls into, capped by the maximum latency.
+        """
+        if not self.latency_count:
+            return None
+        rank = self.latency_count * percentile / 100
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.latency_histogram):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.latency_max)
+        return self.latency_max
+
+
+def rollup_probes(probes: [Probe]) -> [Rollup]:
+    """Aggregates probes into rollups of every resolution"""
+    rollups = {}
+    for probe in probes:
+        for resolution in RESOLUTIONS:
+            key = (
+                probe.monitor_id,
+                resolution,
+                bucket_start(probe.timestamp, resolution),
+            )
+            if key not in rollups:
+                rollups[key] = Rollup(*key)
+            rollups[key].add(probe)
+    # sorted, so that concurrent writers update rows in the same order
+    return [rollups[key] for key in sorted(rollups)]
+
+
+def plan_rollup_ranges(since: int, until: int, now: int) -> [(int, int, int)]:
+    """
+    Splits the time range into (resolution, start, end) ranges, each covered
+    by whole buckets of the coarsest resolution that fits. The range is
+    widened to whole buckets of the finest resolution still kept at its ends.
+    """
+    finest = RESOLUTIONS[0]
+    since = bucket_start(since, finest)
+    until = bucket_start(until + finest - 1, finest)
+    for finer, coarser in zip(RESOLUTIONS, RESOLUTIONS[1:]):
+        if finer not in RETENTION:
+            continue
+        if since < now - RETENTION[finer]:
+            since = bucket_start(since, coarser)
+        if until < now - RETENTION[finer]:
+            until = bucket_start(until + coarser - 1, coarser)
+
+    def split(start: int, end: int, resolutions: [int]) -> [(int, int, int)]:
+        if start >= end:
+            return []
+        resolution = resolutions[-1]
+        if len(resolutions) == 1:
+            return [(resolution, start, end)]
+        lower = bucket_start(start + resolution - 1, resolution)
+        upper = bucket_start(end, resolution)
+        if lower >= upper:
+            return split(start, end, resolutions[:-1])
+        return (
+            split(start, lower, resolutions[:-1])
+            + [(resolution, lower, upper)]
+            + split(upper, end, resolutions[:-1])
+        )
+
+    return split(since, until, RESOLUTIONS)
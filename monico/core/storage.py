@@ -1,10 +1,15 @@
 """
 Defines an abstract storage class for storing monico data.
 """
+import asyncio
 from enum import Enum
+from concurrent.futures import Future
+from typing import Optional
 from abc import ABC, abstractmethod
+from monico.core.affinity import HostAffinity
 from monico.core.monitor import Monitor
 from monico.core.probe import Probe
+from monico.core.rollup import Rollup
 from monico.core.task import Task
 
 
@@ -33,6 +38,17 @@ class MonitorNotFoundException(Exception):
     pass
 
 
+def wait_for_writes(result):
+    """
+    Waits for writes a backend runs in the background, e.g. with group commit,
+    and raises their error. Such backends return the future of the write,
+    or a list of futures, from write methods.
+    """
+    for future in result if isinstance(result, list) else [result]:
+        if isinstance(future, Future):
+            future.result()
+
+
 class MonitorSortingOrder(Enum):
     """Defines the sorting order for monitors"""
 
@@ -43,6 +59,12 @@ class MonitorSortingOrder(Enum):
 class StorageInterface(ABC):
     """Defines the interface for storage backends"""
 
+    # whether wait_for_tasks returns as soon as new tasks are issued
+    NOTIFIES_ABOUT_TASKS = False
+    # whether tasks are only kept in memory of the process, so that the
+    # manager and workers have to run in the same process
+    PROCESS_LOCAL_TASKS = False
+
     def connect(self):
         """Connects to the storage backend. Does nothing by default."""
         pass
@@ -55,10 +77,50 @@ class StorageInterface(ABC):
         """Sets up the storage backend, e.g. creates tables. Does nothing by default."""
         pass
 
+    def migrate(self) -> list:
+        """
+        Applies schema migrations missing from an already set up storage.
+        Returns the applied migrations. Does nothing by default.
+        """
+        return []
+
+    def check_schema(self):
+        """
+        Raises StorageSetupException if the storage was set up by an older
+        version of monico and has to be migrated before use. Does nothing
+        by default.
+        """
+        pass
+
     def teardown(self):
         """Tears down the storage backend, e.g. deletes tables. Does nothing by default."""
         pass
 
+    def flush(self):
+        """Writes out any buffered writes. Does nothing by default."""
+        pass
+
+    def maintain(self) -> dict:
+        """
+        Performs periodic housekeeping, e.g. enforces data retention.
+        Returns counters describing the work done. Does nothing by default.
+        """
+        return {}
+
+    def metrics(self) -> dict:
+        """Returns operational metrics of the backend, e.g. connection pool usage"""
+        return {}
+
+    async def wait_for_tasks(self, timeout: float):
+        """
+        Waits until new tasks may be available for locking, but no longer
+        than timeout seconds. Backends that can notify workers about issued
+        tasks return early; by default it just sleeps for the timeout.
+        Returns whether a notification about issued tasks ended the wait.
+        """
+        await asyncio.sleep(timeout)
+        return False
+
     @abstractmethod
     def create_monitor(self, monitor: Monitor) -> Monitor:
         """Creates a new monitor"""
@@ -87,8 +149,16 @@ class StorageInterface(ABC):
         raise NotImplementedError
 
     @abstractmethod
-    def lock_tasks(self, worker_id: str, batch_size: int) -> [Task]:
-        """Locks a batch of tasks."""
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
+        """
+        Locks a batch of tasks.
+        If affinity is given, tasks for endpoints in worker's slot are preferred.
+        """
         raise NotImplementedError
 
     @abstractmethod
@@ -96,12 +166,46 @@ class StorageInterface(ABC):
         """Updates a task"""
         raise NotImplementedError
 
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        """
+        Claims a batch of due monitors for stateless scheduling: their
+        last_task_at is atomically advanced to now, so that a monitor is
+        claimed by at most one worker per interval. Returns the claimed
+        monitors.
+        If affinity is given, monitors with endpoints in worker's slot are
+        preferred. Not supported by default.
+        """
+        raise NotImplementedError
+
     @abstractmethod
     def record_probe(self, probe):
         """Records the probe"""
         raise NotImplementedError
 
+    def record_probes(self, probes: [Probe]):
+        """
+        Records a batch of probes. Backends can override it with a bulk write
+        path; by default probes are recorded one by one. Backends writing in
+        the background return the futures of the writes, see wait_for_writes().
+        """
+        for probe in probes:
+            self.record_probe(probe)
+
     @abstractmethod
     def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
         """Lists probes for a monitor"""
         raise NotImplementedError
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        """
+        Lists rollups of a monitor at the resolution, with buckets starting
+        in [since, until). Backends that don't keep rollups return none.
+        """
+        return []
@@ -1,8 +1,8 @@
 import time
-import uuid
 from dataclasses import dataclass
 from enum import Enum
 from typing import Optional
+from monico.core.ids import uuid7
 
 
 class TaskStatus(Enum):
@@ -29,14 +29,36 @@ class Task:
         Creates a new task for the given monitor ID.
         """
         return cls(
-            id=str(uuid.uuid4()),
+            id=str(uuid7()),
             timestamp=int(time.time()),
             monitor_id=monitor_id,
             status=TaskStatus.PENDING,
         )
 
+    def lock(self, worker_id: str):
+        """
+        Marks the task as running on the given worker.
+        """
+        self.status = TaskStatus.RUNNING
+        self.locked_at = int(time.time())
+        self.locked_by = worker_id
+
     def abandon(self):
         """
         Abandons the task.
         """
         self.status = TaskStatus.ABANDONED
+
+    def fail(self):
+        """
+        Marks the task as failed, i.e. it was not executed.
+        """
+        self.status = TaskStatus.FAILED
+
+    def release(self):
+        """
+        Returns the task to pending, so that it can be locked again.
+        """
+        self.status = TaskStatus.PENDING
+        self.locked_at = None
+        self.locked_by = None
@@ -4,7 +4,14 @@ import asyncio
 import logging
 import uuid
 import aiohttp
-from monico.core.storage import StorageInterface
+from dataclasses import replace
+from urllib.parse import urlparse
+from monico.core.storage import StorageInterface, wait_for_writes
+from monico.core.limits import RequestLimiter
+from monico.core.breaker import CircuitBreaker
+from monico.core.affinity import HostAffinity
+from monico.core.resolver import CachingResolver, dns_timing_trace_config
+from monico.core.monitor import Monitor
 from monico.core.task import Task
 from monico.core.probe import Probe, ProbeResponseError
 from typing import Optional
@@ -13,34 +20,226 @@ from typing import Optional
 class Worker:
     """Worker process responsible for executing probes"""
 
-    MIN_WAIT_TIME = 5  # seconds to wait between locking batches
+    # seconds between polls for new tasks while the queue is empty;
+    # storages that notify about new tasks wake the worker up earlier
+    POLL_INTERVAL = 5
+    # poll interval when the storage notifies about new tasks; polling is
+    # then only a fallback in case a notification is lost
+    NOTIFIED_POLL_INTERVAL = 60
     REQUEST_TIMEOUT = 5  # seconds until a request is considered timed out
     STALE_THRESHOLD = 600  # seconds until a task is considered stale
     BATCH_SIZE = 10  # number of tasks to lock at once
+    PER_HOST_CONCURRENCY = 2  # max simultaneous requests to the same host
+    RATE_LIMIT = 20  # max requests per second across all hosts
+    KEEPALIVE_TIMEOUT = 60  # seconds to keep idle connections open for reuse
+    DNS_PREFETCH_INTERVAL = 30  # seconds between DNS prefetch rounds
+    DNS_PREFETCH_WINDOW = 60  # prefetch hosts of monitors due within this many seconds
+    METRICS_INTERVAL = 60  # seconds between logging storage metrics
+    DRAIN_TIMEOUT = 10  # seconds in-flight probes are given to finish on shutdown
 
     worker_id: str
     storage: StorageInterface
     log: logging.Logger
+    limiter: RequestLimiter
+    breakers: dict[str, CircuitBreaker]
+    affinity: Optional[HostAffinity]
+    session: Optional[aiohttp.ClientSession]
+    resolver: CachingResolver
+    prefetched_at: Optional[float]
+    metrics_logged_at: Optional[float]
+    stopping: asyncio.Event
+    # probes waiting to be recorded with the next flush
+    probe_buffer: [Probe]
+    # locked tasks that are not finished yet, with futures executing them
+    in_flight: dict[str, (Task, asyncio.Future)]
+    # IDs of in-flight tasks whose probe request has been sent
+    started: set[str]
+    # tasks handed over, already locked, by the manager running in the same
+    # process; they are taken before tasks are locked in the storage
+    queue: Optional[asyncio.Queue]
+    # handed-over tasks received while waiting for new tasks
+    received: [Task]
+    # whether the last wait for tasks was ended by a notification, which
+    # wakes up every worker; the next batch is then only locked in the
+    # worker's affinity slot, so that the owner of the slot gets its tasks
+    notified: bool
 
     def __init__(
         self,
         storage: StorageInterface,
         log: logging.Logger,
         worker_id: Optional[str] = None,
+        affinity: Optional[HostAffinity] = None,
+        queue: Optional[asyncio.Queue] = None,
     ):
         self.worker_id = worker_id or str(uuid.uuid4())
         self.storage = storage
         self.log = log
+        self.affinity = affinity
+        self.session = None
+        self.resolver = CachingResolver()
+        self.prefetched_at = None
+        self.metrics_logged_at = None
+        self.limiter = RequestLimiter(
+            per_host_concurrency=self.PER_HOST_CONCURRENCY,
+            rate_limit=self.RATE_LIMIT,
+        )
+        self.breakers = {}
+        self.stopping = asyncio.Event()
+        self.probe_buffer = []
+        self.in_flight = {}
+        self.started = set()
+        self.queue = queue
+        self.received = []
+        self.notified = False
+
+    def breaker(self, monitor_id: str) -> CircuitBreaker:
+        """
+        Returns the circuit breaker for the monitor. Breaker state is kept
+        in memory; when the worker sees a monitor for the first time,
+        the state is restored from the monitor's recent probes.
+        """
+        if monitor_id not in self.breakers:
+            probes = self.storage.list_probes(
+                monitor_id, limit=CircuitBreaker.history_size()
+            )
+            self.breakers[monitor_id] = CircuitBreaker.from_probes(probes)
+        return self.breakers[monitor_id]
 
     def lock_batch(self):
-        """Locks a batch of tasks"""
-        return self.storage.lock_tasks(self.worker_id, batch_size=self.BATCH_SIZE)
+        """
+        Locks a batch of tasks. Handed-over tasks are taken first; the storage
+        is only queried once there are none, e.g. for tasks released by
+        other workers. Tasks outside the worker's affinity slot are only
+        taken as a fallback when the worker wasn't woken up by a notification
+        (e.g. on a periodic poll), or once their owner is late.
+        """
+        tasks = self.take_queued(self.BATCH_SIZE)
+        if tasks:
+            return tasks
+        affinity = self.affinity
+        if affinity is not None and self.notified:
+            affinity = replace(affinity, fallback=False)
+        self.notified = False
+        return self.storage.lock_tasks(
+            self.worker_id, batch_size=self.BATCH_SIZE, affinity=affinity
+        )
+
+    def take_queued(self, limit: Optional[int] = None) -> [Task]:
+        """Takes up to limit handed-over tasks, all of them by default"""
+        tasks, self.received = self.received, []
+        while (
+            self.queue is not None
+            and not self.queue.empty()
+            and (limit is None or len(tasks) < limit)
+        ):
+            tasks.append(self.queue.get_nowait())
+        if limit is not None:
+            tasks, self.received = tasks[:limit], tasks[limit:]
+        return tasks
+
+    def read_monitor(self, task: Task) -> Monitor:
+        """Returns the monitor the task probes"""
+        return self.storage.read_monitor(task.monitor_id)
+
+    def update_task(self, task: Task):
+        """Saves the changed status of a task"""
+        self.storage.update_task(task)
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """
+        Returns the HTTP session shared by all probes of the worker,
+        so that connections to the same host are kept alive and reused.
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                    resolver=self.resolver,
+                    # the resolver has its own TTL-respecting cache
+                    use_dns_cache=False,
+                ),
+                trace_configs=[dns_timing_trace_config()],
+            )
+        return self.session
+
+    async def close(self):
+        """Releases connections held by the worker"""
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        await self.resolver.close()
+
+    def prefetch_dns(self):
+        """Resolves hostnames of monitors that are about to be due in the background"""
+        now = int(time.time())
+        hosts = [
+            urlparse(monitor.endpoint).hostname
+            for monitor in self.storage.list_monitors()
+            if monitor.last_task_at is None
+            or monitor.last_task_at + monitor.interval - now <= self.DNS_PREFETCH_WINDOW
+        ]
+        # endpoints without a hostname fail when probed
+        hosts = [host for host in hosts if host]
+        self.log.debug(f"worker is prefetching DNS; hosts={len(hosts)}")
+        self.resolver.prefetch(hosts, within=self.DNS_PREFETCH_WINDOW)
+
+    def log_metrics(self):
+        """Logs operational metrics of the storage, if it reports any"""
+        metrics = self.storage.metrics()
+        if metrics:
+            values = " ".join(
+                f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                for (k, v) in metrics.items()
+            )
+            self.log.info(f"storage metrics; {values}")
+
+    def stop(self):
+        """
+        Asks the worker to shut down gracefully: no new tasks are locked,
+        in-flight probes are given DRAIN_TIMEOUT seconds to finish.
+        """
+        self.log.info("worker is stopping")
+        self.stopping.set()
+
+    async def pause(self, seconds: float):
+        """Sleeps for the given number of seconds or until the worker is stopping"""
+        try:
+            await asyncio.wait_for(self.stopping.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
 
     async def run(self):
         """Starts the worker process"""
-        self.log.info(f"worker has started; id={self.worker_id}")
+        self.log.info(
+            f"worker has started; id={self.worker_id} affinity={self.affinity}"
+        )
+        try:
+            await self.process()
+        finally:
+            await self.drain()
+            await self.close()
+
+    async def process(self):
+        """Locks and executes batches of tasks until stopped or cancelled"""
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            if (
+                self.prefetched_at is None
+                or now - self.prefetched_at >= self.DNS_PREFETCH_INTERVAL
+            ):
+                self.prefetched_at = now
+                try:
+                    self.prefetch_dns()
+                except Exception as e:
+                    self.log.error(f"worker failed to prefetch DNS: {e}")
+            if (
+                self.metrics_logged_at is None
+                or now - self.metrics_logged_at >= self.METRICS_INTERVAL
+            ):
+                self.metrics_logged_at = now
+                self.log_metrics()
 
-        while True:
             self.log.debug(
                 f"worker is locking a batch of tasks; batch_size={self.BATCH_SIZE}"
             )
@@ -50,20 +249,127 @@ class Worker:
                 self.log.error(
                     f"worker encountered an unexpected exception while locking: {e}"
                 )
-                await asyncio.sleep(self.MIN_WAIT_TIME)
+                await self.pause(self.POLL_INTERVAL)
                 continue
             self.log.debug(f"worker has locked a {len(batch)} tasks")
 
-            tasks = [self.run_task(task) for task in batch]
+            futures = [self.start_task(task) for task in batch]
             try:
-                # wait minimum of 5 seconds before locking another batch
-                await asyncio.gather(asyncio.sleep(self.MIN_WAIT_TIME), *tasks)
+                await self.wait_for_batch(futures)
+                self.flush_probes()
+                if len(batch) < self.BATCH_SIZE:
+                    # the queue is drained, so wait for new tasks to be issued
+                    await self.wait_for_tasks(self.idle_poll_interval())
             except asyncio.CancelledError:
                 self.log.info("worker process has been cancelled")
                 break
+
+    def idle_poll_interval(self) -> float:
+        # with affinity, tasks outside the worker's slot aren't handed over,
+        # but stored pending; the worker still takes them when their owner
+        # is late, so it keeps polling the storage
+        handed_over = self.queue is not None and self.affinity is None
+        if handed_over or self.storage.NOTIFIES_ABOUT_TASKS:
+            return self.NOTIFIED_POLL_INTERVAL
+        return self.POLL_INTERVAL
+
+    async def wait_for_tasks(self, timeout: float):
+        """
+        Waits until the storage signals that new tasks were issued, a task
+        is handed over, the timeout passes or the worker is stopping
+        """
+        self.notified = False
+        waiter = asyncio.ensure_future(self.storage.wait_for_tasks(timeout))
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        waiting = [waiter, stopping]
+        if self.queue is not None:
+            receiver = asyncio.ensure_future(self.queue.get())
+            waiting.append(receiver)
+        try:
+            await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for future in waiting:
+                future.cancel()
+        if self.queue is not None and receiver.done() and not receiver.cancelled():
+            self.received.append(receiver.result())
+        if waiter.done() and not waiter.cancelled() and waiter.exception():
+            self.log.error(f"worker failed to wait for new tasks: {waiter.exception()}")
+            await self.pause(timeout)
+        elif waiter.done() and not waiter.cancelled():
+            self.notified = bool(waiter.result())
+
+    def start_task(self, task: Task) -> asyncio.Future:
+        """Starts executing the task in the background and tracks it until finished"""
+        future = asyncio.ensure_future(self.run_tracked_task(task))
+        self.in_flight[task.id] = (task, future)
+        return future
+
+    async def run_tracked_task(self, task: Task):
+        try:
+            await self.run_task(task)
+        except Exception as e:
+            self.log.error(f"worker encountered an unexpected exception: {e}")
+        # cancelled tasks stay in flight, so that they are released on drain
+        del self.in_flight[task.id]
+        self.started.discard(task.id)
+
+    async def wait_for_batch(self, futures: [asyncio.Future]):
+        """Waits until all tasks of the batch are finished or the worker is stopping"""
+        if not futures:
+            return
+        stopping = asyncio.ensure_future(self.stopping.wait())
+        try:
+            await asyncio.wait(
+                [asyncio.gather(*futures), stopping],
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+        finally:
+            stopping.cancel()
+
+    async def drain(self):
+        """
+        Finishes in-flight work before shutdown. Tasks whose probe request has
+        already been sent get up to DRAIN_TIMEOUT seconds to finish. Tasks that
+        haven't been started, or didn't finish in time, are returned to pending
+        so that another worker picks them up.
+        """
+        unstarted = [
+            future
+            for (tid, (_, future)) in self.in_flight.items()
+            if tid not in self.started
+        ]
+        for future in unstarted:
+            future.cancel()
+
+        running = [future for (_, future) in self.in_flight.values()]
+        if running:
+            self.log.info(
+                f"worker is draining; in_flight={len(running) - len(unstarted)} "
+                f"unstarted={len(unstarted)}"
+            )
+            _, timed_out = await asyncio.wait(running, timeout=self.DRAIN_TIMEOUT)
+            for future in timed_out:
+                future.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        unfinished = [task for (task, _) in self.in_flight.values()]
+        for task in unfinished + self.take_queued():
+            self.log.info(f"returning an unfinished task to pending; task_id={task.id}")
+            task.release()
+            try:
+                self.update_task(task)
             except Exception as e:
-                self.log.error(f"worker encountered an unexpected exception: {e}")
-                continue
+                self.log.error(
+                    f"worker failed to release a task; task_id={task.id}: {e}"
+                )
+        self.in_flight.clear()
+        self.started.clear()
+        self.flush_probes()
+
+        try:
+            self.storage.flush()
+        except Exception as e:
+            self.log.error(f"worker failed to flush storage writes: {e}")
 
     async def run_task(self, task: Task):
         """Runs a single instance of a task (probe) and records the result"""
@@ -74,59 +380,169 @@ class Worker:
         if now - task.timestamp > self.STALE_THRESHOLD:
             self.log.warning(f"abandoning a stale task; task_id={task.id}")
             task.abandon()
-            self.storage.update_task(task)
+            self.update_task(task)
             return
 
-        # record the probe
+        # endpoints that keep failing are probed less often
+        breaker = self.breaker(task.monitor_id)
+        if not breaker.allow(now):
+            self.log.info(
+                "circuit is open, skipping a probe; "
+                f"task_id={task.id} monitor_id={task.monitor_id} "
+                f"retry_at={breaker.retry_at}"
+            )
+            task.fail()
+            self.update_task(task)
+            return
+
+        # buffer the probe, probes of a batch are recorded together
         probe = await self.get_probe(task)
-        self.storage.record_probe(probe)
+        breaker.record(probe, probe.timestamp)
+        self.probe_buffer.append(probe)
         self.log.debug(
-            f"worker has recorded a probe; task_id={probe.task_id} probe_id={probe.id}"
+            "worker has finished a probe; "
+            f"task_id={probe.task_id} probe_id={probe.id} "
+            f"wait_time={probe.wait_time} dns_time={probe.dns_time}"
         )
 
+    def flush_probes(self):
+        """
+        Records buffered probes in a single storage call, and waits for the
+        write if the storage runs it in the background. If the batch fails,
+        e.g. because a monitor was deleted, the probes are recorded one by
+        one, so that only the failing ones are lost.
+        """
+        probes, self.probe_buffer = self.probe_buffer, []
+        if not probes:
+            return
+        try:
+            wait_for_writes(self.storage.record_probes(probes))
+            self.log.debug(f"worker has recorded probes; count={len(probes)}")
+            return
+        except Exception as e:
+            self.log.warning(
+                f"worker failed to record {len(probes)} probes at once, "
+                f"recording them one by one: {e}"
+            )
+        for probe in probes:
+            try:
+                wait_for_writes(self.storage.record_probe(probe))
+            except Exception as e:
+                self.log.error(
+                    f"worker failed to record a probe; task_id={probe.task_id} "
+                    f"probe_id={probe.id}: {e}"
+                )
+
     async def get_probe(self, task: Task) -> Probe:
+        """
+        Waits for the outbound request limits to allow a request to the monitor's
+        endpoint, then executes the probe. Time spent waiting is recorded
+        as probe's wait_time and is not included in the response time.
+        """
+        monitor = self.read_monitor(task)
+
+        queued_at = asyncio.get_event_loop().time()
+        async with self.limiter.acquire(monitor.endpoint):
+            wait_time = asyncio.get_event_loop().time() - queued_at
+            self.started.add(task.id)
+            probe = await self.execute_probe(task, monitor)
+        probe.wait_time = wait_time
+        return probe
+
+    async def execute_probe(self, task: Task, monitor: Monitor) -> Probe:
         """Executes an http request and returns a probe based on the response"""
         self.log.debug(f"worker is executing a probe; task_id={task.id}")
-        monitor = self.storage.read_monitor(task.monitor_id)
 
+        session = self.get_session()
+        # filled in by the DNS timing trace
+        trace_context = {"dns_time": 0.0}
         start = asyncio.get_event_loop().time()
-        async with aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
-        ) as session:
-            try:
-                async with session.get(monitor.endpoint) as response:
-                    request_time = asyncio.get_event_loop().time() - start
-                    response_text = await response.text()
-
-                    match_str = None
-                    if monitor.body_regexp:
-                        match = re.search(monitor.body_regexp, response_text)
-                        match_str = match.group(0) if match else None
-                    return Probe.create(
-                        monitor_id=task.monitor_id,
-                        task_id=task.id,
-                        response_time=request_time,
-                        response_code=response.status,
-                        response_error=None,
-                        content_match=match_str,
-                    )
-            except aiohttp.ClientError as e:
-                request_time = asyncio.get_event_loop().time() - start
-                return Probe.create(
-                    monitor_id=task.monitor_id,
-                    task_id=task.id,
-                    response_time=request_time,
-                    response_code=None,
-                    response_error=ProbeResponseError.CONNECTION_ERROR,
-                    content_match=None,
-                )
-            except asyncio.TimeoutError:
+        try:
+            async with session.get(
+                monitor.endpoint,
+                timeout=aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT),
+                trace_request_ctx=trace_context,
+            ) as response:
                 request_time = asyncio.get_event_loop().time() - start
-                return Probe.create(
+                response_text = await response.text()
+
+                match_str = None
+                if monitor.body_regexp:
+                    match = re.search(monitor.body_regexp, response_text)
+                    match_str = match.group(0) if match else None
+                probe = Probe.create(
                     monitor_id=task.monitor_id,
                     task_id=task.id,
                     response_time=request_time,
-                    response_code=None,
-                    response_error=ProbeResponseError.TIMEOUT,
-                    content_match=None,
+                    response_code=response.status,
+                    response_error=None,
+                    content_match=match_str,
                 )
+        except aiohttp.ClientError as e:
+            request_time = asyncio.get_event_loop().time() - start
+            probe = Probe.create(
+                monitor_id=task.monitor_id,
+                task_id=task.id,
+                response_time=request_time,
+                response_code=None,
+                response_error=ProbeResponseError.CONNECTION_ERROR,
+                content_match=None,
+            )
+        except asyncio.TimeoutError:
+            request_time = asyncio.get_event_loop().time() - start
+            probe = Probe.create(
+                monitor_id=task.monitor_id,
+                task_id=task.id,
+                response_time=request_time,
+                response_code=None,
+                response_error=ProbeResponseError.TIMEOUT,
+                content_match=None,
+            )
+        probe.dns_time = trace_context["dns_time"]
+        return probe
+
+
+class StatelessWorker(Worker):
+    """
+    Worker for stateless scheduling: instead of locking tasks issued by the
+    manager, it claims due monitors directly. Claims are turned into tasks
+    that only live in the worker's memory and are never stored.
+    """
+
+    # seconds between claims while no monitors are due; nothing notifies
+    # about monitors becoming due, so it bounds how late a probe can be
+    POLL_INTERVAL = 1
+
+    # claimed monitors of in-memory tasks, by task ID
+    claimed: dict[str, Monitor]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.claimed = {}
+
+    def lock_batch(self):
+        """Claims a batch of due monitors, returns a task for each"""
+        monitors = self.storage.claim_monitors(
+            self.worker_id, batch_size=self.BATCH_SIZE, affinity=self.affinity
+        )
+        tasks = []
+        for monitor in monitors:
+            task = monitor.create_task()
+            task.lock(self.worker_id)
+            self.claimed[task.id] = monitor
+            tasks.append(task)
+        return tasks
+
+    def read_monitor(self, task: Task) -> Monitor:
+        return self.claimed.pop(task.id)
+
+    def update_task(self, task: Task):
+        # a claim is not returned on release: the monitor is probed again
+        # in the next interval, so that it's never probed twice in one
+        self.claimed.pop(task.id, None)
+
+    def idle_poll_interval(self) -> float:
+        return self.POLL_INTERVAL
+
+    async def wait_for_tasks(self, timeout: float):
+        await self.pause(timeout)
@@ -1,4 +1,7 @@
 from dataclasses import dataclass
+from monico.core.task import TaskStatus
+from monico.core.probe import ProbeResponseError
+from monico.core.rollup import Rollup, LATENCY_BUCKETS
 
 
 @dataclass
@@ -6,3 +9,151 @@ class TableConfig:
     monitors: str
     tasks: str
     probes: str
+    schema_version: str
+    rollups: str
+
+
+# small int codes enums are stored as; codes of existing values must not change
+TASK_STATUS_CODES = {
+    TaskStatus.PENDING: 0,
+    TaskStatus.RUNNING: 1,
+    TaskStatus.COMPLETED: 2,
+    TaskStatus.ABANDONED: 3,
+    TaskStatus.FAILED: 4,
+}
+TASK_STATUSES = {code: status for (status, code) in TASK_STATUS_CODES.items()}
+PROBE_ERROR_CODES = {
+    ProbeResponseError.TIMEOUT: 1,
+    ProbeResponseError.CONNECTION_ERROR: 2,
+}
+PROBE_ERRORS = {code: error for (error, code) in PROBE_ERROR_CODES.items()}
+
+
+# time a monitor is due at; indexed, so queries must spell it the same way.
+# Monitors that have never been probed are due since the epoch.
+MONITOR_DUE_AT_SQL = "(COALESCE(last_task_at, 0) + interval)"
+
+
+def probe_error_code(error: ProbeResponseError) -> int:
+    return PROBE_ERROR_CODES[error] if error else None
+
+
+def probe_error_value(code: int) -> str:
+    return PROBE_ERRORS[code].value if code is not None else None
+
+
+def enum_codes_sql(codes: dict) -> str:
+    """List of codes, e.g. for a CHECK constraint"""
+    return f"({', '.join(str(code) for code in codes.values())})"
+
+
+def enum_code_sql(column: str, codes: dict) -> str:
+    """Expression converting enum values stored as text to their codes"""
+    cases = " ".join(
+        f"WHEN '{item.value}' THEN {code}" for (item, code) in codes.items()
+    )
+    return f"CASE {column} {cases} END"
+
+
+# columns of the rollups table, in the order of Rollup fields, as created by
+# migration 4; migration 5 turns fk_monitor into a monitor's surrogate key
+ROLLUP_COLUMNS = [
+    ("fk_monitor", "TEXT NOT NULL"),
+    ("resolution", "INT NOT NULL"),
+    ("bucket", "INT NOT NULL"),
+    ("probes", "INT NOT NULL"),
+    ("errors", "INT NOT NULL"),
+    ("status_2xx", "INT NOT NULL"),
+    ("status_3xx", "INT NOT NULL"),
+    ("status_4xx", "INT NOT NULL"),
+    ("status_5xx", "INT NOT NULL"),
+    ("latency_count", "INT NOT NULL"),
+    ("latency_sum", "FLOAT NOT NULL"),
+    ("latency_min", "FLOAT NULL"),
+    ("latency_max", "FLOAT NULL"),
+] + [(f"latency_hist_{i}", "INT NOT NULL") for i in range(len(LATENCY_BUCKETS) + 1)]
+ROLLUP_KEY = ["fk_monitor", "resolution", "bucket"]
+
+
+def rollup_values(rollup: Rollup) -> tuple:
+    return (
+        rollup.monitor_id,
+        rollup.resolution,
+        rollup.bucket,
+        rollup.probes,
+        rollup.errors,
+        rollup.status_2xx,
+        rollup.status_3xx,
+        rollup.status_4xx,
+        rollup.status_5xx,
+        rollup.latency_count,
+        rollup.latency_sum,
+        rollup.latency_min,
+        rollup.latency_max,
+        *rollup.latency_histogram,
+    )
+
+
+def rollup_from_row(row: tuple) -> Rollup:
+    return Rollup(*row[:13], latency_histogram=list(row[13:]))
+
+
+def rollup_upsert_sql(table: str, values: str) -> str:
+    """
+    Statement adding rollups to the stored ones: counters and sums are added,
+    minimum and maximum are compared.
+    """
+    assignments = []
+    for column, _ in ROLLUP_COLUMNS:
+        if column in ROLLUP_KEY:
+            continue
+        if column == "latency_min" or column == "latency_max":
+            op = "<" if column == "latency_min" else ">"
+            assignments.append(
+                f"{column} = CASE WHEN {table}.{column} IS NULL "
+                f"OR excluded.{column} {op} {table}.{column} "
+                f"THEN excluded.{column} ELSE {table}.{column} END"
+            )
+        else:
+            assignments.append(f"{column} = {table}.{column} + excluded.{column}")
+    return f"""
+        INSERT INTO {table} ({", ".join(c for (c, _) in ROLLUP_COLUMNS)})
+        VALUES {values}
+        ON CONFLICT ({", ".join(ROLLUP_KEY)}) DO UPDATE SET
+            {", ".join(assignments)}
+    """
+
+
+def rollup_backfill_sql(table: str, probes: str, resolution: int) -> str:
+    """Statement computing rollups of the resolution from recorded probes"""
+
+    def count_if(condition: str) -> str:
+        return f"SUM(CASE WHEN {condition} THEN 1 ELSE 0 END)"
+
+    bounds = [None] + LATENCY_BUCKETS + [None]
+    histogram = []
+    for lower, upper in zip(bounds, bounds[1:]):
+        conditions = ["response_time IS NOT NULL"]
+        if lower is not None:
+            conditions.append(f"response_time > {lower}")
+        if upper is not None:
+            conditions.append(f"response_time <= {upper}")
+        histogram.append(count_if(" AND ".join(conditions)))
+    bucket = f"timestamp - timestamp % {resolution}"
+    return f"""
+        INSERT INTO {table} ({", ".join(c for (c, _) in ROLLUP_COLUMNS)})
+        SELECT
+            fk_monitor,
+            {resolution},
+            {bucket},
+            COUNT(*),
+            {count_if("response_error IS NOT NULL")},
+            {", ".join(count_if(f"response_code >= {c}00 AND response_code < {c + 1}00") for c in range(2, 6))},
+            COUNT(response_time),
+            COALESCE(SUM(response_time), 0),
+            MIN(response_time),
+            MAX(response_time),
+            {", ".join(histogram)}
+        FROM {probes}
+        GROUP BY fk_monitor, {bucket}
+    """
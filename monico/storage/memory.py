@@ -0,0 +1,422 @@
+"""
+Storage kept in memory of the process.
+
+Nothing is written anywhere, and everything is lost when the process exits,
+so it's meant for benchmarking manager and worker logic without the cost of a
+database, and for ephemeral runs, e.g. trying monico out. Manager and workers
+have to share the process, i.e. run as a single `monico run`.
+"""
+import time
+import uuid
+import heapq
+import asyncio
+import itertools
+import threading
+from collections import deque
+from dataclasses import replace
+from typing import Optional, Hashable
+from monico.core.storage import (
+    StorageInterface,
+    MonitorAlreadyExistsException,
+    MonitorNotFoundException,
+    MonitorSortingOrder,
+)
+from monico.core.affinity import HostAffinity
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe, ProbeResponseError
+from monico.core.rollup import Rollup, RESOLUTIONS, RETENTION, bucket_start
+from monico.core.task import Task, TaskStatus
+
+
+def clone(obj):
+    """
+    Shallow copy of a monitor, task or probe, so that callers don't change
+    stored objects; faster than copy.copy()
+    """
+    cloned = object.__new__(type(obj))
+    cloned.__dict__.update(obj.__dict__)
+    return cloned
+
+
+class IndexedHeap:
+    """
+    Min-heap of keys by priority, where the priority of a key can be changed
+    and a key removed. Replaced entries are left in the heap and skipped when
+    they come up, and dropped all at once when they outnumber the keys, so
+    that keys whose priority changes without being popped don't grow it.
+    """
+
+    def __init__(self):
+        self.heap: [tuple] = []
+        # sequence number of the current entry of every key
+        self.entries: {Hashable: int} = {}
+        self.sequence = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def push(self, key: Hashable, priority):
+        """Adds the key, or changes its priority"""
+        entry = next(self.sequence)
+        self.entries[key] = entry
+        heapq.heappush(self.heap, (priority, entry, key))
+        self._compact()
+
+    def remove(self, key: Hashable):
+        self.entries.pop(key, None)
+        self._compact()
+
+    def _compact(self):
+        """Drops replaced entries once they make up more than half the heap"""
+        if len(self.heap) <= 2 * len(self.entries):
+            return
+        self.heap = [
+            (priority, entry, key)
+            for (priority, entry, key) in self.heap
+            if self.entries.get(key) == entry
+        ]
+        heapq.heapify(self.heap)
+
+    def pop(self, limit: int, max_priority=None) -> [(Hashable, object)]:
+        """
+        Removes up to limit (key, priority) pairs with the lowest priorities,
+        no higher than max_priority, and returns them in order
+        """
+        popped = []
+        while self.heap and len(popped) < limit:
+            priority, entry, key = self.heap[0]
+            if self.entries.get(key) != entry:
+                heapq.heappop(self.heap)
+                continue
+            if max_priority is not None and priority > max_priority:
+                break
+            heapq.heappop(self.heap)
+            del self.entries[key]
+            popped.append((key, priority))
+        return popped
+
+
+class InMemoryStorage(StorageInterface):
+    """
+    Monitors are kept in a dict in the order they were created, pending
+    tasks in a heap by their timestamp, monitors in a heap by the time they
+    are due, and the latest probes of every monitor in a ring buffer.
+    Finished tasks aren't kept, as nothing reads them back.
+
+    Calls never block on I/O, so they are safe to make from the event loop;
+    a lock makes them safe from other threads too. Workers waiting for tasks
+    are woken up as soon as tasks are created.
+    """
+
+    NOTIFIES_ABOUT_TASKS = True
+    PROCESS_LOCAL_TASKS = True
+    PROBES_PER_MONITOR = 1000  # latest probes kept of every monitor
+
+    # seconds to keep probes and finished tasks for; forever if None
+    probe_retention: Optional[int]
+    task_retention: Optional[int]
+
+    def __init__(
+        self,
+        service_uri: str = "memory://",
+        probe_retention: Optional[int] = None,
+        task_retention: Optional[int] = None,
+    ) -> None:
+        self.service_uri = service_uri
+        self.probe_retention = probe_retention
+        # finished tasks aren't kept, so they never outlive any retention
+        self.task_retention = task_retention
+        self.lock = threading.RLock()
+        # (event loop, event) of every worker waiting for tasks
+        self.waiters: [(asyncio.AbstractEventLoop, asyncio.Event)] = []
+        self.teardown()
+
+    def setup(self, force=False):
+        """Nothing to set up, the storage is ready once created"""
+        if force:
+            self.teardown()
+
+    def teardown(self):
+        with self.lock:
+            self.monitors: {str: Monitor} = {}
+            self.due_monitors = IndexedHeap()
+            # unfinished tasks, also indexed by their monitor
+            self.tasks: {str: Task} = {}
+            self.monitor_tasks: {str: {str}} = {}
+            self.pending_tasks = IndexedHeap()
+            self.probes: {str: deque} = {}
+            self.rollups: {str: {(int, int): Rollup}} = {}
+
+    def metrics(self) -> dict:
+        with self.lock:
+            return {
+                "monitors": len(self.monitors),
+                "tasks": len(self.tasks),
+                "pending_tasks": len(self.pending_tasks),
+                "probes": sum(len(probes) for probes in self.probes.values()),
+            }
+
+    async def wait_for_tasks(self, timeout: float):
+        event = asyncio.Event()
+        waiter = (asyncio.get_running_loop(), event)
+        with self.lock:
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.waiters.remove(waiter)
+
+    def _notify_waiters(self):
+        for loop, event in self.waiters:
+            # tasks may be created from another thread than the one of the loop
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(event.set)
+
+    def maintain(self) -> dict:
+        """
+        Deletes probes and fine rollups older than their retention. Finished
+        tasks are deleted once they finish.
+        """
+        now = int(time.time())
+        stats = {}
+        with self.lock:
+            if self.probe_retention is not None:
+                before = now - self.probe_retention
+                stats["probes_deleted"] = 0
+                for monitor_id, probes in self.probes.items():
+                    kept = [p for p in probes if p.timestamp >= before]
+                    stats["probes_deleted"] += len(probes) - len(kept)
+                    self.probes[monitor_id] = deque(kept, self.PROBES_PER_MONITOR)
+            if self.task_retention is not None:
+                stats["tasks_deleted"] = 0
+            stats["rollups_deleted"] = 0
+            for rollups in self.rollups.values():
+                expired = [
+                    key
+                    for key in rollups
+                    if key[0] in RETENTION and key[1] < now - RETENTION[key[0]]
+                ]
+                for key in expired:
+                    del rollups[key]
+                stats["rollups_deleted"] += len(expired)
+        return stats
+
+    def _monitor(self, id: str) -> Monitor:
+        monitor = self.monitors.get(id)
+        if monitor is None:
+            raise MonitorNotFoundException(f'Monitor with ID "{id}" not found')
+        return monitor
+
+    def _update_due(self, monitor: Monitor):
+        self.due_monitors.push(
+            monitor.id, (monitor.last_task_at or 0) + monitor.interval
+        )
+
+    def create_monitor(self, monitor: Monitor) -> Monitor:
+        if not monitor.id:
+            monitor.id = str(uuid.uuid4())
+        created = Monitor(
+            monitor.id,
+            monitor.name,
+            monitor.endpoint,
+            monitor.interval,
+            monitor.body_regexp,
+        )
+        with self.lock:
+            if created.id in self.monitors:
+                raise MonitorAlreadyExistsException(
+                    f"Monitor with ID {monitor.id} already exists"
+                )
+            self.monitors[created.id] = created
+            self.monitor_tasks[created.id] = set()
+            self.probes[created.id] = deque(maxlen=self.PROBES_PER_MONITOR)
+            self.rollups[created.id] = {}
+            self._update_due(created)
+        return clone(created)
+
+    def list_monitors(
+        self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
+    ) -> [Monitor]:
+        with self.lock:
+            monitors = [clone(monitor) for monitor in self.monitors.values()]
+        if sort == MonitorSortingOrder.LAST_TASK_AT_DESC:
+            # monitors without tasks last, like databases sort NULLs
+            monitors.sort(
+                key=lambda m: (m.last_task_at is not None, m.last_task_at or 0),
+                reverse=True,
+            )
+        return monitors
+
+    def read_monitor(self, id: str) -> Monitor:
+        with self.lock:
+            return clone(self._monitor(id))
+
+    def delete_monitor(self, id: str):
+        with self.lock:
+            monitor = self.monitors.pop(id, None)
+            if monitor is None:
+                raise MonitorNotFoundException(f'Monitor with ID "{id}" not found')
+            self.due_monitors.remove(id)
+            for task_id in self.monitor_tasks.pop(id):
+                del self.tasks[task_id]
+                self.pending_tasks.remove(task_id)
+            del self.probes[id]
+            del self.rollups[id]
+        return monitor
+
+    def _store_task(self, task: Task):
+        """Keeps the task if it's unfinished, and queues it if it's pending"""
+        if task.status in (TaskStatus.PENDING, TaskStatus.RUNNING):
+            self.tasks[task.id] = clone(task)
+            self.monitor_tasks[task.monitor_id].add(task.id)
+        else:
+            self.tasks.pop(task.id, None)
+            self.monitor_tasks[task.monitor_id].discard(task.id)
+        if task.status == TaskStatus.PENDING:
+            self.pending_tasks.push(task.id, task.timestamp)
+        else:
+            self.pending_tasks.remove(task.id)
+
+    def create_task(self, task: Task):
+        with self.lock:
+            monitor = self._monitor(task.monitor_id)
+            self._store_task(task)
+            monitor.last_task_at = task.timestamp
+            self._update_due(monitor)
+            if task.status == TaskStatus.PENDING:
+                self._notify_waiters()
+        return task
+
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
+        with self.lock:
+            if affinity is None:
+                ids = [tid for (tid, _) in self.pending_tasks.pop(batch_size)]
+            else:
+                candidates = self.pending_tasks.pop(affinity.scan_size(batch_size))
+                ids = affinity.select(
+                    [
+                        (tid, timestamp, self._endpoint_of_task(tid))
+                        for (tid, timestamp) in candidates
+                    ],
+                    batch_size,
+                    int(time.time()),
+                )
+                # the rest stay pending
+                selected = set(ids)
+                for tid, timestamp in candidates:
+                    if tid not in selected:
+                        self.pending_tasks.push(tid, timestamp)
+            locked = []
+            for tid in ids:
+                task = self.tasks[tid]
+                task.lock(worker_id)
+                locked.append(clone(task))
+            return locked
+
+    def _endpoint_of_task(self, task_id: str) -> str:
+        return self.monitors[self.tasks[task_id].monitor_id].endpoint
+
+    def update_task(self, task: Task):
+        with self.lock:
+            if task.id not in self.tasks:
+                # finished already, or its monitor is deleted
+                return
+            self._store_task(task)
+            if task.status == TaskStatus.PENDING:
+                self._notify_waiters()
+
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        now = int(time.time())
+        with self.lock:
+            if affinity is None:
+                due = self.due_monitors.pop(batch_size, max_priority=now)
+                ids = [mid for (mid, _) in due]
+            else:
+                due = self.due_monitors.pop(affinity.scan_size(batch_size), now)
+                ids = affinity.select(
+                    [
+                        (mid, due_at, self.monitors[mid].endpoint)
+                        for (mid, due_at) in due
+                    ],
+                    batch_size,
+                    now,
+                )
+            claimed = []
+            for mid in ids:
+                self.monitors[mid].last_task_at = now
+                claimed.append(clone(self.monitors[mid]))
+            # popped monitors go back, the claimed ones due in their next interval
+            for mid, _ in due:
+                self._update_due(self.monitors[mid])
+            return claimed
+
+    def record_probe(self, probe: Probe):
+        """
+        Records a probe, updates the last probe time of its monitor, and
+        completes its task
+        """
+        self.record_probes([probe])
+
+    def record_probes(self, probes: [Probe]):
+        with self.lock:
+            # all probes or none are recorded, like in a transaction
+            for probe in probes:
+                self._monitor(probe.monitor_id)
+            for probe in probes:
+                self._record_probe(probe)
+
+    def _record_probe(self, probe: Probe):
+        task = self.tasks.get(probe.task_id)
+        recorded = clone(probe)
+        if isinstance(probe.response_error, ProbeResponseError):
+            recorded.response_error = probe.response_error.value
+        # probes of claimed monitors have no stored task
+        recorded.task_id = probe.task_id if task is not None else None
+        self.probes[probe.monitor_id].append(recorded)
+
+        monitor = self.monitors[probe.monitor_id]
+        monitor.last_probe_at = max(probe.timestamp, monitor.last_probe_at or 0)
+        if task is not None:
+            task.status = TaskStatus.COMPLETED
+            task.completed_at = int(time.time())
+            self._store_task(task)
+
+        rollups = self.rollups[probe.monitor_id]
+        for resolution in RESOLUTIONS:
+            key = (resolution, bucket_start(probe.timestamp, resolution))
+            if key not in rollups:
+                rollups[key] = Rollup(probe.monitor_id, *key)
+            rollups[key].add(probe)
+
+    def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
+        with self.lock:
+            probes = list(self.probes.get(monitor_id, ()))
+        return [
+            clone(probe)
+            for probe in heapq.nlargest(limit, probes, key=lambda p: p.timestamp)
+        ]
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        with self.lock:
+            rollups = [
+                replace(rollup, latency_histogram=list(rollup.latency_histogram))
+                for ((res, bucket), rollup) in self.rollups.get(monitor_id, {}).items()
+                if res == resolution and since <= bucket < until
+            ]
+        return sorted(rollups, key=lambda rollup: rollup.bucket)
@@ -0,0 +1,55 @@
+"""
+Versioned schema migrations.
+
+Each storage backend defines an ordered list of migrations. The first one
+(the baseline) creates the tables, every next one changes the schema of a
+database that is already deployed, e.g. adds an index. Versions of applied
+migrations are recorded in the schema version table, so that `monico migrate`
+only applies the ones that are missing.
+"""
+from dataclasses import dataclass
+from typing import Callable, Any
+from monico.core.storage import StorageSetupException
+
+BASELINE_VERSION = 1
+# oldest schema version the storage code works with; migration 5 changed the
+# layout of every table
+REQUIRED_VERSION = 5
+
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    # receives a cursor of the backend's connection
+    apply: Callable[[Any], None]
+    # transactional migrations are applied atomically together with recording
+    # their version; the rest (e.g. CREATE INDEX CONCURRENTLY on PostgreSQL)
+    # run outside of a transaction, so they must be safe to re-run
+    transactional: bool = True
+
+
+def pending_migrations(migrations: [Migration], version: int) -> [Migration]:
+    """Returns migrations newer than the given schema version, in order"""
+    versions = [migration.version for migration in migrations]
+    if versions != list(range(BASELINE_VERSION, len(migrations) + 1)):
+        raise StorageSetupException(
+            f"Migration versions must be consecutive starting at "
+            f"{BASELINE_VERSION}, got {versions}"
+        )
+    if version > len(migrations):
+        raise StorageSetupException(
+            f"Storage schema version {version} is newer than the latest known "
+            f"version {len(migrations)}. Please upgrade monico."
+        )
+    return migrations[version:]
+
+
+def check_schema_version(version: int):
+    """Raises if storage with the schema version has to be migrated before use"""
+    if version < REQUIRED_VERSION:
+        raise StorageSetupException(
+            f"Storage schema version {version} is older than version "
+            f"{REQUIRED_VERSION} required by this version of monico. "
+            "Run `monico migrate` to upgrade it."
+        )
@@ -1,6 +1,15 @@
+import io
+import re
+from enum import Enum
 from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional
+import time
 import uuid
+import asyncio
+import threading
 import psycopg2
+import psycopg2.extras
 from monico.core.storage import (
     StorageInterface,
     StorageSetupException,
@@ -10,345 +19,1598 @@ from monico.core.storage import (
     MonitorSortingOrder,
 )
 from monico.core.monitor import Monitor
+from monico.core.affinity import HostAffinity
 from monico.core.task import Task, TaskStatus
 from monico.core.probe import Probe, ProbeResponseError
-from monico.storage.common import TableConfig
+from monico.core.rollup import Rollup, RESOLUTIONS, RETENTION, rollup_probes
+from monico.storage.common import (
+    TableConfig,
+    TASK_STATUS_CODES,
+    TASK_STATUSES,
+    PROBE_ERROR_CODES,
+    MONITOR_DUE_AT_SQL,
+    probe_error_code,
+    probe_error_value,
+    enum_code_sql,
+    ROLLUP_COLUMNS,
+    rollup_values,
+    rollup_from_row,
+    rollup_upsert_sql,
+    rollup_backfill_sql,
+)
+from monico.storage.pool import ConnectionPool
+from monico.storage.migrations import (
+    Migration,
+    BASELINE_VERSION,
+    pending_migrations,
+    check_schema_version,
+)
+
+
+def copy_value(value) -> str:
+    """Formats a value for COPY in the text format"""
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+class ProbePartitioning(Enum):
+    """Range partitioning layouts of the probes table"""
+
+    DAY = "day"
+    WEEK = "week"
+
+    @property
+    def period(self) -> int:
+        """Length of a partition in seconds"""
+        return 86400 if self is ProbePartitioning.DAY else 7 * 86400
+
+    def period_start(self, timestamp: int) -> int:
+        """Start of the partition holding the timestamp; weeks start on Monday"""
+        # the epoch was a Thursday, Monday is 4 days later
+        offset = 0 if self is ProbePartitioning.DAY else 4 * 86400
+        return timestamp - (timestamp - offset) % self.period
 
 
 class PgStorage(StorageInterface):
     """
     PostgreSQL storage implementation for monico.
+
+    Storage calls check out a connection from a pool for their duration, so
+    they can be made from several threads at once.
+
+    Creating a task sends a notification on the tasks channel. Workers waiting
+    for tasks LISTEN on it on a separate connection and wake up right away,
+    instead of polling an empty queue.
+
+    The probes table can be range-partitioned by day or week when the storage
+    is set up. Partitions are then created ahead of time by maintain(), and
+    retention drops whole partitions instead of deleting rows.
     """
 
+    NOTIFIES_ABOUT_TASKS = True
+    POOL_MIN_SIZE = 1  # connections kept open even when idle
+    POOL_MAX_SIZE = 10  # upper bound for connections opened by the process
+    PROBE_PARTITIONS_AHEAD = 3  # future probe partitions kept ready
+    # how long partition DDL waits for the probes table lock before giving up,
+    # so that writers don't queue up behind it
+    MAINTENANCE_LOCK_TIMEOUT = "5s"
+    # rows deleted per maintenance transaction, so that row locks are short
+    MAINTENANCE_BATCH_SIZE = 1000
+    MAINTENANCE_MAX_BATCHES = 100  # per table and maintenance run
+    MAINTENANCE_BATCH_PAUSE = 0.05  # seconds between batches
+    # seconds of recent probes searched by list_probes on a partitioned table,
+    # before widening the search; narrow ranges prune older partitions
+    LIST_PROBES_WINDOWS = [86400, 7 * 86400, 31 * 86400]
+
     tables: dict
     service_uri: str
-    conn: psycopg2.extensions.connection
+    pool: ConnectionPool
+    # layout of the probes table created by setup
+    probe_partitioning: Optional[ProbePartitioning]
+    # seconds to keep probes and finished tasks for; forever if None
+    probe_retention: Optional[int]
+    task_retention: Optional[int]
+    # whether setup creates the tasks table UNLOGGED: task state transitions
+    # skip the WAL, and the table is emptied by crash recovery
+    transient_tasks: bool
+    # whether the existing probes table is partitioned, looked up on first use
+    probes_partitioned: Optional[bool] = None
+    # connection listening for task notifications, opened by the first
+    # lock_tasks, so that notifications sent before the worker waits are kept
+    listener: Optional[psycopg2.extensions.connection]
+    listener_lock: threading.Lock
+    # event loop watching the listener, the watched descriptor, and the event
+    # set on the loop when a notification arrives
+    listener_loop: Optional[asyncio.AbstractEventLoop]
+    listener_fd: Optional[int]
+    tasks_available: Optional[asyncio.Event]
 
-    def __init__(self, service_uri: str, prefix: str = "monico"):
+    def __init__(
+        self,
+        service_uri: str,
+        prefix: str = "monico",
+        pool_min_size: Optional[int] = None,
+        pool_max_size: Optional[int] = None,
+        probe_partitioning: Optional[ProbePartitioning] = None,
+        probe_retention: Optional[int] = None,
+        task_retention: Optional[int] = None,
+        transient_tasks: bool = False,
+    ):
         self.tables = TableConfig(
             monitors=prefix + "_monitors",
             tasks=prefix + "_tasks",
             probes=prefix + "_probes",
+            schema_version=prefix + "_schema_version",
+            rollups=prefix + "_rollups",
         )
         self.service_uri = service_uri
+        self.pool = ConnectionPool(
+            lambda: psycopg2.connect(self.service_uri),
+            min_size=self.POOL_MIN_SIZE if pool_min_size is None else pool_min_size,
+            max_size=self.POOL_MAX_SIZE if pool_max_size is None else pool_max_size,
+        )
+        self.probe_partitioning = probe_partitioning
+        self.probe_retention = probe_retention
+        self.task_retention = task_retention
+        self.transient_tasks = transient_tasks
+        self.listener = None
+        self.listener_lock = threading.Lock()
+        self.listener_loop = None
+        self.listener_fd = None
+        self.tasks_available = None
 
     def connect(self) -> None:
-        try:
-            self.conn = psycopg2.connect(self.service_uri)
-            query_sql = "SELECT VERSION()"
-            cur = self.conn.cursor()
-            cur.execute(query_sql)
+        self.pool.open()
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT VERSION()")
             _ = cur.fetchone()[0]
             cur.close()
-        except psycopg2.OperationalError as e:
-            raise StorageConnectionException(
-                f"Could not connect to PostgreSQL storage backend: {e}"
-            )
+            conn.rollback()
 
     def disconnect(self):
-        self.conn.close()
+        self._unlisten()
+        self.pool.close()
 
-    def setup(self, force=False):
-        if force:
-            self.teardown()
+    def connection(self):
+        """Context manager checking out a pooled connection"""
+        return self.pool.connection()
+
+    def metrics(self) -> dict:
+        return self.pool.metrics()
+
+    @property
+    def tasks_channel(self) -> str:
+        return self.tables.tasks
+
+    def _notify_tasks(self, cur: psycopg2.extensions.cursor) -> None:
+        # delivered on commit; notifications within a transaction are merged
+        cur.execute(f"NOTIFY {self.tasks_channel}")
+
+    def _open_listener(self) -> psycopg2.extensions.connection:
+        """
+        Opens the connection listening for task notifications, unless it's
+        open already. Notifications are kept by the connection until read.
+        """
+        with self.listener_lock:
+            if self.listener is None:
+                listener = psycopg2.connect(self.service_uri)
+                listener.autocommit = True
+                listener.cursor().execute(f"LISTEN {self.tasks_channel}")
+                self.listener = listener
+            return self.listener
+
+    def _listen(self) -> asyncio.Event:
+        """
+        Watches the listener on the running event loop. Returns the event set
+        when a notification arrives.
+        """
+        loop = asyncio.get_running_loop()
+        listener = self._open_listener()
+        if self.listener_loop is not loop:
+            self._stop_watching()
+            self.tasks_available = asyncio.Event()
+            self.listener_fd = listener.fileno()
+            self.listener_loop = loop
+            loop.add_reader(self.listener_fd, self._on_notification)
+            # notifications that arrived since LISTEN, e.g. while locking tasks
+            self._on_notification()
+        return self.tasks_available
+
+    def _on_notification(self):
+        try:
+            self.listener.poll()
+        except psycopg2.Error:
+            # connection is lost, it is re-opened on the next wait;
+            # wake the worker up, so that it polls in the meantime
+            self._unlisten()
+            self.tasks_available.set()
+            return
+        if self.listener.notifies:
+            self.listener.notifies.clear()
+            self.tasks_available.set()
 
-        cur = self.conn.cursor()
+    def _stop_watching(self):
+        if self.listener_loop is not None and not self.listener_loop.is_closed():
+            self.listener_loop.remove_reader(self.listener_fd)
+        self.listener_loop = None
+        self.listener_fd = None
+
+    def _unlisten(self):
+        self._stop_watching()
+        with self.listener_lock:
+            if self.listener is not None:
+                self.listener.close()
+                self.listener = None
+
+    async def wait_for_tasks(self, timeout: float):
         try:
+            tasks_available = self._listen()
+        except psycopg2.Error:
+            # notifications only cut latency, polling still works without them
+            await asyncio.sleep(timeout)
+            return False
+        try:
+            await asyncio.wait_for(tasks_available.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            tasks_available.clear()
+
+    def _create_tables(self, cur: psycopg2.extensions.cursor) -> None:
+        cur.execute(
+            f"""
+            CREATE TABLE {self.tables.monitors} (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                interval INT NOT NULL,
+                body_regexp TEXT NULL,
+                last_task_at INT NULL,
+                last_probe_at INT NULL,
+                created_at INT DEFAULT EXTRACT(EPOCH FROM NOW())
+            );
+            CREATE INDEX {self.tables.monitors}_last_probe_at_idx
+                ON {self.tables.monitors} (last_probe_at);
+            CREATE INDEX {self.tables.monitors}_created_at_idx
+                ON {self.tables.monitors} (created_at);
+        """
+        )
+        cur.execute(
+            f"""
+            CREATE TYPE {self.tables.tasks}_status AS ENUM (%s, %s, %s, %s, %s);
+            CREATE {"UNLOGGED " if self.transient_tasks else ""}TABLE {self.tables.tasks} (
+                id TEXT PRIMARY KEY,
+                timestamp INT NOT NULL,
+                fk_monitor TEXT NOT NULL,
+                status {self.tables.tasks}_status NOT NULL,
+                locked_at INT NULL,
+                locked_by TEXT NULL,
+                completed_at INT NULL,
+                CONSTRAINT fk_monitor
+                    FOREIGN KEY(fk_monitor)
+                        REFERENCES {self.tables.monitors}(id) ON DELETE CASCADE
+            );
+            CREATE INDEX {self.tables.tasks}_fk_monitor_idx
+                ON {self.tables.tasks} (fk_monitor);
+        """,
+            (
+                TaskStatus.PENDING.value,
+                TaskStatus.RUNNING.value,
+                TaskStatus.COMPLETED.value,
+                TaskStatus.ABANDONED.value,
+                TaskStatus.FAILED.value,
+            ),
+        )
+        partitioned = self.probe_partitioning is not None
+        task_reference = f"""
+            , CONSTRAINT fk_task
+                FOREIGN KEY(fk_task)
+                    REFERENCES {self.tables.tasks}(id)
+                        ON DELETE SET NULL
+        """
+        if self.transient_tasks:
+            # a logged table can't reference an unlogged one
+            task_reference = ""
+        cur.execute(
+            f"""
+            CREATE TYPE {self.tables.probes}_response_error AS ENUM (%s, %s);
+            CREATE TABLE {self.tables.probes} (
+                id TEXT NOT NULL,
+                timestamp INT NOT NULL,
+                fk_monitor TEXT NOT NULL,
+                fk_task TEXT NULL,
+                response_time FLOAT NULL,
+                response_code INT NULL,
+                response_error {self.tables.probes}_response_error NULL,
+                content_match TEXT NULL,
+                PRIMARY KEY ({"id, timestamp" if partitioned else "id"}),
+                CONSTRAINT fk_monitor
+                    FOREIGN KEY(fk_monitor)
+                        REFERENCES {self.tables.monitors}(id)
+                            ON DELETE CASCADE
+                {task_reference}
+            ) {"PARTITION BY RANGE (timestamp)" if partitioned else ""};
+        """,
+            (
+                ProbeResponseError.TIMEOUT.value,
+                ProbeResponseError.CONNECTION_ERROR.value,
+            ),
+        )
+        if partitioned:
+            # indexes of a partitioned table can't be built concurrently, so
+            # the list_probes index is created here instead of by migration 2
             cur.execute(
                 f"""
-                CREATE TABLE {self.tables.monitors} (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL,
-                    endpoint TEXT NOT NULL,
-                    interval INT NOT NULL,
-                    body_regexp TEXT NULL,
-                    last_task_at INT NULL,
-                    last_probe_at INT NULL,
-                    created_at INT DEFAULT EXTRACT(EPOCH FROM NOW())
-                );
-                CREATE INDEX {self.tables.monitors}_last_probe_at_idx
-                    ON {self.tables.monitors} (last_probe_at);
-                CREATE INDEX {self.tables.monitors}_created_at_idx
-                    ON {self.tables.monitors} (created_at);
+                CREATE INDEX {self.tables.probes}_fk_monitor_timestamp_idx
+                    ON {self.tables.probes} (fk_monitor, timestamp DESC);
+                """
+            )
+            self._create_probe_partitions(cur, int(time.time()))
+            return
+        cur.execute(
+            f"""
+            CREATE INDEX {self.tables.probes}_timestamp_idx
+                ON {self.tables.probes} (timestamp);
+            CREATE INDEX {self.tables.probes}_fk_monitor_idx
+                ON {self.tables.probes} (fk_monitor);
+        """
+        )
+
+    def _is_partitioned(self, cur: psycopg2.extensions.cursor, table: str) -> bool:
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))",
+            (table,),
+        )
+        return cur.fetchone()[0]
+
+    def _probes_are_partitioned(self, cur: psycopg2.extensions.cursor) -> bool:
+        if self.probes_partitioned is None:
+            self.probes_partitioned = self._is_partitioned(cur, self.tables.probes)
+        return self.probes_partitioned
+
+    def _probe_partitions(self, cur: psycopg2.extensions.cursor) -> [(str, int, int)]:
+        """Returns names and bounds of probe partitions, oldest first"""
+        cur.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+                JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass(%s)
+            """,
+            (self.tables.probes,),
+        )
+        partitions = []
+        for name, bound in cur.fetchall():
+            match = re.search(r"FROM \('?(-?\d+)'?\) TO \('?(-?\d+)'?\)", bound)
+            if match:
+                partitions.append((name, int(match[1]), int(match[2])))
+        return sorted(partitions, key=lambda p: p[1])
+
+    def _create_probe_partitions(
+        self, cur: psycopg2.extensions.cursor, now: int
+    ) -> int:
+        """
+        Creates partitions for the current and the next PROBE_PARTITIONS_AHEAD
+        periods, and the default partition catching probes outside of them.
+        Returns the number of created periodic partitions.
+        """
+        default = f"{self.tables.probes}_default"
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {default}
+                PARTITION OF {self.tables.probes} DEFAULT
             """
+        )
+        partitions = self._probe_partitions(cur)
+        if partitions:
+            # continue after the newest partition, with the same period
+            _, lower, start = partitions[-1]
+            period = start - lower
+        else:
+            partitioning = self.probe_partitioning or ProbePartitioning.DAY
+            start = partitioning.period_start(now)
+            period = partitioning.period
+
+        created = 0
+        while start <= now + self.PROBE_PARTITIONS_AHEAD * period:
+            name = (
+                f"{self.tables.probes}_p{time.strftime('%Y%m%d', time.gmtime(start))}"
             )
             cur.execute(
                 f"""
-                CREATE TYPE {self.tables.tasks}_status AS ENUM (%s, %s, %s, %s, %s);
-                CREATE TABLE {self.tables.tasks} (
-                    id TEXT PRIMARY KEY,
-                    timestamp INT NOT NULL,
-                    fk_monitor TEXT NOT NULL,
-                    status {self.tables.tasks}_status NOT NULL,
-                    locked_at INT NULL,
-                    locked_by TEXT NULL,
-                    completed_at INT NULL,
-                    CONSTRAINT fk_monitor
-                        FOREIGN KEY(fk_monitor)
-                            REFERENCES {self.tables.monitors}(id) ON DELETE CASCADE
-                );
-                CREATE INDEX {self.tables.tasks}_fk_monitor_idx
-                    ON {self.tables.tasks} (fk_monitor);
-            """,
-                (
-                    TaskStatus.PENDING.value,
-                    TaskStatus.RUNNING.value,
-                    TaskStatus.COMPLETED.value,
-                    TaskStatus.ABANDONED.value,
-                    TaskStatus.FAILED.value,
-                ),
+                SELECT EXISTS (
+                    SELECT 1 FROM {default} WHERE timestamp >= %s AND timestamp < %s
+                )
+                """,
+                (start, start + period),
             )
+            if cur.fetchone()[0]:
+                # probes recorded before the partition existed are in the default
+                # partition, where they would conflict with the new one; they are
+                # moved to the new table before it's attached
+                cur.execute(
+                    f"""
+                    CREATE TABLE {name} (LIKE {self.tables.probes} INCLUDING DEFAULTS);
+                    WITH moved AS (
+                        DELETE FROM {default}
+                        WHERE timestamp >= %(start)s AND timestamp < %(end)s
+                        RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved;
+                    ALTER TABLE {self.tables.probes} ATTACH PARTITION {name}
+                        FOR VALUES FROM (%(start)s) TO (%(end)s);
+                    """,
+                    {"start": start, "end": start + period},
+                )
+            else:
+                cur.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {name}
+                        PARTITION OF {self.tables.probes}
+                        FOR VALUES FROM (%s) TO (%s)
+                    """,
+                    (start, start + period),
+                )
+            start += period
+            created += 1
+        return created
+
+    def _drop_probe_partitions(self, cur: psycopg2.extensions.cursor, now: int) -> int:
+        """
+        Drops partitions holding only probes older than the retention period.
+        Expired probes of the default partition are deleted from it.
+        Returns the number of dropped partitions.
+        """
+        if self.probe_retention is None:
+            return 0
+        dropped = 0
+        for name, _, upper in self._probe_partitions(cur):
+            if upper <= now - self.probe_retention:
+                cur.execute(f"DROP TABLE {name}")
+                dropped += 1
+        default = f"{self.tables.probes}_default"
+        if self._table_exists(cur, default):
             cur.execute(
-                f"""
-                CREATE TYPE {self.tables.probes}_response_error AS ENUM (%s, %s);
-                CREATE TABLE {self.tables.probes} (
-                    id TEXT PRIMARY KEY,
-                    timestamp INT NOT NULL,
-                    fk_monitor TEXT NOT NULL,
-                    fk_task TEXT NULL,
-                    response_time FLOAT NULL,
-                    response_code INT NULL,
-                    response_error {self.tables.probes}_response_error NULL,
-                    content_match TEXT NULL,
-                    CONSTRAINT fk_monitor
-                        FOREIGN KEY(fk_monitor)
-                            REFERENCES {self.tables.monitors}(id)
-                                ON DELETE CASCADE,
-                    CONSTRAINT fk_task
-                        FOREIGN KEY(fk_task)
-                            REFERENCES {self.tables.tasks}(id)
-                                ON DELETE SET NULL
-                );
-                CREATE INDEX {self.tables.probes}_timestamp_idx
-                    ON {self.tables.probes} (timestamp);
-                CREATE INDEX {self.tables.probes}_fk_monitor_idx
-                    ON {self.tables.probes} (fk_monitor);
+                f"DELETE FROM {default} WHERE timestamp < %s",
+                (now - self.probe_retention,),
+            )
+        return dropped
+
+    def _create_index_concurrently(
+        self, cur: psycopg2.extensions.cursor, name: str, definition: str
+    ) -> None:
+        """
+        Builds an index without blocking writes to the table.
+        A concurrent build that failed half-way leaves an invalid index
+        behind, which is dropped and built again.
+        """
+        cur.execute(
+            """
+            SELECT i.indisvalid FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s
             """,
-                (
-                    ProbeResponseError.TIMEOUT.value,
-                    ProbeResponseError.CONNECTION_ERROR.value,
-                ),
+            (name,),
+        )
+        row = cur.fetchone()
+        if row is not None and row[0]:
+            return
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+        cur.execute(f"CREATE INDEX CONCURRENTLY {name} {definition}")
+
+    def _create_hot_path_indexes(self, cur: psycopg2.extensions.cursor) -> None:
+        # lock_tasks: oldest pending tasks first
+        self._create_index_concurrently(
+            cur,
+            f"{self.tables.tasks}_pending_timestamp_idx",
+            f"ON {self.tables.tasks} (timestamp) "
+            f"WHERE status = '{TaskStatus.PENDING.value}'",
+        )
+        if self._is_partitioned(cur, self.tables.probes):
+            # partitioned table is set up with the index below
+            return
+        # list_probes: latest probes of a monitor first
+        self._create_index_concurrently(
+            cur,
+            f"{self.tables.probes}_fk_monitor_timestamp_idx",
+            f"ON {self.tables.probes} (fk_monitor, timestamp DESC)",
+        )
+        # covered by the composite index above
+        cur.execute(
+            f"DROP INDEX CONCURRENTLY IF EXISTS {self.tables.probes}_fk_monitor_idx"
+        )
+
+    def _create_due_monitors_index(self, cur: psycopg2.extensions.cursor) -> None:
+        # claim_monitors: monitors that are due the longest first
+        self._create_index_concurrently(
+            cur,
+            f"{self.tables.monitors}_due_at_idx",
+            f"ON {self.tables.monitors} ({MONITOR_DUE_AT_SQL})",
+        )
+
+    def _create_probes_task_index(self, cur: psycopg2.extensions.cursor) -> None:
+        # deleting a task sets fk_task of its probes to NULL
+        self._create_probe_index_concurrently(cur, "fk_task_idx", "(fk_task)")
+
+    def _create_probe_index_concurrently(
+        self, cur: psycopg2.extensions.cursor, suffix: str, columns: str
+    ) -> None:
+        """Builds an index of the probes table, which may be partitioned"""
+        name = f"{self.tables.probes}_{suffix}"
+        if not self._is_partitioned(cur, self.tables.probes):
+            self._create_index_concurrently(
+                cur, name, f"ON {self.tables.probes} {columns}"
             )
-            cur.close()
-            self.conn.commit()
-        except psycopg2.errors.DuplicateTable as e:
-            self.conn.rollback()
-            raise StorageSetupException("Storage already initialized")
+            return
+        # indexes of partitions are built concurrently one by one, then attached
+        # to an index of the partitioned table, which becomes valid with the last
+        cur.execute(
+            f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {self.tables.probes} {columns}"
+        )
+        partitions = [name for (name, _, _) in self._probe_partitions(cur)]
+        if self._table_exists(cur, f"{self.tables.probes}_default"):
+            partitions.append(f"{self.tables.probes}_default")
+        for partition in partitions:
+            self._create_index_concurrently(
+                cur, f"{partition}_{suffix}", f"ON {partition} {columns}"
+            )
+            cur.execute(f"ALTER INDEX {name} ATTACH PARTITION {partition}_{suffix}")
 
-    def teardown(self):
-        cur = self.conn.cursor()
+    def _create_table_rollups(self, cur: psycopg2.extensions.cursor) -> None:
+        if self._table_exists(cur, self.tables.rollups):
+            return
+        columns = ", ".join(f"{name} {kind}" for (name, kind) in ROLLUP_COLUMNS)
         cur.execute(
             f"""
-            DROP TABLE IF EXISTS {self.tables.probes};
-            DROP TYPE IF EXISTS {self.tables.probes}_response_error;
-            DROP TABLE IF EXISTS {self.tables.tasks};
-            DROP TYPE IF EXISTS {self.tables.tasks}_status;
-            DROP TABLE IF EXISTS {self.tables.monitors};
+            CREATE TABLE {self.tables.rollups} (
+                {columns},
+                PRIMARY KEY (fk_monitor, resolution, bucket),
+                CONSTRAINT fk_monitor
+                    FOREIGN KEY(fk_monitor)
+                        REFERENCES {self.tables.monitors}(id) ON DELETE CASCADE
+            );
+            -- retention of fine rollups
+            CREATE INDEX {self.tables.rollups}_resolution_bucket_idx
+                ON {self.tables.rollups} (resolution, bucket);
             """
         )
-        cur.close()
-        self.conn.commit()
+        for resolution in RESOLUTIONS:
+            cur.execute(
+                rollup_backfill_sql(self.tables.rollups, self.tables.probes, resolution)
+            )
 
-    def create_monitor(self, monitor):
-        if not monitor.id:
-            monitor.id = str(uuid.uuid4())
-        cur = self.conn.cursor()
-        try:
+    def _reference_surrogate_key(
+        self,
+        cur: psycopg2.extensions.cursor,
+        table: str,
+        column: str,
+        parent: str,
+        kind: str,
+        on_delete: Optional[str],
+    ) -> None:
+        """
+        Replaces a column referencing text IDs of the parent table with one
+        referencing its surrogate keys. Indexes on the column are dropped
+        with it. The foreign key is left out if on_delete is None.
+        """
+        cur.execute(
+            f"""
+            ALTER TABLE {table} ADD COLUMN {column}_seq {kind} NULL;
+            UPDATE {table} c SET {column}_seq = x.seq
+                FROM {parent} x WHERE x.id = c.{column};
+            ALTER TABLE {table} DROP COLUMN {column};
+            ALTER TABLE {table} RENAME COLUMN {column}_seq TO {column};
+            """
+        )
+        if on_delete is not None:
             cur.execute(
-                f"INSERT INTO {self.tables.monitors} (id, name, endpoint, interval, body_regexp) VALUES (%s, %s, %s, %s, %s)",
-                (
-                    monitor.id,
-                    monitor.name,
-                    monitor.endpoint,
-                    monitor.interval,
-                    monitor.body_regexp,
-                ),
+                f"""
+                ALTER TABLE {table} ADD CONSTRAINT {column} FOREIGN KEY({column})
+                    REFERENCES {parent}(seq) ON DELETE {on_delete};
+                """
             )
-            self.conn.commit()
-            return Monitor(
-                monitor.id,
-                monitor.name,
-                monitor.endpoint,
-                monitor.interval,
-                monitor.body_regexp,
+
+    def _create_compact_tables(self, cur: psycopg2.extensions.cursor) -> None:
+        """
+        Monitors and tasks get integer surrogate keys, which replace their
+        text IDs in references; enums become small int codes, and probe IDs
+        the uuid type. Columns are converted in place, with the tables locked;
+        indexes on the converted columns are built by the next migrations,
+        without blocking writes.
+        """
+        if self._column_exists(cur, self.tables.monitors, "seq"):
+            # unversioned storage that already has the compact layout
+            return
+        monitors, tasks, probes, rollups = (
+            self.tables.monitors,
+            self.tables.tasks,
+            self.tables.probes,
+            self.tables.rollups,
+        )
+        cur.execute(
+            f"""
+            ALTER TABLE {monitors}
+                ADD COLUMN seq INT GENERATED ALWAYS AS IDENTITY UNIQUE;
+            """
+        )
+        unlogged_tasks = self._is_unlogged(cur, tasks)
+        if unlogged_tasks:
+            # the identity sequence of an unlogged table is unlogged too, and
+            # would restart after a crash; probes keep referencing the lost
+            # tasks, so their keys come from a logged sequence instead
+            cur.execute(
+                f"""
+                CREATE SEQUENCE {tasks}_seq;
+                ALTER TABLE {tasks}
+                    ADD COLUMN seq BIGINT NOT NULL
+                        DEFAULT nextval('{tasks}_seq') UNIQUE;
+                """
             )
-        except psycopg2.errors.UniqueViolation:
-            self.conn.rollback()
-            raise MonitorAlreadyExistsException(
-                f'Monitor with ID "{monitor.id}" already exists'
+        else:
+            cur.execute(
+                f"""
+                ALTER TABLE {tasks}
+                    ADD COLUMN seq BIGINT GENERATED ALWAYS AS IDENTITY UNIQUE;
+                """
             )
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+        self._reference_surrogate_key(
+            cur, tasks, "fk_monitor", monitors, "INT", "CASCADE"
+        )
+        self._reference_surrogate_key(
+            cur, probes, "fk_monitor", monitors, "INT", "CASCADE"
+        )
+        self._reference_surrogate_key(
+            cur,
+            probes,
+            "fk_task",
+            tasks,
+            "BIGINT",
+            None if unlogged_tasks else "SET NULL",
+        )
+        self._reference_surrogate_key(
+            cur, rollups, "fk_monitor", monitors, "INT", "CASCADE"
+        )
+        # type changes rewrite the tables, which also frees the space of
+        # the dropped text columns
+        cur.execute(
+            f"""
+            ALTER TABLE {tasks} ALTER COLUMN fk_monitor SET NOT NULL;
+            DROP INDEX {tasks}_pending_timestamp_idx;
+            ALTER TABLE {tasks} ALTER COLUMN status TYPE SMALLINT
+                USING ({enum_code_sql("status::text", TASK_STATUS_CODES)})::smallint;
+            DROP TYPE {tasks}_status;
 
-    def list_monitors(
-        self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
-    ):
-        cur = self.conn.cursor()
+            ALTER TABLE {probes} ALTER COLUMN fk_monitor SET NOT NULL;
+            ALTER TABLE {probes}
+                ALTER COLUMN id TYPE UUID USING id::uuid,
+                ALTER COLUMN response_error TYPE SMALLINT
+                    USING ({enum_code_sql("response_error::text", PROBE_ERROR_CODES)})::smallint;
+            DROP TYPE {probes}_response_error;
 
-        sort_postfix_map = {
-            MonitorSortingOrder.CREATED_AT_ASC: "created_at ASC",
-            MonitorSortingOrder.LAST_TASK_AT_DESC: "last_task_at DESC",
-        }
+            ALTER TABLE {rollups} ALTER COLUMN fk_monitor SET NOT NULL;
+            ALTER TABLE {rollups} ADD PRIMARY KEY (fk_monitor, resolution, bucket);
+            """
+        )
+
+    def _create_compact_indexes(self, cur: psycopg2.extensions.cursor) -> None:
+        """Indexes on the columns converted by migration 5"""
+        tasks = self.tables.tasks
+        self._create_index_concurrently(
+            cur, f"{tasks}_fk_monitor_idx", f"ON {tasks} (fk_monitor)"
+        )
+        self._create_index_concurrently(
+            cur,
+            f"{tasks}_pending_timestamp_idx",
+            f"ON {tasks} (timestamp) "
+            f"WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}",
+        )
+        self._create_probe_index_concurrently(
+            cur, "fk_monitor_timestamp_idx", "(fk_monitor, timestamp DESC)"
+        )
+        self._create_probe_index_concurrently(cur, "fk_task_idx", "(fk_task)")
+
+    def migrations(self) -> [Migration]:
+        """Schema migrations, ordered by version"""
+        return [
+            Migration(
+                BASELINE_VERSION,
+                "create monitors, tasks and probes tables",
+                self._create_tables,
+            ),
+            Migration(
+                2,
+                "add pending tasks and latest probes indexes",
+                self._create_hot_path_indexes,
+                transactional=False,
+            ),
+            Migration(
+                3,
+                "add probes task index",
+                self._create_probes_task_index,
+                transactional=False,
+            ),
+            Migration(
+                4,
+                "add probe rollups",
+                self._create_table_rollups,
+            ),
+            Migration(
+                5,
+                "store integer references and enum codes",
+                self._create_compact_tables,
+            ),
+            Migration(
+                6,
+                "add due monitors index",
+                self._create_due_monitors_index,
+                transactional=False,
+            ),
+            Migration(
+                7,
+                "rebuild indexes of integer references and enum codes",
+                self._create_compact_indexes,
+                transactional=False,
+            ),
+        ]
 
+    def _table_exists(self, cur: psycopg2.extensions.cursor, table: str) -> bool:
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        return cur.fetchone()[0] is not None
+
+    def _is_unlogged(self, cur: psycopg2.extensions.cursor, table: str) -> bool:
         cur.execute(
-            f"SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at FROM {self.tables.monitors} ORDER BY {sort_postfix_map[sort]}",
+            "SELECT relpersistence = 'u' FROM pg_class WHERE oid = to_regclass(%s)",
+            (table,),
         )
-        rows = cur.fetchall()
-        cur.close()
-        return [Monitor(*row) for row in rows]
+        return cur.fetchone()[0]
 
-    def read_monitor(self, id):
-        cur = self.conn.cursor()
+    def _column_exists(
+        self, cur: psycopg2.extensions.cursor, table: str, column: str
+    ) -> bool:
         cur.execute(
-            f"SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at FROM {self.tables.monitors} WHERE id = %s",
-            (id,),
+            """
+            SELECT 1 FROM pg_attribute
+            WHERE attrelid = to_regclass(%s) AND attname = %s AND NOT attisdropped
+            """,
+            (table, column),
         )
-        row = cur.fetchone()
-        if not row:
-            raise MonitorNotFoundException(f'Monitor with ID "{id}" not found')
-        cur.close()
-        return Monitor(*row)
+        return cur.fetchone() is not None
 
-    def delete_monitor(self, id):
-        cur = self.conn.cursor()
-        try:
-            monitor = self.read_monitor(id)
-            cur.execute(f"DELETE FROM {self.tables.monitors} WHERE id = %s", (id,))
-            cur.close()
-            self.conn.commit()
-            return monitor
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+    def _create_table_schema_version(self, cur: psycopg2.extensions.cursor) -> None:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.tables.schema_version} (
+                version INT PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at INT DEFAULT EXTRACT(EPOCH FROM NOW())
+            );
+            """
+        )
 
-    def create_task(self, task: Task):
-        cur = self.conn.cursor()
-        try:
+    def _record_migration(
+        self, cur: psycopg2.extensions.cursor, migration: Migration
+    ) -> None:
+        cur.execute(
+            f"""
+            INSERT INTO {self.tables.schema_version} (version, description)
+            VALUES (%s, %s)
+            """,
+            (migration.version, migration.description),
+        )
+
+    def _schema_version(self, cur: psycopg2.extensions.cursor) -> int:
+        if not self._table_exists(cur, self.tables.schema_version):
+            return 0
+        cur.execute(f"SELECT MAX(version) FROM {self.tables.schema_version}")
+        return cur.fetchone()[0] or 0
+
+    def schema_version(self) -> int:
+        """Returns version of the latest applied migration"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                return self._schema_version(cur)
+            finally:
+                cur.close()
+                conn.rollback()
+
+    def _apply_migrations(self, migrations: [Migration]) -> [Migration]:
+        with self.connection() as conn:
+            cur = conn.cursor()
+            # session-level lock serializing concurrent `monico migrate` runs
             cur.execute(
-                f"INSERT INTO {self.tables.tasks} (id, timestamp, fk_monitor, status) VALUES (%s, %s, %s, %s)",
-                (task.id, task.timestamp, task.monitor_id, task.status.value),
+                "SELECT pg_advisory_lock(hashtext(%s))", (self.tables.schema_version,)
+            )
+            try:
+                # migrations may have been applied while waiting for the lock
+                version = self._schema_version(cur)
+                migrations = [m for m in migrations if m.version > version]
+                self._create_table_schema_version(cur)
+                conn.commit()
+                for migration in migrations:
+                    if migration.transactional:
+                        migration.apply(cur)
+                        self._record_migration(cur, migration)
+                        conn.commit()
+                        continue
+                    # e.g. CREATE INDEX CONCURRENTLY can't run inside a transaction
+                    conn.autocommit = True
+                    try:
+                        migration.apply(cur)
+                        self._record_migration(cur, migration)
+                    finally:
+                        conn.autocommit = False
+                return migrations
+            except psycopg2.errors.DuplicateTable:
+                conn.rollback()
+                raise StorageSetupException("Storage already initialized")
+            except psycopg2.Error as e:
+                conn.rollback()
+                raise StorageSetupException(
+                    f"Could not migrate PostgreSQL storage backend: {e}"
+                )
+            finally:
+                cur.execute(
+                    "SELECT pg_advisory_unlock(hashtext(%s))",
+                    (self.tables.schema_version,),
+                )
+                conn.commit()
+                cur.close()
+
+    def setup(self, force=False):
+        self.probes_partitioned = None
+        with self.connection() as conn:
+            if force:
+                self.teardown()
+
+            cur = conn.cursor()
+            try:
+                if self._table_exists(cur, self.tables.monitors):
+                    raise StorageSetupException("Storage already initialized")
+            finally:
+                cur.close()
+                conn.rollback()
+            self._apply_migrations(self.migrations())
+
+    def check_schema(self):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if not self._table_exists(cur, self.tables.monitors):
+                    return
+                version = self._schema_version(cur)
+            finally:
+                cur.close()
+                conn.rollback()
+        check_schema_version(version)
+
+    def migrate(self) -> [Migration]:
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if not self._table_exists(cur, self.tables.schema_version):
+                    if not self._table_exists(cur, self.tables.monitors):
+                        raise StorageSetupException(
+                            "Storage is not initialized. Run `monico setup` first."
+                        )
+                    # database set up before schema versioning has the baseline
+                    self._create_table_schema_version(cur)
+                    self._record_migration(cur, self.migrations()[0])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+            return self._apply_migrations(
+                pending_migrations(self.migrations(), self.schema_version())
             )
+
+    def teardown(self):
+        self.probes_partitioned = None
+        with self.connection() as conn:
+            cur = conn.cursor()
             cur.execute(
-                f"UPDATE {self.tables.monitors} SET last_task_at = %s WHERE id = %s",
-                (task.timestamp, task.monitor_id),
+                f"""
+                DROP TABLE IF EXISTS {self.tables.schema_version};
+                DROP TABLE IF EXISTS {self.tables.rollups};
+                DROP TABLE IF EXISTS {self.tables.probes};
+                DROP TYPE IF EXISTS {self.tables.probes}_response_error;
+                DROP TABLE IF EXISTS {self.tables.tasks};
+                DROP TYPE IF EXISTS {self.tables.tasks}_status;
+                DROP SEQUENCE IF EXISTS {self.tables.tasks}_seq;
+                DROP TABLE IF EXISTS {self.tables.monitors};
+                """
             )
-            self.conn.commit()
-            return task
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
             cur.close()
+            conn.commit()
 
-    def lock_tasks(self, worker_id: str, batch_size: int) -> [Task]:
-        cur = self.conn.cursor()
-        try:
+    def _maintain_probe_partitions(self, conn, cur, now: int) -> dict:
+        stats = {}
+        for key, step in [
+            ("probe_partitions_created", self._create_probe_partitions),
+            ("probe_partitions_dropped", self._drop_probe_partitions),
+        ]:
+            # concurrent managers don't repeat each other's work
+            cur.execute(
+                "SELECT pg_try_advisory_xact_lock(hashtext(%s))",
+                (self.tables.probes,),
+            )
+            if not cur.fetchone()[0]:
+                break
+            cur.execute("SET LOCAL lock_timeout = %s", (self.MAINTENANCE_LOCK_TIMEOUT,))
+            stats[key] = step(cur, now)
+            conn.commit()
+        return stats
+
+    def _delete_in_batches(
+        self, conn, cur, table: str, condition: str, params: tuple, key: str = "id"
+    ) -> int:
+        """
+        Deletes rows matching the condition, MAINTENANCE_BATCH_SIZE rows per
+        transaction. Rows of a batch are deleted by the key columns, which
+        should be indexed. Returns the number of deleted rows.
+        """
+        deleted = 0
+        for _ in range(self.MAINTENANCE_MAX_BATCHES):
+            # rows locked by writers, or by another manager, are left for later
             cur.execute(
                 f"""
-                UPDATE {self.tables.tasks} SET status = %s, locked_at = EXTRACT(EPOCH FROM NOW()), locked_by = %s
-                WHERE id IN (
-                    SELECT id FROM {self.tables.tasks}
-                    WHERE status = %s
-                    ORDER BY timestamp ASC
+                DELETE FROM {table} WHERE ({key}) IN (
+                    SELECT {key} FROM {table}
+                    WHERE {condition}
                     LIMIT %s
+                    FOR UPDATE SKIP LOCKED
                 )
-                RETURNING id, timestamp, fk_monitor, status, locked_at, locked_by, completed_at;
                 """,
-                (
-                    TaskStatus.RUNNING.value,
-                    worker_id,
-                    TaskStatus.PENDING.value,
-                    batch_size,
-                ),
+                params + (self.MAINTENANCE_BATCH_SIZE,),
+            )
+            conn.commit()
+            deleted += cur.rowcount
+            if cur.rowcount < self.MAINTENANCE_BATCH_SIZE:
+                break
+            time.sleep(self.MAINTENANCE_BATCH_PAUSE)
+        return deleted
+
+    def maintain(self) -> dict:
+        """
+        Enforces retention: drops expired probe partitions, or deletes expired
+        probes in small batches, and deletes finished tasks and fine rollups
+        the same way.
+        Tables with deleted rows are vacuumed and analyzed.
+        """
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                now = int(time.time())
+                stats = {}
+                vacuum = []
+                if self._probes_are_partitioned(cur):
+                    stats.update(self._maintain_probe_partitions(conn, cur, now))
+                elif self.probe_retention is not None:
+                    stats["probes_deleted"] = self._delete_in_batches(
+                        conn,
+                        cur,
+                        self.tables.probes,
+                        "timestamp < %s",
+                        (now - self.probe_retention,),
+                    )
+                    if stats["probes_deleted"]:
+                        vacuum.append(self.tables.probes)
+                if self.task_retention is not None:
+                    finished = ", ".join(
+                        str(TASK_STATUS_CODES[status])
+                        for status in (
+                            TaskStatus.COMPLETED,
+                            TaskStatus.ABANDONED,
+                            TaskStatus.FAILED,
+                        )
+                    )
+                    stats["tasks_deleted"] = self._delete_in_batches(
+                        conn,
+                        cur,
+                        self.tables.tasks,
+                        f"status IN ({finished}) AND timestamp < %s",
+                        (now - self.task_retention,),
+                    )
+                    if stats["tasks_deleted"]:
+                        vacuum.append(self.tables.tasks)
+                stats["rollups_deleted"] = 0
+                for resolution, retention in RETENTION.items():
+                    stats["rollups_deleted"] += self._delete_in_batches(
+                        conn,
+                        cur,
+                        self.tables.rollups,
+                        "resolution = %s AND bucket < %s",
+                        (resolution, now - retention),
+                        # selected by the (resolution, bucket) index,
+                        # deleted by the primary key
+                        key="fk_monitor, resolution, bucket",
+                    )
+                if stats["rollups_deleted"]:
+                    vacuum.append(self.tables.rollups)
+                conn.commit()
+
+                # marks space of deleted rows for reuse without waiting for
+                # autovacuum; VACUUM can't run inside a transaction
+                conn.autocommit = True
+                try:
+                    for table in vacuum:
+                        cur.execute(f"VACUUM (ANALYZE) {table}")
+                finally:
+                    conn.autocommit = False
+                return stats
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+                conn.rollback()
+
+    def create_monitor(self, monitor):
+        with self.connection() as conn:
+            if not monitor.id:
+                monitor.id = str(uuid.uuid4())
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    f"INSERT INTO {self.tables.monitors} (id, name, endpoint, interval, body_regexp) VALUES (%s, %s, %s, %s, %s)",
+                    (
+                        monitor.id,
+                        monitor.name,
+                        monitor.endpoint,
+                        monitor.interval,
+                        monitor.body_regexp,
+                    ),
+                )
+                conn.commit()
+                return Monitor(
+                    monitor.id,
+                    monitor.name,
+                    monitor.endpoint,
+                    monitor.interval,
+                    monitor.body_regexp,
+                )
+            except psycopg2.errors.UniqueViolation:
+                conn.rollback()
+                raise MonitorAlreadyExistsException(
+                    f'Monitor with ID "{monitor.id}" already exists'
+                )
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def list_monitors(
+        self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
+    ):
+        with self.connection() as conn:
+            cur = conn.cursor()
+
+            sort_postfix_map = {
+                MonitorSortingOrder.CREATED_AT_ASC: "created_at ASC",
+                MonitorSortingOrder.LAST_TASK_AT_DESC: "last_task_at DESC",
+            }
+
+            cur.execute(
+                f"SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at FROM {self.tables.monitors} ORDER BY {sort_postfix_map[sort]}",
             )
             rows = cur.fetchall()
-            self.conn.commit()
-            return [Task(*row) for row in rows]
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
             cur.close()
+            return [Monitor(*row) for row in rows]
 
-    def update_task(self, task: Task):
-        cur = self.conn.cursor()
-        try:
+    def read_monitor(self, id):
+        with self.connection() as conn:
+            cur = conn.cursor()
             cur.execute(
-                f"""
-                UPDATE {self.tables.tasks} SET
-                    status = %s,
-                    completed_at = %s
-                WHERE id = %s
-                """,
-                (task.status.value, task.completed_at, task.id),
+                f"SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at FROM {self.tables.monitors} WHERE id = %s",
+                (id,),
             )
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
+            row = cur.fetchone()
+            if not row:
+                raise MonitorNotFoundException(f'Monitor with ID "{id}" not found')
             cur.close()
+            return Monitor(*row)
 
-    def record_probe(self, probe: Probe):
-        cur = self.conn.cursor()
+    def delete_monitor(self, id):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                monitor = self.read_monitor(id)
+                cur.execute(f"DELETE FROM {self.tables.monitors} WHERE id = %s", (id,))
+                cur.close()
+                conn.commit()
+                return monitor
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def create_task(self, task: Task):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    f"""
+                    INSERT INTO {self.tables.tasks}
+                        (id, timestamp, fk_monitor, status, locked_at, locked_by)
+                    VALUES (
+                        %s,
+                        %s,
+                        (SELECT seq FROM {self.tables.monitors} WHERE id = %s),
+                        %s,
+                        %s,
+                        %s
+                    )
+                    """,
+                    (
+                        task.id,
+                        task.timestamp,
+                        task.monitor_id,
+                        TASK_STATUS_CODES[task.status],
+                        task.locked_at,
+                        task.locked_by,
+                    ),
+                )
+                cur.execute(
+                    f"UPDATE {self.tables.monitors} SET last_task_at = %s WHERE id = %s",
+                    (task.timestamp, task.monitor_id),
+                )
+                if task.status == TaskStatus.PENDING:
+                    # tasks created locked are handed to a worker directly
+                    self._notify_tasks(cur)
+                conn.commit()
+                return task
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def _select_tasks_with_affinity(
+        self, cur, batch_size: int, affinity: HostAffinity
+    ) -> [str]:
+        cur.execute(
+            f"""
+            SELECT t.id, t.timestamp, m.endpoint
+            FROM {self.tables.tasks} t
+                JOIN {self.tables.monitors} m ON m.seq = t.fk_monitor
+            WHERE t.status = {TASK_STATUS_CODES[TaskStatus.PENDING]}
+            ORDER BY t.timestamp ASC
+            LIMIT %s
+            """,
+            (affinity.scan_size(batch_size),),
+        )
+        return affinity.select(cur.fetchall(), batch_size, int(time.time()))
+
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
         try:
-            # record probe data
-            cur.execute(
-                f"""
-                INSERT INTO {self.tables.probes} (id, timestamp, fk_monitor, fk_task, response_time, response_code, response_error, content_match)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            # listens before looking for tasks, so that tasks issued after an
+            # empty batch wake up the worker waiting for them
+            self._open_listener()
+        except psycopg2.Error:
+            # notifications only cut latency, polling still works without them
+            pass
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                # candidates are locked with SKIP LOCKED, so that concurrent
+                # workers claim disjoint batches instead of waiting on each other
+                if affinity is None:
+                    claim = f"""
+                        SELECT id FROM {self.tables.tasks}
+                        WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}
+                        ORDER BY timestamp ASC
+                        LIMIT %s
+                        FOR UPDATE SKIP LOCKED
+                    """
+                    params = (batch_size,)
+                else:
+                    ids = self._select_tasks_with_affinity(cur, batch_size, affinity)
+                    # status is re-checked, so that tasks locked by a concurrent
+                    # worker since they were selected are skipped
+                    claim = f"""
+                        SELECT id FROM {self.tables.tasks}
+                        WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}
+                            AND id = ANY(%s::text[])
+                        FOR UPDATE SKIP LOCKED
+                    """
+                    params = (ids,)
+                cur.execute(
+                    f"""
+                    WITH claimed AS ({claim})
+                    UPDATE {self.tables.tasks} t SET
+                        status = %s,
+                        locked_at = EXTRACT(EPOCH FROM NOW()),
+                        locked_by = %s
+                    FROM claimed, {self.tables.monitors} m
+                    WHERE t.id = claimed.id AND m.seq = t.fk_monitor
+                    RETURNING
+                        t.id, t.timestamp, m.id, t.status,
+                        t.locked_at, t.locked_by, t.completed_at;
+                    """,
+                    params + (TASK_STATUS_CODES[TaskStatus.RUNNING], worker_id),
+                )
+                rows = cur.fetchall()
+                conn.commit()
+                return [Task(*row[:3], TASK_STATUSES[row[3]], *row[4:]) for row in rows]
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def _select_monitors_with_affinity(
+        self, cur, batch_size: int, affinity: HostAffinity, now: int
+    ) -> [str]:
+        cur.execute(
+            f"""
+            SELECT id, {MONITOR_DUE_AT_SQL}, endpoint FROM {self.tables.monitors}
+            WHERE {MONITOR_DUE_AT_SQL} <= %s
+            ORDER BY {MONITOR_DUE_AT_SQL} ASC
+            LIMIT %s
             """,
-                (
-                    probe.id,
-                    probe.timestamp,
-                    probe.monitor_id,
-                    probe.task_id,
-                    probe.response_time,
-                    probe.response_code,
-                    probe.response_error.value if probe.response_error else None,
-                    probe.content_match,
-                ),
+            (now, affinity.scan_size(batch_size)),
+        )
+        return affinity.select(cur.fetchall(), batch_size, now)
+
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        now = int(time.time())
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                # candidates are locked with SKIP LOCKED, so that concurrent
+                # workers claim disjoint batches instead of waiting on each
+                # other; a monitor claimed since the statement started is
+                # re-checked against its new last_task_at and skipped
+                params = {"now": now, "limit": batch_size}
+                if affinity is None:
+                    claim = f"""
+                        SELECT seq FROM {self.tables.monitors}
+                        WHERE {MONITOR_DUE_AT_SQL} <= %(now)s
+                        ORDER BY {MONITOR_DUE_AT_SQL} ASC
+                        LIMIT %(limit)s
+                        FOR UPDATE SKIP LOCKED
+                    """
+                else:
+                    params["ids"] = self._select_monitors_with_affinity(
+                        cur, batch_size, affinity, now
+                    )
+                    claim = f"""
+                        SELECT seq FROM {self.tables.monitors}
+                        WHERE {MONITOR_DUE_AT_SQL} <= %(now)s
+                            AND id = ANY(%(ids)s::text[])
+                        FOR UPDATE SKIP LOCKED
+                    """
+                cur.execute(
+                    f"""
+                    WITH claimed AS ({claim})
+                    UPDATE {self.tables.monitors} m SET last_task_at = %(now)s
+                    FROM claimed
+                    WHERE m.seq = claimed.seq
+                    RETURNING
+                        m.id, m.name, m.endpoint, m.interval, m.body_regexp,
+                        m.last_task_at, m.last_probe_at;
+                    """,
+                    params,
+                )
+                rows = cur.fetchall()
+                conn.commit()
+                return [Monitor(*row) for row in rows]
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def update_task(self, task: Task):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(
+                    f"""
+                    UPDATE {self.tables.tasks} SET
+                        status = %s,
+                        locked_at = %s,
+                        locked_by = %s,
+                        completed_at = %s
+                    WHERE id = %s
+                    """,
+                    (
+                        TASK_STATUS_CODES[task.status],
+                        task.locked_at,
+                        task.locked_by,
+                        task.completed_at,
+                        task.id,
+                    ),
+                )
+                if task.status is TaskStatus.PENDING:
+                    # released task can be picked up by another worker
+                    self._notify_tasks(cur)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def _update_rollups(self, cur: psycopg2.extensions.cursor, probes: [Probe]) -> None:
+        template = ", ".join(
+            [f"(SELECT seq FROM {self.tables.monitors} WHERE id = %s)"]
+            + ["%s" for _ in ROLLUP_COLUMNS[1:]]
+        )
+        psycopg2.extras.execute_values(
+            cur,
+            rollup_upsert_sql(self.tables.rollups, "%s"),
+            [rollup_values(rollup) for rollup in rollup_probes(probes)],
+            template=f"({template})",
+        )
+
+    @cached_property
+    def _record_probe_sql(self) -> str:
+        """
+        Statement recording a probe in one round trip: data-modifying CTEs
+        touch the monitor, complete the task and update the rollups of every
+        resolution, and the probe is inserted with their surrogate keys.
+        """
+        rollup_rows = ", ".join(
+            "("
+            + ", ".join(
+                ["(SELECT seq FROM monitor)"]
+                + [f"%(r{i}_{column})s" for (column, _) in ROLLUP_COLUMNS[1:]]
+            )
+            + ")"
+            for i in range(len(RESOLUTIONS))
+        )
+        return f"""
+            WITH monitor AS (
+                UPDATE {self.tables.monitors} SET last_probe_at = %(timestamp)s
+                WHERE id = %(monitor_id)s
+                RETURNING seq
+            ), task AS (
+                UPDATE {self.tables.tasks}
+                SET status = %(status)s, completed_at = %(completed_at)s
+                WHERE id = %(task_id)s
+                RETURNING seq
+            ), rollups AS (
+                {rollup_upsert_sql(self.tables.rollups, rollup_rows)}
+            )
+            INSERT INTO {self.tables.probes} (
+                id, timestamp, fk_monitor, fk_task, response_time,
+                response_code, response_error, content_match
             )
+            VALUES (
+                %(id)s,
+                %(timestamp)s,
+                (SELECT seq FROM monitor),
+                (SELECT seq FROM task),
+                %(response_time)s,
+                %(response_code)s,
+                %(response_error)s,
+                %(content_match)s
+            )
+        """
 
-            # update last probe timestamp on monitor
-            cur.execute(
-                f"""
-                UPDATE {self.tables.monitors} SET last_probe_at = %s WHERE id = %s
-            """,
-                (probe.timestamp, probe.monitor_id),
+    def record_probe(self, probe: Probe):
+        """
+        Records a probe, updates the last probe time of its monitor, and
+        completes its task, in a single statement
+        """
+        params = {
+            "id": probe.id,
+            "timestamp": probe.timestamp,
+            "monitor_id": probe.monitor_id,
+            "task_id": probe.task_id,
+            "response_time": probe.response_time,
+            "response_code": probe.response_code,
+            "response_error": probe_error_code(probe.response_error),
+            "content_match": probe.content_match,
+            "status": TASK_STATUS_CODES[TaskStatus.COMPLETED],
+            "completed_at": int(time.time()),
+        }
+        # one rollup per resolution; the monitor is referenced by the CTE
+        for i, rollup in enumerate(rollup_probes([probe])):
+            for (column, _), value in zip(
+                ROLLUP_COLUMNS[1:], rollup_values(rollup)[1:]
+            ):
+                params[f"r{i}_{column}"] = value
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                cur.execute(self._record_probe_sql, params)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def record_probes(self, probes: [Probe]):
+        """
+        Records a batch of probes. Rows are streamed with COPY into a staging
+        table, then moved to the probes table, and monitors and tasks are
+        updated with one set-based statement each.
+        """
+        if not probes:
+            return
+        staging = f"{self.tables.probes}_staging"
+        rows = io.StringIO(
+            "".join(
+                "\t".join(
+                    copy_value(value)
+                    for value in (
+                        probe.id,
+                        probe.timestamp,
+                        probe.monitor_id,
+                        probe.task_id,
+                        probe.response_time,
+                        probe.response_code,
+                        probe_error_code(probe.response_error),
+                        probe.content_match,
+                    )
+                )
+                + "\n"
+                for probe in probes
             )
+        )
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                # created once per connection, emptied on every commit;
+                # monitors and tasks are referenced by their text IDs
+                cur.execute(
+                    f"""
+                    CREATE TEMPORARY TABLE IF NOT EXISTS {staging} (
+                        id UUID,
+                        timestamp INT,
+                        monitor_id TEXT,
+                        task_id TEXT,
+                        response_time FLOAT,
+                        response_code INT,
+                        response_error SMALLINT,
+                        content_match TEXT
+                    ) ON COMMIT DELETE ROWS
+                    """
+                )
+                cur.copy_expert(f"COPY {staging} FROM STDIN", rows)
+                cur.execute(
+                    f"""
+                    INSERT INTO {self.tables.probes} (
+                        id, timestamp, fk_monitor, fk_task, response_time,
+                        response_code, response_error, content_match
+                    )
+                    SELECT
+                        s.id, s.timestamp, m.seq, t.seq, s.response_time,
+                        s.response_code, s.response_error, s.content_match
+                    FROM {staging} s
+                        LEFT JOIN {self.tables.monitors} m ON m.id = s.monitor_id
+                        LEFT JOIN {self.tables.tasks} t ON t.id = s.task_id
+                    """
+                )
+                cur.execute(
+                    f"""
+                    UPDATE {self.tables.monitors} m
+                    SET last_probe_at = s.last_probe_at
+                    FROM (
+                        SELECT monitor_id, MAX(timestamp) AS last_probe_at
+                        FROM {staging}
+                        GROUP BY monitor_id
+                    ) s
+                    WHERE m.id = s.monitor_id
+                    """
+                )
+                cur.execute(
+                    f"""
+                    UPDATE {self.tables.tasks} t
+                    SET status = %s, completed_at = %s
+                    FROM {staging} s
+                    WHERE t.id = s.task_id
+                    """,
+                    (TASK_STATUS_CODES[TaskStatus.COMPLETED], int(time.time())),
+                )
+                self._update_rollups(cur, probes)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise e
+            finally:
+                cur.close()
+
+    def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
+        query = f"""
+            SELECT p.id, p.timestamp, t.id, p.response_time, p.response_code, p.response_error, p.content_match
+            FROM {self.tables.probes} p
+                LEFT JOIN {self.tables.tasks} t ON t.seq = p.fk_task
+            WHERE p.fk_monitor = (
+                SELECT seq FROM {self.tables.monitors} WHERE id = %s
+            ) {{}}
+            ORDER BY p.timestamp DESC
+            LIMIT %s
+        """
+
+        def to_probes(rows) -> [Probe]:
+            return [
+                Probe(
+                    pid,
+                    timestamp,
+                    monitor_id,
+                    task_id,
+                    response_time,
+                    response_code,
+                    probe_error_value(response_error),
+                    content_match,
+                )
+                for (
+                    pid,
+                    timestamp,
+                    task_id,
+                    response_time,
+                    response_code,
+                    response_error,
+                    content_match,
+                ) in rows
+            ]
 
-            # recording a probe means the task is completed
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if self._probes_are_partitioned(cur):
+                    # recent partitions are searched first, older ones are only
+                    # scanned when they are needed to fill the limit
+                    now = int(time.time())
+                    for window in self.LIST_PROBES_WINDOWS:
+                        cur.execute(
+                            query.format("AND p.timestamp >= %s"),
+                            (monitor_id, now - window, limit),
+                        )
+                        rows = cur.fetchall()
+                        if len(rows) >= limit:
+                            return to_probes(rows)
+                cur.execute(query.format(""), (monitor_id, limit))
+                return to_probes(cur.fetchall())
+            finally:
+                cur.close()
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        with self.connection() as conn:
+            cur = conn.cursor()
             cur.execute(
                 f"""
-                UPDATE {self.tables.tasks} SET status = %s WHERE id = %s
-            """,
-                (TaskStatus.COMPLETED.value, probe.task_id),
+                SELECT {", ".join(name for (name, _) in ROLLUP_COLUMNS[1:])}
+                FROM {self.tables.rollups}
+                WHERE fk_monitor = (
+                        SELECT seq FROM {self.tables.monitors} WHERE id = %s
+                    )
+                    AND resolution = %s
+                    AND bucket >= %s
+                    AND bucket < %s
+                ORDER BY bucket ASC
+                """,
+                (monitor_id, resolution, since, until),
             )
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
+            rows = cur.fetchall()
             cur.close()
-
-    def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
-        cur = self.conn.cursor()
-        cur.execute(
-            f"""
-            SELECT id, timestamp, fk_monitor, fk_task, response_time, response_code, response_error, content_match
-            FROM {self.tables.probes}
-            WHERE fk_monitor = %s
-            ORDER BY timestamp DESC
-            LIMIT %s
-        """,
-            (monitor_id, limit),
-        )
-        rows = cur.fetchall()
-        cur.close()
-        return [Probe(*row) for row in rows]
+            return [rollup_from_row((monitor_id, *row)) for row in rows]
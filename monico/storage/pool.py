@@ -0,0 +1,188 @@
+"""
+Thread-safe pool of PostgreSQL connections.
+
+Connections are checked out for the duration of a storage call. Idle
+connections are health-checked before reuse, and connections that were lost
+(e.g. after a network blip or a database restart) are replaced with new ones
+on the next checkout.
+"""
+import time
+import threading
+import psycopg2
+import psycopg2.extensions
+from contextlib import contextmanager
+from typing import Callable
+from monico.core.storage import StorageConnectionException
+
+
+class ConnectionPool:
+    CHECKOUT_TIMEOUT = 30  # seconds to wait for a free connection
+    # seconds a connection can stay idle before it's checked with a query
+    # on checkout; connections used more recently are trusted
+    HEALTH_CHECK_INTERVAL = 30
+
+    min_size: int
+    max_size: int
+
+    def __init__(
+        self,
+        connect: Callable[[], psycopg2.extensions.connection],
+        min_size: int = 1,
+        max_size: int = 10,
+    ):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(
+                f"Invalid pool size: min_size={min_size}, max_size={max_size}"
+            )
+        self.connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        # idle connections with the time they were returned to the pool
+        self.idle: [(psycopg2.extensions.connection, float)] = []
+        # number of open connections, idle or checked out
+        self.size = 0
+        self.condition = threading.Condition()
+        # connection checked out by the current thread, so that storage
+        # methods calling each other share it
+        self.local = threading.local()
+
+        self.waiting = 0
+        self.checkouts = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+
+    def _connect(self) -> psycopg2.extensions.connection:
+        try:
+            return self.connect()
+        except psycopg2.OperationalError as e:
+            raise StorageConnectionException(
+                f"Could not connect to PostgreSQL storage backend: {e}"
+            )
+
+    def open(self):
+        """Opens the minimum number of connections"""
+        while self.size < self.min_size:
+            conn = self._connect()
+            with self.condition:
+                self.idle.append((conn, time.monotonic()))
+                self.size += 1
+
+    def close(self):
+        """Closes idle connections; checked out ones are closed when returned"""
+        with self.condition:
+            for conn, _ in self.idle:
+                conn.close()
+            self.size -= len(self.idle)
+            self.idle = []
+
+    def _is_healthy(self, conn: psycopg2.extensions.connection, idle_since: float):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _acquire(self) -> psycopg2.extensions.connection:
+        started_at = time.monotonic()
+        with self.condition:
+            self.waiting += 1
+            try:
+                while not self.idle and self.size >= self.max_size:
+                    remaining = started_at + self.CHECKOUT_TIMEOUT - time.monotonic()
+                    if remaining <= 0:
+                        raise StorageConnectionException(
+                            "Timed out waiting for a free PostgreSQL connection"
+                        )
+                    self.condition.wait(remaining)
+                if self.idle:
+                    conn, idle_since = self.idle.pop()
+                else:
+                    # reserve a slot for a new connection
+                    conn, idle_since = None, None
+                    self.size += 1
+            finally:
+                self.waiting -= 1
+                wait_time = time.monotonic() - started_at
+                self.checkouts += 1
+                self.total_wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        try:
+            if conn is None:
+                return self._connect()
+            if not self._is_healthy(conn, idle_since):
+                conn.close()
+                conn = self._connect()
+                self.reconnects += 1
+            return conn
+        except Exception:
+            self._discard()
+            raise
+
+    def _discard(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    def _release(self, conn: psycopg2.extensions.connection):
+        if not conn.closed:
+            try:
+                # don't hand out connections with a transaction left open
+                if (
+                    conn.get_transaction_status()
+                    != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+                ):
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+        if conn.closed:
+            # lost connection; a new one is opened on demand
+            self._discard()
+            return
+        with self.condition:
+            self.idle.append((conn, time.monotonic()))
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Checks out a connection for the duration of the block. Nested
+        checkouts in the same thread reuse the outer connection.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._acquire()
+        self.local.conn = conn
+        try:
+            yield conn
+        finally:
+            self.local.conn = None
+            self._release(conn)
+
+    def metrics(self) -> dict:
+        with self.condition:
+            in_use = self.size - len(self.idle)
+            return {
+                "pool_size": self.size,
+                "pool_in_use": in_use,
+                "pool_idle": len(self.idle),
+                "pool_waiting": self.waiting,
+                "pool_utilization": in_use / self.max_size,
+                "pool_checkouts": self.checkouts,
+                "pool_wait_time_avg": (
+                    self.total_wait_time / self.checkouts if self.checkouts else 0.0
+                ),
+                "pool_wait_time_max": self.max_wait_time,
+                "pool_reconnects": self.reconnects,
+            }
@@ -0,0 +1,311 @@
+"""
+SQLite storage sharded across several database files.
+
+Every SQLite database has a single writer at a time, so one file serializes
+all writes of the system. Monitors are spread across shards, each a database
+file of its own, by a hash of their ID; tasks, probes and rollups of a monitor
+live in its shard. Operations on a single monitor go to its shard, while
+listing monitors, locking tasks and claiming monitors fan out across shards,
+so writes to different shards don't wait for each other.
+"""
+import os
+import zlib
+import itertools
+from concurrent.futures import Future
+from urllib.parse import urlparse
+from typing import Optional, Iterator
+from dataclasses import replace
+from monico.core.storage import (
+    StorageInterface,
+    MonitorSortingOrder,
+    StorageSetupException,
+)
+from monico.core.affinity import HostAffinity
+from monico.core.ids import uuid7, is_uuid7
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.core.rollup import Rollup
+from monico.core.task import Task
+from monico.storage.migrations import Migration
+from monico.storage.sqlite import SqliteStorage
+
+
+class ShardedSqliteStorage(StorageInterface):
+    """
+    Spreads monitors across `shards` SQLite databases, named after the
+    database of the URI with the shard number appended, e.g. monico.0.db,
+    monico.1.db. The number of shards can't be changed once the storage is
+    set up, as monitors would be looked up in different shards: every shard
+    records its number and the number of shards, and connecting with a
+    different number fails, as does connecting while the database of the URI
+    itself holds an unsharded storage.
+
+    Monitor IDs generated by the storage are time-ordered, so that monitors
+    created within the same second in different shards are listed in the
+    order they were created. Other IDs, e.g. random UUIDs of monitors created
+    by older versions, don't tell the order across shards: monitors created
+    within the same second with such IDs are listed by shard, and in the
+    order they were created within a shard.
+    """
+
+    shards: [SqliteStorage]
+    # table in every shard holding its number and the number of shards
+    layout_table: str
+
+    def __init__(self, service_uri: str, shards: int, **kwargs) -> None:
+        """Keyword arguments are passed to the SqliteStorage of every shard"""
+        if shards < 1:
+            raise ValueError("Number of shards must be at least 1")
+        self.service_uri = service_uri
+        self.prefix = kwargs.get("prefix", "monico")
+        self.layout_table = self.prefix + "_shards"
+        uri = urlparse(service_uri)
+        root, ext = os.path.splitext(uri.path)
+        self.shards = [
+            SqliteStorage(uri._replace(path=f"{root}.{i}{ext}").geturl(), **kwargs)
+            for i in range(shards)
+        ]
+        # picks the shard the next fan-out starts at, so that the same shard
+        # isn't always drained first
+        self.rotation = itertools.count()
+
+    @property
+    def tables(self):
+        return self.shards[0].tables
+
+    @property
+    def PROCESS_LOCAL_TASKS(self) -> bool:
+        return self.shards[0].PROCESS_LOCAL_TASKS
+
+    def shard_index(self, monitor_id: str) -> int:
+        """Shard number of the monitor; stable across processes and restarts"""
+        return zlib.crc32(monitor_id.encode()) % len(self.shards)
+
+    def shard(self, monitor_id: str) -> SqliteStorage:
+        return self.shards[self.shard_index(monitor_id)]
+
+    def _fan_out(
+        self, affinity: Optional[HostAffinity]
+    ) -> Iterator[tuple[SqliteStorage, Optional[HostAffinity]]]:
+        """
+        Shards to lock tasks or claim monitors from, with the affinity to
+        pass to each. With affinity, a shard without work in the worker's
+        slot would fall back to any work, so all shards are asked for work in
+        the slot first, and only then for any work.
+        """
+        start = next(self.rotation) % len(self.shards)
+        shards = self.shards[start:] + self.shards[:start]
+        if affinity is not None:
+            strict = replace(affinity, fallback=False)
+            yield from ((shard, strict) for shard in shards)
+            if not affinity.fallback:
+                return
+        yield from ((shard, affinity) for shard in shards)
+
+    def connect(self) -> None:
+        for shard in self.shards:
+            shard.connect()
+        self.check_layout()
+
+    def check_layout(self):
+        """Raises if the storage was set up with a different number of shards"""
+        if self._unsharded_is_set_up():
+            raise StorageSetupException(
+                f"{urlparse(self.service_uri).path} holds an unsharded storage, "
+                f"whose monitors wouldn't be found in {len(self.shards)} shards. "
+                "Set sqlite_shards to 1, or move the database away to set up "
+                "a sharded storage."
+            )
+        for index, shard in enumerate(self.shards):
+            layout = self._read_layout(shard)
+            if layout is not None and layout != (index, len(self.shards)):
+                raise StorageSetupException(
+                    f"Storage was set up with {layout[1]} SQLite shards, but "
+                    f"{len(self.shards)} are configured, so monitors would be "
+                    f"looked up in the wrong shards. Set sqlite_shards to "
+                    f"{layout[1]}."
+                )
+
+    def _unsharded_is_set_up(self) -> bool:
+        unsharded = SqliteStorage(self.service_uri, prefix=self.prefix)
+        if not os.path.exists(unsharded.path):
+            return False
+        try:
+            cur = unsharded.conn.cursor()
+            try:
+                return unsharded._table_exists(cur, unsharded.tables.monitors)
+            finally:
+                cur.close()
+        finally:
+            unsharded.disconnect()
+
+    def _read_layout(self, shard: SqliteStorage) -> Optional[tuple[int, int]]:
+        """Returns the recorded (shard number, number of shards) of the shard"""
+        cur = shard.conn.cursor()
+        try:
+            if not shard._table_exists(cur, self.layout_table):
+                return None
+            cur.execute(f"SELECT shard, shards FROM {self.layout_table}")
+            return cur.fetchone()
+        finally:
+            cur.close()
+
+    def _record_layout(self, shard: SqliteStorage, index: int):
+        cur = shard.conn.cursor()
+        try:
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.layout_table} (
+                    shard INTEGER NOT NULL,
+                    shards INTEGER NOT NULL
+                )"""
+            )
+            cur.execute(f"DELETE FROM {self.layout_table}")
+            cur.execute(
+                f"INSERT INTO {self.layout_table} (shard, shards) VALUES (?, ?)",
+                (index, len(self.shards)),
+            )
+            shard.conn.commit()
+        finally:
+            cur.close()
+
+    def disconnect(self) -> None:
+        for shard in self.shards:
+            shard.disconnect()
+
+    def setup(self, force=False):
+        # recorded right away, so that shards set up before a failure
+        # are checked on the next connect too
+        for index, shard in enumerate(self.shards):
+            shard.setup(force=force)
+            self._record_layout(shard, index)
+
+    def migrations(self) -> [Migration]:
+        return self.shards[0].migrations()
+
+    def schema_version(self) -> int:
+        """Returns the version of the least migrated shard"""
+        return min(shard.schema_version() for shard in self.shards)
+
+    def check_schema(self):
+        for shard in self.shards:
+            shard.check_schema()
+
+    def migrate(self) -> [Migration]:
+        applied = {}
+        for shard in self.shards:
+            for migration in shard.migrate():
+                applied[migration.version] = migration
+        # shards set up before the layout was recorded
+        for index, shard in enumerate(self.shards):
+            if self._read_layout(shard) is None:
+                self._record_layout(shard, index)
+        return [applied[version] for version in sorted(applied)]
+
+    def teardown(self):
+        for shard in self.shards:
+            shard.teardown()
+            shard.conn.execute(f"DROP TABLE IF EXISTS {self.layout_table}")
+            shard.conn.commit()
+
+    def flush(self) -> None:
+        """Flushes every shard, then raises the first error of a shard"""
+        errors = []
+        for shard in self.shards:
+            try:
+                shard.flush()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    def maintain(self) -> dict:
+        stats = {}
+        for shard in self.shards:
+            for name, value in shard.maintain().items():
+                stats[name] = stats.get(name, 0) + value
+        return stats
+
+    def metrics(self) -> dict:
+        return {
+            f"shard{i}_{name}": value
+            for (i, shard) in enumerate(self.shards)
+            for (name, value) in shard.metrics().items()
+        }
+
+    def create_monitor(self, monitor: Monitor) -> Monitor:
+        if not monitor.id:
+            monitor.id = str(uuid7())
+        return self.shard(monitor.id).create_monitor(monitor)
+
+    def list_monitors(
+        self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
+    ) -> [Monitor]:
+        rows = [row for shard in self.shards for row in shard._select_monitors(sort)]
+        if sort == MonitorSortingOrder.CREATED_AT_ASC:
+            # stable, so that ties without time-ordered IDs keep shard order
+            rows.sort(
+                key=lambda row: (row[-1] or "", row[0] if is_uuid7(row[0]) else "")
+            )
+        else:
+            # monitors without tasks last, like SQLite sorts NULLs
+            rows.sort(key=lambda row: (row[5] is not None, row[5] or 0), reverse=True)
+        return [Monitor(*row[:-1]) for row in rows]
+
+    def read_monitor(self, id: str) -> Monitor:
+        return self.shard(id).read_monitor(id)
+
+    def delete_monitor(self, id: str):
+        return self.shard(id).delete_monitor(id)
+
+    def create_task(self, task: Task):
+        return self.shard(task.monitor_id).create_task(task)
+
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
+        tasks = []
+        for shard, affinity in self._fan_out(affinity):
+            if len(tasks) >= batch_size:
+                break
+            tasks += shard.lock_tasks(worker_id, batch_size - len(tasks), affinity)
+        return tasks
+
+    def update_task(self, task: Task):
+        self.shard(task.monitor_id).update_task(task)
+
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        monitors = []
+        for shard, affinity in self._fan_out(affinity):
+            if len(monitors) >= batch_size:
+                break
+            monitors += shard.claim_monitors(
+                worker_id, batch_size - len(monitors), affinity
+            )
+        return monitors
+
+    def record_probe(self, probe: Probe) -> Future:
+        return self.shard(probe.monitor_id).record_probe(probe)
+
+    def record_probes(self, probes: [Probe]) -> [Future]:
+        """Records the probes of every shard in a single transaction of the shard"""
+        batches = {}
+        for probe in probes:
+            batches.setdefault(self.shard_index(probe.monitor_id), []).append(probe)
+        return [self.shards[i].record_probes(batch) for (i, batch) in batches.items()]
+
+    def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
+        return self.shard(monitor_id).list_probes(monitor_id, limit)
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        return self.shard(monitor_id).list_rollups(monitor_id, resolution, since, until)
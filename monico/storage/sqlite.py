@@ -1,9 +1,14 @@
 import os
+import time
 import uuid
 import sqlite3
+import threading
 from enum import Enum
-from urllib.parse import urlparse
+from concurrent.futures import Future, wait
+from urllib.parse import urlparse, quote
 from dataclasses import dataclass
+from functools import cached_property
+from typing import Optional, Callable, Any
 from monico.core.storage import (
     StorageInterface,
     StorageSetupException,
@@ -13,43 +18,325 @@ from monico.core.storage import (
     MonitorSortingOrder,
 )
 from monico.core.monitor import Monitor
+from monico.core.affinity import HostAffinity
 from monico.core.task import Task, TaskStatus
-from monico.storage.common import TableConfig
+from monico.core.rollup import Rollup, RESOLUTIONS, RETENTION, rollup_probes
+from monico.storage.common import (
+    TableConfig,
+    TASK_STATUS_CODES,
+    TASK_STATUSES,
+    PROBE_ERROR_CODES,
+    MONITOR_DUE_AT_SQL,
+    probe_error_code,
+    probe_error_value,
+    enum_codes_sql,
+    enum_code_sql,
+    ROLLUP_COLUMNS,
+    rollup_values,
+    rollup_from_row,
+    rollup_upsert_sql,
+    rollup_backfill_sql,
+)
+from monico.storage.writer import SqliteWriter, WriteFuture
+from monico.storage.migrations import (
+    Migration,
+    BASELINE_VERSION,
+    pending_migrations,
+    check_schema_version,
+)
 from monico.core.probe import Probe, ProbeResponseError
 
 
+class SqliteProfile(Enum):
+    """
+    Connection settings profile.
+
+    DEFAULT uses SQLite defaults (rollback journal, no busy timeout).
+    TUNED is meant for running manager and workers as separate processes
+    against the same database file: readers don't block the writer (WAL),
+    commits don't wait for fsync of every transaction, and a writer waits
+    for the lock instead of failing with "database is locked".
+    """
+
+    DEFAULT = "default"
+    TUNED = "tuned"
+
+
 class SqliteStorage(StorageInterface):
     """
     SQLite storage implementation for monico.
+
+    Connections are opened per thread on first use, since SQLite
+    connections can't be shared between threads.
+
+    Databases are set up with incremental auto-vacuum, so that maintain() can
+    return pages freed by retention to the file system a few at a time.
+
+    With transient tasks, the tasks table is kept in an in-memory database
+    attached to every connection, shared by the threads of the process.
+
+    With group commit, writes go through a single writer thread, which
+    commits the writes queued within a few milliseconds together. Writes
+    whose result isn't needed, like recording probes, return futures without
+    waiting for the commit; their errors are raised by flush(), unless the
+    caller waited for the future. Reads of a thread wait for the writes it
+    queued.
     """
 
+    BUSY_TIMEOUT = 5  # seconds to wait for a lock held by another connection
+    # failed writes nobody waited for kept until the next flush() at most
+    MAX_FAILED_WRITES = 100
+    MMAP_SIZE = 256 * 1024 * 1024  # bytes of the database file to memory-map
+    CACHE_SIZE = 64 * 1024  # KiB of page cache per connection
+    # rows deleted (or pages vacuumed) per maintenance transaction; writers
+    # get the database lock back after every batch
+    MAINTENANCE_BATCH_SIZE = 1000
+    MAINTENANCE_MAX_BATCHES = 100  # per table and maintenance run
+    MAINTENANCE_BATCH_PAUSE = 0.05  # seconds between batches
+    # name the database with transient tasks is attached under
+    QUEUE_SCHEMA = "queue"
+
     tables: TableConfig
     service_uri: str
-    conn: sqlite3.Connection
+    profile: SqliteProfile
+    # seconds to keep probes and finished tasks for; forever if None
+    probe_retention: Optional[int]
+    task_retention: Optional[int]
+    # whether tasks are kept in the attached queue database
+    transient_tasks: bool
+    # thread all writes go through with group commit
+    writer: Optional[SqliteWriter]
 
-    def __init__(self, service_uri: str, prefix: str = "monico") -> None:
+    def __init__(
+        self,
+        service_uri: str,
+        prefix: str = "monico",
+        profile: SqliteProfile = SqliteProfile.DEFAULT,
+        probe_retention: Optional[int] = None,
+        task_retention: Optional[int] = None,
+        transient_tasks: bool = False,
+        group_commit: bool = False,
+    ) -> None:
         self.tables = TableConfig(
             monitors=prefix + "_monitors",
             tasks=prefix + "_tasks",
             probes=prefix + "_probes",
+            schema_version=prefix + "_schema_version",
+            rollups=prefix + "_rollups",
         )
         self.service_uri = service_uri
+        self.profile = profile
+        self.probe_retention = probe_retention
+        self.task_retention = task_retention
+        self.transient_tasks = transient_tasks
+        self.local = threading.local()
+        # all opened connections, so that they can be closed on disconnect
+        self.connections: [sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+        self.writer = SqliteWriter(self._open_connection) if group_commit else None
+        # failed writes nobody waited for, their errors are raised by the
+        # next flush()
+        self.failed_writes: [WriteFuture] = []
+        self.failed_writes_lock = threading.Lock()
 
-    def connect(self) -> None:
-        try:
-            sqlite_dir = os.path.dirname(urlparse(self.service_uri).path)
-            if not os.path.exists(sqlite_dir):
-                os.makedirs(sqlite_dir)
+    @property
+    def path(self) -> str:
+        return urlparse(self.service_uri).path
+
+    @property
+    def PROCESS_LOCAL_TASKS(self) -> bool:
+        return self.transient_tasks
+
+    @property
+    def queue_uri(self) -> str:
+        """
+        In-memory database with transient tasks. The memdb VFS shares it
+        between connections of the process using the same name, with the
+        usual locking, until the last of them is closed.
+        """
+        return f"file:{quote(os.path.abspath(self.path))}.tasks?vfs=memdb"
 
-            sqlite_path = urlparse(self.service_uri).path
-            self.conn = sqlite3.connect(sqlite_path)
+    @property
+    def tasks_schema(self) -> str:
+        return self.QUEUE_SCHEMA if self.transient_tasks else "main"
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """
+        Connection of the current thread, opened on first use. With group
+        commit, writes queued by the thread are committed first, so that the
+        thread reads its own writes.
+        """
+        last_write = getattr(self.local, "last_write", None)
+        if last_write is not None:
+            wait([last_write])
+            self.local.last_write = None
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self._open_connection()
+            self.local.conn = conn
+        return conn
+
+    def _pragmas(self) -> [str]:
+        if self.profile is not SqliteProfile.TUNED:
+            return []
+        return [
+            "journal_mode = WAL",
+            "synchronous = NORMAL",
+            f"busy_timeout = {self.BUSY_TIMEOUT * 1000}",
+            f"mmap_size = {self.MMAP_SIZE}",
+            f"cache_size = -{self.CACHE_SIZE}",
+            "foreign_keys = ON",
+        ]
+
+    def _open_connection(self) -> sqlite3.Connection:
+        try:
+            # connections are only used by the thread that opened them,
+            # but are closed by the thread calling disconnect()
+            conn = sqlite3.connect(
+                self.path,
+                timeout=self.BUSY_TIMEOUT,
+                check_same_thread=False,
+                # so that the queue database is attached by its URI
+                uri=self.transient_tasks,
+            )
+            for pragma in self._pragmas():
+                conn.execute(f"PRAGMA {pragma}")
+            if self.transient_tasks:
+                conn.execute(
+                    f"ATTACH DATABASE ? AS {self.QUEUE_SCHEMA}", (self.queue_uri,)
+                )
         except sqlite3.Error as e:
             raise StorageConnectionException(
                 f"Could not connect to SQLite storage backend: {e}"
             )
+        with self.connections_lock:
+            self.connections.append(conn)
+        return conn
+
+    def connect(self) -> None:
+        sqlite_dir = os.path.dirname(self.path)
+        if not os.path.exists(sqlite_dir):
+            os.makedirs(sqlite_dir)
+        if self.transient_tasks:
+            self._create_task_queue()
+        self.conn
+        if self.writer is not None:
+            self.writer.start()
+
+    def _create_task_queue(self) -> None:
+        """
+        Creates the tasks table in the queue database of the process. Probes
+        keep referencing tasks lost with the previous process, so keys of new
+        tasks start after the referenced ones.
+        """
+        cur = self.conn.cursor()
+        try:
+            if (
+                not self._table_exists(cur, self.tables.monitors)
+                or self._table_exists(cur, self.tables.tasks)
+                or self._table_exists(cur, self.tables.tasks, self.QUEUE_SCHEMA)
+            ):
+                # not set up yet, tasks are kept in the main database, or
+                # the queue was already created by another connection
+                return
+            cur.execute("BEGIN IMMEDIATE")
+            self._create_compact_table_tasks(cur)
+            self._create_compact_task_indexes(cur)
+            cur.execute(
+                f"""
+                INSERT INTO {self.QUEUE_SCHEMA}.sqlite_sequence (name, seq)
+                SELECT :tasks, COALESCE(MAX(fk_task), 0) FROM {self.tables.probes}""",
+                {"tasks": self.tables.tasks},
+            )
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            raise e
+        finally:
+            cur.close()
 
     def disconnect(self) -> None:
-        self.conn.close()
+        if self.writer is not None:
+            self.writer.stop()
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+        self.local = threading.local()
+
+    def flush(self) -> None:
+        """
+        Waits until queued writes are committed. Raises the first error of
+        writes nobody waited for since the last flush.
+        """
+        if self.writer is None:
+            return
+        self.writer.flush()
+        with self.failed_writes_lock:
+            failed, self.failed_writes = self.failed_writes, []
+        errors = [future.exception() for future in failed if not future.waited]
+        if errors:
+            raise errors[0]
+
+    def metrics(self) -> dict:
+        if self.writer is None:
+            return {}
+        return self.writer.metrics()
+
+    def _submit(self, operation: Callable[..., Any], *args) -> Future:
+        """
+        Runs the operation with a cursor in a transaction of its own, or
+        queues it for the writer thread with group commit. Returns the future
+        of its result.
+        """
+        if self.writer is not None:
+            future = self.writer.submit(operation, *args)
+            self.local.last_write = future
+            return future
+        future = WriteFuture()
+        cur = self.conn.cursor()
+        try:
+            # the write lock is taken up front, so that the transaction can't
+            # fail half-way on a lock held by another process
+            cur.execute("BEGIN IMMEDIATE")
+            result = operation(cur, *args)
+            self.conn.commit()
+            future.set_result(result)
+        except Exception as e:
+            self.conn.rollback()
+            future.set_exception(e)
+        finally:
+            cur.close()
+        return future
+
+    def _write(self, operation: Callable[..., Any], *args) -> Any:
+        """Runs the write operation, returns its result once committed"""
+        return self._submit(operation, *args).result()
+
+    def _write_later(self, operation: Callable[..., Any], *args) -> Future:
+        """
+        Runs the write operation without waiting for the commit with group
+        commit. Its error is raised by the next flush(), unless the caller
+        waits for the returned future and handles it.
+        """
+        future = self._submit(operation, *args)
+        if self.writer is None:
+            # committed already, errors are raised right away
+            future.result()
+        else:
+            future.add_done_callback(self._keep_write_error)
+        return future
+
+    def _keep_write_error(self, future: WriteFuture) -> None:
+        if future.exception() is None or future.waited:
+            return
+        with self.failed_writes_lock:
+            # the caller may still wait for a failed write after it's kept
+            self.failed_writes = [f for f in self.failed_writes if not f.waited]
+            # flush() only raises the first error, so later ones aren't kept
+            if len(self.failed_writes) < self.MAX_FAILED_WRITES:
+                self.failed_writes.append(future)
 
     @staticmethod
     def _to_sqlite_enum(enum: Enum):
@@ -142,31 +429,524 @@ class SqliteStorage(StorageInterface):
                     ON {self.tables.probes} (fk_monitor);"""
         )
 
+    def _create_tables(self, cur: sqlite3.Cursor) -> None:
+        self._create_table_monitors(cur)
+        self._create_table_tasks(cur)
+        self._create_table_probes(cur)
+
+    def _create_hot_path_indexes(self, cur: sqlite3.Cursor) -> None:
+        # tasks of unversioned storage may already be in the queue database
+        schema = "main"
+        if self._table_exists(cur, self.tables.tasks, self.tasks_schema):
+            schema = self.tasks_schema
+        # lock_tasks: oldest pending tasks first
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS
+                {schema}.{self.tables.tasks}_pending_timestamp_idx
+                ON {self.tables.tasks} (timestamp)
+                WHERE status = '{TaskStatus.PENDING.value}';"""
+        )
+        # list_probes: latest probes of a monitor first
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {self.tables.probes}_fk_monitor_timestamp_idx
+                ON {self.tables.probes} (fk_monitor, timestamp DESC);"""
+        )
+        # covered by the composite index above
+        cur.execute(f"DROP INDEX IF EXISTS {self.tables.probes}_fk_monitor_idx")
+
+    def _create_probes_task_index(self, cur: sqlite3.Cursor) -> None:
+        # deleting a task sets fk_task of its probes to NULL
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {self.tables.probes}_fk_task_idx
+                ON {self.tables.probes} (fk_task);"""
+        )
+
+    def _create_due_monitors_index(self, cur: sqlite3.Cursor) -> None:
+        # claim_monitors: monitors that are due the longest first
+        cur.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS {self.tables.monitors}_due_at_idx
+                ON {self.tables.monitors} {MONITOR_DUE_AT_SQL};"""
+        )
+
+    def _create_table_rollups(self, cur: sqlite3.Cursor) -> None:
+        if self._table_exists(cur, self.tables.rollups):
+            return
+        columns = ", ".join(f"{name} {kind}" for (name, kind) in ROLLUP_COLUMNS)
+        cur.execute(
+            f"""
+            CREATE TABLE {self.tables.rollups} (
+                {columns},
+                PRIMARY KEY (fk_monitor, resolution, bucket),
+                FOREIGN KEY(fk_monitor)
+                    REFERENCES {self.tables.monitors}(id)
+                        ON DELETE CASCADE
+            );"""
+        )
+        # retention of fine rollups
+        cur.execute(
+            f"""
+            CREATE INDEX {self.tables.rollups}_resolution_bucket_idx
+                ON {self.tables.rollups} (resolution, bucket);"""
+        )
+        for resolution in RESOLUTIONS:
+            cur.execute(
+                rollup_backfill_sql(self.tables.rollups, self.tables.probes, resolution)
+            )
+
+    def _create_compact_tables(self, cur: sqlite3.Cursor) -> None:
+        """
+        Rebuilds the tables, as SQLite can't change column types: monitors and
+        tasks get integer surrogate keys, which replace their text IDs in
+        references; enums become small int codes, and probe IDs 16-byte UUIDs.
+        Rows of deleted monitors, left behind when foreign keys weren't
+        enforced, are dropped.
+        """
+        if self._column_exists(cur, self.tables.monitors, "seq"):
+            # unversioned storage that already has the compact layout
+            return
+        monitors, tasks, probes, rollups = (
+            self.tables.monitors,
+            self.tables.tasks,
+            self.tables.probes,
+            self.tables.rollups,
+        )
+        for table in (monitors, tasks, probes, rollups):
+            cur.execute(f"ALTER TABLE {table} RENAME TO {table}_old")
+
+        cur.execute(
+            f"""
+            CREATE TABLE {monitors} (
+                id TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                endpoint TEXT NOT NULL,
+                interval INTEGER NOT NULL,
+                body_regexp TEXT NULL,
+                last_task_at INT NULL,
+                last_probe_at INT NULL,
+                created_at INT DEFAULT CURRENT_TIMESTAMP,
+                seq INTEGER PRIMARY KEY
+            );"""
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {monitors}
+            SELECT
+                id, name, endpoint, interval, body_regexp,
+                last_task_at, last_probe_at, created_at, rowid
+            FROM {monitors}_old"""
+        )
+        self._create_compact_table_tasks(cur)
+        cur.execute(
+            f"""
+            INSERT INTO {tasks}
+            SELECT
+                t.id, t.timestamp, m.seq,
+                {enum_code_sql("t.status", TASK_STATUS_CODES)},
+                t.locked_at, t.locked_by, t.completed_at, t.rowid
+            FROM {tasks}_old t
+                JOIN {monitors} m ON m.id = t.fk_monitor"""
+        )
+        task_reference = f"""
+            , FOREIGN KEY(fk_task)
+                REFERENCES {tasks}(seq)
+                    ON DELETE SET NULL
+        """
+        if self.transient_tasks:
+            # foreign keys can't reference tables of another database
+            task_reference = ""
+        cur.execute(
+            f"""
+            CREATE TABLE {probes} (
+                id BLOB PRIMARY KEY,
+                timestamp INTEGER NOT NULL,
+                fk_monitor INTEGER NOT NULL,
+                fk_task INTEGER NULL,
+                response_time FLOAT NULL,
+                response_code INTEGER NULL,
+                response_error INTEGER
+                    CHECK (response_error IN {enum_codes_sql(PROBE_ERROR_CODES)})
+                    NULL,
+                content_match TEXT NULL,
+                FOREIGN KEY(fk_monitor)
+                    REFERENCES {monitors}(seq)
+                        ON DELETE CASCADE
+                {task_reference}
+            )"""
+        )
+        self.conn.create_function(
+            "uuid_bytes", 1, lambda value: uuid.UUID(value).bytes, deterministic=True
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {probes}
+            SELECT
+                uuid_bytes(p.id), p.timestamp, m.seq, t.seq,
+                p.response_time, p.response_code,
+                {enum_code_sql("p.response_error", PROBE_ERROR_CODES)},
+                p.content_match
+            FROM {probes}_old p
+                JOIN {monitors} m ON m.id = p.fk_monitor
+                LEFT JOIN {tasks} t ON t.id = p.fk_task"""
+        )
+        columns = ", ".join(
+            f"{name} {kind}"
+            for (name, kind) in [("fk_monitor", "INTEGER NOT NULL")]
+            + ROLLUP_COLUMNS[1:]
+        )
+        cur.execute(
+            f"""
+            CREATE TABLE {rollups} (
+                {columns},
+                PRIMARY KEY (fk_monitor, resolution, bucket),
+                FOREIGN KEY(fk_monitor)
+                    REFERENCES {monitors}(seq)
+                        ON DELETE CASCADE
+            );"""
+        )
+        cur.execute(
+            f"""
+            INSERT INTO {rollups}
+            SELECT m.seq, {", ".join(f"r.{name}" for (name, _) in ROLLUP_COLUMNS[1:])}
+            FROM {rollups}_old r
+                JOIN {monitors} m ON m.id = r.fk_monitor"""
+        )
+
+        # children first, so that dropping a table doesn't cascade
+        for table in (rollups, probes, tasks, monitors):
+            cur.execute(f"DROP TABLE {table}_old")
+        for statement in [
+            f"CREATE INDEX {monitors}_last_probe_at_idx ON {monitors} (last_probe_at)",
+            f"CREATE INDEX {monitors}_created_at_idx ON {monitors} (created_at)",
+            f"CREATE INDEX {probes}_timestamp_idx ON {probes} (timestamp)",
+            f"CREATE INDEX {probes}_fk_monitor_timestamp_idx "
+            f"ON {probes} (fk_monitor, timestamp DESC)",
+            f"CREATE INDEX {probes}_fk_task_idx ON {probes} (fk_task)",
+            f"CREATE INDEX {rollups}_resolution_bucket_idx "
+            f"ON {rollups} (resolution, bucket)",
+        ]:
+            cur.execute(statement)
+        self._create_compact_task_indexes(cur)
+
+    def _create_compact_table_tasks(self, cur: sqlite3.Cursor) -> None:
+        """
+        Creates the tasks table with integer references. Transient tasks are
+        created in the queue database, without a foreign key to monitors, and
+        their keys are never reused, as probes keep referencing deleted tasks.
+        """
+        key = "INTEGER PRIMARY KEY"
+        monitor_reference = f"""
+            , FOREIGN KEY(fk_monitor)
+                REFERENCES {self.tables.monitors}(seq)
+                    ON DELETE CASCADE
+        """
+        if self.transient_tasks:
+            key = "INTEGER PRIMARY KEY AUTOINCREMENT"
+            monitor_reference = ""
+        cur.execute(
+            f"""
+            CREATE TABLE {self.tasks_schema}.{self.tables.tasks} (
+                id TEXT NOT NULL UNIQUE,
+                timestamp INTEGER NOT NULL,
+                fk_monitor INTEGER NOT NULL,
+                status INTEGER CHECK
+                    (status IN {enum_codes_sql(TASK_STATUS_CODES)})
+                    NOT NULL,
+                locked_at INTEGER NULL,
+                locked_by TEXT NULL,
+                completed_at INTEGER NULL,
+                seq {key}
+                {monitor_reference}
+            );"""
+        )
+
+    def _create_compact_task_indexes(self, cur: sqlite3.Cursor) -> None:
+        tasks = self.tables.tasks
+        cur.execute(
+            f"CREATE INDEX {self.tasks_schema}.{tasks}_fk_monitor_idx "
+            f"ON {tasks} (fk_monitor)"
+        )
+        cur.execute(
+            f"CREATE INDEX {self.tasks_schema}.{tasks}_pending_timestamp_idx "
+            f"ON {tasks} (timestamp) "
+            f"WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}"
+        )
+
+    def migrations(self) -> [Migration]:
+        """Schema migrations, ordered by version"""
+        return [
+            Migration(
+                BASELINE_VERSION,
+                "create monitors, tasks and probes tables",
+                self._create_tables,
+            ),
+            Migration(
+                2,
+                "add pending tasks and latest probes indexes",
+                self._create_hot_path_indexes,
+            ),
+            Migration(
+                3,
+                "add probes task index",
+                self._create_probes_task_index,
+            ),
+            Migration(
+                4,
+                "add probe rollups",
+                self._create_table_rollups,
+            ),
+            Migration(
+                5,
+                "store integer references and enum codes",
+                self._create_compact_tables,
+            ),
+            Migration(
+                6,
+                "add due monitors index",
+                self._create_due_monitors_index,
+            ),
+        ]
+
+    def _table_exists(
+        self, cur: sqlite3.Cursor, table: str, schema: str = "main"
+    ) -> bool:
+        cur.execute(
+            f"SELECT 1 FROM {schema}.sqlite_master "
+            "WHERE type = 'table' AND name = :name",
+            {"name": table},
+        )
+        return cur.fetchone() is not None
+
+    def _column_exists(self, cur: sqlite3.Cursor, table: str, column: str) -> bool:
+        cur.execute(f"PRAGMA table_info({table})")
+        return column in [row[1] for row in cur.fetchall()]
+
+    def _create_table_schema_version(self, cur: sqlite3.Cursor) -> None:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {self.tables.schema_version} (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at INTEGER NOT NULL
+            );"""
+        )
+
+    def _record_migration(self, cur: sqlite3.Cursor, migration: Migration) -> None:
+        cur.execute(
+            f"""
+            INSERT INTO {self.tables.schema_version}
+                (version, description, applied_at)
+            VALUES (:version, :description, :applied_at)""",
+            {
+                "version": migration.version,
+                "description": migration.description,
+                "applied_at": int(time.time()),
+            },
+        )
+
+    def schema_version(self) -> int:
+        """Returns version of the latest applied migration"""
+        cur = self.conn.cursor()
+        try:
+            if not self._table_exists(cur, self.tables.schema_version):
+                return 0
+            cur.execute(f"SELECT MAX(version) FROM {self.tables.schema_version}")
+            return cur.fetchone()[0] or 0
+        finally:
+            cur.close()
+
+    def _apply_migrations(self, migrations: [Migration]) -> [Migration]:
+        cur = self.conn.cursor()
+        try:
+            self._create_table_schema_version(cur)
+            self.conn.commit()
+            for migration in migrations:
+                if migration.transactional:
+                    # DDL doesn't open a transaction implicitly in sqlite3
+                    cur.execute("BEGIN")
+                migration.apply(cur)
+                self._record_migration(cur, migration)
+                self.conn.commit()
+            return migrations
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            raise StorageSetupException(
+                f"Could not migrate SQLite storage backend: {e}"
+            )
+        finally:
+            cur.close()
+
     def setup(self, force=False):
         if force:
             self.teardown()
         cur = self.conn.cursor()
         try:
-            self._create_table_monitors(cur)
-            self._create_table_tasks(cur)
-            self._create_table_probes(cur)
+            if self._table_exists(cur, self.tables.monitors):
+                raise StorageSetupException("Storage already initialized")
+            self._enable_incremental_vacuum(cur)
+        finally:
             cur.close()
-            self.conn.commit()
-        except sqlite3.OperationalError as e:
-            raise StorageSetupException(f"Could not setup SQLite storage backend: {e}")
+        self._apply_migrations(self.migrations())
+
+    def _enable_incremental_vacuum(self, cur: sqlite3.Cursor) -> None:
+        cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] != 2:
+            # the mode of a database that had tables is only changed by VACUUM;
+            # monico tables don't exist yet, so it is cheap
+            cur.execute("VACUUM")
+
+    def check_schema(self):
+        cur = self.conn.cursor()
+        try:
+            initialized = self._table_exists(cur, self.tables.monitors)
+        finally:
+            cur.close()
+        if initialized:
+            check_schema_version(self.schema_version())
+
+    def migrate(self) -> [Migration]:
+        cur = self.conn.cursor()
+        try:
+            if not self._table_exists(cur, self.tables.schema_version):
+                if not self._table_exists(cur, self.tables.monitors):
+                    raise StorageSetupException(
+                        "Storage is not initialized. Run `monico setup` first."
+                    )
+                # database set up before schema versioning has the baseline
+                self._create_table_schema_version(cur)
+                self._record_migration(cur, self.migrations()[0])
+                self.conn.commit()
+        finally:
+            cur.close()
+        return self._apply_migrations(
+            pending_migrations(self.migrations(), self.schema_version())
+        )
 
     def teardown(self):
         cur = self.conn.cursor()
+        cur.execute(f"DROP TABLE IF EXISTS {self.tables.schema_version}")
+        cur.execute(f"DROP TABLE IF EXISTS {self.tables.rollups}")
         cur.execute(f"DROP TABLE IF EXISTS {self.tables.probes}")
         cur.execute(f"DROP TABLE IF EXISTS {self.tables.tasks}")
+        if self.transient_tasks:
+            cur.execute(f"DROP TABLE IF EXISTS {self.QUEUE_SCHEMA}.{self.tables.tasks}")
         cur.execute(f"DROP TABLE IF EXISTS {self.tables.monitors}")
         cur.close()
         self.conn.commit()
 
+    def _delete_in_batches(
+        self, table: str, condition: str, params: dict, key: str = "id"
+    ) -> int:
+        """
+        Deletes rows matching the condition, MAINTENANCE_BATCH_SIZE rows per
+        transaction. Returns the number of deleted rows.
+        """
+        deleted = 0
+        for _ in range(self.MAINTENANCE_MAX_BATCHES):
+            batch = self._write(self._delete_batch, table, condition, params, key)
+            deleted += batch
+            if batch < self.MAINTENANCE_BATCH_SIZE:
+                break
+            time.sleep(self.MAINTENANCE_BATCH_PAUSE)
+        return deleted
+
+    def _delete_batch(
+        self, cur: sqlite3.Cursor, table: str, condition: str, params: dict, key: str
+    ) -> int:
+        cur.execute(
+            f"""
+            DELETE FROM {table} WHERE {key} IN (
+                SELECT {key} FROM {table} WHERE {condition} LIMIT :limit
+            )""",
+            {**params, "limit": self.MAINTENANCE_BATCH_SIZE},
+        )
+        return cur.rowcount
+
+    def _incremental_vacuum(self) -> int:
+        """Returns free pages to the file system, returns the number of freed pages"""
+        cur = self.conn.cursor()
+        try:
+            cur.execute("PRAGMA auto_vacuum")
+            if cur.fetchone()[0] != 2:
+                return 0
+            cur.execute("PRAGMA freelist_count")
+            free_pages = cur.fetchone()[0]
+            for _ in range(self.MAINTENANCE_MAX_BATCHES):
+                cur.execute("PRAGMA freelist_count")
+                if cur.fetchone()[0] == 0:
+                    break
+                # executescript() runs the pragma to completion, execute()
+                # would only free a single page
+                self.conn.executescript(
+                    f"PRAGMA incremental_vacuum({self.MAINTENANCE_BATCH_SIZE})"
+                )
+                time.sleep(self.MAINTENANCE_BATCH_PAUSE)
+            cur.execute("PRAGMA freelist_count")
+            return free_pages - cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    def maintain(self) -> dict:
+        """
+        Deletes probes, finished tasks and fine rollups older than their
+        retention in small batches, then reclaims the freed space and
+        refreshes statistics.
+        """
+        now = int(time.time())
+        stats = {}
+        if self.probe_retention is not None:
+            stats["probes_deleted"] = self._delete_in_batches(
+                self.tables.probes,
+                "timestamp < :before",
+                {"before": now - self.probe_retention},
+                key="rowid",
+            )
+        if self.task_retention is not None:
+            finished = ", ".join(
+                str(TASK_STATUS_CODES[status])
+                for status in (
+                    TaskStatus.COMPLETED,
+                    TaskStatus.ABANDONED,
+                    TaskStatus.FAILED,
+                )
+            )
+            stats["tasks_deleted"] = self._delete_in_batches(
+                self.tables.tasks,
+                f"status IN ({finished}) AND timestamp < :before",
+                {"before": now - self.task_retention},
+            )
+        stats["rollups_deleted"] = sum(
+            self._delete_in_batches(
+                self.tables.rollups,
+                "resolution = :resolution AND bucket < :before",
+                {"resolution": resolution, "before": now - retention},
+                key="rowid",
+            )
+            for (resolution, retention) in RETENTION.items()
+        )
+        if any(stats.values()):
+            stats["pages_freed"] = self._incremental_vacuum()
+        # runs ANALYZE on tables whose statistics are out of date
+        self.conn.execute("PRAGMA optimize")
+        return stats
+
     def create_monitor(self, monitor: Monitor) -> Monitor:
         if not monitor.id:
             monitor.id = str(uuid.uuid4())
-        cur = self.conn.cursor()
+        self._write(self._insert_monitor, monitor)
+        return Monitor(
+            monitor.id,
+            monitor.name,
+            monitor.endpoint,
+            monitor.interval,
+            monitor.body_regexp,
+        )
+
+    def _insert_monitor(self, cur: sqlite3.Cursor, monitor: Monitor) -> None:
         try:
             cur.execute(
                 f"""
@@ -175,24 +955,10 @@ class SqliteStorage(StorageInterface):
                     (:id, :name, :endpoint, :interval, :body_regexp)""",
                 monitor.__dict__,
             )
-            self.conn.commit()
-            return Monitor(
-                monitor.id,
-                monitor.name,
-                monitor.endpoint,
-                monitor.interval,
-                monitor.body_regexp,
-            )
-        except sqlite3.IntegrityError as e:
-            self.conn.rollback()
+        except sqlite3.IntegrityError:
             raise MonitorAlreadyExistsException(
                 f"Monitor with ID {monitor.id} already exists"
             )
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
 
     def read_monitor(self, id):
         cur = self.conn.cursor()
@@ -210,181 +976,393 @@ class SqliteStorage(StorageInterface):
     def list_monitors(
         self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
     ):
+        return [Monitor(*row[:-1]) for row in self._select_monitors(sort)]
+
+    def _select_monitors(self, sort: MonitorSortingOrder) -> [tuple]:
+        """Rows of monitors in the order, with their created_at last"""
         cur = self.conn.cursor()
 
         sort_postfix_map = {
-            MonitorSortingOrder.CREATED_AT_ASC: "created_at ASC",
+            # monitors created within the same second in insertion order
+            MonitorSortingOrder.CREATED_AT_ASC: "created_at ASC, seq ASC",
             MonitorSortingOrder.LAST_TASK_AT_DESC: "last_task_at DESC",
         }
 
         cur.execute(
-            "SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at "
-            f"FROM {self.tables.monitors} ORDER BY {sort_postfix_map[sort]}",
+            "SELECT id, name, endpoint, interval, body_regexp, last_task_at, last_probe_at, "
+            f"created_at FROM {self.tables.monitors} ORDER BY {sort_postfix_map[sort]}",
         )
         rows = cur.fetchall()
         cur.close()
-        return [Monitor(*row) for row in rows]
+        return rows
 
     def delete_monitor(self, id):
-        cur = self.conn.cursor()
-        try:
-            monitor = self.read_monitor(id)
+        monitor = self.read_monitor(id)
+        self._write(self._delete_monitor, id)
+        return monitor
+
+    def _delete_monitor(self, cur: sqlite3.Cursor, id: str) -> None:
+        if self.transient_tasks:
+            # not reached by the cascade from another database
             cur.execute(
-                f"DELETE FROM {self.tables.monitors} " "WHERE id = :id", {"id": id}
+                f"""
+                DELETE FROM {self.tables.tasks} WHERE fk_monitor = (
+                    SELECT seq FROM {self.tables.monitors} WHERE id = :id
+                )""",
+                {"id": id},
             )
-            cur.close()
-            self.conn.commit()
-            return monitor
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+        cur.execute(f"DELETE FROM {self.tables.monitors} WHERE id = :id", {"id": id})
 
     def create_task(self, task: Task):
-        cur = self.conn.cursor()
-        try:
-            cur.execute(
-                f"INSERT INTO {self.tables.tasks}"
-                "(id, timestamp, fk_monitor, status) VALUES "
-                "(:id, :timestamp, :fk_monitor, :status)",
-                (task.id, task.timestamp, task.monitor_id, task.status.value),
-            )
-            cur.execute(
-                f"UPDATE {self.tables.monitors} "
-                "SET last_task_at = :last_task_at WHERE id = :id",
-                {"last_task_at": task.timestamp, "id": task.monitor_id},
-            )
-            self.conn.commit()
-            return task
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+        self._write_later(self._insert_task, task)
+        return task
 
-    def lock_tasks(self, worker_id: str, batch_size: int) -> [Task]:
-        cur = self.conn.cursor()
-        try:
-            cur.execute(
-                f"""
-                UPDATE {self.tables.tasks} SET
-                    status = :new_status,
-                    locked_at = CURRENT_TIMESTAMP,
-                    locked_by = :locked_by
-                WHERE id IN (
-                    SELECT id FROM {self.tables.tasks}
-                    WHERE status = :status
-                    ORDER BY timestamp ASC
-                    LIMIT :limit
-                )
-                RETURNING id, timestamp, fk_monitor, status, locked_at, locked_by, completed_at;
-                """,
-                {
-                    "new_status": TaskStatus.RUNNING.value,
-                    "locked_by": worker_id,
-                    "status": TaskStatus.PENDING.value,
-                    "limit": batch_size,
-                },
-            )
-            rows = cur.fetchall()
-            self.conn.commit()
-            return [Task(*row) for row in rows]
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+    def _insert_task(self, cur: sqlite3.Cursor, task: Task) -> None:
+        cur.execute(
+            f"""
+            INSERT INTO {self.tables.tasks}
+                (id, timestamp, fk_monitor, status, locked_at, locked_by)
+            VALUES (
+                :id,
+                :timestamp,
+                (SELECT seq FROM {self.tables.monitors} WHERE id = :monitor_id),
+                :status,
+                :locked_at,
+                :locked_by
+            )""",
+            {
+                "id": task.id,
+                "timestamp": task.timestamp,
+                "monitor_id": task.monitor_id,
+                "status": TASK_STATUS_CODES[task.status],
+                "locked_at": task.locked_at,
+                "locked_by": task.locked_by,
+            },
+        )
+        cur.execute(
+            f"UPDATE {self.tables.monitors} "
+            "SET last_task_at = :last_task_at WHERE id = :id",
+            {"last_task_at": task.timestamp, "id": task.monitor_id},
+        )
+
+    def _select_tasks_with_affinity(
+        self, cur: sqlite3.Cursor, batch_size: int, affinity: HostAffinity
+    ) -> [str]:
+        cur.execute(
+            f"""
+            SELECT t.id, t.timestamp, m.endpoint
+            FROM {self.tables.tasks} t
+                JOIN {self.tables.monitors} m ON m.seq = t.fk_monitor
+            WHERE t.status = {TASK_STATUS_CODES[TaskStatus.PENDING]}
+            ORDER BY t.timestamp ASC
+            LIMIT :limit
+            """,
+            {"limit": affinity.scan_size(batch_size)},
+        )
+        return affinity.select(cur.fetchall(), batch_size, int(time.time()))
+
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
+        return self._write(self._lock_tasks, worker_id, batch_size, affinity)
+
+    def _lock_tasks(
+        self,
+        cur: sqlite3.Cursor,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity],
+    ) -> [Task]:
+        params = {
+            "new_status": TASK_STATUS_CODES[TaskStatus.RUNNING],
+            "locked_by": worker_id,
+            "status": TASK_STATUS_CODES[TaskStatus.PENDING],
+            "limit": batch_size,
+        }
+        if affinity is None:
+            # status is a literal, so that the partial index on
+            # pending tasks can be used
+            selection = f"""
+                SELECT id FROM {self.tables.tasks}
+                WHERE status = {TASK_STATUS_CODES[TaskStatus.PENDING]}
+                ORDER BY timestamp ASC
+                LIMIT :limit
+            """
+        else:
+            ids = self._select_tasks_with_affinity(cur, batch_size, affinity)
+            if not ids:
+                return []
+            params.update({f"id{i}": tid for (i, tid) in enumerate(ids)})
+            selection = ", ".join(f":id{i}" for i in range(len(ids)))
+
+        # status is re-checked, so that tasks locked by a concurrent
+        # worker since they were selected are skipped
+        cur.execute(
+            f"""
+            UPDATE {self.tables.tasks} SET
+                status = :new_status,
+                locked_at = CURRENT_TIMESTAMP,
+                locked_by = :locked_by
+            WHERE status = :status AND id IN ({selection})
+            RETURNING
+                id,
+                timestamp,
+                (SELECT id FROM {self.tables.monitors} WHERE seq = fk_monitor),
+                status,
+                locked_at,
+                locked_by,
+                completed_at;
+            """,
+            params,
+        )
+        rows = cur.fetchall()
+        return [Task(*row[:3], TASK_STATUSES[row[3]], *row[4:]) for row in rows]
+
+    def _select_monitors_with_affinity(
+        self, cur: sqlite3.Cursor, batch_size: int, affinity: HostAffinity, now: int
+    ) -> [str]:
+        cur.execute(
+            f"""
+            SELECT id, {MONITOR_DUE_AT_SQL}, endpoint FROM {self.tables.monitors}
+            WHERE {MONITOR_DUE_AT_SQL} <= :now
+            ORDER BY {MONITOR_DUE_AT_SQL} ASC
+            LIMIT :limit
+            """,
+            {"now": now, "limit": affinity.scan_size(batch_size)},
+        )
+        return affinity.select(cur.fetchall(), batch_size, now)
+
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        return self._write(self._claim_monitors, batch_size, affinity)
+
+    def _claim_monitors(
+        self, cur: sqlite3.Cursor, batch_size: int, affinity: Optional[HostAffinity]
+    ) -> [Monitor]:
+        now = int(time.time())
+        params = {"now": now, "limit": batch_size}
+        if affinity is None:
+            selection = f"""
+                SELECT seq FROM {self.tables.monitors}
+                WHERE {MONITOR_DUE_AT_SQL} <= :now
+                ORDER BY {MONITOR_DUE_AT_SQL} ASC
+                LIMIT :limit
+            """
+        else:
+            ids = self._select_monitors_with_affinity(cur, batch_size, affinity, now)
+            if not ids:
+                return []
+            params.update({f"id{i}": mid for (i, mid) in enumerate(ids)})
+            selection = f"""
+                SELECT seq FROM {self.tables.monitors}
+                WHERE id IN ({", ".join(f":id{i}" for i in range(len(ids)))})
+            """
+
+        # due time is re-checked, so that monitors claimed by a concurrent
+        # worker since they were selected are skipped
+        cur.execute(
+            f"""
+            UPDATE {self.tables.monitors} SET last_task_at = :now
+            WHERE {MONITOR_DUE_AT_SQL} <= :now AND seq IN ({selection})
+            RETURNING
+                id, name, endpoint, interval, body_regexp,
+                last_task_at, last_probe_at;
+            """,
+            params,
+        )
+        return [Monitor(*row) for row in cur.fetchall()]
 
     def update_task(self, task: Task):
-        cur = self.conn.cursor()
-        try:
-            cur.execute(
-                f"""
-                UPDATE {self.tables.tasks} SET
-                    status = :status,
-                    completed_at = :completed_at
-                WHERE id = :id
-                """,
-                {
-                    "status": task.status.value,
-                    "completed_at": task.completed_at,
-                    "id": task.id,
-                },
-            ),
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+        self._write_later(self._update_task, task)
 
-    def record_probe(self, probe: Probe):
-        cur = self.conn.cursor()
-        try:
-            # record probe data
-            cur.execute(
-                f"""
-                INSERT INTO {self.tables.probes} (
-                    id, timestamp, fk_monitor, fk_task, response_time,
-                    response_code, response_error, content_match
-                )
-                VALUES (
-                    :id, :timestamp, :fk_monitor, :fk_task, :response_time,
-                    :response_code, :response_error, :content_match
-                )
+    def _update_task(self, cur: sqlite3.Cursor, task: Task) -> None:
+        cur.execute(
+            f"""
+            UPDATE {self.tables.tasks} SET
+                status = :status,
+                locked_at = :locked_at,
+                locked_by = :locked_by,
+                completed_at = :completed_at
+            WHERE id = :id
             """,
-                {
-                    "id": probe.id,
-                    "timestamp": probe.timestamp,
-                    "fk_monitor": probe.monitor_id,
-                    "fk_task": probe.task_id,
-                    "response_time": probe.response_time,
-                    "response_code": probe.response_code,
-                    "response_error": probe.response_error.value
-                    if probe.response_error
-                    else None,
-                    "content_match": probe.content_match,
-                },
-            )
+            {
+                "status": TASK_STATUS_CODES[task.status],
+                "locked_at": task.locked_at,
+                "locked_by": task.locked_by,
+                "completed_at": task.completed_at,
+                "id": task.id,
+            },
+        )
 
-            # update last probe timestamp on monitor
-            cur.execute(
-                f"""
-                UPDATE {self.tables.monitors}
-                SET last_probe_at = :last_probe_at WHERE id = :id
-                """,
-                {"last_probe_at": probe.timestamp, "id": probe.monitor_id},
+    # statements of recording probes are built once, so that they are
+    # compiled once per connection and then reused from its statement cache
+
+    @cached_property
+    def _upsert_rollups_sql(self) -> str:
+        placeholders = ", ".join(
+            [f"(SELECT seq FROM {self.tables.monitors} WHERE id = ?)"]
+            + ["?" for _ in ROLLUP_COLUMNS[1:]]
+        )
+        return rollup_upsert_sql(self.tables.rollups, f"({placeholders})")
+
+    @cached_property
+    def _insert_probe_sql(self) -> str:
+        return f"""
+            INSERT INTO {self.tables.probes} (
+                id, timestamp, fk_monitor, fk_task, response_time,
+                response_code, response_error, content_match
+            )
+            VALUES (
+                ?,
+                ?,
+                (SELECT seq FROM {self.tables.monitors} WHERE id = ?),
+                (SELECT seq FROM {self.tables.tasks} WHERE id = ?),
+                ?,
+                ?,
+                ?,
+                ?
             )
+        """
 
-            # recording a probe means the task is completed
-            cur.execute(
-                f"""
-                UPDATE {self.tables.tasks} SET status = :status WHERE id = :id
-                """,
-                {"status": TaskStatus.COMPLETED.value, "id": probe.task_id},
+    @cached_property
+    def _update_last_probe_sql(self) -> str:
+        return f"UPDATE {self.tables.monitors} SET last_probe_at = ? WHERE id = ?"
+
+    @cached_property
+    def _complete_task_sql(self) -> str:
+        return (
+            f"UPDATE {self.tables.tasks} SET status = ?, completed_at = ? WHERE id = ?"
+        )
+
+    def _update_rollups(self, cur: sqlite3.Cursor, probes: [Probe]) -> None:
+        cur.executemany(
+            self._upsert_rollups_sql,
+            [rollup_values(rollup) for rollup in rollup_probes(probes)],
+        )
+
+    @staticmethod
+    def _probe_values(probe: Probe) -> tuple:
+        return (
+            uuid.UUID(probe.id).bytes,
+            probe.timestamp,
+            probe.monitor_id,
+            probe.task_id,
+            probe.response_time,
+            probe.response_code,
+            probe_error_code(probe.response_error),
+            probe.content_match,
+        )
+
+    def record_probe(self, probe: Probe) -> Future:
+        """
+        Records a probe, updates the last probe time of its monitor, and
+        completes its task, in one transaction
+        """
+        return self._write_later(self._record_probes, [probe])
+
+    def record_probes(self, probes: [Probe]) -> Future:
+        """Records a batch of probes in a single transaction"""
+        if not probes:
+            return self._write_later(lambda cur: None)
+        return self._write_later(self._record_probes, probes)
+
+    def _record_probes(self, cur: sqlite3.Cursor, probes: [Probe]) -> None:
+        # latest probe of each monitor
+        last_probe_at = {}
+        for probe in probes:
+            last_probe_at[probe.monitor_id] = max(
+                probe.timestamp, last_probe_at.get(probe.monitor_id, probe.timestamp)
             )
-            self.conn.commit()
-        except Exception as e:
-            self.conn.rollback()
-            raise e
-        finally:
-            cur.close()
+        completed_at = int(time.time())
+
+        cur.executemany(
+            self._insert_probe_sql,
+            [self._probe_values(probe) for probe in probes],
+        )
+        cur.executemany(
+            self._update_last_probe_sql,
+            [(timestamp, mid) for (mid, timestamp) in last_probe_at.items()],
+        )
+        cur.executemany(
+            self._complete_task_sql,
+            [
+                (TASK_STATUS_CODES[TaskStatus.COMPLETED], completed_at, probe.task_id)
+                for probe in probes
+            ],
+        )
+        self._update_rollups(cur, probes)
 
     def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
         cur = self.conn.cursor()
         cur.execute(
             f"""
             SELECT
-                id, timestamp, fk_monitor, fk_task, response_time,
-                response_code, response_error, content_match
-            FROM {self.tables.probes}
-                WHERE fk_monitor = :fk_monitor
-            ORDER BY timestamp DESC
+                p.id, p.timestamp, t.id, p.response_time,
+                p.response_code, p.response_error, p.content_match
+            FROM {self.tables.probes} p
+                LEFT JOIN {self.tables.tasks} t ON t.seq = p.fk_task
+            WHERE p.fk_monitor = (
+                SELECT seq FROM {self.tables.monitors} WHERE id = :monitor_id
+            )
+            ORDER BY p.timestamp DESC
             LIMIT :limit
         """,
-            {"fk_monitor": monitor_id, "limit": limit},
+            {"monitor_id": monitor_id, "limit": limit},
         ),
         rows = cur.fetchall()
         cur.close()
-        return [Probe(*row) for row in rows]
+        return [
+            Probe(
+                str(uuid.UUID(bytes=pid)),
+                timestamp,
+                monitor_id,
+                task_id,
+                response_time,
+                response_code,
+                probe_error_value(response_error),
+                content_match,
+            )
+            for (
+                pid,
+                timestamp,
+                task_id,
+                response_time,
+                response_code,
+                response_error,
+                content_match,
+            ) in rows
+        ]
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        cur = self.conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {", ".join(name for (name, _) in ROLLUP_COLUMNS[1:])}
+            FROM {self.tables.rollups}
+            WHERE fk_monitor = (
+                    SELECT seq FROM {self.tables.monitors} WHERE id = :monitor_id
+                )
+                AND resolution = :resolution
+                AND bucket >= :since
+                AND bucket < :until
+            ORDER BY bucket ASC
+            """,
+            {
+                "monitor_id": monitor_id,
+                "resolution": resolution,
+                "since": since,
+                "until": until,
+            },
+        )
+        rows = cur.fetchall()
+        cur.close()
+        return [rollup_from_row((monitor_id, *row)) for row in rows]
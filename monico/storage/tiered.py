@@ -0,0 +1,388 @@
+"""
+Tiered probe storage: recent probes in memory in front of any storage backend.
+
+Recent probes are read far more often than old ones, e.g. to restore circuit
+breakers or to show the status of a monitor. The latest probes of every
+monitor are kept in memory and served from there, while recorded probes are
+written to the backend in batches by a background thread. Everything else
+goes straight to the backend.
+"""
+import time
+import bisect
+import threading
+from dataclasses import replace
+from typing import Optional
+from monico.core.storage import (
+    StorageInterface,
+    MonitorSortingOrder,
+    wait_for_writes,
+)
+from monico.core.affinity import HostAffinity
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe, ProbeResponseError
+from monico.core.rollup import Rollup
+from monico.core.task import Task
+
+
+def as_read(probe: Probe) -> Probe:
+    """The probe as backends return it, with the error as a string"""
+    if isinstance(probe.response_error, ProbeResponseError):
+        return replace(probe, response_error=probe.response_error.value)
+    return probe
+
+
+class RecentProbes:
+    """
+    Latest probes of a monitor, oldest first, as read from the backend at
+    `loaded_at` and with probes recorded since then added as they come.
+    """
+
+    def __init__(self):
+        self.probes: [Probe] = []
+        # monotonic time of the last read from the backend, None if never read
+        self.loaded_at: Optional[float] = None
+        # whether the probes are all the probes the monitor has
+        self.complete = False
+
+    def add(self, probe: Probe, size: int):
+        bisect.insort(self.probes, probe, key=lambda p: p.timestamp)
+        if len(self.probes) > size:
+            del self.probes[: len(self.probes) - size]
+            self.complete = False
+
+    def newest(self, limit: int) -> [Probe]:
+        return self.probes[: -limit - 1 : -1] if limit > 0 else []
+
+
+class TieredStorage(StorageInterface):
+    """
+    Wraps a storage backend. The latest `probes_per_monitor` probes of every
+    monitor are kept in memory, and list_probes is answered from them when
+    they are recent enough and hold as many probes as asked for; otherwise
+    the backend is read and the probes of the monitor are refreshed.
+
+    Recorded probes are added to memory right away, and written to the
+    backend by a flusher thread every `FLUSH_INTERVAL` seconds, or as soon as
+    `FLUSH_BATCH_SIZE` probes are waiting. Until then, reads of the storage
+    see them: the last probe time of their monitors is filled in, and tasks
+    locked before their probes are written aren't handed out again. Rollups
+    and maintenance flush the probes first. Errors of background writes are
+    raised by the next flush().
+
+    Probes are only cached for the process recording them: probes recorded by
+    other processes are seen once the probes of the monitor are refreshed.
+    """
+
+    FLUSH_INTERVAL = 1.0  # seconds between background flushes
+    FLUSH_BATCH_SIZE = 500  # probes per write to the backend
+    # recording waits for a flush once this many probes are waiting
+    MAX_PENDING_PROBES = 10000
+    # seconds the probes read from the backend are served for
+    REFRESH_INTERVAL = 5.0
+
+    backend: StorageInterface
+
+    def __init__(self, backend: StorageInterface, probes_per_monitor: int = 100):
+        if probes_per_monitor < 1:
+            raise ValueError("At least one probe per monitor has to be kept")
+        self.backend = backend
+        self.probes_per_monitor = probes_per_monitor
+        self.lock = threading.Lock()
+        # held while probes are written, so that there is one writer at a time
+        self.flush_lock = threading.Lock()
+        self.recent: {str: RecentProbes} = {}
+        # (monotonic time recorded, probe) of probes not written yet
+        self.pending: [(float, Probe)] = []
+        self.error: Optional[Exception] = None
+
+        self.thread = None
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flushed = 0
+        self.failed = 0
+
+    @property
+    def NOTIFIES_ABOUT_TASKS(self):
+        return self.backend.NOTIFIES_ABOUT_TASKS
+
+    @property
+    def PROCESS_LOCAL_TASKS(self):
+        return self.backend.PROCESS_LOCAL_TASKS
+
+    def connect(self) -> None:
+        self.backend.connect()
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(
+                target=self._run, name="monico-probe-flusher", daemon=True
+            )
+            self.thread.start()
+
+    def disconnect(self) -> None:
+        """Writes out waiting probes, then disconnects from the backend"""
+        try:
+            if self.thread is not None:
+                self.stopping.set()
+                self.wakeup.set()
+                self.thread.join()
+                self.thread = None
+            self.flush()
+        finally:
+            self.backend.disconnect()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.FLUSH_INTERVAL)
+            self.wakeup.clear()
+            self._write_pending()
+
+    def _forget(self):
+        """Drops probes kept in memory, including the ones not written yet"""
+        with self.flush_lock, self.lock:
+            self.recent = {}
+            self.pending = []
+            self.error = None
+
+    def setup(self, force=False):
+        if force:
+            self._forget()
+        self.backend.setup(force=force)
+
+    def check_schema(self):
+        self.backend.check_schema()
+
+    def migrate(self) -> list:
+        return self.backend.migrate()
+
+    def teardown(self):
+        self._forget()
+        self.backend.teardown()
+
+    def flush(self) -> None:
+        """
+        Writes out waiting probes and flushes the backend. Raises the first
+        error of probes that failed to be written since the last flush.
+        """
+        self._write_pending()
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+        self.backend.flush()
+
+    def maintain(self) -> dict:
+        """Runs maintenance of the backend; probes are refreshed afterwards"""
+        self._write_pending()
+        stats = self.backend.maintain()
+        # retention may have deleted probes kept in memory
+        with self.lock:
+            self.recent = {}
+        return stats
+
+    def metrics(self) -> dict:
+        with self.lock:
+            reads = self.hits + self.misses
+            oldest = self.pending[0][0] if self.pending else None
+            metrics = {
+                "cache_hits": self.hits,
+                "cache_misses": self.misses,
+                "cache_hit_rate": round(self.hits / reads, 3) if reads else 0.0,
+                "cached_monitors": len(self.recent),
+                "pending_probes": len(self.pending),
+                "flush_lag": (
+                    round(time.monotonic() - oldest, 3) if oldest is not None else 0.0
+                ),
+                "flushes": self.flushes,
+                "flushed_probes": self.flushed,
+                "failed_probes": self.failed,
+            }
+        return {**self.backend.metrics(), **metrics}
+
+    async def wait_for_tasks(self, timeout: float):
+        return await self.backend.wait_for_tasks(timeout)
+
+    def _write_pending(self):
+        """Writes waiting probes to the backend in batches"""
+        with self.flush_lock:
+            while True:
+                with self.lock:
+                    batch = [
+                        probe for (_, probe) in self.pending[: self.FLUSH_BATCH_SIZE]
+                    ]
+                if not batch:
+                    return
+                failed, error = self._write(batch)
+                with self.lock:
+                    # probes stay pending until written, so that reads in the
+                    # meantime see them
+                    del self.pending[: len(batch)]
+                    self.flushes += 1
+                    self.flushed += len(batch) - failed
+                    self.failed += failed
+                    if error is not None and self.error is None:
+                        self.error = error
+
+    def _write(self, probes: [Probe]) -> (int, Optional[Exception]):
+        """
+        Records the probes in the backend. If the batch fails, e.g. because a
+        monitor was deleted, the probes are recorded one by one, so that only
+        the failing ones are lost. Returns the number of failed probes and
+        the first error.
+        """
+        try:
+            wait_for_writes(self.backend.record_probes(probes))
+            return 0, None
+        except Exception:
+            pass
+        failed, first_error = 0, None
+        for probe in probes:
+            try:
+                wait_for_writes(self.backend.record_probe(probe))
+            except Exception as e:
+                failed += 1
+                first_error = first_error or e
+        return failed, first_error
+
+    def _pending_probes(self, monitor_id: Optional[str] = None) -> [Probe]:
+        with self.lock:
+            return [
+                probe
+                for (_, probe) in self.pending
+                if monitor_id is None or probe.monitor_id == monitor_id
+            ]
+
+    def _fill_last_probe(self, monitors: [Monitor], pending: [Probe]) -> [Monitor]:
+        """Sets the last probe time of monitors with probes not written yet"""
+        latest = {}
+        for probe in pending:
+            latest[probe.monitor_id] = max(
+                probe.timestamp, latest.get(probe.monitor_id, 0)
+            )
+        for monitor in monitors:
+            if monitor.id in latest:
+                monitor.last_probe_at = max(
+                    latest[monitor.id], monitor.last_probe_at or 0
+                )
+        return monitors
+
+    def create_monitor(self, monitor: Monitor) -> Monitor:
+        return self.backend.create_monitor(monitor)
+
+    def list_monitors(
+        self, sort: MonitorSortingOrder = MonitorSortingOrder.CREATED_AT_ASC
+    ) -> [Monitor]:
+        # taken before the read, so that probes written meanwhile aren't missed
+        pending = self._pending_probes()
+        return self._fill_last_probe(self.backend.list_monitors(sort), pending)
+
+    def read_monitor(self, id: str) -> Monitor:
+        pending = self._pending_probes(id)
+        [monitor] = self._fill_last_probe([self.backend.read_monitor(id)], pending)
+        return monitor
+
+    def delete_monitor(self, id: str):
+        with self.flush_lock, self.lock:
+            self.recent.pop(id, None)
+            self.pending = [
+                (recorded_at, probe)
+                for (recorded_at, probe) in self.pending
+                if probe.monitor_id != id
+            ]
+        return self.backend.delete_monitor(id)
+
+    def create_task(self, task: Task):
+        return self.backend.create_task(task)
+
+    def lock_tasks(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Task]:
+        """
+        Tasks whose probes aren't written yet are still pending in the
+        backend; once locked they are left for the probes to complete.
+        """
+        recorded = {probe.task_id for probe in self._pending_probes()}
+        tasks = self.backend.lock_tasks(worker_id, batch_size, affinity)
+        return [task for task in tasks if task.id not in recorded]
+
+    def update_task(self, task: Task):
+        return self.backend.update_task(task)
+
+    def claim_monitors(
+        self,
+        worker_id: str,
+        batch_size: int,
+        affinity: Optional[HostAffinity] = None,
+    ) -> [Monitor]:
+        return self.backend.claim_monitors(worker_id, batch_size, affinity)
+
+    def record_probe(self, probe: Probe):
+        self.record_probes([probe])
+
+    def record_probes(self, probes: [Probe]):
+        """Keeps the probes in memory; they are written to the backend later"""
+        now = time.monotonic()
+        with self.lock:
+            for probe in probes:
+                self.pending.append((now, probe))
+                if probe.monitor_id not in self.recent:
+                    self.recent[probe.monitor_id] = RecentProbes()
+                self.recent[probe.monitor_id].add(
+                    as_read(probe), self.probes_per_monitor
+                )
+            waiting = len(self.pending)
+        if waiting >= self.MAX_PENDING_PROBES:
+            # the backend can't keep up, the caller waits for it
+            self._write_pending()
+        elif waiting >= self.FLUSH_BATCH_SIZE:
+            self.wakeup.set()
+
+    def list_probes(self, monitor_id: str, limit: int = 10) -> [Probe]:
+        started_at = time.monotonic()
+        with self.lock:
+            recent = self.recent.get(monitor_id)
+            if (
+                recent is not None
+                and recent.loaded_at is not None
+                and started_at - recent.loaded_at < self.REFRESH_INTERVAL
+                and limit <= self.probes_per_monitor
+                and (len(recent.probes) >= limit or recent.complete)
+            ):
+                self.hits += 1
+                return recent.newest(limit)
+            self.misses += 1
+
+        pending = self._pending_probes(monitor_id)
+        wanted = max(limit, self.probes_per_monitor)
+        loaded = self.backend.list_probes(monitor_id, limit=wanted)
+        with self.lock:
+            refreshed = RecentProbes()
+            refreshed.loaded_at = started_at
+            refreshed.complete = len(loaded) < wanted
+            kept = self.recent.get(monitor_id)
+            seen = set()
+            # probes recorded while the backend was read are kept too
+            for probe in loaded + (kept.probes if kept else []) + pending:
+                if probe.id not in seen:
+                    probe = as_read(probe)
+                    seen.add(probe.id)
+                    refreshed.add(probe, wanted)
+            probes = refreshed.newest(limit)
+            if len(refreshed.probes) > self.probes_per_monitor:
+                del refreshed.probes[: -self.probes_per_monitor]
+                refreshed.complete = False
+            self.recent[monitor_id] = refreshed
+        return probes
+
+    def list_rollups(
+        self, monitor_id: str, resolution: int, since: int, until: int
+    ) -> [Rollup]:
+        # rollups are updated by the backend as probes are written
+        self._write_pending()
+        return self.backend.list_rollups(monitor_id, resolution, since, until)
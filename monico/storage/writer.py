@@ -0,0 +1,166 @@
+"""
+Single writer thread of an SQLite database with group commit.
+
+SQLite lets one connection write at a time, and every commit waits for the
+journal to be written out. Instead of each caller taking the write lock and
+committing on its own, write operations are queued for a single thread, which
+runs the operations queued within a few milliseconds in one transaction and
+commits them together. Callers get futures of the operations' results.
+"""
+import time
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import Callable, Any
+from monico.core.storage import StorageConnectionException
+
+
+class WriteFuture(Future):
+    """
+    Future of a write operation, which tells whether a caller has waited for
+    its result, and so has handled its error.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.waited = False
+
+    def result(self, timeout=None):
+        self.waited = True
+        return super().result(timeout)
+
+
+class SqliteWriter:
+    # seconds to wait for more operations after the first one of a group
+    GROUP_INTERVAL = 0.002
+    MAX_GROUP_SIZE = 1000  # operations per transaction
+
+    def __init__(self, connect: Callable[[], sqlite3.Connection]):
+        self.connect = connect
+        # (operation, arguments, future) items; None asks the thread to stop
+        self.queue: queue.Queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+        self.groups = 0
+        self.committed = 0
+        self.failed = 0
+        self.max_group_size = 0
+
+    def start(self):
+        """Starts the writer thread, unless it's running already"""
+        with self.lock:
+            if self.thread is not None:
+                return
+            conn = self.connect()
+            self.thread = threading.Thread(
+                target=self._run, args=(conn,), name="monico-sqlite-writer", daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        """Commits queued operations, then stops the writer thread"""
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            # operations queued behind the stop request are never run
+            error = StorageConnectionException("SQLite writer thread has stopped")
+            while not self.queue.empty():
+                item = self.queue.get_nowait()
+                if item is not None and not item[2].done():
+                    item[2].set_exception(error)
+
+    def submit(self, operation: Callable[..., Any], *args) -> Future:
+        """
+        Queues the operation, which is called with a cursor of the writer's
+        connection and the arguments, inside a transaction. Returns the
+        future of its result, set once the transaction is committed.
+        """
+        future = WriteFuture()
+        # so that the operation isn't queued behind the stop request
+        with self.lock:
+            if self.thread is None:
+                raise StorageConnectionException("SQLite writer thread is not running")
+            self.queue.put((operation, args, future))
+        return future
+
+    def flush(self):
+        """Waits until the operations queued so far are committed"""
+        self.submit(lambda cur: None).result()
+
+    def _run(self, conn: sqlite3.Connection):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            group = [item]
+            deadline = time.monotonic() + self.GROUP_INTERVAL
+            while len(group) < self.MAX_GROUP_SIZE:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                group.append(item)
+            self._commit(conn, group)
+
+    def _commit(self, conn: sqlite3.Connection, group: list):
+        """
+        Runs the operations in one transaction. Every operation runs in a
+        savepoint, so that a failed one is rolled back without the others.
+        """
+        outcomes = []
+        cur = conn.cursor()
+        try:
+            cur.execute("BEGIN IMMEDIATE")
+            for operation, args, future in group:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                cur.execute("SAVEPOINT operation")
+                try:
+                    outcomes.append((future, operation(cur, *args), None))
+                    cur.execute("RELEASE operation")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO operation")
+                    cur.execute("RELEASE operation")
+                    outcomes.append((future, None, e))
+            conn.commit()
+        except Exception as e:
+            # the whole group is lost, e.g. the write lock wasn't acquired;
+            # every caller of the group gets the error, including those whose
+            # operations haven't started
+            conn.rollback()
+            outcomes = [
+                (future, None, e) for (_, _, future) in group if not future.done()
+            ]
+        finally:
+            cur.close()
+
+        self.groups += 1
+        self.max_group_size = max(self.max_group_size, len(group))
+        for future, result, error in outcomes:
+            if error is None:
+                self.committed += 1
+                future.set_result(result)
+            else:
+                self.failed += 1
+                future.set_exception(error)
+
+    def metrics(self) -> dict:
+        return {
+            "writer_queued": self.queue.qsize(),
+            "writer_groups": self.groups,
+            "writer_committed": self.committed,
+            "writer_failed": self.failed,
+            "writer_group_size_avg": (
+                (self.committed + self.failed) / self.groups if self.groups else 0.0
+            ),
+            "writer_group_size_max": self.max_group_size,
+        }
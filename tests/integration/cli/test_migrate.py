@@ -0,0 +1,25 @@
+import logging
+from unittest import mock
+from click.testing import CliRunner
+from monico.core.app import App
+from monico.cli.migrate import migrate as migrate_cmd
+from monico.storage.migrations import Migration
+
+
+def test_cli_command():
+    runner = CliRunner()
+
+    with mock.patch.object(logging, "getLogger") as get_logger_mock:
+        get_logger_mock.return_value = mock.MagicMock()
+        with mock.patch.object(App, "migrate") as migrate_mock:
+            migrate_mock.return_value = [
+                Migration(2, "add an index", lambda cur: None),
+            ]
+            result = runner.invoke(migrate_cmd, [])
+            assert result.exit_code == 0
+            assert result.output == "Applied migration 2: add an index\n"
+
+            migrate_mock.return_value = []
+            result = runner.invoke(migrate_cmd, [])
+            assert result.exit_code == 0
+            assert result.output == "Database schema is up to date\n"
@@ -19,3 +19,12 @@ def test_run_worker():
             assert run_worker_mock.called_once_with("test-worker-id")
             assert result.exit_code == 0
             assert result.output == ""
+
+
+def test_run_worker_invalid_affinity():
+    runner = CliRunner()
+    with mock.patch.object(App, "run_worker") as run_worker_mock:
+        result = runner.invoke(run_worker, ["--affinity", "2/2"])
+        run_worker_mock.assert_not_called()
+        assert result.exit_code == 2
+        assert "Affinity slot must be between 0 and 1" in result.output
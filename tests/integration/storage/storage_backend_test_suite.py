@@ -1,7 +1,14 @@
+import time
 import pytest
+from concurrent.futures import ThreadPoolExecutor
 from monico.core.monitor import Monitor
 from monico.storage.pg import StorageSetupException
-from monico.core.probe import Probe
+from monico.core.probe import Probe, ProbeResponseError
+from monico.core.task import TaskStatus
+from monico.core.affinity import HostAffinity
+from monico.core.rollup import RESOLUTIONS
+from monico.storage.migrations import Migration
+from monico.storage.common import rollup_backfill_sql
 from monico.core.storage import MonitorAlreadyExistsException, MonitorNotFoundException
 from .fixtures import test_monitor
 
@@ -26,6 +33,97 @@ class StorageBackendTestSuite:
         with pytest.raises(StorageSetupException):
             self.storage.setup()
 
+    def test_setup_records_schema_version(self):
+        assert self.storage.schema_version() == len(self.storage.migrations())
+        assert self.storage.migrate() == []
+
+    def test_migrate_applies_pending_migrations(self):
+        applied = []
+
+        def add_index(cur):
+            applied.append(True)
+            cur.execute(
+                f"CREATE INDEX {self.storage.tables.monitors}_name_idx "
+                f"ON {self.storage.tables.monitors} (name)"
+            )
+
+        migrations = self.storage.migrations()
+        migration = Migration(len(migrations) + 1, "add index", add_index)
+        self.storage.migrations = lambda: migrations + [migration]
+        try:
+            assert self.storage.migrate() == [migration]
+            assert self.storage.schema_version() == migration.version
+            # already applied migrations are not applied again
+            assert self.storage.migrate() == []
+            assert applied == [True]
+        finally:
+            del self.storage.migrations
+
+    def test_migrate_records_baseline_of_unversioned_storage(self):
+        self.execute_sql(f"DROP TABLE {self.storage.tables.schema_version}")
+        assert self.storage.schema_version() == 0
+
+        self.storage.migrate()
+        assert self.storage.schema_version() == len(self.storage.migrations())
+
+    def test_check_schema_requires_migration(self):
+        self.storage.check_schema()
+        self.execute_sql(
+            f"DELETE FROM {self.storage.tables.schema_version} WHERE version >= 5"
+        )
+        with pytest.raises(StorageSetupException, match="monico migrate"):
+            self.storage.check_schema()
+        # storage that isn't set up has nothing to check
+        self.storage.teardown()
+        self.storage.check_schema()
+
+    def test_migrate_requires_setup(self):
+        self.storage.teardown()
+        with pytest.raises(StorageSetupException):
+            self.storage.migrate()
+
+    def test_compact_migration_keeps_data(self):
+        # storage deployed with text references and enums
+        self.storage.teardown()
+        self.storage._apply_migrations(self.storage.migrations()[:3])
+        now = int(time.time())
+        probe_id = "6f1c1fb4-5b4a-4c4e-9d39-1f4f2a8e0c1a"
+        tables = self.storage.tables
+        for sql in [
+            f"INSERT INTO {tables.monitors} (id, name, endpoint, interval) "
+            "VALUES ('m1', 'Monitor', 'https://example.com', 60)",
+            f"INSERT INTO {tables.tasks} (id, timestamp, fk_monitor, status) "
+            f"VALUES ('t1', {now}, 'm1', 'completed')",
+            f"INSERT INTO {tables.tasks} (id, timestamp, fk_monitor, status) "
+            f"VALUES ('t2', {now}, 'm1', 'pending')",
+            f"INSERT INTO {tables.probes} (id, timestamp, fk_monitor, fk_task, "
+            "response_time, response_code, response_error, content_match) "
+            f"VALUES ('{probe_id}', {now}, 'm1', 't1', NULL, NULL, 'timeout', 'x')",
+        ]:
+            self.execute_sql(sql)
+
+        self.storage.migrate()
+        assert self.storage.schema_version() == len(self.storage.migrations())
+        assert self.storage.read_monitor("m1").name == "Monitor"
+        [probe] = self.storage.list_probes("m1")
+        assert (probe.id, probe.timestamp, probe.monitor_id, probe.task_id) == (
+            probe_id,
+            now,
+            "m1",
+            "t1",
+        )
+        assert probe.response_error == ProbeResponseError.TIMEOUT.value
+        assert probe.content_match == "x"
+        [task] = self.storage.lock_tasks("test_worker", 10)
+        assert (task.id, task.monitor_id, task.status) == (
+            "t2",
+            "m1",
+            TaskStatus.RUNNING,
+        )
+        hour = now - now % 3600
+        [rollup] = self.storage.list_rollups("m1", 3600, hour, hour + 3600)
+        assert (rollup.probes, rollup.errors) == (1, 1)
+
     def test_create_monitor(self):
         test_monitor = Monitor(
             mid=None,
@@ -138,6 +236,35 @@ class StorageBackendTestSuite:
         tasks = sorted(tasks, key=lambda t: t.timestamp)
         self.verify_tasks_locked(tasks, test_worker, task1, task2, task3)
 
+    def test_lock_tasks_with_affinity(self):
+        affinity = HostAffinity(0, 2)
+        monitors = {}
+        for i in range(100):
+            endpoint = f"https://host{i}.example.com"
+            monitors.setdefault(affinity.matches(endpoint), endpoint)
+            if len(monitors) == 2:
+                break
+        other_monitor = self.storage.create_monitor(
+            Monitor(None, "other", monitors[False])
+        )
+        preferred_monitor = self.storage.create_monitor(
+            Monitor(None, "preferred", monitors[True])
+        )
+        other_task = other_monitor.create_task()
+        other_task.timestamp -= 1
+        other_task = self.storage.create_task(other_task)
+        preferred_task = self.storage.create_task(preferred_monitor.create_task())
+
+        # preferred task is locked even though the other task is older
+        tasks = self.storage.lock_tasks("test_worker", 1, affinity=affinity)
+        assert [t.id for t in tasks] == [preferred_task.id]
+
+        # with no preferred work left, worker falls back to any pending task
+        tasks = self.storage.lock_tasks("test_worker", 1, affinity=affinity)
+        assert [t.id for t in tasks] == [other_task.id]
+
+        assert self.storage.lock_tasks("test_worker", 1, affinity=affinity) == []
+
     def test_update_task(self, test_monitor):
         self.storage.create_monitor(test_monitor)
         test_task = self.storage.create_task(test_monitor.create_task())
@@ -145,6 +272,288 @@ class StorageBackendTestSuite:
         self.storage.update_task(test_task)
         self.verify_task_abandoned(test_task)
 
+    def test_update_task_releases_lock(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        self.storage.create_task(test_monitor.create_task())
+        [task] = self.storage.lock_tasks("test_worker", 1)
+        task.release()
+        self.storage.update_task(task)
+
+        # released task can be locked again
+        [relocked] = self.storage.lock_tasks("another_worker", 1)
+        assert relocked.id == task.id
+        assert relocked.locked_by == "another_worker"
+
+    def test_create_locked_task(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        task = test_monitor.create_task()
+        task.lock("test_worker")
+        self.storage.create_task(task)
+        # handed over to a worker, so it's not locked by another one
+        assert self.storage.lock_tasks("another_worker", 10) == []
+
+        task.release()
+        self.storage.update_task(task)
+        [relocked] = self.storage.lock_tasks("another_worker", 10)
+        assert relocked.id == task.id
+
+    def test_claim_monitors(self):
+        monitors = [
+            self.storage.create_monitor(Monitor(None, f"monitor-{i}", "https://a.com"))
+            for i in range(3)
+        ]
+        # the last monitor has been probed within its interval
+        self.storage.create_task(monitors[2].create_task())
+
+        claimed = self.storage.claim_monitors("test_worker", 10)
+        assert {m.id for m in claimed} == {monitors[0].id, monitors[1].id}
+        for monitor in claimed:
+            assert monitor.name == self.storage.read_monitor(monitor.id).name
+            assert monitor.last_task_at >= int(time.time()) - 1
+        # claimed monitors are not due again until the next interval
+        assert self.storage.claim_monitors("test_worker", 10) == []
+
+        task = monitors[0].create_task()
+        task.timestamp -= monitors[0].interval
+        self.storage.create_task(task)
+        [claimed] = self.storage.claim_monitors("test_worker", 10)
+        assert claimed.id == monitors[0].id
+
+    def test_claim_monitors_batch_size(self):
+        for i in range(3):
+            self.storage.create_monitor(Monitor(None, f"monitor-{i}", "https://a.com"))
+        assert len(self.storage.claim_monitors("test_worker", 2)) == 2
+        assert len(self.storage.claim_monitors("test_worker", 2)) == 1
+
+    def test_claim_monitors_concurrently(self):
+        ids = {
+            self.storage.create_monitor(
+                Monitor(None, f"monitor-{i}", "https://a.com")
+            ).id
+            for i in range(20)
+        }
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            batches = list(
+                executor.map(
+                    lambda worker: self.storage.claim_monitors(worker, 5),
+                    [f"worker-{i}" for i in range(8)],
+                )
+            )
+        claimed = [m.id for batch in batches for m in batch]
+        # every monitor is claimed by exactly one worker
+        assert sorted(claimed) == sorted(ids)
+
+    def test_claim_monitors_with_affinity(self):
+        affinity = HostAffinity(0, 2)
+        monitors = {}
+        for i in range(100):
+            endpoint = f"https://host{i}.example.com"
+            monitors.setdefault(affinity.matches(endpoint), endpoint)
+            if len(monitors) == 2:
+                break
+        other_monitor = self.storage.create_monitor(
+            Monitor(None, "other", monitors[False])
+        )
+        preferred_monitor = self.storage.create_monitor(
+            Monitor(None, "preferred", monitors[True])
+        )
+        # both became due recently, the other monitor a second earlier
+        for monitor, age in [(other_monitor, 1), (preferred_monitor, 0)]:
+            task = monitor.create_task()
+            task.timestamp -= monitor.interval + age
+            self.storage.create_task(task)
+
+        claimed = self.storage.claim_monitors("test_worker", 1, affinity=affinity)
+        assert [m.id for m in claimed] == [preferred_monitor.id]
+
+        # with no preferred monitor due, worker falls back to any due monitor
+        claimed = self.storage.claim_monitors("test_worker", 1, affinity=affinity)
+        assert [m.id for m in claimed] == [other_monitor.id]
+
+        assert self.storage.claim_monitors("test_worker", 1, affinity=affinity) == []
+
+    def test_record_probe_of_claimed_monitor(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        [monitor] = self.storage.claim_monitors("test_worker", 1)
+        # the task of a claim only exists in the worker's memory
+        probe = Probe.create(monitor.id, monitor.create_task().id, 0.1, 200, None, None)
+        self.storage.record_probes([probe])
+
+        [recorded] = self.storage.list_probes(monitor.id)
+        assert recorded.id == probe.id
+        monitor = self.storage.read_monitor(monitor.id)
+        assert monitor.last_probe_at == probe.timestamp
+
+    def test_record_probes(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        tasks = [test_monitor.create_task() for _ in range(3)]
+        for task in tasks:
+            self.storage.create_task(task)
+        probes = [
+            Probe.create(
+                monitor_id=test_monitor.id,
+                task_id=task.id,
+                response_time=0.5,
+                response_code=200 if i else None,
+                response_error=None if i else ProbeResponseError.TIMEOUT,
+                # values that need escaping in bulk formats
+                content_match="tab\tnew\nline \\N" if i == 1 else None,
+            )
+            for (i, task) in enumerate(tasks)
+        ]
+        probes[2].timestamp += 10
+
+        self.storage.record_probes(probes)
+        self.storage.record_probes([])
+
+        recorded = self.storage.list_probes(test_monitor.id, limit=10)
+        assert {p.id for p in recorded} == {p.id for p in probes}
+        by_id = {p.id: p for p in recorded}
+        assert by_id[probes[0].id].response_error == ProbeResponseError.TIMEOUT.value
+        assert by_id[probes[0].id].response_code is None
+        assert by_id[probes[1].id].content_match == "tab\tnew\nline \\N"
+        assert by_id[probes[2].id].content_match is None
+
+        monitor = self.storage.read_monitor(test_monitor.id)
+        assert monitor.last_probe_at == probes[2].timestamp
+        self.verify_probe_recorded(probes[2], test_monitor, tasks[2])
+        locked = self.storage.lock_tasks("test_worker", 10)
+        assert locked == []
+
+    def test_maintain(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        assert isinstance(self.storage.maintain(), dict)
+        # maintenance doesn't touch current data
+        assert self.storage.read_monitor(test_monitor.id).id == test_monitor.id
+
+    def record_old_probe(self, monitor: Monitor, age: int, status=TaskStatus.COMPLETED):
+        """Records a probe of a task issued `age` seconds ago"""
+        task = monitor.create_task()
+        task.timestamp -= age
+        task.status = status
+        self.storage.create_task(task)
+        if status is not TaskStatus.COMPLETED:
+            return task, None
+        probe = Probe.create(monitor.id, task.id, 0.1, 200, None, None)
+        probe.timestamp = task.timestamp
+        self.storage.record_probe(probe)
+        return task, probe
+
+    def test_maintain_enforces_retention(self, test_monitor, monkeypatch):
+        self.storage.create_monitor(test_monitor)
+        day = 86400
+        expired_tasks = [
+            self.record_old_probe(test_monitor, 2 * 3600)[0] for _ in range(5)
+        ]
+        _, expired_probe = self.record_old_probe(test_monitor, 40 * day)
+        _, kept_probe = self.record_old_probe(test_monitor, 60)
+        pending, _ = self.record_old_probe(test_monitor, 2 * 3600, TaskStatus.PENDING)
+
+        # several batches are needed
+        monkeypatch.setattr(self.storage, "MAINTENANCE_BATCH_SIZE", 2)
+        monkeypatch.setattr(self.storage, "MAINTENANCE_BATCH_PAUSE", 0)
+        monkeypatch.setattr(self.storage, "probe_retention", 30 * day)
+        monkeypatch.setattr(self.storage, "task_retention", 3600)
+        stats = self.storage.maintain()
+
+        # expired tasks, including the task of the expired probe, are deleted
+        assert stats["tasks_deleted"] == len(expired_tasks) + 1
+        probes = self.storage.list_probes(test_monitor.id, limit=10)
+        assert len(probes) == len(expired_tasks) + 1
+        assert kept_probe.id in [p.id for p in probes]
+        assert expired_probe.id not in [p.id for p in probes]
+        # pending tasks are kept regardless of their age
+        assert [t.id for t in self.storage.lock_tasks("test_worker", 10)] == [
+            pending.id
+        ]
+        assert self.storage.maintain()["tasks_deleted"] == 0
+
+    def test_maintain_deletes_expired_rollups_in_batches(
+        self, test_monitor, monkeypatch
+    ):
+        self.storage.create_monitor(test_monitor)
+        day = 86400
+        # minute rollups of probes 10 days ago expire, hourly ones are kept
+        for i in range(5):
+            self.record_old_probe(test_monitor, 10 * day + i * 60)
+        self.record_old_probe(test_monitor, 60)
+        monkeypatch.setattr(self.storage, "MAINTENANCE_BATCH_SIZE", 2)
+        monkeypatch.setattr(self.storage, "MAINTENANCE_BATCH_PAUSE", 0)
+        assert self.storage.maintain()["rollups_deleted"] == 5
+
+        now = int(time.time())
+        since = now - 11 * day
+        assert self.storage.list_rollups(test_monitor.id, 60, since, now - day) == []
+        assert self.storage.list_rollups(test_monitor.id, 60, now - day, now + 60)
+        assert self.storage.list_rollups(test_monitor.id, 3600, since, now - day)
+        assert self.storage.maintain()["rollups_deleted"] == 0
+
+    def record_rollup_probes(self, monitor: Monitor) -> int:
+        """Records probes of the current hour, returns the start of the hour"""
+        now = int(time.time())
+        hour = now - now % 3600
+        probes = []
+        for i, (response_time, code, error) in enumerate(
+            [
+                (0.05, 200, None),
+                (0.3, 404, None),
+                (3.0, 503, None),
+                (None, None, ProbeResponseError.TIMEOUT),
+            ]
+        ):
+            task = self.storage.create_task(monitor.create_task())
+            probe = Probe.create(monitor.id, task.id, response_time, code, error, None)
+            # two minutes of the hour
+            probe.timestamp = hour + (i % 2) * 60
+            probes.append(probe)
+        self.storage.record_probe(probes[0])
+        self.storage.record_probes(probes[1:])
+        return hour
+
+    def test_record_probe_updates_rollups(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        hour = self.record_rollup_probes(test_monitor)
+
+        [rollup] = self.storage.list_rollups(test_monitor.id, 3600, hour, hour + 3600)
+        assert (rollup.monitor_id, rollup.resolution, rollup.bucket) == (
+            test_monitor.id,
+            3600,
+            hour,
+        )
+        assert rollup.probes == 4
+        assert rollup.errors == 1
+        assert (rollup.status_2xx, rollup.status_4xx, rollup.status_5xx) == (1, 1, 1)
+        assert rollup.latency_count == 3
+        assert rollup.latency_sum == pytest.approx(3.35)
+        assert (rollup.latency_min, rollup.latency_max) == (0.05, 3.0)
+        assert rollup.latency_histogram == [1, 0, 1, 0, 0, 1, 0, 0]
+
+        minutes = self.storage.list_rollups(test_monitor.id, 60, hour, hour + 3600)
+        assert [(r.bucket, r.probes) for r in minutes] == [(hour, 2), (hour + 60, 2)]
+        assert (
+            self.storage.list_rollups(test_monitor.id, 60, hour + 60, hour + 60) == []
+        )
+
+    def test_backfill_rollups(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        hour = self.record_rollup_probes(test_monitor)
+        recorded = self.storage.list_rollups(test_monitor.id, 3600, hour, hour + 3600)
+
+        # statements migration 4 fills the rollups table with
+        self.execute_sql(f"DELETE FROM {self.storage.tables.rollups}")
+        for resolution in RESOLUTIONS:
+            self.execute_sql(
+                rollup_backfill_sql(
+                    self.storage.tables.rollups, self.storage.tables.probes, resolution
+                )
+            )
+        backfilled = self.storage.list_rollups(test_monitor.id, 3600, hour, hour + 3600)
+        assert len(backfilled) == len(recorded) == 1
+        # sums of floats depend on the order of addition
+        assert backfilled[0].latency_sum == pytest.approx(recorded[0].latency_sum)
+        backfilled[0].latency_sum = recorded[0].latency_sum
+        assert backfilled == recorded
+
     def test_record_probe(self, test_monitor):
         self.storage.create_monitor(test_monitor)
         test_task = self.storage.create_task(test_monitor.create_task())
@@ -0,0 +1,197 @@
+import time
+import pytest
+import asyncio
+import threading
+from types import SimpleNamespace
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.core.task import Task, TaskStatus
+from monico.storage.memory import InMemoryStorage, IndexedHeap
+from .storage_backend_test_suite import StorageBackendTestSuite
+from .fixtures import test_monitor
+
+
+class TestInMemoryStorage(StorageBackendTestSuite):
+    @classmethod
+    def build_storage(cls):
+        return InMemoryStorage()
+
+    def test_double_setup(self):
+        pytest.skip("memory storage has nothing to set up")
+
+    def test_setup_records_schema_version(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_migrate_applies_pending_migrations(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_migrate_records_baseline_of_unversioned_storage(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_migrate_requires_setup(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_check_schema_requires_migration(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_compact_migration_keeps_data(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_backfill_rollups(self):
+        pytest.skip("memory storage has no schema")
+
+    def test_maintain_enforces_retention(self):
+        pytest.skip("finished tasks aren't kept by memory storage")
+
+    def test_maintain_deletes_expired_rollups_in_batches(self, test_monitor):
+        # expired rollups are deleted at once, there are no batches to set up
+        unbatched = SimpleNamespace(setattr=lambda target, name, value: None)
+        super().test_maintain_deletes_expired_rollups_in_batches(
+            test_monitor, unbatched
+        )
+
+    def verify_monitor_created(self, created_monitor):
+        stored = self.storage.monitors[created_monitor.id]
+        assert stored is not created_monitor
+        assert stored.__dict__ == created_monitor.__dict__
+        assert created_monitor.id in self.storage.due_monitors.entries
+
+    def verify_task_created(self, monitor, test_task):
+        stored = self.storage.tasks[test_task.id]
+        assert stored == test_task
+        assert test_task.id in self.storage.monitor_tasks[monitor.id]
+        assert test_task.id in self.storage.pending_tasks.entries
+        assert self.storage.monitors[monitor.id].last_task_at == test_task.timestamp
+
+    def verify_tasks_locked(
+        self,
+        tasks: [Task],
+        test_worker: str,
+        task1_locked: Task,
+        task2_locked: Task,
+        task3_not_locked: Task,
+    ):
+        assert [t.id for t in tasks] == [task1_locked.id, task2_locked.id]
+        for task in (task1_locked, task2_locked):
+            stored = self.storage.tasks[task.id]
+            assert stored.status == TaskStatus.RUNNING
+            assert stored.locked_at is not None
+            assert stored.locked_by == test_worker
+            assert task.id not in self.storage.pending_tasks.entries
+        stored = self.storage.tasks[task3_not_locked.id]
+        assert stored.status == TaskStatus.PENDING
+        assert stored.locked_by is None
+        assert task3_not_locked.id in self.storage.pending_tasks.entries
+
+    def verify_task_abandoned(self, test_task: Task):
+        # finished tasks aren't kept
+        assert test_task.id not in self.storage.tasks
+        assert test_task.id not in self.storage.pending_tasks.entries
+
+    def verify_probe_recorded(
+        self, probe: Probe, test_monitor: Monitor, test_task: Task
+    ):
+        [recorded] = [
+            p for p in self.storage.probes[test_monitor.id] if p.id == probe.id
+        ]
+        assert recorded.timestamp == probe.timestamp
+        assert recorded.task_id == test_task.id
+        assert recorded.response_code == probe.response_code
+        assert self.storage.monitors[test_monitor.id].last_probe_at == probe.timestamp
+        # the task is finished
+        assert test_task.id not in self.storage.tasks
+
+    def test_probes_are_kept_in_ring_buffer(self, test_monitor, monkeypatch):
+        monkeypatch.setattr(self.storage, "PROBES_PER_MONITOR", 3)
+        self.storage.create_monitor(test_monitor)
+        probes = [
+            Probe.create(test_monitor.id, None, 0.1, 200, None, None) for _ in range(5)
+        ]
+        for i, probe in enumerate(probes):
+            probe.timestamp += i
+        self.storage.record_probes(probes)
+        assert [p.id for p in self.storage.list_probes(test_monitor.id)] == [
+            p.id for p in reversed(probes[2:])
+        ]
+
+    def test_maintain_enforces_probe_retention(self, test_monitor, monkeypatch):
+        self.storage.create_monitor(test_monitor)
+        expired = Probe.create(test_monitor.id, None, 0.1, 200, None, None)
+        expired.timestamp -= 2 * 86400
+        kept = Probe.create(test_monitor.id, None, 0.1, 200, None, None)
+        self.storage.record_probes([expired, kept])
+
+        monkeypatch.setattr(self.storage, "probe_retention", 86400)
+        assert self.storage.maintain()["probes_deleted"] == 1
+        assert [p.id for p in self.storage.list_probes(test_monitor.id)] == [kept.id]
+
+    def test_record_probes_of_missing_monitor_records_nothing(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        probes = [
+            Probe.create(test_monitor.id, None, 0.1, 200, None, None),
+            Probe.create("missing", None, 0.1, 200, None, None),
+        ]
+        with pytest.raises(Exception):
+            self.storage.record_probes(probes)
+        assert self.storage.list_probes(test_monitor.id) == []
+
+    def test_delete_monitor_deletes_tasks(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        self.storage.create_task(test_monitor.create_task())
+        self.storage.delete_monitor(test_monitor.id)
+        assert self.storage.tasks == {}
+        assert self.storage.lock_tasks("test_worker", 10) == []
+
+    def test_waiting_worker_wakes_up_on_created_task(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+
+        async def wait_for_task_from_thread():
+            waiting = asyncio.ensure_future(self.storage.wait_for_tasks(10))
+            await asyncio.sleep(0)
+            thread = threading.Thread(
+                target=self.storage.create_task, args=(test_monitor.create_task(),)
+            )
+            started_at = time.monotonic()
+            thread.start()
+            await waiting
+            thread.join()
+            return time.monotonic() - started_at
+
+        assert asyncio.run(wait_for_task_from_thread()) < 1
+        assert self.storage.waiters == []
+
+
+def test_indexed_heap():
+    heap = IndexedHeap()
+    for key, priority in [("a", 3), ("b", 1), ("c", 2), ("d", 5)]:
+        heap.push(key, priority)
+    # changed priority and removed keys
+    heap.push("a", 0)
+    heap.remove("c")
+    assert len(heap) == 3
+    assert heap.pop(2) == [("a", 0), ("b", 1)]
+    assert heap.pop(10, max_priority=4) == []
+    assert heap.pop(10) == [("d", 5)]
+    assert len(heap) == 0
+
+
+def test_indexed_heap_drops_replaced_entries():
+    heap = IndexedHeap()
+    for priority in range(1000):
+        heap.push("a", priority)
+        heap.push("b", priority)
+    assert len(heap.heap) <= 4
+    for key in ["a", "b"]:
+        heap.remove(key)
+    assert heap.heap == []
+
+
+def test_issued_tasks_dont_grow_due_monitors(test_monitor):
+    # due monitors are only popped with stateless scheduling
+    storage = InMemoryStorage()
+    storage.create_monitor(test_monitor)
+    for _ in range(1000):
+        task = storage.create_task(test_monitor.create_task())
+        task.status = TaskStatus.COMPLETED
+        storage.update_task(task)
+    assert len(storage.due_monitors.heap) <= 2
@@ -0,0 +1,41 @@
+import pytest
+from monico.core.storage import StorageSetupException
+from monico.storage.migrations import (
+    Migration,
+    REQUIRED_VERSION,
+    check_schema_version,
+    pending_migrations,
+)
+
+
+def noop(cur):
+    pass
+
+
+def test_pending_migrations():
+    migrations = [
+        Migration(1, "baseline", noop),
+        Migration(2, "second", noop),
+        Migration(3, "third", noop),
+    ]
+    assert pending_migrations(migrations, 0) == migrations
+    assert pending_migrations(migrations, 1) == migrations[1:]
+    assert pending_migrations(migrations, 3) == []
+
+
+def test_pending_migrations_requires_consecutive_versions():
+    migrations = [Migration(1, "baseline", noop), Migration(3, "third", noop)]
+    with pytest.raises(StorageSetupException):
+        pending_migrations(migrations, 1)
+
+
+def test_pending_migrations_rejects_newer_schema():
+    migrations = [Migration(1, "baseline", noop)]
+    with pytest.raises(StorageSetupException, match="upgrade monico"):
+        pending_migrations(migrations, 2)
+
+
+def test_check_schema_version():
+    check_schema_version(REQUIRED_VERSION)
+    with pytest.raises(StorageSetupException, match="Run `monico migrate`"):
+        check_schema_version(REQUIRED_VERSION - 1)
@@ -1,9 +1,14 @@
 import pytest
 import os
-from monico.storage.pg import PgStorage
+import time
+import asyncio
+import threading
+import psycopg2
+from monico.storage.pg import PgStorage, ProbePartitioning
 from monico.core.monitor import Monitor
 from monico.core.task import TaskStatus, Task
 from monico.core.probe import Probe
+from monico.storage.common import TASK_STATUS_CODES
 from .storage_backend_test_suite import StorageBackendTestSuite
 from .fixtures import test_monitor
 
@@ -17,8 +22,137 @@ class TestPgStorage(StorageBackendTestSuite):
 
         return PgStorage(test_postgres_uri, prefix="monico_test")
 
+    @classmethod
+    def setup_class(cls):
+        super().setup_class()
+        # separate connection for verifying what the storage has committed
+        cls.conn = psycopg2.connect(cls.storage.service_uri)
+        cls.conn.autocommit = True
+
+    @classmethod
+    def teardown_class(cls):
+        cls.conn.close()
+        super().teardown_class()
+
+    def execute_sql(self, sql: str):
+        self.conn.cursor().execute(sql)
+
+    def build_worker_storage(self) -> PgStorage:
+        storage = PgStorage(self.storage.service_uri, prefix="monico_test")
+        storage.connect()
+        return storage
+
+    def test_lock_tasks_skips_locked_rows(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        tasks = []
+        for i in range(4):
+            task = test_monitor.create_task()
+            task.timestamp += i
+            tasks.append(self.storage.create_task(task))
+
+        # another transaction holds a row lock on the two oldest tasks
+        blocker = self.build_worker_storage()
+        other = self.build_worker_storage()
+        try:
+            with blocker.connection() as blocker_conn:
+                cur = blocker_conn.cursor()
+                cur.execute(
+                    "SELECT id FROM monico_test_tasks WHERE id = ANY(%s) FOR UPDATE",
+                    ([tasks[0].id, tasks[1].id],),
+                )
+                # the claim doesn't wait for the blocker, it takes the next tasks
+                with other.connection() as other_conn:
+                    other_conn.cursor().execute("SET lock_timeout = '1s'")
+                    other_conn.commit()
+                    locked = other.lock_tasks("test_worker", 2)
+                assert {t.id for t in locked} == {tasks[2].id, tasks[3].id}
+                blocker_conn.rollback()
+        finally:
+            blocker.disconnect()
+            other.disconnect()
+
+    def test_concurrent_workers_claim_disjoint_batches(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        created = {
+            self.storage.create_task(test_monitor.create_task()).id for _ in range(100)
+        }
+        claimed = {}
+
+        def work(worker_id):
+            storage = self.build_worker_storage()
+            claimed[worker_id] = []
+            try:
+                while batch := storage.lock_tasks(worker_id, 5):
+                    claimed[worker_id] += [task.id for task in batch]
+            finally:
+                storage.disconnect()
+
+        threads = [
+            threading.Thread(target=work, args=(f"worker-{i}",)) for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        all_claimed = [tid for tids in claimed.values() for tid in tids]
+        assert len(all_claimed) == len(set(all_claimed))
+        assert set(all_claimed) == created
+
+    @pytest.mark.asyncio
+    async def test_wait_for_tasks_wakes_up_on_created_task(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        other = self.build_worker_storage()
+        try:
+            # start listening, nothing is pending yet
+            await self.storage.wait_for_tasks(0.01)
+
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.05, other.create_task, test_monitor.create_task())
+            started_at = loop.time()
+            await self.storage.wait_for_tasks(5)
+            assert loop.time() - started_at < 1
+        finally:
+            other.disconnect()
+            self.storage._unlisten()
+
+    @pytest.mark.asyncio
+    async def test_tasks_issued_before_waiting_wake_up_worker(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        other = self.build_worker_storage()
+        try:
+            # the worker finds no tasks, and a task is issued before it waits
+            assert self.storage.lock_tasks("test_worker", 10) == []
+            other.create_task(test_monitor.create_task())
+
+            loop = asyncio.get_running_loop()
+            started_at = loop.time()
+            await self.storage.wait_for_tasks(5)
+            assert loop.time() - started_at < 1
+        finally:
+            other.disconnect()
+            self.storage._unlisten()
+
+    def test_compact_indexes_are_built_concurrently(self):
+        # migration 5 rewrites the tables, their indexes are built by migration 7
+        [migration] = [m for m in self.storage.migrations() if m.version == 7]
+        assert not migration.transactional
+        cur = self.conn.cursor()
+        for index in [
+            "monico_test_tasks_fk_monitor_idx",
+            "monico_test_tasks_pending_timestamp_idx",
+            "monico_test_probes_fk_monitor_timestamp_idx",
+            "monico_test_probes_fk_task_idx",
+        ]:
+            cur.execute(
+                "SELECT indisvalid FROM pg_index i "
+                "JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+                (index,),
+            )
+            assert cur.fetchone() == (True,)
+
     def verify_monitor_created(self, created_monitor):
-        cur = self.storage.conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(
             "SELECT * FROM monico_test_monitors WHERE id = %s", (created_monitor.id,)
         )
@@ -32,17 +166,19 @@ class TestPgStorage(StorageBackendTestSuite):
         assert row[6] == created_monitor.last_probe_at
 
     def verify_task_created(self, monitor: Monitor, test_task: Task):
-        cur = self.storage.conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(
-            "SELECT id, timestamp, fk_monitor, status, locked_at, locked_by, completed_at "
-            f"FROM {self.storage.tables.tasks} WHERE id = %s",
+            "SELECT t.id, t.timestamp, m.id, t.status, t.locked_at, t.locked_by, t.completed_at "
+            f"FROM {self.storage.tables.tasks} t "
+            f"JOIN {self.storage.tables.monitors} m ON m.seq = t.fk_monitor "
+            "WHERE t.id = %s",
             (test_task.id,),
         )
         row = cur.fetchone()
         assert row[0] == test_task.id
         assert row[1] == test_task.timestamp
         assert row[2] == monitor.id
-        assert row[3] == test_task.status.value
+        assert row[3] == TASK_STATUS_CODES[test_task.status]
         assert row[4] == test_task.locked_at
         assert row[5] == test_task.locked_by
         assert row[6] == test_task.completed_at
@@ -61,13 +197,13 @@ class TestPgStorage(StorageBackendTestSuite):
         task2_locked: Task,
         task3_not_locked: Task,
     ):
-        cur = self.storage.conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(
             "SELECT status, locked_at, locked_by FROM monico_test_tasks WHERE id = %s",
             (task1_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.RUNNING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.RUNNING]
         assert row[1] is not None
         assert row[2] == test_worker
 
@@ -76,7 +212,7 @@ class TestPgStorage(StorageBackendTestSuite):
             (task2_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.RUNNING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.RUNNING]
         assert row[1] is not None
         assert row[2] == test_worker
 
@@ -86,26 +222,29 @@ class TestPgStorage(StorageBackendTestSuite):
             (task3_not_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.PENDING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.PENDING]
         assert row[1] is None
         assert row[2] is None
 
     def verify_task_abandoned(self, test_task: Task):
-        cur = self.storage.conn.cursor()
+        cur = self.conn.cursor()
 
         cur.execute(
             "SELECT status FROM monico_test_tasks WHERE id = %s", (test_task.id,)
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.ABANDONED.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.ABANDONED]
 
     def verify_probe_recorded(
         self, probe: Probe, test_monitor: Monitor, test_task: Task
     ):
-        cur = self.storage.conn.cursor()
+        cur = self.conn.cursor()
         cur.execute(
-            "SELECT id, timestamp, fk_monitor, fk_task, response_time, response_code, response_error, content_match "
-            f"FROM {self.storage.tables.probes} WHERE id = %s",
+            "SELECT p.id, p.timestamp, m.id, t.id, p.response_time, p.response_code, p.response_error, p.content_match "
+            f"FROM {self.storage.tables.probes} p "
+            f"JOIN {self.storage.tables.monitors} m ON m.seq = p.fk_monitor "
+            f"LEFT JOIN {self.storage.tables.tasks} t ON t.seq = p.fk_task "
+            "WHERE p.id = %s",
             (probe.id,),
         )
         row = cur.fetchone()
@@ -126,8 +265,180 @@ class TestPgStorage(StorageBackendTestSuite):
         assert row[0] == probe.timestamp
 
         cur.execute(
-            f"SELECT status FROM {self.storage.tables.tasks} WHERE id = %s",
+            f"SELECT status, completed_at FROM {self.storage.tables.tasks} "
+            "WHERE id = %s",
             (test_task.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.COMPLETED.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.COMPLETED]
+        assert row[1] >= test_task.timestamp
+
+
+class TestPartitionedPgStorage(TestPgStorage):
+    @classmethod
+    def build_storage(cls):
+        storage = super().build_storage()
+        storage.probe_partitioning = ProbePartitioning.DAY
+        return storage
+
+    def test_probes_task_index_covers_partitions(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = 'monico_test_probes_fk_task_idx'"
+        )
+        assert cur.fetchone()[0]
+
+    def probe_partitions(self) -> [(str, int, int)]:
+        with self.storage.connection() as conn:
+            cur = conn.cursor()
+            partitions = self.storage._probe_partitions(cur)
+            cur.close()
+            conn.rollback()
+        return partitions
+
+    def create_partition(self, name: str, start: int, end: int):
+        self.execute_sql(
+            f"CREATE TABLE {name} PARTITION OF {self.storage.tables.probes} "
+            f"FOR VALUES FROM ({start}) TO ({end})"
+        )
+
+    def record_probe_at(self, monitor: Monitor, timestamp: int) -> Probe:
+        task = self.storage.create_task(monitor.create_task())
+        probe = Probe.create(monitor.id, task.id, 0.1, 200, None, None)
+        probe.timestamp = timestamp
+        self.storage.record_probe(probe)
+        return probe
+
+    def test_list_probes(self, test_monitor):
+        # probes of the shared test are recorded in November 2023
+        self.create_partition("monico_test_probes_p20231114", 1699920000, 1700006400)
+        super().test_list_probes(test_monitor)
+
+    def test_maintain_enforces_retention(self, test_monitor, monkeypatch):
+        expired_at = ProbePartitioning.DAY.period_start(int(time.time()) - 40 * 86400)
+        self.create_partition(
+            "monico_test_probes_expired", expired_at, expired_at + 86400
+        )
+        super().test_maintain_enforces_retention(test_monitor, monkeypatch)
+
+    def test_setup_creates_probe_partitions(self):
+        now = int(time.time())
+        partitions = self.probe_partitions()
+        assert len(partitions) == PgStorage.PROBE_PARTITIONS_AHEAD + 1
+        assert partitions[0][1] <= now < partitions[0][2]
+        assert all(upper - lower == 86400 for (_, lower, upper) in partitions)
+
+    def test_maintain_creates_upcoming_partitions(self):
+        newest = self.probe_partitions()[-1]
+        self.execute_sql(f"DROP TABLE {newest[0]}")
+        assert self.storage.maintain() == {
+            "probe_partitions_created": 1,
+            "probe_partitions_dropped": 0,
+        }
+        assert self.probe_partitions()[-1] == newest
+
+    def test_maintain_drops_expired_partitions(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        now = int(time.time())
+        expired_at = ProbePartitioning.DAY.period_start(now) - 40 * 86400
+        self.create_partition(
+            "monico_test_probes_expired", expired_at, expired_at + 86400
+        )
+        expired = self.record_probe_at(test_monitor, expired_at)
+        kept = self.record_probe_at(test_monitor, now)
+
+        self.storage.probe_retention = 30 * 86400
+        try:
+            stats = self.storage.maintain()
+        finally:
+            self.storage.probe_retention = None
+        assert stats["probe_partitions_dropped"] == 1
+        assert "monico_test_probes_expired" not in [
+            p[0] for p in self.probe_partitions()
+        ]
+        probes = self.storage.list_probes(test_monitor.id)
+        assert [p.id for p in probes] == [kept.id]
+        assert expired.id not in [p.id for p in probes]
+
+    def test_probes_past_the_newest_partition_are_kept(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        _, _, upper = self.probe_partitions()[-1]
+        single = self.record_probe_at(test_monitor, upper)
+        task = self.storage.create_task(test_monitor.create_task())
+        batch = [
+            Probe.create(test_monitor.id, task.id, 0.1, 200, None, None)
+            for _ in range(2)
+        ]
+        for probe in batch:
+            probe.timestamp = upper + 1
+        self.storage.record_probes(batch)
+
+        probes = self.storage.list_probes(test_monitor.id)
+        assert {p.id for p in probes} == {single.id, batch[0].id, batch[1].id}
+        cur = self.conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM monico_test_probes_default")
+        assert cur.fetchone()[0] == 3
+
+        # the partition created later takes over the probes
+        self.storage.PROBE_PARTITIONS_AHEAD += 1
+        try:
+            stats = self.storage.maintain()
+        finally:
+            del self.storage.PROBE_PARTITIONS_AHEAD
+        assert stats["probe_partitions_created"] == 1
+        assert self.probe_partitions()[-1][1] == upper
+        cur.execute("SELECT COUNT(*) FROM monico_test_probes_default")
+        assert cur.fetchone()[0] == 0
+        probes = self.storage.list_probes(test_monitor.id)
+        assert {p.id for p in probes} == {single.id, batch[0].id, batch[1].id}
+
+    def test_list_probes_searches_older_partitions(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        now = int(time.time())
+        old_at = ProbePartitioning.DAY.period_start(now) - 60 * 86400
+        self.create_partition("monico_test_probes_old", old_at, old_at + 86400)
+        old = self.record_probe_at(test_monitor, old_at)
+        recent = self.record_probe_at(test_monitor, now)
+
+        probes = self.storage.list_probes(test_monitor.id, limit=1)
+        assert [p.id for p in probes] == [recent.id]
+        probes = self.storage.list_probes(test_monitor.id, limit=2)
+        assert [p.id for p in probes] == [recent.id, old.id]
+
+
+class TestTransientTasksPgStorage(TestPgStorage):
+    @classmethod
+    def build_storage(cls):
+        storage = super().build_storage()
+        storage.transient_tasks = True
+        return storage
+
+    def test_tasks_table_is_unlogged(self):
+        cur = self.conn.cursor()
+        cur.execute(
+            "SELECT relname, relpersistence FROM pg_class WHERE relname IN "
+            "('monico_test_tasks', 'monico_test_tasks_seq', 'monico_test_probes')"
+        )
+        assert dict(cur.fetchall()) == {
+            "monico_test_tasks": "u",
+            "monico_test_tasks_seq": "p",
+            "monico_test_probes": "p",
+        }
+
+    def test_lost_tasks_keep_probes(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        task = self.storage.create_task(test_monitor.create_task())
+        probe = Probe.create(test_monitor.id, task.id, 0.1, 200, None, None)
+        self.storage.record_probe(probe)
+
+        # crash recovery empties unlogged tables
+        self.execute_sql(f"TRUNCATE {self.storage.tables.tasks}")
+
+        [recorded] = self.storage.list_probes(test_monitor.id)
+        assert recorded.id == probe.id
+        assert recorded.task_id is None
+        # keys of lost tasks aren't reused
+        self.storage.create_task(test_monitor.create_task())
+        [recorded] = self.storage.list_probes(test_monitor.id)
+        assert recorded.task_id is None
@@ -0,0 +1,157 @@
+import time
+import pytest
+import threading
+import psycopg2
+import psycopg2.extensions
+from monico.core.storage import StorageConnectionException
+from monico.storage.pool import ConnectionPool
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, params=None):
+        if self.conn.closed:
+            raise psycopg2.OperationalError("server closed the connection")
+        self.conn.status = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def get_transaction_status(self):
+        return self.status
+
+    def rollback(self):
+        self.status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def opened():
+    return []
+
+
+@pytest.fixture
+def pool(opened):
+    def connect():
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    pool = ConnectionPool(connect, min_size=1, max_size=2)
+    pool.CHECKOUT_TIMEOUT = 0.1
+    pool.open()
+    return pool
+
+
+def test_open_creates_min_connections(pool, opened):
+    assert len(opened) == 1
+    assert pool.metrics()["pool_idle"] == 1
+
+
+def test_invalid_size():
+    with pytest.raises(ValueError):
+        ConnectionPool(FakeConnection, min_size=2, max_size=1)
+
+
+def test_connection_is_reused(pool, opened):
+    with pool.connection() as conn:
+        first = conn
+    with pool.connection() as conn:
+        assert conn is first
+    assert len(opened) == 1
+
+
+def test_nested_checkout_shares_connection(pool, opened):
+    with pool.connection() as outer:
+        with pool.connection() as inner:
+            assert inner is outer
+        assert pool.metrics()["pool_in_use"] == 1
+
+
+def test_open_transaction_is_rolled_back_on_release(pool):
+    with pool.connection() as conn:
+        conn.cursor().execute("SELECT 1")
+    assert conn.get_transaction_status() == (
+        psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    )
+
+
+def test_checkout_waits_for_free_connection(pool):
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.connection():
+            checked_out.set()
+            release.wait()
+
+    threads = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    checked_out.wait()
+    time.sleep(0.01)
+    assert pool.metrics()["pool_utilization"] == 1.0
+
+    # both connections are taken, so the checkout times out
+    with pytest.raises(StorageConnectionException):
+        with pool.connection():
+            pass
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    with pool.connection():
+        pass
+    assert pool.metrics()["pool_wait_time_max"] >= 0.1
+
+
+def test_lost_connection_is_replaced(pool, opened):
+    with pool.connection() as conn:
+        # connection dropped by the server while in use
+        conn.close()
+    assert pool.metrics()["pool_size"] == 0
+
+    with pool.connection() as conn:
+        assert not conn.closed
+    assert len(opened) == 2
+
+
+def test_idle_connection_is_health_checked(pool, opened):
+    pool.HEALTH_CHECK_INTERVAL = 0
+    opened[0].closed = 2
+    with pool.connection() as conn:
+        assert conn is opened[1]
+
+    opened[1].cursor = lambda: (_ for _ in ()).throw(psycopg2.InterfaceError())
+    with pool.connection() as conn:
+        assert conn is opened[2]
+    assert pool.metrics()["pool_reconnects"] == 2
+
+
+def test_connect_error(opened):
+    def connect():
+        raise psycopg2.OperationalError("could not connect")
+
+    pool = ConnectionPool(connect)
+    with pytest.raises(StorageConnectionException):
+        with pool.connection():
+            pass
+    assert pool.metrics()["pool_size"] == 0
+
+
+def test_close(pool, opened):
+    pool.close()
+    assert opened[0].closed
+    assert pool.metrics()["pool_size"] == 0
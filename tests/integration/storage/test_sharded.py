@@ -0,0 +1,238 @@
+import uuid
+import pytest
+import shutil
+import tempfile
+from types import SimpleNamespace
+from dataclasses import replace
+from monico.core.affinity import HostAffinity
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.sharded import ShardedSqliteStorage
+from monico.core.storage import StorageSetupException
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from .storage_backend_test_suite import StorageBackendTestSuite
+from . import test_sqlite
+from .fixtures import test_monitor
+
+
+def create_monitors(storage, count: int) -> [Monitor]:
+    return [
+        storage.create_monitor(
+            Monitor(None, f"monitor-{i}", f"https://example-{i}.com", 60)
+        )
+        for i in range(count)
+    ]
+
+
+class TestShardedSqliteStorage(StorageBackendTestSuite):
+    @classmethod
+    def build_storage(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        return ShardedSqliteStorage(
+            f"{cls.tmpdir}/monico_test.db",
+            shards=3,
+            prefix="monico_test",
+            profile=SqliteProfile.TUNED,
+        )
+
+    @classmethod
+    def teardown_class(cls):
+        super().teardown_class()
+        shutil.rmtree(cls.tmpdir)
+
+    def execute_sql(self, sql: str):
+        for shard in self.storage.shards:
+            shard.conn.execute(sql)
+            shard.conn.commit()
+
+    def on_shard(self, monitor_id: str):
+        """Test case to run SqliteStorage checks on the shard of the monitor"""
+        return SimpleNamespace(storage=self.storage.shard(monitor_id))
+
+    def verify_monitor_created(self, created_monitor):
+        test_sqlite.TestSqliteStorage.verify_monitor_created(
+            self.on_shard(created_monitor.id), created_monitor
+        )
+
+    def verify_task_created(self, monitor, test_task):
+        test_sqlite.TestSqliteStorage.verify_task_created(
+            self.on_shard(monitor.id), monitor, test_task
+        )
+
+    def verify_tasks_locked(self, tasks, test_worker, *expected):
+        test_sqlite.TestSqliteStorage.verify_tasks_locked(
+            self.on_shard(expected[0].monitor_id), tasks, test_worker, *expected
+        )
+
+    def verify_task_abandoned(self, test_task):
+        test_sqlite.TestSqliteStorage.verify_task_abandoned(
+            self.on_shard(test_task.monitor_id), test_task
+        )
+
+    def verify_probe_recorded(self, probe, test_monitor, test_task):
+        test_sqlite.TestSqliteStorage.verify_probe_recorded(
+            self.on_shard(test_monitor.id), probe, test_monitor, test_task
+        )
+
+    def test_migrate_applies_pending_migrations(self):
+        pytest.skip("migrations of a shard are covered by TestSqliteStorage")
+
+    def test_compact_migration_keeps_data(self):
+        pytest.skip("migrations of a shard are covered by TestSqliteStorage")
+
+    def test_maintain_enforces_retention(self, test_monitor, monkeypatch):
+        # maintenance settings are attributes of every shard
+        shards = SimpleNamespace(
+            setattr=lambda target, name, value: [
+                monkeypatch.setattr(shard, name, value) for shard in target.shards
+            ]
+        )
+        super().test_maintain_enforces_retention(test_monitor, shards)
+
+    def test_maintain_deletes_expired_rollups_in_batches(
+        self, test_monitor, monkeypatch
+    ):
+        shards = SimpleNamespace(
+            setattr=lambda target, name, value: [
+                monkeypatch.setattr(shard, name, value) for shard in target.shards
+            ]
+        )
+        super().test_maintain_deletes_expired_rollups_in_batches(test_monitor, shards)
+
+    def test_shard_files(self):
+        assert [shard.path for shard in self.storage.shards] == [
+            f"{self.tmpdir}/monico_test.{i}.db" for i in range(3)
+        ]
+
+    def test_monitors_are_spread_across_shards(self):
+        monitors = create_monitors(self.storage, 30)
+        for shard in self.storage.shards:
+            ids = {m.id for m in shard.list_monitors()}
+            assert ids
+            assert all(self.storage.shard(mid) is shard for mid in ids)
+        assert [m.id for m in self.storage.list_monitors()] == [m.id for m in monitors]
+
+    def test_monitors_with_random_ids_are_listed_by_shard(self):
+        # created by older versions within the same second
+        monitors = [
+            self.storage.create_monitor(
+                Monitor(str(uuid.uuid4()), f"monitor-{i}", f"https://e{i}.com", 60)
+            )
+            for i in range(20)
+        ]
+        self.execute_sql(
+            f"UPDATE {self.storage.tables.monitors} "
+            "SET created_at = '2024-01-01 00:00:00'"
+        )
+        expected = sorted(monitors, key=lambda m: self.storage.shard_index(m.id))
+        assert [m.id for m in self.storage.list_monitors()] == [m.id for m in expected]
+
+    def test_lock_tasks_fans_out_across_shards(self):
+        tasks = [
+            self.storage.create_task(m.create_task())
+            for m in create_monitors(self.storage, 30)
+        ]
+        locked = self.storage.lock_tasks("test_worker", 20)
+        assert len(locked) == 20
+        assert len({self.storage.shard_index(t.monitor_id) for t in locked}) > 1
+        locked += self.storage.lock_tasks("test_worker", 20)
+        assert sorted(t.id for t in locked) == sorted(t.id for t in tasks)
+
+    def test_lock_tasks_without_fallback_stays_in_slot(self):
+        slot = HostAffinity(0, 2)
+        for m in create_monitors(self.storage, 30):
+            if slot.matches(m.endpoint):
+                self.storage.create_task(m.create_task())
+        other = HostAffinity(1, 2, fallback=False)
+        assert self.storage.lock_tasks("test_worker", 10, other) == []
+        assert self.storage.lock_tasks("test_worker", 10, replace(other, fallback=True))
+
+    def test_lock_tasks_starts_at_next_shard(self):
+        for m in create_monitors(self.storage, 30):
+            self.storage.create_task(m.create_task())
+        shards = [
+            self.storage.shard_index(task.monitor_id)
+            for _ in range(3)
+            for task in self.storage.lock_tasks("test_worker", 1)
+        ]
+        assert sorted(shards) == [0, 1, 2]
+
+    def test_record_probes_of_monitors_in_different_shards(self):
+        monitors = create_monitors(self.storage, 10)
+        probes = [Probe.create(m.id, None, 0.1, 200, None, None) for m in monitors]
+        self.storage.record_probes(probes)
+        for monitor, probe in zip(monitors, probes):
+            [recorded] = self.storage.list_probes(monitor.id)
+            assert recorded.id == probe.id
+            assert self.storage.read_monitor(monitor.id).last_probe_at is not None
+
+
+def build_sharded(tmp_path, shards: int) -> ShardedSqliteStorage:
+    return ShardedSqliteStorage(f"{tmp_path}/monico_test.db", shards=shards)
+
+
+def test_connect_refuses_different_number_of_shards(tmp_path):
+    storage = build_sharded(tmp_path, 2)
+    storage.connect()
+    storage.setup()
+    storage.disconnect()
+
+    for shards in (1, 3):
+        storage = build_sharded(tmp_path, shards)
+        with pytest.raises(StorageSetupException, match="set up with 2 SQLite shards"):
+            storage.connect()
+        storage.disconnect()
+
+    storage = build_sharded(tmp_path, 2)
+    storage.connect()
+    storage.disconnect()
+
+
+def test_connect_refuses_unsharded_storage(tmp_path):
+    unsharded = SqliteStorage(f"{tmp_path}/monico_test.db", prefix="monico")
+    unsharded.connect()
+    unsharded.setup()
+    unsharded.disconnect()
+
+    storage = build_sharded(tmp_path, 2)
+    with pytest.raises(StorageSetupException, match="unsharded storage"):
+        storage.connect()
+    storage.disconnect()
+
+
+def test_migrate_records_layout_of_shards_set_up_without_it(tmp_path):
+    storage = build_sharded(tmp_path, 2)
+    storage.connect()
+    storage.setup()
+    for shard in storage.shards:
+        shard.conn.execute(f"DROP TABLE {storage.layout_table}")
+    assert storage.migrate() == []
+    assert [storage._read_layout(shard) for shard in storage.shards] == [
+        (0, 2),
+        (1, 2),
+    ]
+    storage.disconnect()
+
+    storage = build_sharded(tmp_path, 3)
+    with pytest.raises(StorageSetupException, match="set up with 2 SQLite shards"):
+        storage.connect()
+    storage.disconnect()
+
+
+def test_shards_set_up_before_a_failure_record_layout(tmp_path, monkeypatch):
+    storage = build_sharded(tmp_path, 2)
+    storage.connect()
+
+    def fail(force=False):
+        raise Exception("disk is full")
+
+    monkeypatch.setattr(storage.shards[1], "setup", fail)
+    with pytest.raises(Exception, match="disk is full"):
+        storage.setup()
+    assert storage._read_layout(storage.shards[0]) == (0, 2)
+    storage.disconnect()
+
+    storage = build_sharded(tmp_path, 3)
+    with pytest.raises(StorageSetupException, match="set up with 2 SQLite shards"):
+        storage.connect()
+    storage.disconnect()
@@ -1,10 +1,16 @@
+import uuid
 import pytest
+import sqlite3
 import shutil
 import tempfile
-from monico.storage.sqlite import SqliteStorage
+import threading
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from monico.storage.writer import SqliteWriter, WriteFuture
 from monico.core.monitor import Monitor
 from monico.core.task import Task, TaskStatus
 from monico.core.probe import Probe
+from monico.core.storage import StorageConnectionException, wait_for_writes
+from monico.storage.common import TASK_STATUS_CODES
 from .storage_backend_test_suite import StorageBackendTestSuite
 from .fixtures import test_monitor
 
@@ -21,11 +27,58 @@ class TestSqliteStorage(StorageBackendTestSuite):
         super().teardown_class()
         shutil.rmtree(cls.tmpdir)
 
+    def execute_sql(self, sql: str):
+        self.storage.conn.execute(sql)
+        self.storage.conn.commit()
+
     def test_connect_error(self):
         storage = SqliteStorage("file:///nonexistent.db")
         with pytest.raises(Exception):
             storage.connect()
 
+    def test_hot_path_queries_use_indexes(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        statements = []
+        # writes may go through another connection
+        connections = [self.storage.conn] + self.storage.connections
+        for conn in connections:
+            conn.set_trace_callback(statements.append)
+        try:
+            self.storage.lock_tasks("test_worker", 10)
+            self.storage.list_probes(test_monitor.id)
+        finally:
+            for conn in connections:
+                conn.set_trace_callback(None)
+
+        plans = []
+        for statement in statements:
+            if statement.lstrip().startswith(("UPDATE", "SELECT")):
+                cur = self.storage.conn.execute(f"EXPLAIN QUERY PLAN {statement}")
+                plans.append(" ".join(row[3] for row in cur.fetchall()))
+        [lock_tasks_plan, list_probes_plan] = plans
+        assert "monico_test_tasks_pending_timestamp_idx" in lock_tasks_plan
+        assert "TEMP B-TREE" not in lock_tasks_plan
+        assert "monico_test_probes_fk_monitor_timestamp_idx" in list_probes_plan
+        assert "TEMP B-TREE" not in list_probes_plan
+
+    def test_maintain_returns_freed_pages(self, test_monitor):
+        assert self.storage.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        self.storage.create_monitor(test_monitor)
+        task = self.storage.create_task(test_monitor.create_task())
+        for _ in range(500):
+            probe = Probe.create(test_monitor.id, task.id, 0.1, 200, None, "x" * 1000)
+            probe.timestamp -= 86400
+            self.storage.record_probe(probe)
+
+        self.storage.probe_retention = 3600
+        try:
+            stats = self.storage.maintain()
+        finally:
+            self.storage.probe_retention = None
+        assert stats["probes_deleted"] == 500
+        assert stats["pages_freed"] > 0
+        assert self.storage.conn.execute("PRAGMA freelist_count").fetchone()[0] == 0
+
     def verify_monitor_created(self, created_monitor):
         cur = self.storage.conn.cursor()
         cur.execute(
@@ -45,16 +98,18 @@ class TestSqliteStorage(StorageBackendTestSuite):
         cur = self.storage.conn.cursor()
         cur.execute(
             "SELECT "
-            "id, timestamp, fk_monitor, status, "
-            "locked_at, locked_by, completed_at "
-            f"FROM {self.storage.tables.tasks} WHERE id = :id",
+            "t.id, t.timestamp, m.id, t.status, "
+            "t.locked_at, t.locked_by, t.completed_at "
+            f"FROM {self.storage.tables.tasks} t "
+            f"JOIN {self.storage.tables.monitors} m ON m.seq = t.fk_monitor "
+            "WHERE t.id = :id",
             {"id": test_task.id},
         )
         row = cur.fetchone()
         assert row[0] == test_task.id
         assert row[1] == test_task.timestamp
         assert row[2] == monitor.id
-        assert row[3] == test_task.status.value
+        assert row[3] == TASK_STATUS_CODES[test_task.status]
         assert row[4] == test_task.locked_at
         assert row[5] == test_task.locked_by
         assert row[6] == test_task.completed_at
@@ -84,7 +139,7 @@ class TestSqliteStorage(StorageBackendTestSuite):
             (task1_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.RUNNING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.RUNNING]
         assert row[1] is not None
         assert row[2] == test_worker
 
@@ -93,7 +148,7 @@ class TestSqliteStorage(StorageBackendTestSuite):
             (task2_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.RUNNING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.RUNNING]
         assert row[1] is not None
         assert row[2] == test_worker
 
@@ -103,7 +158,7 @@ class TestSqliteStorage(StorageBackendTestSuite):
             (task3_not_locked.id,),
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.PENDING.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.PENDING]
         assert row[1] is None
         assert row[2] is None
 
@@ -113,20 +168,23 @@ class TestSqliteStorage(StorageBackendTestSuite):
             "SELECT status FROM monico_test_tasks WHERE id = :id", {"id": test_task.id}
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.ABANDONED.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.ABANDONED]
 
     def verify_probe_recorded(
         self, probe: Probe, test_monitor: Monitor, test_task: Task
     ):
         cur = self.storage.conn.cursor()
         cur.execute(
-            "SELECT id, timestamp, fk_monitor, fk_task, "
-            "response_time, response_code, response_error, content_match "
-            f"FROM {self.storage.tables.probes} WHERE id = :id",
-            {"id": probe.id},
+            "SELECT p.id, p.timestamp, m.id, t.id, "
+            "p.response_time, p.response_code, p.response_error, p.content_match "
+            f"FROM {self.storage.tables.probes} p "
+            f"JOIN {self.storage.tables.monitors} m ON m.seq = p.fk_monitor "
+            f"LEFT JOIN {self.storage.tables.tasks} t ON t.seq = p.fk_task "
+            "WHERE p.id = :id",
+            {"id": uuid.UUID(probe.id).bytes},
         )
         row = cur.fetchone()
-        assert row[0] == probe.id
+        assert row[0] == uuid.UUID(probe.id).bytes
         assert row[1] == probe.timestamp
         assert row[2] == test_monitor.id
         assert row[3] == test_task.id
@@ -143,8 +201,226 @@ class TestSqliteStorage(StorageBackendTestSuite):
         assert row[0] == probe.timestamp
 
         cur.execute(
-            f"SELECT status FROM {self.storage.tables.tasks} WHERE id = :id",
+            f"SELECT status, completed_at FROM {self.storage.tables.tasks} "
+            "WHERE id = :id",
             {"id": test_task.id},
         )
         row = cur.fetchone()
-        assert row[0] == TaskStatus.COMPLETED.value
+        assert row[0] == TASK_STATUS_CODES[TaskStatus.COMPLETED]
+        assert row[1] >= test_task.timestamp
+
+
+class TestTunedSqliteStorage(TestSqliteStorage):
+    @classmethod
+    def build_storage(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        test_sqlite_uri = f"{cls.tmpdir}/monico_test.db"
+        return SqliteStorage(
+            test_sqlite_uri, prefix="monico_test", profile=SqliteProfile.TUNED
+        )
+
+    def test_pragmas(self):
+        conn = self.storage.conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # 1 is NORMAL
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        assert conn.execute("PRAGMA foreign_keys").fetchone()[0] == 1
+
+    def test_connection_per_thread(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        connections = []
+
+        def read_monitor():
+            connections.append(self.storage.conn)
+            assert self.storage.read_monitor(test_monitor.id).id == test_monitor.id
+
+        thread = threading.Thread(target=read_monitor)
+        thread.start()
+        thread.join()
+
+        assert len(connections) == 1
+        assert connections[0] is not self.storage.conn
+        assert connections[0] in self.storage.connections
+
+
+class TestTransientTasksSqliteStorage(TestTunedSqliteStorage):
+    @classmethod
+    def build_storage(cls):
+        storage = super().build_storage()
+        storage.transient_tasks = True
+        return storage
+
+    def test_tasks_are_kept_in_queue_database(self, test_monitor):
+        cur = self.storage.conn.cursor()
+        assert self.storage._table_exists(
+            cur, self.storage.tables.tasks, SqliteStorage.QUEUE_SCHEMA
+        )
+        assert not self.storage._table_exists(cur, self.storage.tables.tasks)
+
+        # shared by connections of other threads
+        self.storage.create_monitor(test_monitor)
+        task = self.storage.create_task(test_monitor.create_task())
+        locked = []
+        thread = threading.Thread(
+            target=lambda: locked.extend(self.storage.lock_tasks("test_worker", 10))
+        )
+        thread.start()
+        thread.join()
+        assert [t.id for t in locked] == [task.id]
+
+    def test_delete_monitor_deletes_tasks(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        self.storage.create_task(test_monitor.create_task())
+        self.storage.delete_monitor(test_monitor.id)
+        assert self.storage.lock_tasks("test_worker", 10) == []
+
+    def test_tasks_are_lost_on_disconnect(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        task = self.storage.create_task(test_monitor.create_task())
+        probe = Probe.create(test_monitor.id, task.id, 0.1, 200, None, None)
+        self.storage.record_probe(probe)
+        self.storage.create_task(test_monitor.create_task())
+
+        self.storage.disconnect()
+        self.storage.connect()
+
+        assert self.storage.lock_tasks("test_worker", 10) == []
+        [recorded] = self.storage.list_probes(test_monitor.id)
+        assert recorded.id == probe.id
+        assert recorded.task_id is None
+        # keys of lost tasks aren't reused
+        self.storage.create_task(test_monitor.create_task())
+        [recorded] = self.storage.list_probes(test_monitor.id)
+        assert recorded.task_id is None
+
+
+class TestGroupCommitSqliteStorage(TestTunedSqliteStorage):
+    @classmethod
+    def build_storage(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        test_sqlite_uri = f"{cls.tmpdir}/monico_test.db"
+        return SqliteStorage(
+            test_sqlite_uri,
+            prefix="monico_test",
+            profile=SqliteProfile.TUNED,
+            group_commit=True,
+        )
+
+    def test_concurrent_writes_are_committed_in_groups(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        before = self.storage.metrics()
+        threads, probes = 8, 50
+
+        def record():
+            futures = [
+                self.storage.record_probe(
+                    Probe.create(
+                        test_monitor.id, str(uuid.uuid4()), 0.1, 200, None, None
+                    )
+                )
+                for _ in range(probes)
+            ]
+            for future in futures:
+                future.result()
+
+        workers = [threading.Thread(target=record) for _ in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.storage.flush()
+
+        recorded = self.storage.conn.execute(
+            f"SELECT COUNT(*) FROM {self.storage.tables.probes}"
+        ).fetchone()[0]
+        assert recorded == threads * probes
+        after = self.storage.metrics()
+        assert after["writer_failed"] == before["writer_failed"]
+        assert after["writer_groups"] - before["writer_groups"] < threads * probes
+
+    def test_flush_raises_errors_of_deferred_writes(self, test_monitor):
+        # the task references a monitor that doesn't exist
+        self.storage.create_task(test_monitor.create_task())
+        with pytest.raises(Exception, match="NOT NULL"):
+            self.storage.flush()
+        # errors are only raised once
+        self.storage.flush()
+
+    def test_errors_of_waited_writes_arent_raised_by_flush(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        probes = [
+            Probe.create(test_monitor.id, None, 0.1, 200, None, None),
+            Probe.create("missing", None, 0.1, 200, None, None),
+        ]
+        with pytest.raises(Exception):
+            wait_for_writes(self.storage.record_probes(probes))
+        # the caller has handled the error, e.g. by recording probes one by one
+        wait_for_writes(self.storage.record_probe(probes[0]))
+        self.storage.flush()
+        assert self.storage.failed_writes == []
+        assert [p.id for p in self.storage.list_probes(test_monitor.id)] == [
+            probes[0].id
+        ]
+
+    def test_failed_writes_kept_for_flush_are_bounded(self, monkeypatch):
+        monkeypatch.setattr(self.storage, "MAX_FAILED_WRITES", 2)
+        for _ in range(5):
+            self.storage.create_task(Task.create("missing"))
+        self.storage.writer.flush()
+        assert len(self.storage.failed_writes) == 2
+        with pytest.raises(Exception, match="NOT NULL"):
+            self.storage.flush()
+
+    def test_failed_write_doesnt_roll_back_its_group(self, test_monitor):
+        self.storage.create_monitor(test_monitor)
+        writer = self.storage.writer
+        writer.GROUP_INTERVAL = 0.1
+        try:
+            task = test_monitor.create_task()
+            failed = writer.submit(self.storage._insert_task, Task.create("missing"))
+            committed = writer.submit(self.storage._insert_task, task)
+            assert committed.result() is None
+            with pytest.raises(Exception, match="NOT NULL"):
+                failed.result()
+        finally:
+            writer.GROUP_INTERVAL = SqliteWriter.GROUP_INTERVAL
+        [locked] = self.storage.lock_tasks("test_worker", 10)
+        assert locked.id == task.id
+
+    def test_failed_group_raises_to_every_caller(self):
+        # the write lock is held by another connection for longer
+        # than the writer waits for it
+        writer = SqliteWriter(
+            lambda: sqlite3.connect(
+                self.storage.path, timeout=0.1, check_same_thread=False
+            )
+        )
+        blocker = sqlite3.connect(self.storage.path)
+        blocker.execute("BEGIN IMMEDIATE")
+        writer.start()
+        try:
+            writer.GROUP_INTERVAL = 0.1
+            futures = [writer.submit(lambda cur: None) for _ in range(3)]
+            for future in futures:
+                with pytest.raises(sqlite3.OperationalError, match="locked"):
+                    future.result(timeout=5)
+        finally:
+            blocker.rollback()
+            blocker.close()
+            writer.stop()
+        assert writer.metrics()["writer_failed"] == 3
+
+
+def test_writer_fails_operations_queued_after_stop():
+    writer = SqliteWriter(lambda: sqlite3.connect(":memory:", check_same_thread=False))
+    writer.start()
+    # an operation that got behind the stop request
+    writer.queue.put(None)
+    future = WriteFuture()
+    writer.queue.put((lambda cur: None, (), future))
+    writer.stop()
+    with pytest.raises(StorageConnectionException, match="stopped"):
+        future.result(timeout=1)
+    with pytest.raises(StorageConnectionException, match="not running"):
+        writer.submit(lambda cur: None)
@@ -0,0 +1,224 @@
+import time
+import pytest
+import shutil
+import tempfile
+from types import SimpleNamespace
+from monico.core.monitor import Monitor
+from monico.core.probe import Probe
+from monico.storage.memory import InMemoryStorage
+from monico.storage.sqlite import SqliteStorage, SqliteProfile
+from monico.storage.tiered import TieredStorage
+from .storage_backend_test_suite import StorageBackendTestSuite
+from . import test_sqlite
+from .fixtures import test_monitor
+
+
+class TestTieredStorage(StorageBackendTestSuite):
+    @classmethod
+    def build_storage(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        return TieredStorage(
+            SqliteStorage(
+                f"{cls.tmpdir}/monico_test.db",
+                prefix="monico_test",
+                profile=SqliteProfile.TUNED,
+            ),
+            probes_per_monitor=5,
+        )
+
+    @classmethod
+    def teardown_class(cls):
+        super().teardown_class()
+        shutil.rmtree(cls.tmpdir)
+
+    def on_backend(self):
+        """Test case to run SqliteStorage checks on the wrapped storage"""
+        return SimpleNamespace(storage=self.storage.backend)
+
+    def verify_monitor_created(self, created_monitor):
+        test_sqlite.TestSqliteStorage.verify_monitor_created(
+            self.on_backend(), created_monitor
+        )
+
+    def verify_task_created(self, monitor, test_task):
+        test_sqlite.TestSqliteStorage.verify_task_created(
+            self.on_backend(), monitor, test_task
+        )
+
+    def verify_tasks_locked(self, tasks, test_worker, *expected):
+        test_sqlite.TestSqliteStorage.verify_tasks_locked(
+            self.on_backend(), tasks, test_worker, *expected
+        )
+
+    def verify_task_abandoned(self, test_task):
+        test_sqlite.TestSqliteStorage.verify_task_abandoned(
+            self.on_backend(), test_task
+        )
+
+    def verify_probe_recorded(self, probe, test_monitor, test_task):
+        self.storage.flush()
+        test_sqlite.TestSqliteStorage.verify_probe_recorded(
+            self.on_backend(), probe, test_monitor, test_task
+        )
+
+    def test_setup_records_schema_version(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_migrate_applies_pending_migrations(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_migrate_records_baseline_of_unversioned_storage(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_compact_migration_keeps_data(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_backfill_rollups(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_check_schema_requires_migration(self):
+        pytest.skip("schema of the backend is covered by TestSqliteStorage")
+
+    def test_maintain_enforces_retention(self, test_monitor, monkeypatch):
+        # maintenance settings are attributes of the backend
+        backend = SimpleNamespace(
+            setattr=lambda target, name, value: monkeypatch.setattr(
+                target.backend, name, value
+            )
+        )
+        super().test_maintain_enforces_retention(test_monitor, backend)
+
+    def test_maintain_deletes_expired_rollups_in_batches(
+        self, test_monitor, monkeypatch
+    ):
+        backend = SimpleNamespace(
+            setattr=lambda target, name, value: monkeypatch.setattr(
+                target.backend, name, value
+            )
+        )
+        super().test_maintain_deletes_expired_rollups_in_batches(test_monitor, backend)
+
+
+@pytest.fixture
+def tiered(test_monitor):
+    """Storage without the flusher thread, probes are written by flush()"""
+    storage = TieredStorage(InMemoryStorage(), probes_per_monitor=3)
+    storage.create_monitor(test_monitor)
+    return storage
+
+
+def record(storage, monitor: Monitor, count: int) -> [Probe]:
+    probes = [
+        Probe.create(monitor.id, None, 0.1, 200, None, None) for _ in range(count)
+    ]
+    for i, probe in enumerate(probes):
+        probe.timestamp += i
+    storage.record_probes(probes)
+    return probes
+
+
+def test_list_probes_from_memory(tiered, test_monitor, monkeypatch):
+    probes = record(tiered, test_monitor, 5)
+    reads = []
+    list_probes = tiered.backend.list_probes
+    monkeypatch.setattr(
+        tiered.backend,
+        "list_probes",
+        lambda *args, **kwargs: reads.append(args) or list_probes(*args, **kwargs),
+    )
+
+    newest = [p.id for p in reversed(probes)]
+    # probes not written yet are listed too
+    assert [p.id for p in tiered.list_probes(test_monitor.id, 2)] == newest[:2]
+    assert [p.id for p in tiered.list_probes(test_monitor.id, 3)] == newest[:3]
+    assert len(reads) == 1
+    # more probes than are kept in memory are read from the backend
+    assert [p.id for p in tiered.list_probes(test_monitor.id, 10)] == newest
+    assert len(reads) == 2
+
+    metrics = tiered.metrics()
+    assert (metrics["cache_hits"], metrics["cache_misses"]) == (1, 2)
+    assert metrics["cache_hit_rate"] == pytest.approx(0.333)
+
+
+def test_monitor_with_few_probes_is_served_from_memory(tiered, test_monitor):
+    assert tiered.list_probes(test_monitor.id, 3) == []
+    [probe] = record(tiered, test_monitor, 1)
+    assert [p.id for p in tiered.list_probes(test_monitor.id, 3)] == [probe.id]
+    assert tiered.metrics()["cache_hits"] == 1
+
+
+def test_probes_are_refreshed_from_backend(tiered, test_monitor, monkeypatch):
+    assert tiered.list_probes(test_monitor.id, 3) == []
+    # e.g. recorded by another process
+    [probe] = record(tiered.backend, test_monitor, 1)
+    assert tiered.list_probes(test_monitor.id, 3) == []
+
+    monkeypatch.setattr(tiered, "REFRESH_INTERVAL", 0)
+    assert [p.id for p in tiered.list_probes(test_monitor.id, 3)] == [probe.id]
+
+
+def test_probes_are_written_in_batches(tiered, test_monitor, monkeypatch):
+    monkeypatch.setattr(tiered, "FLUSH_BATCH_SIZE", 2)
+    task = tiered.create_task(test_monitor.create_task())
+    record(tiered, test_monitor, 4)
+    tiered.record_probe(Probe.create(test_monitor.id, task.id, 0.1, 200, None, None))
+
+    metrics = tiered.metrics()
+    assert metrics["pending_probes"] == 5
+    assert metrics["flush_lag"] >= 0
+    assert tiered.backend.list_probes(test_monitor.id) == []
+    # reads see probes that aren't written yet
+    assert tiered.read_monitor(test_monitor.id).last_probe_at is not None
+    assert tiered.lock_tasks("test_worker", 10) == []
+
+    tiered.flush()
+    metrics = tiered.metrics()
+    assert (metrics["pending_probes"], metrics["flush_lag"]) == (0, 0.0)
+    assert (metrics["flushes"], metrics["flushed_probes"]) == (3, 5)
+    assert len(tiered.backend.list_probes(test_monitor.id)) == 5
+
+
+def test_failed_probes_are_raised_by_flush(tiered, test_monitor):
+    [probe] = record(tiered, test_monitor, 1)
+    tiered.record_probe(Probe.create("missing", None, 0.1, 200, None, None))
+    with pytest.raises(Exception):
+        tiered.flush()
+    # only the failing probe is lost
+    assert [p.id for p in tiered.backend.list_probes(test_monitor.id)] == [probe.id]
+    assert tiered.metrics()["failed_probes"] == 1
+    tiered.flush()
+
+
+def test_recording_waits_for_backend_when_too_many_probes_wait(
+    tiered, test_monitor, monkeypatch
+):
+    monkeypatch.setattr(tiered, "MAX_PENDING_PROBES", 3)
+    record(tiered, test_monitor, 2)
+    assert tiered.metrics()["pending_probes"] == 2
+    record(tiered, test_monitor, 1)
+    assert tiered.metrics()["pending_probes"] == 0
+    assert len(tiered.backend.list_probes(test_monitor.id)) == 3
+
+
+def test_delete_monitor_drops_its_probes(tiered, test_monitor):
+    record(tiered, test_monitor, 2)
+    tiered.delete_monitor(test_monitor.id)
+    tiered.flush()
+    assert tiered.metrics()["pending_probes"] == 0
+    assert tiered.recent == {}
+
+
+def test_flusher_thread_writes_probes(tiered, test_monitor, monkeypatch):
+    monkeypatch.setattr(tiered, "FLUSH_BATCH_SIZE", 2)
+    tiered.connect()
+    try:
+        record(tiered, test_monitor, 2)
+        for _ in range(50):
+            if tiered.metrics()["flushed_probes"] == 2:
+                break
+            time.sleep(0.1)
+        assert len(tiered.backend.list_probes(test_monitor.id)) == 2
+    finally:
+        tiered.disconnect()
+    assert tiered.thread is None
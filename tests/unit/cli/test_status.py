@@ -0,0 +1,13 @@
+from monico.cli.status import circuit_description
+from monico.core.breaker import CircuitBreaker
+from monico.core.probe import Probe, ProbeResponseError
+
+
+def test_circuit_description():
+    breaker = CircuitBreaker()
+    assert circuit_description(breaker, 1000) == "closed"
+    for i in range(CircuitBreaker.FAILURE_THRESHOLD):
+        probe = Probe.create("1", None, None, None, ProbeResponseError.TIMEOUT, None)
+        breaker.record(probe, 1000 + i)
+    assert circuit_description(breaker, breaker.retry_at - 1).startswith("open since")
+    assert circuit_description(breaker, breaker.retry_at).startswith("half-open")
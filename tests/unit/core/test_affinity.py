@@ -0,0 +1,78 @@
+import pytest
+from monico.core.affinity import HostAffinity, AffinityError
+
+
+def endpoint_in_slot(affinity: HostAffinity, matching=True) -> str:
+    """Finds an endpoint that does (or does not) map to the affinity slot"""
+    for i in range(1000):
+        endpoint = f"https://host{i}.example.com/"
+        if affinity.matches(endpoint) == matching:
+            return endpoint
+    raise Exception("no endpoint found")
+
+
+def test_parse():
+    assert HostAffinity.parse("1/3") == HostAffinity(1, 3)
+    assert str(HostAffinity(1, 3)) == "1/3"
+
+
+def test_parse_raises():
+    for value in ["", "1", "a/b", "1/2/3", "3/3", "-1/3", "0/0"]:
+        with pytest.raises(AffinityError):
+            HostAffinity.parse(value)
+
+
+def test_matches_is_based_on_host():
+    affinity = HostAffinity(0, 4)
+    endpoint = endpoint_in_slot(affinity)
+    assert affinity.matches(endpoint + "some/path")
+    assert not HostAffinity(1, 4).matches(endpoint)
+
+
+def test_single_slot_matches_everything():
+    assert HostAffinity(0, 1).matches("https://example.com")
+
+
+def test_select_prefers_tasks_in_slot():
+    affinity = HostAffinity(0, 2)
+    mine = endpoint_in_slot(affinity)
+    other = endpoint_in_slot(affinity, matching=False)
+    now = 1000
+    candidates = [
+        ("1", now, other),
+        ("2", now, mine),
+        ("3", now, other),
+        ("4", now, mine),
+    ]
+    assert affinity.select(candidates, 10, now) == ["2", "4"]
+    assert affinity.select(candidates, 1, now) == ["2"]
+
+
+def test_select_takes_overdue_tasks():
+    affinity = HostAffinity(0, 2)
+    mine = endpoint_in_slot(affinity)
+    other = endpoint_in_slot(affinity, matching=False)
+    now = 1000
+    candidates = [
+        ("1", now - HostAffinity.GRACE_PERIOD - 1, other),
+        ("2", now, mine),
+        ("3", now, other),
+    ]
+    assert affinity.select(candidates, 10, now) == ["1", "2"]
+
+
+def test_select_falls_back_to_any_task():
+    affinity = HostAffinity(0, 2)
+    other = endpoint_in_slot(affinity, matching=False)
+    now = 1000
+    candidates = [("1", now, other), ("2", now, other)]
+    assert affinity.select(candidates, 1, now) == ["1"]
+
+
+def test_select_without_fallback():
+    affinity = HostAffinity(0, 2, fallback=False)
+    other = endpoint_in_slot(affinity, matching=False)
+    now = 1000
+    candidates = [("1", now - 60, other), ("2", now, other)]
+    # only overdue tasks are taken
+    assert affinity.select(candidates, 10, now) == ["1"]
@@ -1,11 +1,18 @@
+import os
+import time
+import signal
+import asyncio
 import pytest
 import logging
 from unittest import mock
 from monico.core.app import App
 from monico.core.monitor import Monitor
-from monico.core.probe import Probe
-from monico.core.worker import Worker
+from monico.core.probe import Probe, ProbeResponseError
+from monico.core.breaker import CircuitBreaker, CircuitState
+from monico.core.worker import Worker, StatelessWorker
+from monico.core.affinity import HostAffinity
 from monico.core.manager import Manager
+from monico.core.storage import StorageSetupException
 from ..storage import MemStorage
 
 
@@ -40,6 +47,13 @@ def test_setup(app):
     assert not setup_called_with_force
 
 
+def test_migrate(app):
+    with mock.patch.object(MemStorage, "migrate") as migrate_mock:
+        migrate_mock.return_value = ["migration"]
+        assert app.migrate() == ["migration"]
+        migrate_mock.assert_called_once()
+
+
 def test_connect(app):
     with mock.patch.object(MemStorage, "connect"):
         app.connect()
@@ -128,6 +142,22 @@ def test_run_worker(app):
         mock_run.assert_called_once()
 
 
+def test_separate_processes_require_shared_tasks(app, monkeypatch):
+    monkeypatch.setattr(app.storage, "PROCESS_LOCAL_TASKS", True, raising=False)
+    with pytest.raises(StorageSetupException, match="monico run"):
+        app.run_manager()
+    with pytest.raises(StorageSetupException, match="monico run"):
+        app.run_worker()
+
+    # a single process is fine, and so is scheduling without tasks
+    components = []
+    app.run_until_stopped = lambda *args: components.extend(args)
+    app.run()
+    app.stateless = True
+    app.run_worker()
+    assert len(components) == 3
+
+
 def test_run(app):
     with mock.patch.object(Worker, "run") as mock_worker_run:
         with mock.patch.object(Manager, "run") as mock_manager_run:
@@ -136,6 +166,43 @@ def test_run(app):
             mock_manager_run.assert_called_once()
 
 
+def test_run_hands_tasks_over_through_queue(app):
+    components = []
+    app.run_until_stopped = lambda *args: components.extend(args)
+    app.run()
+    manager, worker = components
+    assert manager.issue_tasks
+    assert worker.queue is not None
+    assert manager.queue is worker.queue
+    assert manager.queue_worker_id == worker.worker_id
+    assert manager.queue_affinity is None
+    assert worker.queue.maxsize == Manager.QUEUE_SIZE
+
+
+def test_run_hands_over_tasks_in_affinity_slot(app):
+    components = []
+    app.run_until_stopped = lambda *args: components.extend(args)
+    affinity = HostAffinity(0, 2)
+    app.run(affinity=affinity)
+    manager, worker = components
+    assert worker.affinity == affinity
+    assert manager.queue_affinity == affinity
+
+
+def test_run_stateless(app):
+    app.stateless = True
+    components = []
+
+    def run_until_stopped(*args):
+        components.extend(args)
+
+    app.run_until_stopped = run_until_stopped
+    app.run()
+    manager, worker = components
+    assert not manager.issue_tasks
+    assert isinstance(worker, StatelessWorker)
+
+
 def test_shutdown(app):
     disconnect_called = False
 
@@ -146,3 +213,74 @@ def test_shutdown(app):
     app.storage.disconnect = fake_disconnect
     app.shutdown()
     assert disconnect_called
+
+
+def test_circuit_breaker(app):
+    app.storage.probes = {
+        str(i): Probe(
+            id=str(i),
+            timestamp=i,
+            monitor_id="1",
+            task_id="task_id",
+            response_code=None,
+            response_time=5,
+            response_error=ProbeResponseError.TIMEOUT,
+            content_match=None,
+        )
+        for i in range(CircuitBreaker.FAILURE_THRESHOLD)
+    }
+    breaker = app.circuit_breaker("1")
+    assert breaker.state is CircuitState.OPEN
+
+
+def test_circuit_breaker_replays_backoff(app, monkeypatch):
+    listed = []
+    monkeypatch.setattr(
+        app.storage, "list_probes", lambda mid, limit: listed.append(limit) or []
+    )
+    app.circuit_breaker("1")
+    assert listed == [CircuitBreaker.history_size()]
+    assert CircuitBreaker.history_size() > CircuitBreaker.FAILURE_THRESHOLD
+
+
+def test_run_until_stopped_handles_sigterm(app):
+    class Component:
+        def __init__(self):
+            self.stopping = asyncio.Event()
+
+        def stop(self):
+            self.stopping.set()
+
+        async def run(self):
+            os.kill(os.getpid(), signal.SIGTERM)
+            await self.stopping.wait()
+
+    components = [Component(), Component()]
+    app.run_until_stopped(*components)
+    assert all(c.stopping.is_set() for c in components)
+
+
+def test_probe_stats(app):
+    app.storage.monitors = {"1": Monitor("1", "test monitor", "http://example.com")}
+    now = int(time.time())
+    for i, timestamp in enumerate([now - 3 * 3600, now - 3600, now - 60]):
+        probe = Probe.create(
+            "1",
+            "task_id",
+            0.1 * (i + 1),
+            200 if i else None,
+            None if i else ProbeResponseError.TIMEOUT,
+            None,
+        )
+        probe.timestamp = timestamp
+        app.storage.probes[probe.id] = probe
+
+    stats = app.probe_stats("1", since=now - 2 * 3600)
+    assert stats.probes == 2
+    assert stats.errors == 0
+    assert stats.latency_min == 0.2
+
+    stats = app.probe_stats("1", since=now - 4 * 3600, until=now)
+    assert stats.probes == 3
+    assert stats.errors == 1
+    assert stats.uptime == pytest.approx(2 / 3)
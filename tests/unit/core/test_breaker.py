@@ -0,0 +1,126 @@
+from monico.core.breaker import CircuitBreaker, CircuitState
+from monico.core.probe import Probe, ProbeResponseError
+
+
+def make_probe(timestamp, response_error=None):
+    probe = Probe.create(
+        monitor_id="1",
+        task_id="task_id",
+        response_time=0.1,
+        response_code=None if response_error else 200,
+        response_error=response_error,
+        content_match=None,
+    )
+    probe.timestamp = timestamp
+    return probe
+
+
+def fail_times(breaker, times, start=1000):
+    for i in range(times):
+        breaker.record(make_probe(start + i, ProbeResponseError.TIMEOUT), start + i)
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker()
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD - 1)
+    assert breaker.state is CircuitState.CLOSED
+    assert breaker.allow(1010)
+
+    fail_times(breaker, 1, start=1010)
+    assert breaker.state is CircuitState.OPEN
+    assert breaker.opened_at == 1010
+    assert breaker.retry_at == 1010 + CircuitBreaker.OPEN_DURATION
+    assert not breaker.allow(1011)
+
+
+def test_success_resets_failure_count():
+    breaker = CircuitBreaker()
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD - 1)
+    breaker.record(make_probe(1100), 1100)
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD - 1, start=1200)
+    assert breaker.state is CircuitState.CLOSED
+
+
+def test_half_open_trial_success_closes():
+    breaker = CircuitBreaker()
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD)
+    retry_at = breaker.retry_at
+
+    assert breaker.allow(retry_at)
+    assert breaker.state is CircuitState.HALF_OPEN
+    # only a single trial probe is let through
+    assert not breaker.allow(retry_at + 1)
+
+    breaker.record(make_probe(retry_at + 1), retry_at + 1)
+    assert breaker.state is CircuitState.CLOSED
+    assert breaker.allow(retry_at + 2)
+
+
+def test_half_open_trial_failure_backs_off():
+    breaker = CircuitBreaker()
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD)
+    opened_at = breaker.opened_at
+    retry_at = breaker.retry_at
+
+    assert breaker.allow(retry_at)
+    breaker.record(make_probe(retry_at, ProbeResponseError.CONNECTION_ERROR), retry_at)
+    assert breaker.state is CircuitState.OPEN
+    assert breaker.opened_at == opened_at
+    assert breaker.retry_at == retry_at + 2 * CircuitBreaker.OPEN_DURATION
+
+
+def test_open_duration_is_capped():
+    breaker = CircuitBreaker()
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD)
+    for _ in range(10):
+        now = breaker.retry_at
+        assert breaker.allow(now)
+        breaker.record(make_probe(now, ProbeResponseError.TIMEOUT), now)
+    assert breaker.open_duration == CircuitBreaker.MAX_OPEN_DURATION
+
+
+def test_from_probes():
+    probes = [
+        make_probe(1000 + i, ProbeResponseError.TIMEOUT)
+        for i in range(CircuitBreaker.FAILURE_THRESHOLD)
+    ]
+    # probes are usually listed newest first
+    breaker = CircuitBreaker.from_probes(list(reversed(probes)))
+    assert breaker.state is CircuitState.OPEN
+    assert breaker.opened_at == 1000 + CircuitBreaker.FAILURE_THRESHOLD - 1
+
+    breaker = CircuitBreaker.from_probes(probes + [make_probe(2000)])
+    assert breaker.state is CircuitState.CLOSED
+
+
+def test_from_probes_restores_backoff():
+    breaker = CircuitBreaker()
+    now = 1000
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD, start=now)
+    probes = [
+        make_probe(now + i, ProbeResponseError.TIMEOUT)
+        for i in range(CircuitBreaker.FAILURE_THRESHOLD)
+    ]
+    # failed trials until the wait between them stops growing
+    while breaker.open_duration < CircuitBreaker.MAX_OPEN_DURATION:
+        now = breaker.retry_at
+        assert breaker.allow(now)
+        probes.append(make_probe(now, ProbeResponseError.TIMEOUT))
+        breaker.record(probes[-1], now)
+
+    assert len(probes) == CircuitBreaker.history_size()
+    restored = CircuitBreaker.from_probes(probes)
+    assert (restored.opened_at, restored.retry_at, restored.open_duration) == (
+        breaker.opened_at,
+        breaker.retry_at,
+        CircuitBreaker.MAX_OPEN_DURATION,
+    )
+
+
+def test_state_at():
+    breaker = CircuitBreaker()
+    assert breaker.state_at(1000) is CircuitState.CLOSED
+    fail_times(breaker, CircuitBreaker.FAILURE_THRESHOLD)
+    assert breaker.state_at(breaker.retry_at - 1) is CircuitState.OPEN
+    # a trial probe is let through once the retry time passes
+    assert breaker.state_at(breaker.retry_at) is CircuitState.HALF_OPEN
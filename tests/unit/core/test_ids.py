@@ -0,0 +1,45 @@
+import time
+import random
+from monico.core import ids
+from monico.core.ids import uuid7
+
+
+def test_uuid7_layout():
+    before = time.time_ns() // 1_000_000
+    value = uuid7()
+    after = time.time_ns() // 1_000_000
+    assert value.version == 7
+    assert value.variant == "specified in RFC 4122"
+    assert before <= value.int >> 80 <= after
+
+
+def test_uuid7_is_ordered():
+    values = [uuid7() for _ in range(10000)]
+    assert values == sorted(values)
+    assert len(set(values)) == len(values)
+    # the text form sorts the same way, e.g. in TEXT columns
+    assert [str(v) for v in values] == sorted(str(v) for v in values)
+
+
+def test_uuid7_is_ordered_when_clock_goes_back(monkeypatch):
+    first = uuid7()
+    monkeypatch.setattr(time, "time_ns", lambda: 0)
+    assert uuid7() > first
+
+
+def test_uuid7_counter_overflow_moves_to_next_millisecond(monkeypatch):
+    now = (ids._last_ms + 1) * 1_000_000
+    monkeypatch.setattr(time, "time_ns", lambda: now)
+    values = [uuid7() for _ in range(ids._COUNTER_MAX + 2)]
+    assert values == sorted(values)
+    assert values[-1].int >> 80 == (values[0].int >> 80) + 1
+
+
+def test_uuid7_random_bits_do_not_depend_on_random_seed():
+    # forked workers inherit the state of the `random` module
+    random.seed(0)
+    first = uuid7()
+    random.seed(0)
+    second = uuid7()
+    mask = (1 << 62) - 1
+    assert first.int & mask != second.int & mask
@@ -0,0 +1,89 @@
+import time
+import asyncio
+import pytest
+from monico.core.limits import (
+    endpoint_host,
+    TokenBucket,
+    HostLimiter,
+    RequestLimiter,
+)
+
+
+def test_endpoint_host():
+    assert endpoint_host("https://example.com/foo") == "example.com"
+    assert endpoint_host("http://example.com:8080/") == "example.com:8080"
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_allows_burst_up_to_capacity():
+    bucket = TokenBucket(rate=10, capacity=3)
+    start = time.monotonic()
+    for _ in range(3):
+        await bucket.acquire()
+    assert time.monotonic() - start < 0.05
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=20, capacity=1)
+    start = time.monotonic()
+    for _ in range(3):
+        await bucket.acquire()
+    # first token is available immediately, two more take 1/20s each
+    assert time.monotonic() - start >= 0.09
+
+
+def test_token_bucket_raises_for_invalid_rate():
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
+
+
+@pytest.mark.asyncio
+async def test_host_limiter_caps_concurrency_per_host():
+    limiter = HostLimiter(max_concurrency=2)
+    active = 0
+    max_active = 0
+
+    async def request():
+        nonlocal active, max_active
+        async with limiter.acquire("example.com"):
+            active += 1
+            max_active = max(max_active, active)
+            await asyncio.sleep(0.01)
+            active -= 1
+
+    await asyncio.gather(*[request() for _ in range(5)])
+    assert max_active == 2
+    # unused hosts are cleaned up
+    assert limiter.semaphores == {}
+
+
+@pytest.mark.asyncio
+async def test_host_limiter_does_not_block_other_hosts():
+    limiter = HostLimiter(max_concurrency=1)
+    busy = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_request():
+        async with limiter.acquire("slow.com"):
+            busy.set()
+            await release.wait()
+
+    slow_task = asyncio.create_task(slow_request())
+    await busy.wait()
+
+    # request to another host goes through while slow.com is busy
+    async with limiter.acquire("fast.com"):
+        pass
+
+    release.set()
+    await slow_task
+
+
+@pytest.mark.asyncio
+async def test_request_limiter_without_limits():
+    limiter = RequestLimiter()
+    async with limiter.acquire("https://example.com"):
+        pass
+    assert limiter.hosts is None
+    assert limiter.bucket is None
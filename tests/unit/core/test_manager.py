@@ -2,8 +2,11 @@ import pytest
 import asyncio
 import time
 import logging
+import threading
+from monico.core.affinity import HostAffinity
 from monico.core.manager import Manager
 from monico.core.monitor import Monitor
+from monico.core.task import TaskStatus
 from ..storage import MemStorage
 
 
@@ -30,6 +33,50 @@ def test_issue_task(manager):
     list(manager.storage.tasks.values())[0].monitor_id == "1"
 
 
+@pytest.mark.asyncio
+async def test_issue_task_hands_over_to_queue(manager):
+    manager.queue = asyncio.Queue()
+    manager.queue_worker_id = "worker"
+    manager.issue_task(manager.storage.monitors["1"])
+    [task] = manager.storage.tasks.values()
+    # stored locked by the worker, so that no other worker locks it
+    assert task.status == TaskStatus.RUNNING
+    assert task.locked_by == "worker"
+    assert manager.queue.get_nowait() is task
+
+
+@pytest.mark.asyncio
+async def test_issue_task_hands_over_tasks_in_affinity_slot(manager):
+    manager.queue = asyncio.Queue()
+    manager.queue_worker_id = "worker"
+    # example.com is in the worker's slot, example.net isn't
+    manager.queue_affinity = HostAffinity(1, 2)
+    other = Monitor("2", "other monitor", "http://example.net", 60)
+    manager.storage.monitors[other.id] = other
+    manager.issue_task(manager.storage.monitors["1"])
+    manager.issue_task(other)
+
+    handed_over = manager.queue.get_nowait()
+    assert manager.queue.empty()
+    assert handed_over.monitor_id == "1"
+    # the other task is left for the worker owning the slot of its host
+    [pending] = [t for t in manager.storage.tasks.values() if t.monitor_id == "2"]
+    assert pending.status == TaskStatus.PENDING
+    assert pending.locked_by is None
+
+
+@pytest.mark.asyncio
+async def test_issue_task_stores_pending_when_queue_is_full(manager):
+    manager.queue = asyncio.Queue(maxsize=1)
+    manager.queue_worker_id = "worker"
+    manager.issue_task(manager.storage.monitors["1"])
+    manager.issue_task(manager.storage.monitors["1"])
+
+    assert manager.queue.qsize() == 1
+    statuses = sorted(t.status.value for t in manager.storage.tasks.values())
+    assert statuses == sorted([TaskStatus.RUNNING.value, TaskStatus.PENDING.value])
+
+
 @pytest.mark.asyncio
 async def test_schedule_first_run(manager):
     await manager.schedule()
@@ -53,6 +100,14 @@ async def test_schedule_recent_run(manager):
     assert len(manager.storage.tasks) == 0
 
 
+@pytest.mark.asyncio
+async def test_schedule_without_issuing_tasks(manager):
+    # with stateless scheduling workers claim due monitors themselves
+    manager.issue_tasks = False
+    await manager.schedule()
+    assert len(manager.storage.tasks) == 0
+
+
 @pytest.mark.asyncio
 async def test_schedule_run(manager):
     task = asyncio.create_task(manager.run())
@@ -74,3 +129,52 @@ async def test_schedule_run(manager):
 
     await task
     assert called_twice
+
+
+@pytest.mark.asyncio
+async def test_stop(manager):
+    task = asyncio.create_task(manager.run())
+    await asyncio.sleep(0.01)
+    manager.stop()
+    await asyncio.wait_for(task, timeout=1)
+    assert len(manager.storage.tasks) == 1
+
+
+@pytest.mark.asyncio
+async def test_start_maintenance_is_periodic(manager):
+    calls = []
+    manager.storage.maintain = lambda: calls.append(1) or {"tasks_deleted": 1}
+    manager.start_maintenance()
+    manager.start_maintenance()
+    await manager.maintenance
+    manager.start_maintenance()
+    assert manager.maintenance.done()
+    assert len(calls) == 1
+
+    manager.maintained_at -= manager.MAINTENANCE_INTERVAL
+    manager.start_maintenance()
+    await manager.maintenance
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_maintenance_doesnt_block_scheduling(manager):
+    release = threading.Event()
+    manager.storage.maintain = lambda: release.wait(1) and {}
+    manager.start_maintenance()
+    await manager.schedule()
+    assert len(manager.storage.tasks) == 1
+    assert not manager.maintenance.done()
+    release.set()
+    await manager.maintenance
+
+
+@pytest.mark.asyncio
+async def test_maintain_logs_storage_errors(manager, caplog):
+    def failing_maintain():
+        raise Exception("disk full")
+
+    manager.storage.maintain = failing_maintain
+    manager.log.setLevel(logging.ERROR)
+    await manager.maintain()
+    assert "manager failed to maintain storage: disk full" in caplog.text
@@ -1,3 +1,4 @@
+import uuid
 import time
 from monico.core.probe import Probe
 
@@ -23,6 +24,7 @@ def test_probe_create():
     )
 
     assert isinstance(probe.id, str)
+    assert uuid.UUID(probe.id).version == 7
     assert abs(probe.timestamp - now) < time_tolerance
     assert probe.monitor_id == test_monitor_id
     assert probe.task_id == test_task_id
@@ -0,0 +1,200 @@
+import time
+import socket
+import asyncio
+import aiodns
+import pytest
+from types import SimpleNamespace
+from monico.core.resolver import CachingResolver
+
+
+class FakeDNS:
+    """Stands in for aiodns.DNSResolver"""
+
+    def __init__(self, records=None, hosts_file=None, records6=None):
+        self.records = records or {}  # host -> [(address, ttl)] of A records
+        self.records6 = records6 or {}  # host -> [(address, ttl)] of AAAA records
+        self.hosts_file = hosts_file or {}  # host -> [address]
+        self.hosts_lookups = []
+        self.queries = []
+
+    async def query(self, host, qtype):
+        self.queries.append((host, qtype))
+        await asyncio.sleep(0)
+        records = self.records if qtype == "A" else self.records6
+        if host not in records:
+            if host in self.records or host in self.records6:
+                raise aiodns.error.DNSError(1, "DNS server returned no data")
+            raise aiodns.error.DNSError(4, "Domain name not found")
+        return [
+            SimpleNamespace(host=address, ttl=ttl) for (address, ttl) in records[host]
+        ]
+
+    async def gethostbyname(self, host, family):
+        self.hosts_lookups.append((host, family))
+        if host not in self.hosts_file or family != socket.AF_INET:
+            raise aiodns.error.DNSError(4, "Domain name not found")
+        return SimpleNamespace(addresses=self.hosts_file[host])
+
+    def cancel(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_resolve():
+    dns = FakeDNS({"example.com": [("93.184.216.34", 300)]})
+    resolver = CachingResolver(dns)
+    hosts = await resolver.resolve("example.com", 443, family=socket.AF_UNSPEC)
+    assert hosts == [
+        {
+            "hostname": "example.com",
+            "host": "93.184.216.34",
+            "port": 443,
+            "family": socket.AF_INET,
+            "proto": 0,
+            "flags": socket.AI_NUMERICHOST | socket.AI_NUMERICSERV,
+        }
+    ]
+
+
+@pytest.mark.asyncio
+async def test_resolve_any_address_family():
+    dns = FakeDNS(
+        {"dual.com": [("93.184.216.34", 300)]},
+        records6={
+            "dual.com": [("2606:2800:220:1::1", 300)],
+            "ipv6-only.com": [("2606:2800:220:1::2", 300)],
+        },
+    )
+    resolver = CachingResolver(dns)
+    hosts = await resolver.resolve("dual.com", 443, family=socket.AF_UNSPEC)
+    assert [(h["host"], h["family"]) for h in hosts] == [
+        ("93.184.216.34", socket.AF_INET),
+        ("2606:2800:220:1::1", socket.AF_INET6),
+    ]
+
+    hosts = await resolver.resolve("ipv6-only.com", 443, family=socket.AF_UNSPEC)
+    assert [(h["host"], h["family"]) for h in hosts] == [
+        ("2606:2800:220:1::2", socket.AF_INET6)
+    ]
+    # a single family is asked for only
+    with pytest.raises(OSError):
+        await resolver.resolve("ipv6-only.com", 443, family=socket.AF_INET)
+
+
+@pytest.mark.asyncio
+async def test_resolve_caches_for_ttl():
+    dns = FakeDNS({"example.com": [("93.184.216.34", 300), ("93.184.216.35", 100)]})
+    resolver = CachingResolver(dns)
+    await resolver.resolve("example.com")
+    await resolver.resolve("example.com")
+    assert dns.queries == [("example.com", "A")]
+
+    # entry lives as long as the shortest TTL
+    entry = resolver.cache[("example.com", socket.AF_INET)]
+    assert 99 < entry.expires_at - time.monotonic() <= 100
+
+    # expired entries are resolved again
+    entry.expires_at = time.monotonic() - 1
+    await resolver.resolve("example.com")
+    assert len(dns.queries) == 2
+
+
+@pytest.mark.asyncio
+async def test_resolve_clamps_ttl():
+    dns = FakeDNS({"short.com": [("1.1.1.1", 0)], "long.com": [("2.2.2.2", 10**6)]})
+    resolver = CachingResolver(dns)
+    await resolver.resolve("short.com")
+    await resolver.resolve("long.com")
+    now = time.monotonic()
+    short = resolver.cache[("short.com", socket.AF_INET)]
+    long = resolver.cache[("long.com", socket.AF_INET)]
+    assert short.expires_at - now == pytest.approx(CachingResolver.MIN_TTL, abs=1)
+    assert long.expires_at - now == pytest.approx(CachingResolver.MAX_TTL, abs=1)
+
+
+@pytest.mark.asyncio
+async def test_resolve_negative_caching():
+    dns = FakeDNS()
+    resolver = CachingResolver(dns)
+    with pytest.raises(OSError, match="Domain name not found"):
+        await resolver.resolve("nonexistent.com")
+    with pytest.raises(OSError):
+        await resolver.resolve("nonexistent.com")
+    assert dns.queries == [("nonexistent.com", "A")]
+
+
+@pytest.mark.asyncio
+async def test_resolve_falls_back_to_hosts_file():
+    dns = FakeDNS(hosts_file={"localhost": ["127.0.0.1"]})
+    resolver = CachingResolver(dns)
+    hosts = await resolver.resolve("localhost")
+    assert hosts[0]["host"] == "127.0.0.1"
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_a_query():
+    dns = FakeDNS({"example.com": [("93.184.216.34", 300)]})
+    resolver = CachingResolver(dns)
+    await asyncio.gather(*[resolver.resolve("example.com") for _ in range(5)])
+    assert len(dns.queries) == 1
+
+
+@pytest.mark.asyncio
+async def test_prefetch():
+    dns = FakeDNS({"a.com": [("1.1.1.1", 300)], "b.com": [("2.2.2.2", 30)]})
+    resolver = CachingResolver(dns)
+    resolver.prefetch(["a.com", "b.com", "a.com"])
+    await asyncio.sleep(0.01)
+    assert sorted(dns.queries) == [
+        ("a.com", "A"),
+        ("a.com", "AAAA"),
+        ("b.com", "A"),
+        ("b.com", "AAAA"),
+    ]
+
+    # b.com expires before the prefetch window ends, a.com does not;
+    # missing AAAA records are cached for NODATA_TTL, longer than the window
+    dns.queries = []
+    resolver.prefetch(["a.com", "b.com"], within=60)
+    await asyncio.sleep(0.01)
+    assert dns.queries == [("b.com", "A")]
+
+    # prefetched entries are served from cache
+    await resolver.resolve("a.com", family=socket.AF_UNSPEC)
+    assert len(dns.queries) == 1
+    await resolver.close()
+
+
+@pytest.mark.asyncio
+async def test_missing_records_of_a_family_are_cached():
+    dns = FakeDNS({"ipv4-only.com": [("1.1.1.1", 300)]})
+    resolver = CachingResolver(dns)
+    hosts = await resolver.resolve("ipv4-only.com", family=socket.AF_UNSPEC)
+    assert [h["host"] for h in hosts] == ["1.1.1.1"]
+    # the name is in DNS, so the hosts file is not asked for IPv6 addresses
+    assert dns.hosts_lookups == []
+    entry = resolver.cache[("ipv4-only.com", socket.AF_INET6)]
+    assert entry.expires_at - time.monotonic() == pytest.approx(
+        CachingResolver.NODATA_TTL, abs=1
+    )
+
+    dns.queries = []
+    await resolver.resolve("ipv4-only.com", family=socket.AF_UNSPEC)
+    assert dns.queries == []
+    with pytest.raises(OSError, match="no data"):
+        await resolver.resolve("ipv4-only.com", family=socket.AF_INET6)
+
+
+@pytest.mark.asyncio
+async def test_failed_lookup_skips_hosts_file_for_names_in_dns():
+    dns = FakeDNS({"example.com": [("93.184.216.34", 300)]})
+    resolver = CachingResolver(dns)
+    await resolver.resolve("example.com")
+
+    async def timeout(host, qtype):
+        raise aiodns.error.DNSError(12, "Timeout while contacting DNS servers")
+
+    dns.query = timeout
+    with pytest.raises(OSError, match="Timeout"):
+        await resolver.resolve("example.com", family=socket.AF_INET6)
+    assert dns.hosts_lookups == []
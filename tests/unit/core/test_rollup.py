@@ -0,0 +1,94 @@
+from monico.core.probe import Probe, ProbeResponseError
+from monico.core.rollup import (
+    Rollup,
+    LATENCY_BUCKETS,
+    RETENTION,
+    plan_rollup_ranges,
+    rollup_probes,
+)
+
+
+def probe(timestamp, response_time=0.2, response_code=200, response_error=None):
+    probe = Probe.create(
+        "1", "task", response_time, response_code, response_error, None
+    )
+    probe.timestamp = timestamp
+    return probe
+
+
+def test_add():
+    rollup = Rollup("1", 60, 0)
+    rollup.add(probe(0, 0.05, 200))
+    rollup.add(probe(1, 0.3, 301))
+    rollup.add(probe(2, 0.7, 404))
+    rollup.add(probe(3, 12.0, 503))
+    rollup.add(probe(4, None, None, ProbeResponseError.TIMEOUT))
+
+    assert rollup.probes == 5
+    assert rollup.errors == 1
+    assert (rollup.status_2xx, rollup.status_3xx) == (1, 1)
+    assert (rollup.status_4xx, rollup.status_5xx) == (1, 1)
+    assert rollup.latency_count == 4
+    assert rollup.latency_min == 0.05
+    assert rollup.latency_max == 12.0
+    assert rollup.latency_histogram == [1, 0, 1, 1, 0, 0, 0, 1]
+    assert rollup.uptime == 0.8
+    assert rollup.latency_avg == (0.05 + 0.3 + 0.7 + 12.0) / 4
+
+
+def test_merge():
+    first, second, empty = Rollup("1", 60, 0), Rollup("1", 60, 60), Rollup("1", 60, 120)
+    first.add(probe(0, 0.5))
+    second.add(probe(60, 0.1, None, ProbeResponseError.CONNECTION_ERROR))
+    first.merge(second)
+    first.merge(empty)
+
+    assert first.probes == 2
+    assert first.errors == 1
+    assert first.latency_min == 0.1
+    assert first.latency_max == 0.5
+    assert sum(first.latency_histogram) == 2
+
+
+def test_latency_percentile():
+    rollup = Rollup("1", 60, 0)
+    assert rollup.latency_percentile(50) is None
+    for latency in [0.05] * 90 + [0.4] * 9 + [3.0]:
+        rollup.add_latency(latency)
+    assert rollup.latency_percentile(50) == LATENCY_BUCKETS[0]
+    assert rollup.latency_percentile(95) == 0.5
+    # capped by the slowest response
+    assert rollup.latency_percentile(100) == 3.0
+
+
+def test_rollup_probes():
+    rollups = rollup_probes([probe(3599), probe(3600), probe(3660)])
+    assert [(r.resolution, r.bucket, r.probes) for r in rollups] == [
+        (60, 3540, 1),
+        (60, 3600, 1),
+        (60, 3660, 1),
+        (3600, 0, 1),
+        (3600, 3600, 2),
+    ]
+
+
+def test_plan_rollup_ranges():
+    now = 100 * 3600
+    # whole hours in the middle, minutes at the unaligned ends
+    assert plan_rollup_ranges(3600 - 90, 3 * 3600 + 30, now) == [
+        (60, 3600 - 120, 3600),
+        (3600, 3600, 3 * 3600),
+        (60, 3 * 3600, 3 * 3600 + 60),
+    ]
+    # ranges shorter than an hour only use minutes
+    assert plan_rollup_ranges(3600, 3600 + 600, now) == [(60, 3600, 3600 + 600)]
+    assert plan_rollup_ranges(3600, 3600, now) == []
+
+
+def test_plan_rollup_ranges_widens_to_kept_rollups():
+    now = 100 * 86400
+    since = now - RETENTION[60] - 2 * 3600 + 90
+    # minute rollups of the start of the range are not kept anymore
+    [(resolution, start, _), *_] = plan_rollup_ranges(since, now, now)
+    assert resolution == 3600
+    assert start == since - since % 3600
@@ -1,3 +1,4 @@
+import time
 import pytest
 from unittest import mock
 from monico.core.storage import StorageInterface
@@ -12,6 +13,8 @@ class TestStorageInterface:
         si.disconnect()
         si.setup()
         si.teardown()
+        si.flush()
+        assert si.migrate() == []
 
     @mock.patch.multiple(StorageInterface, __abstractmethods__=set())
     def test_abstract_methods(self):
@@ -35,3 +38,11 @@ class TestStorageInterface:
             si.record_probe(None)
         with pytest.raises(NotImplementedError):
             si.list_probes(None)
+
+    @pytest.mark.asyncio
+    @mock.patch.multiple(StorageInterface, __abstractmethods__=set())
+    async def test_wait_for_tasks_sleeps_for_timeout(self):
+        si = StorageInterface()
+        started_at = time.monotonic()
+        await si.wait_for_tasks(0.05)
+        assert time.monotonic() - started_at >= 0.05
@@ -1,3 +1,4 @@
+import uuid
 import time
 from monico.core.task import Task, TaskStatus
 
@@ -8,6 +9,8 @@ def test_task_create():
     now = int(time.time())
     task = Task.create(test_monitor_id)
     assert isinstance(task.id, str)
+    # time-ordered
+    assert uuid.UUID(task.id).version == 7
     assert abs(task.timestamp - now) < time_tolerance
     assert task.monitor_id == test_monitor_id
     assert task.status is TaskStatus.PENDING
@@ -18,3 +21,20 @@ def test_task_abandon():
     task = Task.create("test_monitor_id")
     task.abandon()
     assert task.status is TaskStatus.ABANDONED
+
+
+def test_task_fail():
+    task = Task.create("test_monitor_id")
+    task.fail()
+    assert task.status is TaskStatus.FAILED
+
+
+def test_task_release():
+    task = Task.create("test_monitor_id")
+    task.status = TaskStatus.RUNNING
+    task.locked_at = 1700000000
+    task.locked_by = "test_worker"
+    task.release()
+    assert task.status is TaskStatus.PENDING
+    assert task.locked_at is None
+    assert task.locked_by is None
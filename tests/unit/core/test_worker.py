@@ -3,12 +3,18 @@ import time
 import logging
 import asyncio
 import aiohttp
+from concurrent.futures import Future
 from aioresponses import aioresponses
-from monico.core.worker import Worker
+from monico.core.worker import Worker, StatelessWorker
+from monico.core.limits import RequestLimiter, endpoint_host
+from monico.core.breaker import CircuitBreaker, CircuitState
+from monico.core.affinity import HostAffinity
 from monico.core.monitor import Monitor
 from monico.core.task import Task, TaskStatus
 from monico.core.probe import Probe, ProbeResponseError
+from monico.core.resolver import CachingResolver
 from ..storage import MemStorage
+from .test_resolver import FakeDNS
 
 
 @pytest.fixture
@@ -25,7 +31,16 @@ def worker():
             body_regexp="hello world",
         )
     }
-    return Worker(storage, log)
+    worker = Worker(storage, log)
+    worker.resolver = CachingResolver(
+        FakeDNS({"example.com": [("93.184.216.34", 300)]})
+    )
+    return worker
+
+
+@pytest.fixture
+def stateless_worker(worker: Worker):
+    return StatelessWorker(worker.storage, worker.log)
 
 
 def test_lock_batch(worker: Worker):
@@ -64,12 +79,13 @@ async def test_run(worker):
     # record the number of tasks completed
     tasks_completed = 0
 
-    def fake_run_task(task):
+    async def fake_run_task(task):
         nonlocal tasks_completed
         tasks_completed += 1
         return task
 
     worker.run_task = fake_run_task
+    worker.POLL_INTERVAL = 0.1
 
     worker_task = asyncio.create_task(worker.run())
 
@@ -121,6 +137,9 @@ async def test_run_task_success(worker: Worker):
     }
 
     await worker.run_task(task)
+    # probes are buffered until the batch is flushed
+    assert len(worker.storage.probes) == 0
+    worker.flush_probes()
     assert len(worker.storage.probes) == 1
     stored_probe = list(worker.storage.probes.values())[0]
     assert stored_probe.content_match == test_probe_content_match
@@ -134,12 +153,14 @@ async def test_get_probe_success(worker: Worker):
     with aioresponses() as mocked:
         mocked.get(monitor.endpoint, status=200, body="*** hello world ***")
         probe = await worker.get_probe(task)
+    await worker.close()
 
     assert probe.monitor_id == monitor.id
     assert probe.task_id == task.id
     assert probe.response_code == 200
     assert probe.response_error == None
     assert probe.content_match == "hello world"
+    assert probe.dns_time == 0
 
 
 @pytest.mark.asyncio
@@ -150,6 +171,7 @@ async def test_get_probe_connection_error(worker: Worker):
     with aioresponses() as mocked:
         mocked.get(monitor.endpoint, exception=aiohttp.ClientError)
         probe = await worker.get_probe(task)
+    await worker.close()
 
     assert probe.monitor_id == monitor.id
     assert probe.task_id == task.id
@@ -166,9 +188,464 @@ async def test_get_probe_timeout_error(worker: Worker):
     with aioresponses() as mocked:
         mocked.get(monitor.endpoint, exception=asyncio.TimeoutError)
         probe = await worker.get_probe(task)
+    await worker.close()
 
     assert probe.monitor_id == monitor.id
     assert probe.task_id == task.id
     assert probe.response_code == None
     assert probe.response_error == ProbeResponseError.TIMEOUT
     assert probe.content_match == None
+
+
+@pytest.mark.asyncio
+async def test_get_probe_measures_wait_time(worker: Worker):
+    monitor = worker.storage.monitors["1"]
+    task1 = monitor.create_task()
+    task2 = monitor.create_task()
+    worker.limiter = RequestLimiter(per_host_concurrency=1)
+
+    async def slow_execute_probe(task, monitor):
+        await asyncio.sleep(0.1)
+        return Probe.create(
+            monitor_id=task.monitor_id,
+            task_id=task.id,
+            response_time=0.1,
+            response_code=200,
+            response_error=None,
+            content_match=None,
+        )
+
+    worker.execute_probe = slow_execute_probe
+    probe1, probe2 = await asyncio.gather(
+        worker.get_probe(task1), worker.get_probe(task2)
+    )
+
+    # second probe had to wait for the first one to release the host slot
+    assert probe1.wait_time < 0.05
+    assert probe2.wait_time >= 0.09
+    assert probe2.response_time == 0.1
+
+
+@pytest.mark.asyncio
+async def test_run_task_circuit_open(worker: Worker):
+    breaker = worker.breaker("1")
+    breaker.open(int(time.time()), CircuitBreaker.OPEN_DURATION)
+
+    async def fake_get_probe(task: Task):
+        raise Exception("probe should not be executed")
+
+    worker.get_probe = fake_get_probe
+    task = worker.storage.monitors["1"].create_task()
+    worker.storage.tasks = {task.id: task}
+
+    await worker.run_task(task)
+    assert worker.storage.tasks[task.id].status == TaskStatus.FAILED
+    assert len(worker.storage.probes) == 0
+
+
+@pytest.mark.asyncio
+async def test_run_task_records_probe_result_in_breaker(worker: Worker):
+    async def fake_get_probe(task: Task):
+        return Probe.create(
+            monitor_id=task.monitor_id,
+            task_id=task.id,
+            response_time=5,
+            response_code=None,
+            response_error=ProbeResponseError.TIMEOUT,
+            content_match=None,
+        )
+
+    worker.get_probe = fake_get_probe
+    for _ in range(CircuitBreaker.FAILURE_THRESHOLD):
+        task = worker.storage.monitors["1"].create_task()
+        worker.storage.tasks[task.id] = task
+        await worker.run_task(task)
+
+    assert worker.breaker("1").state is CircuitState.OPEN
+
+
+def test_lock_batch_with_affinity(worker: Worker):
+    worker.affinity = HostAffinity(0, 1)
+    task = Task.create("1")
+    worker.storage.tasks = {task.id: task}
+    assert [t.id for t in worker.lock_batch()] == [task.id]
+
+
+@pytest.mark.asyncio
+async def test_session_is_shared_between_probes(worker: Worker):
+    session = worker.get_session()
+    assert worker.get_session() is session
+
+    await worker.close()
+    assert session.closed
+    assert worker.get_session() is not session
+    await worker.close()
+
+
+@pytest.mark.asyncio
+async def test_prefetch_dns(worker: Worker):
+    worker.storage.monitors["2"] = Monitor(
+        mid="2",
+        name="not due soon",
+        endpoint="http://not-due.com",
+        interval=300,
+        last_task_at=int(time.time()),
+    )
+    # e.g. stored before endpoints were validated
+    worker.storage.monitors["3"] = Monitor(
+        mid="3", name="no hostname", endpoint="http://example.com", interval=300
+    )
+    worker.storage.monitors["3"].endpoint = "http://"
+    worker.prefetch_dns()
+    await asyncio.sleep(0.01)
+    assert sorted(worker.resolver.dns.queries) == [
+        ("example.com", "A"),
+        ("example.com", "AAAA"),
+    ]
+    await worker.close()
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_in_flight_tasks(worker: Worker):
+    worker.limiter = RequestLimiter(per_host_concurrency=1)
+    worker.POLL_INTERVAL = 0.1
+    request_sent = asyncio.Event()
+
+    async def slow_execute_probe(task, monitor):
+        request_sent.set()
+        await asyncio.sleep(0.1)
+        return Probe.create(
+            monitor_id=task.monitor_id,
+            task_id=task.id,
+            response_time=0.1,
+            response_code=200,
+            response_error=None,
+            content_match=None,
+        )
+
+    worker.execute_probe = slow_execute_probe
+    # second task waits for the first one to release the host slot
+    task1 = worker.storage.monitors["1"].create_task()
+    task2 = worker.storage.monitors["1"].create_task()
+    worker.storage.tasks = {task1.id: task1, task2.id: task2}
+
+    worker_task = asyncio.create_task(worker.run())
+    await request_sent.wait()
+    worker.stop()
+    await asyncio.wait_for(worker_task, timeout=1)
+
+    # first probe is finished and recorded, second one is returned to pending
+    assert worker.storage.tasks[task1.id].status == TaskStatus.COMPLETED
+    assert worker.storage.tasks[task2.id].status == TaskStatus.PENDING
+    assert len(worker.storage.probes) == 1
+    assert worker.in_flight == {}
+
+
+@pytest.mark.asyncio
+async def test_drain_releases_tasks_after_timeout(worker: Worker):
+    worker.DRAIN_TIMEOUT = 0.1
+
+    async def hanging_execute_probe(task, monitor):
+        await asyncio.sleep(10)
+
+    worker.execute_probe = hanging_execute_probe
+    task = worker.storage.monitors["1"].create_task()
+    worker.storage.tasks = {task.id: task}
+    [task] = worker.lock_batch()
+    worker.start_task(task)
+    await asyncio.sleep(0.01)
+    assert task.id in worker.started
+
+    worker.stop()
+    await worker.drain()
+    assert worker.storage.tasks[task.id].status == TaskStatus.PENDING
+    assert len(worker.storage.probes) == 0
+
+
+@pytest.mark.asyncio
+async def test_drain_flushes_storage(worker: Worker):
+    flushed = False
+
+    def fake_flush():
+        nonlocal flushed
+        flushed = True
+
+    worker.storage.flush = fake_flush
+    await worker.drain()
+    assert flushed
+
+
+@pytest.mark.asyncio
+async def test_idle_worker_wakes_up_on_new_tasks(worker: Worker):
+    worker.POLL_INTERVAL = 10
+    tasks_issued = asyncio.Event()
+    waiting = asyncio.Event()
+
+    async def wait_for_tasks(timeout):
+        waiting.set()
+        await asyncio.wait_for(tasks_issued.wait(), timeout)
+        tasks_issued.clear()
+
+    worker.storage.wait_for_tasks = wait_for_tasks
+    probed = asyncio.Event()
+
+    async def fake_run_task(task):
+        probed.set()
+
+    worker.run_task = fake_run_task
+    worker_task = asyncio.create_task(worker.run())
+
+    # the queue is empty, so the worker waits for tasks
+    await asyncio.wait_for(waiting.wait(), timeout=1)
+    task = worker.storage.monitors["1"].create_task()
+    worker.storage.tasks = {task.id: task}
+    tasks_issued.set()
+
+    # the task is picked up without waiting for the poll interval
+    await asyncio.wait_for(probed.wait(), timeout=1)
+    worker.stop()
+    await asyncio.wait_for(worker_task, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_lock_batch_takes_queued_tasks_first(worker: Worker):
+    worker.queue = asyncio.Queue()
+    worker.BATCH_SIZE = 2
+    stored = worker.storage.monitors["1"].create_task()
+    worker.storage.tasks = {stored.id: stored}
+    queued = [worker.storage.monitors["1"].create_task() for _ in range(3)]
+    for task in queued:
+        worker.queue.put_nowait(task)
+
+    assert worker.lock_batch() == queued[:2]
+    assert worker.lock_batch() == queued[2:]
+    # the storage is locked from once the queue is empty
+    assert [t.id for t in worker.lock_batch()] == [stored.id]
+
+
+@pytest.mark.asyncio
+async def test_idle_worker_wakes_up_on_handed_over_task(worker: Worker):
+    worker.queue = asyncio.Queue()
+    waiting = asyncio.Event()
+    wait_for_tasks = worker.wait_for_tasks
+
+    async def watched_wait_for_tasks(timeout):
+        assert timeout == worker.NOTIFIED_POLL_INTERVAL
+        waiting.set()
+        await wait_for_tasks(timeout)
+
+    worker.wait_for_tasks = watched_wait_for_tasks
+    probed = []
+
+    async def fake_run_task(task):
+        probed.append(task)
+
+    worker.run_task = fake_run_task
+    worker_task = asyncio.create_task(worker.run())
+
+    await asyncio.wait_for(waiting.wait(), timeout=1)
+    task = worker.storage.monitors["1"].create_task()
+    worker.queue.put_nowait(task)
+
+    # the task is picked up without polling the storage
+    while not probed:
+        await asyncio.sleep(0.01)
+    assert probed == [task]
+    worker.stop()
+    await asyncio.wait_for(worker_task, timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_drain_releases_queued_tasks(worker: Worker):
+    worker.queue = asyncio.Queue()
+    task = worker.storage.monitors["1"].create_task()
+    task.lock(worker.worker_id)
+    worker.storage.tasks = {task.id: task}
+    worker.queue.put_nowait(task)
+
+    worker.stop()
+    await worker.drain()
+    assert worker.storage.tasks[task.id].status == TaskStatus.PENDING
+    assert worker.queue.empty()
+
+
+@pytest.mark.asyncio
+async def test_notified_worker_leaves_tasks_of_busy_slot_owner(worker: Worker):
+    # the task is in the other slot, whose owner is busy with its own tasks
+    monitor = worker.storage.monitors["1"]
+    owner_slot = HostAffinity.slot(endpoint_host(monitor.endpoint), 2)
+    worker.affinity = HostAffinity(1 - owner_slot, 2)
+    task = monitor.create_task()
+    worker.storage.tasks = {task.id: task}
+
+    async def notified(timeout):
+        return True
+
+    # the notification about the task wakes up every worker
+    worker.storage.wait_for_tasks = notified
+    await worker.wait_for_tasks(1)
+    assert worker.lock_batch() == []
+    assert task.status == TaskStatus.PENDING
+
+    async def polled(timeout):
+        return False
+
+    # on a periodic poll the worker falls back to tasks of other slots
+    worker.storage.wait_for_tasks = polled
+    await worker.wait_for_tasks(1)
+    assert [t.id for t in worker.lock_batch()] == [task.id]
+
+
+def test_idle_poll_interval(worker: Worker):
+    assert worker.idle_poll_interval() == worker.POLL_INTERVAL
+    worker.storage.NOTIFIES_ABOUT_TASKS = True
+    assert worker.idle_poll_interval() == worker.NOTIFIED_POLL_INTERVAL
+
+
+def test_idle_poll_interval_with_queue(worker: Worker):
+    worker.queue = asyncio.Queue()
+    assert worker.idle_poll_interval() == worker.NOTIFIED_POLL_INTERVAL
+    # tasks outside the affinity slot are only found by polling the storage
+    worker.affinity = HostAffinity(0, 2)
+    assert worker.idle_poll_interval() == worker.POLL_INTERVAL
+
+
+def test_log_metrics(worker: Worker, caplog):
+    worker.log.setLevel(logging.INFO)
+    worker.log_metrics()
+    assert "storage metrics" not in caplog.text
+
+    worker.storage.metrics = lambda: {"pool_size": 2, "pool_utilization": 0.5}
+    worker.log_metrics()
+    assert "storage metrics; pool_size=2 pool_utilization=0.500" in caplog.text
+
+
+def test_flush_probes_records_batch(worker: Worker):
+    recorded = []
+    worker.storage.record_probes = recorded.append
+    probes = [Probe.create("1", f"task-{i}", 0.1, 200, None, None) for i in range(3)]
+    worker.probe_buffer = list(probes)
+    worker.flush_probes()
+    assert recorded == [probes]
+    assert worker.probe_buffer == []
+
+    # nothing to record
+    worker.flush_probes()
+    assert len(recorded) == 1
+
+
+def test_flush_probes_logs_storage_errors(worker: Worker):
+    def failing_record_probes(probes):
+        raise Exception("storage is down")
+
+    def failing_record_probe(probe):
+        raise Exception("storage is down")
+
+    worker.storage.record_probes = failing_record_probes
+    worker.storage.record_probe = failing_record_probe
+    worker.probe_buffer = [Probe.create("1", "task", 0.1, 200, None, None)]
+    worker.flush_probes()
+    assert worker.probe_buffer == []
+
+
+def test_flush_probes_waits_for_background_writes(worker: Worker):
+    def record_probes(probes):
+        # e.g. group commit of SQLite, where the batch fails once committed
+        future = Future()
+        future.set_exception(Exception("monitor was deleted"))
+        return future
+
+    recorded = []
+    worker.storage.record_probes = record_probes
+    worker.storage.record_probe = recorded.append
+    probes = [Probe.create("1", f"task-{i}", 0.1, 200, None, None) for i in range(2)]
+    worker.probe_buffer = list(probes)
+    worker.flush_probes()
+    assert recorded == probes
+
+
+def test_flush_probes_loses_only_failing_probes(worker: Worker):
+    record_probe = worker.storage.record_probe
+
+    def checked_record_probe(probe):
+        # raises for a missing monitor before anything is recorded
+        worker.storage.monitors[probe.monitor_id]
+        record_probe(probe)
+
+    def checked_record_probes(probes):
+        for probe in probes:
+            worker.storage.monitors[probe.monitor_id]
+        for probe in probes:
+            record_probe(probe)
+
+    worker.storage.record_probe = checked_record_probe
+    worker.storage.record_probes = checked_record_probes
+    tasks = [Task.create("1") for _ in range(2)]
+    for task in tasks:
+        worker.storage.create_task(task)
+    probes = [Probe.create("1", task.id, 0.1, 200, None, None) for task in tasks]
+    # the monitor of the probe was deleted
+    deleted = Probe.create("deleted", None, 0.1, 200, None, None)
+    worker.probe_buffer = [probes[0], deleted, probes[1]]
+    worker.flush_probes()
+
+    assert set(worker.storage.probes) == {probe.id for probe in probes}
+    assert all(task.status == TaskStatus.COMPLETED for task in tasks)
+
+
+def test_stateless_lock_batch_claims_due_monitors(stateless_worker: StatelessWorker):
+    monitor = stateless_worker.storage.monitors["1"]
+    [task] = stateless_worker.lock_batch()
+    assert task.monitor_id == "1"
+    assert task.status == TaskStatus.RUNNING
+    assert task.locked_by == stateless_worker.worker_id
+    assert monitor.last_task_at == task.timestamp
+    # tasks are not stored, and the monitor isn't due until the next interval
+    assert stateless_worker.storage.tasks == {}
+    assert stateless_worker.lock_batch() == []
+
+
+@pytest.mark.asyncio
+async def test_stateless_run_task_uses_claimed_monitor(
+    stateless_worker: StatelessWorker,
+):
+    def read_monitor(mid):
+        raise AssertionError("claimed monitor is read again")
+
+    stateless_worker.storage.read_monitor = read_monitor
+    [task] = stateless_worker.lock_batch()
+    with aioresponses() as mocked:
+        mocked.get("http://example.com", status=200, body="hello world")
+        await stateless_worker.run_task(task)
+    await stateless_worker.close()
+    stateless_worker.flush_probes()
+
+    [probe] = stateless_worker.storage.probes.values()
+    assert probe.task_id == task.id
+    assert probe.content_match == "hello world"
+    assert stateless_worker.storage.monitors["1"].last_probe_at == probe.timestamp
+    assert stateless_worker.claimed == {}
+
+
+@pytest.mark.asyncio
+async def test_stateless_drain_drops_unstarted_claims(
+    stateless_worker: StatelessWorker,
+):
+    stateless_worker.limiter = RequestLimiter(per_host_concurrency=1)
+    [task] = stateless_worker.lock_batch()
+    async with stateless_worker.limiter.acquire("http://example.com"):
+        stateless_worker.start_task(task)
+        await asyncio.sleep(0.01)
+        stateless_worker.stop()
+        await stateless_worker.drain()
+
+    # the monitor stays claimed until its next interval
+    assert stateless_worker.claimed == {}
+    assert stateless_worker.storage.tasks == {}
+    assert stateless_worker.storage.probes == {}
+    assert stateless_worker.lock_batch() == []
+
+
+def test_stateless_idle_poll_interval(stateless_worker: StatelessWorker):
+    stateless_worker.storage.NOTIFIES_ABOUT_TASKS = True
+    assert stateless_worker.idle_poll_interval() == StatelessWorker.POLL_INTERVAL
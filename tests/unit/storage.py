@@ -1,7 +1,9 @@
+import time
 import uuid
 from monico.core.storage import StorageInterface
 from monico.core.monitor import Monitor
 from monico.core.task import TaskStatus, Task
+from monico.core.rollup import rollup_probes
 
 
 class MemStorage(StorageInterface):
@@ -38,11 +40,18 @@ class MemStorage(StorageInterface):
         self.tasks[task.id] = task
         self.monitors[task.monitor_id].last_task_at = task.timestamp
 
-    def lock_tasks(self, worker_id, batch_size):
+    def lock_tasks(self, worker_id, batch_size, affinity=None):
         locked = []
         selected = [
             task for task in self.tasks.values() if task.status == TaskStatus.PENDING
-        ][:batch_size]
+        ]
+        if affinity is not None:
+            candidates = [
+                (task, task.timestamp, self.monitors[task.monitor_id].endpoint)
+                for task in selected
+            ]
+            selected = affinity.select(candidates, batch_size, int(time.time()))
+        selected = selected[:batch_size]
         for task in selected:
             task.status = TaskStatus.RUNNING
             task.worker_id = worker_id
@@ -52,14 +61,39 @@ class MemStorage(StorageInterface):
     def update_task(self, task):
         self.tasks[task.id] = task
 
+    def claim_monitors(self, worker_id, batch_size, affinity=None):
+        now = int(time.time())
+        due = [
+            (monitor, (monitor.last_task_at or 0) + monitor.interval, monitor.endpoint)
+            for monitor in self.monitors.values()
+            if (monitor.last_task_at or 0) + monitor.interval <= now
+        ]
+        due.sort(key=lambda candidate: candidate[1])
+        if affinity is not None:
+            selected = affinity.select(due, batch_size, now)
+        else:
+            selected = [monitor for (monitor, _, _) in due]
+        selected = selected[:batch_size]
+        for monitor in selected:
+            monitor.last_task_at = now
+        return selected
+
     def record_probe(self, probe):
         self.probes[probe.id] = probe
-        self.tasks[probe.task_id].status = TaskStatus.COMPLETED
-        self.monitors[
-            self.tasks[probe.task_id].monitor_id
-        ].last_probe_at = probe.timestamp
+        # probes of stateless scheduling have no stored task
+        if probe.task_id in self.tasks:
+            self.tasks[probe.task_id].status = TaskStatus.COMPLETED
+            self.tasks[probe.task_id].completed_at = int(time.time())
+        self.monitors[probe.monitor_id].last_probe_at = probe.timestamp
 
     def list_probes(self, monitor_id: str, limit: int = 10):
         return [
             probe for probe in self.probes.values() if probe.monitor_id == monitor_id
         ]
+
+    def list_rollups(self, monitor_id, resolution, since, until):
+        return [
+            rollup
+            for rollup in rollup_probes(self.list_probes(monitor_id))
+            if rollup.resolution == resolution and since <= rollup.bucket < until
+        ]
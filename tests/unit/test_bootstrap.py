@@ -2,6 +2,11 @@ import logging
 from unittest import mock
 from monico import bootstrap
 from monico.core.storage import StorageInterface
+from monico.config import ConfigLoader
+from monico.storage.pg import ProbePartitioning
+from monico.storage.sqlite import SqliteProfile
+from monico.storage.memory import InMemoryStorage
+from monico.storage.tiered import TieredStorage
 
 
 def test_app_context():
@@ -22,3 +27,120 @@ def test_build_default_app():
         get_logger_mock.assert_called_once_with("monico")
         assert app.log is get_logger_mock.return_value
         assert isinstance(app.storage, StorageInterface)
+        assert not app.stateless
+
+
+def test_build_default_app_checks_schema():
+    with mock.patch("monico.bootstrap.build_storage") as build_storage_mock:
+        storage = build_storage_mock.return_value
+        bootstrap.build_default_app(postgres_support=True)
+        storage.check_schema.assert_called_once()
+
+        storage.reset_mock()
+        bootstrap.build_default_app(postgres_support=True, check_schema=False)
+        storage.check_schema.assert_not_called()
+
+
+def test_build_storage_postgres_probe_layout():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_POSTGRES_URI": "postgres://localhost/monico",
+            "MONICO_POSTGRES_PROBE_PARTITIONING": "week",
+            "MONICO_PROBE_RETENTION": "30d",
+            "MONICO_TASK_QUEUE": "transient",
+            "MONICO_POSTGRES_POOL_MIN_SIZE": "2",
+            "MONICO_POSTGRES_POOL_MAX_SIZE": "20",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    assert (storage.pool.min_size, storage.pool.max_size) == (2, 20)
+    assert storage.probe_partitioning is ProbePartitioning.WEEK
+    assert storage.probe_retention == 30 * 86400
+    assert storage.transient_tasks
+
+
+def test_build_storage_sqlite_group_commit():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_SQLITE_URI": "sqlite:///tmp/monico.db",
+            "MONICO_SQLITE_PROFILE": "tuned",
+            "MONICO_SQLITE_WRITES": "grouped",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    assert storage.profile is SqliteProfile.TUNED
+    assert storage.writer is not None
+    assert not storage.PROCESS_LOCAL_TASKS
+
+
+def test_build_storage_sqlite_transient_tasks():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_SQLITE_URI": "sqlite:///tmp/monico.db",
+            "MONICO_TASK_QUEUE": "transient",
+            "MONICO_PROBE_CACHE": "10",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    # manager and workers have to share the process
+    assert storage.PROCESS_LOCAL_TASKS
+
+
+def test_build_storage_sqlite_shards():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_SQLITE_URI": "sqlite:///tmp/monico.db",
+            "MONICO_SQLITE_SHARDS": "3",
+            "MONICO_SQLITE_WRITES": "grouped",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    assert [shard.path for shard in storage.shards] == [
+        "/tmp/monico.0.db",
+        "/tmp/monico.1.db",
+        "/tmp/monico.2.db",
+    ]
+    assert all(shard.writer is not None for shard in storage.shards)
+
+
+def test_build_storage_memory():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_MEMORY_URI": "memory://",
+            "MONICO_PROBE_RETENTION": "1d",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    assert isinstance(storage, InMemoryStorage)
+    assert storage.probe_retention == 86400
+
+
+def test_build_storage_probe_cache():
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_MEMORY_URI": "memory://",
+            "MONICO_PROBE_CACHE": "50",
+        }
+    )
+    storage = bootstrap.build_storage(
+        loader.config, logging.getLogger("test"), postgres_support=True
+    )
+    assert isinstance(storage, TieredStorage)
+    assert isinstance(storage.backend, InMemoryStorage)
+    assert storage.probes_per_monitor == 50
@@ -1,13 +1,27 @@
 import pytest
 import tempfile
-from monico.config import Config, ConfigLoader, ConfigurationError
+from monico.config import Config, ConfigLoader, ConfigurationError, parse_duration
 
 
 def test_repr():
-    config = Config(postgres_uri="postgres://localhost/monico", log_level="DEBUG")
+    config = Config(
+        postgres_uri="postgres://localhost/monico",
+        sqlite_profile="default",
+        sqlite_writes="grouped",
+        sqlite_shards=4,
+        postgres_probe_partitioning="day",
+        postgres_pool_min_size=2,
+        postgres_pool_max_size=20,
+        probe_retention="30d",
+        task_retention="1h",
+        probe_cache=100,
+        task_queue="transient",
+        scheduling="stateless",
+        log_level="DEBUG",
+    )
     assert (
         repr(config)
-        == "<Config: sqlite_uri=None, postgres_uri=postgres://localhost/monico, log_level=DEBUG>"
+        == "<Config: sqlite_uri=None, sqlite_profile=default, sqlite_writes=grouped, sqlite_shards=4, postgres_uri=postgres://localhost/monico, postgres_probe_partitioning=day, postgres_pool_min_size=2, postgres_pool_max_size=20, memory_uri=None, probe_retention=30d, task_retention=1h, probe_cache=100, task_queue=transient, scheduling=stateless, log_level=DEBUG>"
     )
 
 
@@ -15,7 +29,19 @@ def test_sets_default_values():
     loader = ConfigLoader()
     assert loader.config.postgres_uri is None
     assert loader.config.sqlite_uri is None
+    assert loader.config.memory_uri is None
     assert loader.config.log_level.value == "WARNING"
+    assert loader.config.sqlite_profile.value == "default"
+    assert loader.config.sqlite_writes.value == "direct"
+    assert loader.config.sqlite_shards.value == 1
+    assert loader.config.postgres_probe_partitioning.value == "none"
+    assert loader.config.postgres_pool_min_size.value == 1
+    assert loader.config.postgres_pool_max_size.value == 10
+    assert loader.config.probe_retention is None
+    assert loader.config.task_retention is None
+    assert loader.config.probe_cache.value == 0
+    assert loader.config.task_queue.value == "durable"
+    assert loader.config.scheduling.value == "tasks"
 
 
 def test_validate_single_storage_backend():
@@ -67,6 +93,181 @@ def test_validate_log_level_fail():
         loader.validate_log_level()
 
 
+def test_validate_sqlite_profile_fail():
+    """Config that has unknown SQLite profile is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_SQLITE_PROFILE": "fast",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid SQLite profile: fast. Valid values are: default, tuned.\n"
+        "Defined in: environment variable MONICO_SQLITE_PROFILE"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_sqlite_profile()
+
+
+def test_validate_sqlite_writes_fail():
+    """Config that has unknown SQLite writes is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_SQLITE_WRITES": "async",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid SQLite writes: async. Valid values are: direct, grouped.\n"
+        "Defined in: environment variable MONICO_SQLITE_WRITES"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_sqlite_writes()
+
+
+@pytest.mark.parametrize("shards", ["0", "two"])
+def test_validate_sqlite_shards_fail(shards):
+    """Config that has an invalid number of SQLite shards is not validated"""
+    loader = ConfigLoader()
+    loader.load_from_env(environment={"MONICO_SQLITE_SHARDS": shards})
+    expected_error_msg = (
+        f"Invalid number of SQLite shards: {shards}. Expected a positive integer.\n"
+        "Defined in: environment variable MONICO_SQLITE_SHARDS"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_sqlite_shards()
+
+
+@pytest.mark.parametrize("probe_cache", ["-1", "all"])
+def test_validate_probe_cache_fail(probe_cache):
+    """Config that has an invalid probe cache size is not validated"""
+    loader = ConfigLoader()
+    loader.load_from_env(environment={"MONICO_PROBE_CACHE": probe_cache})
+    expected_error_msg = (
+        f"Invalid probe cache: {probe_cache}. "
+        "Expected a number of probes, 0 to disable the cache.\n"
+        "Defined in: environment variable MONICO_PROBE_CACHE"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_probe_cache()
+
+
+@pytest.mark.parametrize(
+    "min_size,max_size,message",
+    [
+        ("-1", "10", "-1. Expected an integer of at least 0"),
+        ("1", "0", "0. Expected an integer of at least 1"),
+        ("5", "2", "minimum 5 is larger than maximum 2"),
+    ],
+)
+def test_validate_postgres_pool_size_fail(min_size, max_size, message):
+    """Config that has an invalid PostgreSQL pool size is not validated"""
+    loader = ConfigLoader()
+    loader.load_from_env(
+        environment={
+            "MONICO_POSTGRES_POOL_MIN_SIZE": min_size,
+            "MONICO_POSTGRES_POOL_MAX_SIZE": max_size,
+        }
+    )
+    with pytest.raises(
+        ConfigurationError, match=f"Invalid PostgreSQL pool size: {message}"
+    ):
+        loader.validate_postgres_pool_size()
+
+
+def test_validate_postgres_probe_partitioning_fail():
+    """Config that has unknown probe partitioning is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_POSTGRES_PROBE_PARTITIONING": "month",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid PostgreSQL probe partitioning: month. Valid values are: none, day, week.\n"
+        "Defined in: environment variable MONICO_POSTGRES_PROBE_PARTITIONING"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_postgres_probe_partitioning()
+
+
+def test_validate_task_queue_fail():
+    """Config that has unknown task queue is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_TASK_QUEUE": "memory",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid task queue: memory. Valid values are: durable, transient.\n"
+        "Defined in: environment variable MONICO_TASK_QUEUE"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_task_queue()
+
+
+def test_validate_scheduling_fail():
+    """Config that has unknown scheduling is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_SCHEDULING": "cron",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid scheduling: cron. Valid values are: tasks, stateless.\n"
+        "Defined in: environment variable MONICO_SCHEDULING"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_scheduling()
+
+
+def test_validate_memory_uri_fail():
+    """Config that has a memory storage URI of another scheme is not validated"""
+    loader = ConfigLoader()
+    loader.load_from_env(environment={"MONICO_MEMORY_URI": "sqlite://"})
+    expected_error_msg = (
+        'Invalid memory storage URI: sqlite://. Expected a URI like "memory://".\n'
+        "Defined in: environment variable MONICO_MEMORY_URI"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_memory_uri()
+
+
+def test_validate_retention_fail():
+    """Config that has malformed retention is not validated"""
+    loader = ConfigLoader()
+    test_env = {
+        "MONICO_PROBE_RETENTION": "30d",
+        "MONICO_TASK_RETENTION": "an hour",
+    }
+    loader.load_from_env(environment=test_env)
+    expected_error_msg = (
+        "Invalid task retention: an hour. Expected a duration like 30d, 12h, 15m or 90s.\n"
+        "Defined in: environment variable MONICO_TASK_RETENTION"
+    )
+    with pytest.raises(ConfigurationError, match=expected_error_msg):
+        loader.validate_retention()
+
+
+@pytest.mark.parametrize(
+    "value,seconds",
+    [
+        (90, 90),
+        ("90", 90),
+        ("90s", 90),
+        ("15m", 900),
+        ("12h", 43200),
+        ("30d", 2592000),
+        ("2w", 1209600),
+    ],
+)
+def test_parse_duration(value, seconds):
+    assert parse_duration(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "d", "-1d", "1.5h", "30 days"])
+def test_parse_duration_invalid(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+
 def test_from_config_file():
     # write config to temp dir
     with tempfile.NamedTemporaryFile() as f: